@@ -0,0 +1,545 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Implementation of the OMERO.features AbstractAPI using local files
+
+Features are stored in memory-mapped arrays which can be written without
+access to an OMERO server, and uploaded later.
+"""
+
+from AbstractAPI import AbstractFeatureStore, AbstractFeatureStoreManager
+from OmeroTablesFeatureStore import (
+    FEATURE_NAME_RE, FeatureRow, LRUClosableCache, arrays_to_dataframe,
+    evaluate_id_conditions)
+from exceptions import (
+    NoTableMatchException, TableUsageException, TooManyTablesException)
+from mmaparrays import MANIFEST_FILE, MemmapFeatureArrays
+from utils import ID_COLUMNS, NOID
+import aggregate
+import nearest
+import normalize
+import pairwise
+import predicates
+
+import itertools
+import numpy
+import os
+import re
+import shutil
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Number of rows to buffer in memory before writing them to disk
+DEFAULT_FLUSH_ROWS = 1000
+
+# Number of rows returned by each iteration of iter_chunks
+DEFAULT_CHUNK_SIZE = 10000
+
+
+class LocalFeatureStore(AbstractFeatureStore):
+    """
+    A feature store in a local directory.
+    Each row is an Image-ID, Roi-ID and a fixed-width array of doubles.
+
+    New rows are buffered and written in batches, reads automatically flush
+    the buffer. An in-memory index of (Image-ID, Roi-ID) to row number is
+    used when replacing existing rows.
+    """
+
+    def __init__(self, path, names=None, flush_rows=DEFAULT_FLUSH_ROWS):
+        """
+        :param path: The featureset directory
+        :param names: If provided a new featureset will be created with this
+               list of feature names, default None (featureset must already
+               exist)
+        :param flush_rows: The number of rows to buffer before writing
+        """
+        self.path = path
+        self.flush_rows = flush_rows
+        self.arrays = None
+        self.ftnames = None
+        self.index = None
+        self.buffer_ids = []
+        self.buffer_values = []
+        exists = os.path.exists(os.path.join(path, MANIFEST_FILE))
+        if names:
+            if exists:
+                raise TooManyTablesException(
+                    'Featureset already exists: %s' % path)
+            self.new_store(names)
+        else:
+            if not exists:
+                raise NoTableMatchException(
+                    'No featureset found: %s' % path)
+            self.arrays = MemmapFeatureArrays(path)
+            self.ftnames = self.arrays.manifest['names']
+
+    def new_store(self, names):
+        """
+        Create a new featureset
+
+        :param names: A list of feature names
+        """
+        for n in names:
+            if not re.match(FEATURE_NAME_RE, n):
+                raise TableUsageException('Invalid feature name: %s' % n)
+        self.arrays = MemmapFeatureArrays.create(
+            self.path, len(names), names=list(names))
+        self.ftnames = self.arrays.manifest['names']
+
+    def feature_names(self):
+        """
+        Get the list of feature names
+        """
+        return self.ftnames
+
+    def get_index(self):
+        """
+        Get the index of (Image-ID, Roi-ID) to the last matching row number
+        """
+        if self.index is None:
+            self.flush()
+            self.index = dict(itertools.izip(
+                itertools.imap(tuple, self.arrays.ids.tolist()),
+                xrange(self.arrays.nrows)))
+        return self.index
+
+    def flush(self):
+        """
+        Write any buffered rows to disk
+        """
+        if self.buffer_ids:
+            self.arrays.append(self.buffer_ids, self.buffer_values)
+            self.buffer_ids = []
+            self.buffer_values = []
+
+    def close(self):
+        """
+        Flush buffered rows and close the featureset
+        """
+        if self.arrays is not None:
+            self.flush()
+            self.arrays.close()
+            self.arrays = None
+            self.index = None
+
+    def store_by_image(self, image_id, values):
+        self.store_by_object('Image', long(image_id), values)
+
+    def store_by_roi(self, roi_id, values, image_id=None):
+        """
+        Store a single FeatureRow by ROI ID
+
+        :param roi_id: The ROI ID
+        :param values: The feature values
+        :param image_id: The parent Image ID, this can't be looked up
+               without a server so defaults to unknown
+        """
+        if image_id is None or image_id < 0:
+            self.store_by_object('Roi', long(roi_id), values)
+        else:
+            self.store_by_object(
+                'Roi', long(roi_id), values, 'Image', image_id)
+
+    def store_by_object(self, object_type, object_id, values,
+                        parent_type=None, parent_id=None, replace=True):
+        """
+        Store a feature row
+
+        :param object_type: The object directly associated with the features
+        :param object_id: The object ID
+        :param values: Feature values, an array of doubles
+        :param parent_type: The parent type of the object, optional
+        :param parent_id: The parent ID of the object
+        :param replace: If True (default) replace existing rows with the same
+               IDs
+        """
+        image_id = NOID
+        roi_id = NOID
+        if object_type == 'Image':
+            if parent_type:
+                raise TableUsageException('Parent not supported for Image')
+            image_id = object_id
+        elif object_type == 'Roi':
+            roi_id = object_id
+            if parent_type:
+                if parent_type == 'Image':
+                    image_id = parent_id
+                else:
+                    raise TableUsageException(
+                        'Invalid parent type: %s' % parent_type)
+        else:
+            raise TableUsageException(
+                'Invalid object type: %s' % object_type)
+
+        if len(values) != self.arrays.width:
+            raise TableUsageException(
+                'Expected %d values, received %d' % (
+                    self.arrays.width, len(values)))
+
+        key = (image_id, roi_id)
+        offset = -1
+        if replace:
+            offset = self.get_index().get(key, -1)
+        if offset > -1:
+            n = self.arrays.nrows
+            if offset < n:
+                self.arrays.update(offset, key, values)
+            else:
+                self.buffer_values[offset - n] = list(values)
+        else:
+            # The index is only built when it's first needed
+            if self.index is not None:
+                self.index[key] = self.arrays.nrows + len(self.buffer_ids)
+            self.buffer_ids.append(key)
+            self.buffer_values.append(list(values))
+            if len(self.buffer_ids) >= self.flush_rows:
+                self.flush()
+
+    def fetch_by_image(self, image_id, last=False):
+        values = self.fetch_by_object('Image', image_id)
+        if len(values) > 1 and not last:
+            raise TableUsageException(
+                'Multiple feature rows found for Image %d' % image_id)
+        if not values:
+            raise TableUsageException(
+                'No feature rows found for Image %d' % image_id)
+        return self.feature_row(values[-1])
+
+    def fetch_by_roi(self, roi_id, last=False):
+        values = self.fetch_by_object('Roi', roi_id)
+        if len(values) > 1 and not last:
+            raise TableUsageException(
+                'Multiple feature rows found for Roi %d' % roi_id)
+        if not values:
+            raise TableUsageException(
+                'No feature rows found for Roi %d' % roi_id)
+        return self.feature_row(values[-1])
+
+    def fetch_all(self, image_id):
+        values = self.fetch_by_object('Image', image_id)
+        return [self.feature_row(v) for v in values]
+
+    def filter(self, conditions):
+        values = self.filter_raw(conditions)
+        return [self.feature_row(v) for v in values]
+
+    def fetch_by_object(self, object_type, object_id):
+        """
+        Fetch all feature rows for an object
+
+        :param object_type: The object type
+        :param object_id: The object ID
+        :return: A list of tuples (Image-ID, Roi-ID, feature-values)
+        """
+        if object_type in ('Image', 'Roi'):
+            cond = '(%sID==%d)' % (object_type, object_id)
+        else:
+            raise TableUsageException(
+                'Unsupported object type: %s' % object_type)
+        return self.filter_raw(cond)
+
+    def filter_raw(self, conditions, features=None):
+        """
+        Query the featureset, return data as rows
+
+        :param conditions: The query conditions, only ImageID and RoiID
+               are supported
+        :param features: Optional list of feature names, default all
+        :return: A list of tuples (Image-ID, Roi-ID, feature-values)
+        """
+        self.flush()
+        cols = self.feature_indices(features)
+        ids = self.arrays.ids
+        idx = numpy.flatnonzero(evaluate_id_conditions(conditions, ids))
+        values = self.arrays.values[idx]
+        if cols is not None:
+            values = values[:, cols]
+        return [(i[0], i[1], v) for i, v in itertools.izip(
+            ids[idx].tolist(), values.tolist())]
+
+    def feature_indices(self, features):
+        """
+        Get the column indices of a subset of features
+
+        :param features: A list of feature names, or None for all features
+        :return: A list of indices, or None if features is None
+        """
+        if features is None:
+            return None
+        lookup = dict((n, i) for (i, n) in enumerate(self.ftnames))
+        try:
+            return [lookup[f] for f in features]
+        except KeyError as e:
+            raise TableUsageException('Unknown feature: %s' % e.args[0])
+
+    def read_arrays(self, conditions=None, features=None):
+        """
+        Read matching rows into arrays, see FeatureTable.read_arrays
+
+        :param conditions: Optional query conditions, only ImageID and RoiID
+               are supported
+        :param features: Optional list of feature names, default all
+        :return: An (n, 2) int64 array of Image-ID and Roi-ID, and an
+                 (n, nfeatures) float64 array of feature values
+        """
+        self.flush()
+        if conditions:
+            idx = numpy.flatnonzero(
+                evaluate_id_conditions(conditions, self.arrays.ids))
+        else:
+            idx = numpy.arange(self.arrays.nrows)
+        cols = self.feature_indices(features)
+        if cols is None:
+            values = numpy.take(self.arrays.values, idx, axis=0)
+        else:
+            values = self.arrays.values[numpy.ix_(idx, cols)]
+        return numpy.take(self.arrays.ids, idx, axis=0), values
+
+    def query(self, predicate, features=None):
+        """
+        Find rows matching a predicate on feature values and IDs, see
+        FeatureTable.query
+        """
+        condition, expr = predicates.split(predicate)
+        return predicates.filter_chunks(
+            self.iter_matching_chunks(condition), expr, self.ftnames,
+            self.feature_indices(features))
+
+    def aggregate(self, by='ImageID', funcs=None, conditions=None,
+                  features=None, chunk_size=None):
+        """
+        Compute per-group reductions of feature values, see
+        FeatureTable.aggregate
+        """
+        if funcs is None:
+            funcs = aggregate.DEFAULT_FUNCS
+        stats = aggregate.aggregate_chunks(
+            self.iter_matching_chunks(conditions, chunk_size),
+            len(self.ftnames), by, funcs, self.feature_indices(features))
+        return stats.keys, stats.result(funcs)
+
+    def describe(self, features=None):
+        """
+        Calculate summary statistics of each feature, see
+        FeatureTable.describe
+        """
+        cols = self.feature_indices(features)
+        stats = aggregate.GroupedStats(
+            len(self.ftnames) if cols is None else len(cols))
+        nrows = 0
+        for ids, values in self.iter_matching_chunks():
+            if cols is not None:
+                values = values[:, cols]
+            stats.add(numpy.zeros(len(ids), dtype=numpy.int64), values)
+            nrows += len(ids)
+        return aggregate.describe_stats(stats, nrows)
+
+    def nearest(self, query, k=10, metric='euclidean', features=None,
+                conditions=None, chunk_size=None, exclude=None):
+        """
+        Find the k rows closest to a query, see FeatureTable.nearest
+
+        :param exclude: Optional tuple (object-type, object-ID) of rows to
+               skip when query is a vector
+        """
+        cols = self.feature_indices(features)
+        vector, obj = nearest.resolve_query(self, query, cols)
+        return nearest.nearest_chunks(
+            self.iter_matching_chunks(conditions, chunk_size), vector, k,
+            metric, cols, exclude=obj or exclude)
+
+    def normalized(self, method='zscore', features=None):
+        """
+        Get a view of this featureset with every feature normalised, see
+        FeatureTable.normalized
+        """
+        return normalize.normalized_view(self, method, features)
+
+    def top_k(self, feature, k=10, largest=True, conditions=None,
+              vectors=False):
+        """
+        Find the rows with the largest or smallest values of a feature, see
+        FeatureTable.top_k
+        """
+        self.flush()
+        col = self.feature_indices([feature])[0]
+        if conditions:
+            idx = numpy.flatnonzero(
+                evaluate_id_conditions(conditions, self.arrays.ids))
+        else:
+            idx = numpy.arange(self.arrays.nrows)
+        rows, scores = nearest.top_k_chunks(
+            [(idx[:, numpy.newaxis], self.arrays.values[idx, col])], k,
+            largest, 1)
+        rows = rows[:, 0]
+        ids = numpy.take(self.arrays.ids, rows, axis=0)
+        if not vectors:
+            return ids, scores
+        return ids, scores, numpy.take(self.arrays.values, rows, axis=0)
+
+    def pairwise_distances(self, path, metric='euclidean', features=None,
+                           conditions=None, block_rows=pairwise.BLOCK_ROWS):
+        """
+        Calculate the distance between every pair of matching rows, see
+        FeatureTable.pairwise_distances
+        """
+        cols = self.feature_indices(features)
+        width = len(self.ftnames) if cols is None else len(cols)
+        return pairwise.pairwise_distances(
+            self.iter_matching_chunks(conditions), width, path, metric,
+            block_rows, cols)
+
+    def feature_correlation(self, features=None, conditions=None):
+        """
+        Calculate the correlation between every pair of features, see
+        FeatureTable.feature_correlation
+        """
+        return pairwise.feature_correlation(
+            self.iter_matching_chunks(conditions),
+            self.feature_indices(features))
+
+    def to_dataframe(self, conditions=None, features=None):
+        """
+        Read matching rows into a pandas DataFrame indexed by ImageID and
+        RoiID. Requires pandas.
+        """
+        ids, values = self.read_arrays(conditions, features)
+        if features is None:
+            features = self.ftnames
+        return arrays_to_dataframe(ids, values, features)
+
+    def feature_row(self, values):
+        """
+        Create a FeatureRow object
+
+        :param values: The feature values
+        """
+        return FeatureRow(
+            names=self.feature_names(), infonames=list(ID_COLUMNS),
+            values=values[2], infovalues=values[:2])
+
+    def iter_chunks(self, offsets=None, start=0, stop=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Iterate through rows in chunks, see FeatureTable.iter_chunks
+
+        :return: A generator of tuples (row-numbers, ids, values)
+        """
+        self.flush()
+        ids = self.arrays.ids
+        values = self.arrays.values
+        if offsets is None:
+            if stop is None:
+                stop = self.arrays.nrows
+            for n in xrange(start, stop, chunk_size):
+                m = min(n + chunk_size, stop)
+                yield numpy.arange(n, m), ids[n:m], values[n:m]
+        else:
+            offsets = numpy.asarray(offsets, dtype=numpy.int64)
+            for n in xrange(0, len(offsets), chunk_size):
+                rows = offsets[n:(n + chunk_size)]
+                yield rows, ids[rows], values[rows]
+
+    def iter_matching_chunks(self, conditions=None,
+                             chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Iterate through matching rows in chunks, see
+        FeatureTable.iter_matching_chunks. Chunks are copies of the
+        memory-mapped arrays.
+
+        :param conditions: Optional query conditions, only ImageID and RoiID
+               are supported
+        :return: A generator of tuples (ids, values)
+        """
+        self.flush()
+        offsets = None
+        if conditions:
+            offsets = numpy.flatnonzero(
+                evaluate_id_conditions(conditions, self.arrays.ids))
+        for rows, ids, values in self.iter_chunks(
+                offsets, chunk_size=chunk_size or DEFAULT_CHUNK_SIZE):
+            yield numpy.array(ids), numpy.array(values)
+
+    def delete(self):
+        """
+        Delete the entire featureset
+        """
+        self.buffer_ids = []
+        self.buffer_values = []
+        self.close()
+        shutil.rmtree(self.path)
+
+
+class LocalFeatureStoreManager(AbstractFeatureStoreManager):
+    """
+    Manage feature stores in subdirectories of a local directory
+    """
+
+    def __init__(self, path, **kwargs):
+        """
+        :param path: The parent directory of all featuresets
+        :param cachesize: The maximum number of open featuresets
+        :param flush_rows: The number of rows to buffer before writing
+        """
+        self.path = path
+        self.cachesize = kwargs.get('cachesize', 10)
+        self.flush_rows = kwargs.get('flush_rows', DEFAULT_FLUSH_ROWS)
+        self.fss = LRUClosableCache(self.cachesize)
+
+    def _featureset_path(self, featureset_name):
+        if (not featureset_name or os.sep in featureset_name or
+                featureset_name in (os.curdir, os.pardir)):
+            raise TableUsageException(
+                'Invalid featureset name: %s' % featureset_name)
+        return os.path.join(self.path, featureset_name)
+
+    def create(self, featureset_name, names):
+        fs = LocalFeatureStore(
+            self._featureset_path(featureset_name), names, self.flush_rows)
+        self.fss.insert(featureset_name, fs)
+        return fs
+
+    def get(self, featureset_name):
+        fs = self.fss.get(featureset_name)
+        # If fs.arrays is None it has been closed
+        if not fs or fs.arrays is None:
+            # raises NoTableMatchException if not found
+            fs = LocalFeatureStore(
+                self._featureset_path(featureset_name),
+                flush_rows=self.flush_rows)
+            self.fss.insert(featureset_name, fs)
+        return fs
+
+    def list(self):
+        """
+        List the names of all featuresets
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(d for d in os.listdir(self.path) if os.path.exists(
+            os.path.join(self.path, d, MANIFEST_FILE)))
+
+    def close(self):
+        self.fss.close()
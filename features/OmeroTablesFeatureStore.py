@@ -25,12 +25,42 @@ Implementation of the OMERO.features AbstractAPI
 
 from AbstractAPI import (
     AbstractFeatureRow, AbstractFeatureStore, AbstractFeatureStoreManager)
+from exceptions import (
+    FeaturePermissionException, FeatureRowException, NoTableMatchException,
+    OmeroTableException, TableStoreException, TableUsageException,
+    TooManyTablesException)
+from materialized import AGGREGATE_SIDECAR
+from mmaparrays import MemmapFeatureArrays
+from utils import ID_COLUMNS, NOID, parallel_map
+import aggregate
+import ann
+import bloom
+import cluster
+import export
+import idindex
+import materialized
+import nearest
+import normalize
+import pairwise
+import pca
+import predicates
+import zonemap
+import numpy
 import omero
 import omero.clients
 from omero.rtypes import unwrap, wrap
 
+import bisect
+from collections import OrderedDict
 import itertools
+import json
+import Queue
 import re
+import struct
+import sys
+import threading
+import time
+import zlib
 
 import logging
 log = logging.getLogger(__name__)
@@ -42,58 +72,260 @@ DEFAULT_ANNOTATION_SUBSPACE = 'source'
 
 FEATURE_NAME_RE = r'^[A-Za-z0-9][A-Za-z0-9_ \-\(\)\[\]\{\}\.]*$'
 
-# Indicates the object ID is unknown
-NOID = -1
+# Feature names are stored in the DoubleArrayColumn name if they fit,
+# otherwise in a sidecar file and the column name is set to a marker
+FEATURE_NAMES_HEADER_LIMIT = 64000
+FEATURE_NAMES_SIDECAR = 'feature-names'
+FEATURE_NAMES_SIDECAR_MARKER = '@' + FEATURE_NAMES_SIDECAR
+FEATURE_NAMES_MAGIC = 'OFN1'
+FEATURE_NAMES_CACHE_SIZE = 100
 
+SIDECAR_MIMETYPE = 'application/x-omero-features-sidecar'
 
-class TableStoreException(Exception):
+# Maximum number of bytes to transfer in a single RawFileStore call
+FILE_CHUNK_SIZE = 16777216
+
+# Partitioned featuresets are stored as multiple tables under
+# <ft_space>/<featureset_name>, the layout is saved in a sidecar of the
+# first partition
+PARTITION_NAME = 'part-%04d'
+PARTITIONS_SIDECAR = 'partitions'
+
+# Maximum number of IDs in a single query or objects in a single save
+QUERY_BATCH_SIZE = 1000
+
+# Optional sidecar holding per-zone minimum and maximum values
+ZONE_MAP_SIDECAR = 'zonemap'
+
+# Optional sidecar holding sorted ImageID and RoiID indexes
+ID_INDEX_SIDECAR = 'idindex'
+
+# Optional sidecar holding an approximate nearest-neighbour index
+ANN_INDEX_SIDECAR = 'ann'
+
+# Optional sidecar holding a fitted PCA projection
+PCA_SIDECAR = 'pca'
+
+# Seconds before the Bloom filter checks the table for rows appended by
+# other clients
+BLOOM_FILTER_TTL = 60
+
+# Defaults for the optional filter_raw result cache, the size of a cached
+# row is estimated as 8 bytes per value plus a fixed overhead
+RESULT_CACHE_BYTES = 268435456
+RESULT_CACHE_SIZE = 1000
+ROW_OVERHEAD_BYTES = 200
+
+def encode_feature_names(names):
     """
-    Parent class for exceptions occuring in the OMERO.features tables store
-    implementation
+    Pack a list of feature names into a compact binary string
+
+    The format is a magic string, the number of names, then a zlib
+    compressed block of length-prefixed names
+
+    :param names: A list of feature names
+    :return: A binary string
     """
-    pass
+    body = ''.join(struct.pack('<H', len(n)) + n for n in names)
+    return (FEATURE_NAMES_MAGIC + struct.pack('<I', len(names)) +
+            zlib.compress(body))
+
 
+def decode_feature_names(data):
+    """
+    Unpack a binary string created by encode_feature_names
 
-class OmeroTableException(TableStoreException):
+    :param data: A binary string
+    :return: A list of feature names
+    """
+    if not data or not data.startswith(FEATURE_NAMES_MAGIC):
+        raise OmeroTableException('Invalid feature names sidecar')
+    offset = len(FEATURE_NAMES_MAGIC)
+    n, = struct.unpack_from('<I', data, offset)
+    body = zlib.decompress(data[offset + 4:])
+    names = []
+    pos = 0
+    for i in xrange(n):
+        w, = struct.unpack_from('<H', body, pos)
+        pos += 2
+        names.append(body[pos:pos + w])
+        pos += w
+    if pos != len(body):
+        raise OmeroTableException('Invalid feature names sidecar')
+    return names
+
+
+def shuffle_blocks(idx, block_size, rng=None):
     """
-    Errors whilst using the OMERO.tables API
+    Shuffle the order of consecutive blocks of an array
+
+    :param idx: An array, typically of row numbers
+    :param block_size: The number of elements in each block
+    :param rng: Optional numpy.random.RandomState, default numpy.random
+    :return: A new array with the blocks in a random order
     """
-    pass
+    if rng is None:
+        rng = numpy.random
+    starts = numpy.arange(0, len(idx), block_size)
+    if len(starts) < 2:
+        return numpy.array(idx)
+    rng.shuffle(starts)
+    return numpy.concatenate([idx[n:(n + block_size)] for n in starts])
 
 
-class NoTableMatchException(TableStoreException):
+def shuffle_ranges(stop, block_size, rng=None):
     """
-    No matching annotation was found when searching for a table
+    Split the range 0-stop into consecutive blocks in a random order,
+    without creating an array of every element
+
+    :param stop: One past the last element
+    :param block_size: The number of elements in each block
+    :param rng: Optional numpy.random.RandomState, default numpy.random
+    :return: A list of tuples (start, stop)
     """
-    pass
+    if rng is None:
+        rng = numpy.random
+    starts = numpy.arange(0, stop, block_size)
+    rng.shuffle(starts)
+    return [(n, min(n + block_size, stop)) for n in starts.tolist()]
 
 
-class TooManyTablesException(TableStoreException):
+def prefetch(iterable, depth=1):
     """
-    Too many matching annotation were found when searching for a table
+    Iterate in a background thread so the following items are fetched
+    while the caller is processing the current one
+
+    :param iterable: The iterable, typically a generator of server reads
+    :param depth: The maximum number of items fetched in advance
+    :return: A generator of the items in iterable
     """
-    pass
+    q = Queue.Queue(depth)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
 
+    def fetch():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception:
+            # Keep the traceback of the worker thread
+            put((end, sys.exc_info()))
+
+    t = threading.Thread(target=fetch)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            item, exc_info = q.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is end:
+                break
+            yield item
+    finally:
+        stopped.set()
+        t.join()
+
+
+def get_objects(session, object_type, kvs):
+    """
+    Retrieve OMERO objects
 
-class TableUsageException(TableStoreException):
+    :param session: An active session
+    :param object_type: The OMERO model type
+    :param kvs: A dictionary of field names and required values, if a value
+           is a list match any of the elements
+    :return: A list of matching objects
     """
-    Invalid usage of this implementation of the Features API
+    params = omero.sys.ParametersI()
+
+    qs = session.getQueryService()
+    conditions = []
+
+    for k, v in kvs.iteritems():
+        ek = k.replace('_', '__').replace('.', '_')
+        if isinstance(v, list):
+            conditions.append(
+                '%s in (:%s)' % (k, ek))
+        else:
+            conditions.append(
+                '%s = :%s' % (k, ek))
+        params.add(ek, wrap(v))
+
+    q = 'FROM %s' % object_type
+    if conditions:
+        q += ' WHERE ' + ' AND '.join(conditions)
+
+    results = qs.findAllByQuery(q, params)
+    return results
+
+
+def evaluate_id_conditions(conditions, ids):
     """
-    pass
+    Evaluate an OMERO.tables query condition on local arrays of IDs
 
+    Only the ImageID and RoiID columns, numbers, comparisons and the
+    &, | and ~ operators are supported.
 
-class FeaturePermissionException(TableStoreException):
+    :param conditions: The query conditions, e.g. '(ImageID==1) & (RoiID>2)'
+    :param ids: An (n, 2) array of Image-ID and Roi-ID
+    :return: A boolean array of length n
     """
-    Client does not have permission to access a feature table
+    try:
+        code = compile(conditions, '<conditions>', 'eval')
+    except SyntaxError:
+        raise TableUsageException('Invalid conditions: %s' % conditions)
+    if (set(code.co_names).difference(ID_COLUMNS) or
+            any(hasattr(c, 'co_code') for c in code.co_consts)):
+        raise TableUsageException('Unsupported conditions: %s' % conditions)
+    r = eval(code, {'__builtins__': {}}, dict(zip(ID_COLUMNS, ids.T)))
+    mask = numpy.zeros(len(ids), dtype=bool)
+    mask[:] = r
+    return mask
+
+
+def filter_id_conditions(chunks, conditions):
     """
-    pass
+    Filter chunks of rows with an OMERO.tables query condition, see
+    evaluate_id_conditions
+
+    :param chunks: An iterable of tuples (ids, values)
+    :param conditions: The query conditions
+    :return: A generator of tuples (ids, values)
+    """
+    for ids, values in chunks:
+        mask = evaluate_id_conditions(conditions, ids)
+        yield ids[mask], values[mask]
 
 
-class FeatureRowException(TableStoreException):
+def arrays_to_dataframe(ids, values, names):
     """
-    Errors in a FeatureRow object
+    Wrap arrays of IDs and feature values in a pandas DataFrame without
+    copying the values
+
+    :param ids: An (n, 2) array of Image-ID and Roi-ID
+    :param values: An (n, width) float64 array of feature values
+    :param names: The width feature names
+    :return: A DataFrame with an ImageID, RoiID MultiIndex
     """
-    pass
+    try:
+        import pandas
+    except ImportError:
+        raise TableUsageException('pandas is required for DataFrames')
+    index = pandas.MultiIndex.from_arrays(
+        [ids[:, 0], ids[:, 1]], names=list(ID_COLUMNS))
+    return pandas.DataFrame(values, index=index, columns=list(names))
 
 
 class FeatureRow(AbstractFeatureRow):
@@ -238,7 +470,11 @@ class FeatureTable(AbstractFeatureStore):
     """
 
     def __init__(self, session, name, ft_space, ann_space, ownerid,
-                 coldesc=None):
+                 coldesc=None, tablefile=None):
+        """
+        :param tablefile: If provided open this table OriginalFile instead
+               of searching for it, default None
+        """
         self.session = session
         self.perms = PermissionsHandler(session)
         self.name = name
@@ -248,7 +484,32 @@ class FeatureTable(AbstractFeatureStore):
         self.table = None
         self.ftnames = None
         self.chunk_size = None
-        self.get_table(ownerid, coldesc=coldesc)
+        self.result_cache = None
+        self.write_count = 0
+        # Number of writes which replaced existing rows
+        self.replace_count = 0
+        self.snapshot_arrays = None
+        self.snapshot_replace_count = 0
+        self.zonemap = None
+        self.zonemap_loaded = False
+        self.zonemap_dirty = False
+        self.idindex = None
+        self.idindex_loaded = False
+        self.idindex_dirty = False
+        self.bloom = None
+        self.bloom_checked = 0
+        self.ann = None
+        self.ann_loaded = False
+        self.ann_dirty = False
+        self.summary = None
+        self.pca = None
+        self.pca_loaded = False
+        self.write_listeners = []
+        if tablefile:
+            self.open_table(tablefile)
+        else:
+            self.get_table(ownerid, coldesc=coldesc)
+        self.get_bloom_filter()
 
     def _owns_table(func):
         def assert_owns_table(*args, **kwargs):
@@ -264,10 +525,20 @@ class FeatureTable(AbstractFeatureStore):
         Close the table
         """
         if self.table:
+            if self.zonemap_dirty:
+                self.save_zone_map()
+            if self.idindex_dirty:
+                self.save_id_index()
+            if self.ann_dirty:
+                self.save_ann_index()
             self.table.close()
             self.table = None
             self.cols = None
             self.ftnames = None
+            self.bloom = None
+        if self.result_cache:
+            self.result_cache.clear()
+        self.drop_snapshot()
 
     def get_table(self, ownerid, coldesc=None):
         """
@@ -357,11 +628,12 @@ class FeatureTable(AbstractFeatureStore):
         # - Column descriptions can't be retrieved through the API
         # - The total size of table attributes is limited to around 64K (not
         #   sure if this is a per-attribute/object/table limitation)
-        # For now save the feature names into the column name.
+        # Save the feature names into the column name if possible, otherwise
+        # into a sidecar file.
         names = ','.join(coldesc)
-        if len(names) > 64000:
-            log.warn(
-                'Feature names may exceed the limit of the current Tables API')
+        sidecar = len(names) > FEATURE_NAMES_HEADER_LIMIT
+        if sidecar:
+            names = FEATURE_NAMES_SIDECAR_MARKER
         coldef.append(omero.grid.DoubleArrayColumn(
             names, '', len(coldesc)))
 
@@ -375,6 +647,9 @@ class FeatureTable(AbstractFeatureStore):
         if not self.cols:
             raise OmeroTableException(
                 'Failed to get columns for table ID:%d' % tid)
+        if sidecar:
+            self.write_sidecar(
+                FEATURE_NAMES_SIDECAR, encode_feature_names(coldesc))
 
     def open_table(self, tablefile):
         """
@@ -394,31 +669,172 @@ class FeatureTable(AbstractFeatureStore):
     def feature_names(self):
         """
         Get the list of feature names
+
+        Parsed names are cached by table file ID so reopening a featureset
+        does not repeat the work. Names held in a sidecar file are only
+        downloaded again if the sidecar modification time changes.
         """
         if not self.ftnames:
-            self.ftnames = self.cols[2].name.split(',')
+            tid = unwrap(self.table.getOriginalFile().getId())
+            header = self.cols[2].name
+            if header == FEATURE_NAMES_SIDECAR_MARKER:
+                self.ftnames = self._sidecar_feature_names(tid)
+            else:
+                cached = _feature_names_cache.get((tid, None))
+                if cached and cached[0] == header:
+                    self.ftnames = cached[1]
+                else:
+                    self.ftnames = header.split(',')
+                    _feature_names_cache.insert(
+                        (tid, None), (header, self.ftnames))
             assert len(self.ftnames) == self.cols[2].size
         return self.ftnames
 
+    def _sidecar_feature_names(self, tid):
+        f = self.get_sidecar(FEATURE_NAMES_SIDECAR)
+        if not f:
+            raise OmeroTableException(
+                'Feature names not found for table ID:%d' % tid)
+        key = (tid, unwrap(f.getMtime()))
+        names = _feature_names_cache.get(key)
+        if names is None:
+            names = decode_feature_names(self.read_file(f))
+            _feature_names_cache.insert(key, names)
+        return names
+
+    def _table_owner_id(self):
+        d = self.table.getOriginalFile().getDetails()
+        return unwrap(d.getOwner().getId())
+
+    def list_sidecars(self, kind=None):
+        """
+        Find the sidecar files belonging to this featureset
+
+        Sidecars are OriginalFiles owned by the table owner, with a path
+        equal to the full table path and a name identifying their contents.
+
+        :param kind: If provided only return sidecars with this name
+        :return: A list of OriginalFiles
+        """
+        q = {'path': self.ft_space + '/' + self.name,
+             'details.owner.id': self._table_owner_id()}
+        if kind:
+            q['name'] = kind
+        return self.get_objects('OriginalFile', q)
+
+    def get_sidecar(self, kind):
+        """
+        Get a single sidecar file
+
+        :param kind: The sidecar name
+        :return: An OriginalFile, or None if not found
+        """
+        files = self.list_sidecars(kind)
+        if len(files) > 1:
+            raise TooManyTablesException(
+                'Multiple sidecar files found for: %s/%s/%s' % (
+                    self.ft_space, self.name, kind))
+        if files:
+            return files[0]
+        return None
+
+    def read_sidecar(self, kind):
+        """
+        Read the contents of a sidecar file
+
+        :param kind: The sidecar name
+        :return: The file contents, or None if the sidecar doesn't exist
+        """
+        f = self.get_sidecar(kind)
+        if f:
+            return self.read_file(f)
+        return None
+
+    @_owns_table
+    def write_sidecar(self, kind, data):
+        """
+        Create or overwrite a sidecar file
+
+        :param kind: The sidecar name
+        :param data: The file contents
+        :return: The updated OriginalFile
+        """
+        f = self.get_sidecar(kind)
+        if not f:
+            f = omero.model.OriginalFileI()
+            f.setName(wrap(kind))
+            f.setPath(wrap(self.ft_space + '/' + self.name))
+            f.setMimetype(wrap(SIDECAR_MIMETYPE))
+            f.setSize(wrap(0L))
+            f = self.session.getUpdateService().saveAndReturnObject(f)
+        return self.write_file(f, data)
+
+    def read_file(self, ofile):
+        """
+        Read the contents of an OriginalFile in chunks
+
+        :param ofile: The OriginalFile
+        :return: The file contents
+        """
+        rfs = self.session.createRawFileStore()
+        try:
+            rfs.setFileId(unwrap(ofile.getId()))
+            size = rfs.size()
+            buf = []
+            for n in xrange(0, size, FILE_CHUNK_SIZE):
+                buf.append(rfs.read(n, min(FILE_CHUNK_SIZE, size - n)))
+            return ''.join(buf)
+        finally:
+            rfs.close()
+
+    def write_file(self, ofile, data):
+        """
+        Replace the contents of an OriginalFile in chunks
+
+        :param ofile: The OriginalFile
+        :param data: The new file contents
+        :return: The updated OriginalFile
+        """
+        rfs = self.session.createRawFileStore()
+        try:
+            rfs.setFileId(unwrap(ofile.getId()))
+            for n in xrange(0, len(data), FILE_CHUNK_SIZE):
+                chunk = data[n:(n + FILE_CHUNK_SIZE)]
+                rfs.write(chunk, n, len(chunk))
+            if rfs.size() > len(data):
+                rfs.truncate(len(data))
+            return rfs.save()
+        finally:
+            rfs.close()
+
     def store_by_image(self, image_id, values):
         self.store_by_object('Image', long(image_id), values)
 
     def store_by_roi(self, roi_id, values, image_id=None):
         if image_id is None:
-            params = omero.sys.ParametersI()
-            params.addId(roi_id)
-            image_id = self.session.getQueryService().projection(
-                'SELECT r.image.id FROM Roi r WHERE r.id=:id', params)
-            try:
-                image_id = unwrap(image_id[0][0])
-            except IndexError:
-                raise TableUsageException('No image found for Roi: %d', roi_id)
+            image_id = self.get_roi_image_id(roi_id)
         if image_id < 0:
             self.store_by_object('Roi', long(roi_id), values)
         else:
             self.store_by_object(
                 'Roi', long(roi_id), values, 'Image', image_id)
 
+    def get_roi_image_id(self, roi_id):
+        """
+        Lookup the parent Image ID of a ROI
+
+        :param roi_id: The ROI ID
+        :return: The Image ID
+        """
+        params = omero.sys.ParametersI()
+        params.addId(roi_id)
+        image_id = self.session.getQueryService().projection(
+            'SELECT r.image.id FROM Roi r WHERE r.id=:id', params)
+        try:
+            return unwrap(image_id[0][0])
+        except IndexError:
+            raise TableUsageException('No image found for Roi: %d' % roi_id)
+
     @_owns_table
     def store_by_object(self, object_type, object_id, values,
                         parent_type=None, parent_id=None, replace=True):
@@ -456,10 +872,14 @@ class FeatureTable(AbstractFeatureStore):
 
         offset = -1
         if replace:
-            conditions = '(ImageID==%d) & (RoiID==%d)' % (
-                self.cols[0].values[0], self.cols[1].values[0])
-            offsets = self.table.getWhereList(
-                conditions, {}, 0, self.table.getNumberOfRows(), 0)
+            idx = self.get_id_index()
+            if idx is not None:
+                offsets = idx.lookup_ids(image_id, roi_id).tolist()
+            else:
+                conditions = '(ImageID==%d) & (RoiID==%d)' % (
+                    self.cols[0].values[0], self.cols[1].values[0])
+                offsets = self.table.getWhereList(
+                    conditions, {}, 0, self.table.getNumberOfRows(), 0)
             if offsets:
                 offset = max(offsets)
 
@@ -468,8 +888,15 @@ class FeatureTable(AbstractFeatureStore):
         if offset > -1:
             data = omero.grid.Data(rowNumbers=[offset], columns=self.cols)
             self.table.update(data)
+            self._zone_map_update(offset, [[image_id, roi_id]], [values])
+            self._ann_index_update(offset, values)
+            # Statistics can't be updated when a row is replaced
+            self.summary = None
+            self.replace_count += 1
         else:
             self.table.addData(self.cols)
+            self._indexes_append([[image_id, roi_id]], [values])
+        self.write_count += 1
 
         if image_id > NOID:
             self.create_file_annotation('Image', image_id, self.ann_space,
@@ -477,6 +904,137 @@ class FeatureTable(AbstractFeatureStore):
         if roi_id > NOID:
             self.create_file_annotation('Roi', roi_id, self.ann_space,
                                         self.table.getOriginalFile())
+        self._notify_write([image_id], [values], offset > -1)
+
+    @_owns_table
+    def store_many_by_image(self, image_ids, values):
+        """
+        Store the feature rows of multiple Images, replacing existing rows
+        with one update call and appending the rest with append_rows. The
+        caller is responsible for keeping the message size below the Ice
+        limit, see get_chunk_size.
+
+        :param image_ids: A list of Image IDs
+        :param values: A list or 2D array of feature values
+        """
+        image_ids = [long(i) for i in image_ids]
+        if isinstance(values, numpy.ndarray):
+            values = values.tolist()
+        if len(image_ids) != len(values):
+            raise TableUsageException(
+                'image_ids and values must be the same length')
+        if not values:
+            return
+
+        idx = self.get_id_index()
+        replaced = []
+        appended = []
+        for n, image_id in enumerate(image_ids):
+            if idx is not None:
+                offsets = idx.lookup_ids(image_id, NOID).tolist()
+            else:
+                offsets = self.table.getWhereList(
+                    '(ImageID==%d) & (RoiID==%d)' % (image_id, NOID), {},
+                    0, self.table.getNumberOfRows(), 0)
+            if offsets:
+                replaced.append((max(offsets), n))
+            else:
+                appended.append(n)
+
+        if replaced:
+            ids = [image_ids[n] for offset, n in replaced]
+            vals = [values[n] for offset, n in replaced]
+            self.cols[0].values = ids
+            self.cols[1].values = [NOID] * len(ids)
+            self.cols[2].values = vals
+            data = omero.grid.Data(
+                rowNumbers=[offset for offset, n in replaced],
+                columns=self.cols)
+            self.table.update(data)
+            for (offset, n), iid, v in zip(replaced, ids, vals):
+                self._zone_map_update(offset, [[iid, NOID]], [v])
+                self._ann_index_update(offset, v)
+            # Statistics can't be updated when a row is replaced
+            self.summary = None
+            self.write_count += 1
+            self.replace_count += 1
+            self._notify_write(ids, vals, True)
+        if appended:
+            self.append_rows([image_ids[n] for n in appended],
+                             [NOID] * len(appended),
+                             [values[n] for n in appended])
+
+    @_owns_table
+    def append_rows(self, image_ids, roi_ids, values, annotate=True):
+        """
+        Append multiple feature rows in a single call without checking for
+        existing rows. The caller is responsible for keeping the message
+        size below the Ice limit, see get_chunk_size.
+
+        :param image_ids: A list of Image IDs, NOID if unknown
+        :param roi_ids: A list of ROI IDs, NOID if unknown
+        :param values: A list or 2D array of feature values
+        :param annotate: If True (default) link the table to the Images and
+               ROIs
+        """
+        image_ids = [long(i) for i in image_ids]
+        roi_ids = [long(i) for i in roi_ids]
+        if isinstance(values, numpy.ndarray):
+            values = values.tolist()
+        if not (len(image_ids) == len(roi_ids) == len(values)):
+            raise TableUsageException(
+                'image_ids, roi_ids and values must be the same length')
+        if not values:
+            return
+
+        self.cols[0].values = image_ids
+        self.cols[1].values = roi_ids
+        self.cols[2].values = values
+        self.table.addData(self.cols)
+        self._indexes_append(zip(image_ids, roi_ids), values)
+        self.write_count += 1
+
+        if annotate:
+            self.annotate_rows(image_ids, roi_ids)
+        self._notify_write(image_ids, values)
+
+    def annotate_rows(self, image_ids, roi_ids):
+        """
+        Link the table to the Images and ROIs of rows, objects which are
+        already linked are skipped so this is safe to repeat
+
+        :param image_ids: A list of Image IDs, NOID if unknown
+        :param roi_ids: A list of ROI IDs, NOID if unknown
+        """
+        tof = self.table.getOriginalFile()
+        iids = set(long(i) for i in image_ids if i > NOID)
+        rids = set(long(i) for i in roi_ids if i > NOID)
+        if iids:
+            self.create_file_annotations('Image', iids, self.ann_space, tof)
+        if rids:
+            self.create_file_annotations('Roi', rids, self.ann_space, tof)
+
+    def add_write_listener(self, func):
+        """
+        Register a function to be called after rows are written to this
+        table, used to maintain derived featuresets
+
+        :param func: A callable func(image_ids, values, replaced) which is
+               passed a list of the Image IDs of the written rows, which may
+               include NOID, a list of the feature values of each row, and
+               True if an existing row was replaced
+        """
+        self.write_listeners.append(func)
+
+    def remove_write_listener(self, func):
+        """
+        Unregister a write listener
+        """
+        self.write_listeners.remove(func)
+
+    def _notify_write(self, image_ids, values, replaced=False):
+        for func in self.write_listeners:
+            func(image_ids, values, replaced)
 
     def fetch_by_image(self, image_id, last=False):
         values = self.fetch_by_object('Image', image_id)
@@ -520,18 +1078,23 @@ class FeatureTable(AbstractFeatureStore):
         else:
             raise TableUsageException(
                 'Unsupported object type: %s' % object_type)
+        if (self.bloom is not None and
+                (object_type, object_id) not in self.get_bloom_filter()):
+            return []
+        if self.snapshot_arrays is None:
+            idx = self.get_id_index()
+            if idx is not None:
+                return self.read_rows(
+                    idx.lookup(object_type, object_id).tolist())
         return self.filter_raw(cond)
 
-    def filter_raw(self, conditions):
+    def read_rows(self, offsets):
         """
-        Query a feature table, return data as rows
+        Read table rows
 
-        :param conditions: The query conditions
-               Note the query syntax is still to be decided
+        :param offsets: A list of row numbers
         :return: A list of tuples (Image-ID, Roi-ID, feature-values)
         """
-        offsets = self.table.getWhereList(
-            conditions, {}, 0, self.table.getNumberOfRows(), 0)
         values = self.chunked_table_read(offsets, self.get_chunk_size())
 
         # Convert into row-wise storage
@@ -541,6 +1104,139 @@ class FeatureTable(AbstractFeatureStore):
             assert len(offsets) == len(v)
         return zip(*values)
 
+    def filter_raw(self, conditions, features=None):
+        """
+        Query a feature table, return data as rows
+
+        If the result cache is enabled the rows may be copied from the
+        cache.
+
+        :param conditions: The query conditions
+               Note the query syntax is still to be decided
+        :param features: Optional list of feature names, default all
+        :return: A list of tuples (Image-ID, Roi-ID, feature-values)
+        """
+        if self.snapshot_arrays is not None:
+            return self.snapshot_filter_raw(conditions, features)
+
+        nrows = self.table.getNumberOfRows()
+        if self.result_cache is not None:
+            version = (nrows, self.write_count)
+            key = (conditions, None if features is None else tuple(features))
+            cached = self.result_cache.get(key)
+            if cached and cached[0] == version:
+                return [(i, r, list(v)) for (i, r, v) in cached[1]]
+
+        cols = self.feature_indices(features)
+        offsets = self.table.getWhereList(conditions, {}, 0, nrows, 0)
+        rows = self.read_rows(offsets)
+        if cols is not None:
+            rows = [(i, r, [v[c] for c in cols]) for (i, r, v) in rows]
+
+        if self.result_cache is not None:
+            # Callers may modify the returned feature values in place
+            self.result_cache.insert(key, (version, tuple(
+                (i, r, tuple(v)) for (i, r, v) in rows)))
+        return rows
+
+    def enable_result_cache(self, maxbytes=RESULT_CACHE_BYTES,
+                            maxentries=RESULT_CACHE_SIZE):
+        """
+        Cache the results of filter_raw. Entries are invalidated when the
+        number of rows in the table changes or this object writes to the
+        table. Rows updated in place by another client will not be detected.
+
+        :param maxbytes: The approximate maximum memory used by the cache
+        :param maxentries: The maximum number of cached queries
+        """
+        rowsize = 8 * (self.cols[2].size + 2) + ROW_OVERHEAD_BYTES
+        self.result_cache = LRUCache(
+            maxentries, maxweight=maxbytes,
+            weight=lambda v: len(v[1]) * rowsize)
+
+    def disable_result_cache(self):
+        """
+        Disable and clear the filter_raw result cache
+        """
+        self.result_cache = None
+
+    def snapshot(self, path):
+        """
+        Copy the table into a local memory-mapped snapshot. Subsequent
+        queries are answered from the snapshot, which is topped up with any
+        rows appended to the table. If this object has replaced rows since
+        the snapshot was taken it is read again.
+
+        An existing snapshot of the same table at path is reused.
+
+        :param path: A local directory
+        :return: A MemmapFeatureArrays object
+        """
+        tid = unwrap(self.table.getOriginalFile().getId())
+        width = self.cols[2].size
+        snap = None
+        try:
+            snap = MemmapFeatureArrays(path)
+            if snap.manifest.get('file_id') != tid or snap.width != width:
+                log.warn('Replacing snapshot of a different table: %s', path)
+                snap = None
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        if not snap:
+            snap = MemmapFeatureArrays.create(path, width, file_id=tid)
+        self.snapshot_arrays = snap
+        self.snapshot_replace_count = self.replace_count
+        self.update_snapshot()
+        return snap
+
+    def update_snapshot(self):
+        """
+        Append new table rows to the snapshot, the snapshot is only read
+        again if rows were replaced
+
+        :return: The number of rows in the table
+        """
+        snap = self.snapshot_arrays
+        nrows = self.table.getNumberOfRows()
+        if (self.snapshot_replace_count != self.replace_count or
+                nrows < snap.nrows):
+            log.info('Resetting snapshot: %s', snap.path)
+            snap.truncate(0)
+            self.snapshot_replace_count = self.replace_count
+        if nrows > snap.nrows:
+            log.info('Updating snapshot rows %d-%d', snap.nrows, nrows)
+            for rows, ids, values in self.iter_chunks(
+                    start=snap.nrows, stop=nrows):
+                snap.append(ids, values)
+        return nrows
+
+    def drop_snapshot(self):
+        """
+        Stop using the local snapshot, the files are not deleted
+        """
+        if self.snapshot_arrays is not None:
+            self.snapshot_arrays.close()
+            self.snapshot_arrays = None
+
+    def snapshot_filter_raw(self, conditions, features=None):
+        """
+        Query the local snapshot after updating it, return data as rows
+
+        :param conditions: The query conditions, only ImageID and RoiID
+               are supported
+        :param features: Optional list of feature names, default all
+        :return: A list of tuples (Image-ID, Roi-ID, feature-values)
+        """
+        self.update_snapshot()
+        snap = self.snapshot_arrays
+        cols = self.feature_indices(features)
+        idx = numpy.flatnonzero(evaluate_id_conditions(conditions, snap.ids))
+        values = snap.values[idx]
+        if cols is not None:
+            values = values[:, cols]
+        return [(i[0], i[1], v) for i, v in itertools.izip(
+            snap.ids[idx].tolist(), values.tolist())]
+
     def feature_row(self, values):
         """
         Create a FeatureRow object
@@ -567,173 +1263,1779 @@ class FeatureTable(AbstractFeatureStore):
 
         return self.chunk_size
 
-    def chunked_table_read(self, offsets, chunk_size):
-        """
-        Read part of a table in chunks to avoid the Ice maximum message size
+    @staticmethod
+    def columns_to_arrays(columns, width):
         """
-        values = None
-
-        log.info('Chunk size: %d', chunk_size)
-        for n in xrange(0, len(offsets), chunk_size):
-            log.info('Chunk offset: %d+%d', n, chunk_size)
-            data = self.table.readCoordinates(offsets[n:(n + chunk_size)])
-            if values is None:
-                values = [c.values for c in data.columns]
-            else:
-                for c, v in itertools.izip(data.columns, values):
-                    v.extend(c.values)
+        Convert the ID and feature columns returned by the Tables API into
+        arrays
 
-        return values
+        :param columns: A list of ImageID, RoiID and DoubleArrayColumns
+        :param width: The number of features
+        :return: An (n, 2) int64 array of Image-ID and Roi-ID, and an
+                 (n, width) float64 array of feature values
+        """
+        n = len(columns[0].values)
+        ids = numpy.empty((n, 2), dtype=numpy.int64)
+        ids[:, 0] = columns[0].values
+        ids[:, 1] = columns[1].values
+        values = numpy.array(columns[2].values, dtype=numpy.float64)
+        return ids, values.reshape((n, width))
+
+    def iter_chunks(self, offsets=None, start=0, stop=None,
+                    chunk_size=None):
+        """
+        Iterate through table rows in chunks without holding the entire
+        table in memory
+
+        :param offsets: If provided read these rows, otherwise read the
+               contiguous range start-stop
+        :param start: The first row to read if offsets is None
+        :param stop: One past the last row to read if offsets is None,
+               default is the end of the table
+        :param chunk_size: The maximum number of rows in a chunk, default is
+               get_chunk_size()
+        :return: A generator of tuples (row-numbers, ids, values) where ids
+                 is an (n, 2) array of Image-ID and Roi-ID and values is an
+                 (n, width) array of feature values
+        """
+        if not chunk_size:
+            chunk_size = self.get_chunk_size()
+        width = self.cols[2].size
+        if offsets is None:
+            if stop is None:
+                stop = self.table.getNumberOfRows()
+            colnumbers = range(len(self.cols))
+            for n in xrange(start, stop, chunk_size):
+                m = min(n + chunk_size, stop)
+                data = self.table.read(colnumbers, n, m)
+                ids, values = self.columns_to_arrays(data.columns, width)
+                yield numpy.arange(n, m), ids, values
+        else:
+            for n in xrange(0, len(offsets), chunk_size):
+                rows = offsets[n:(n + chunk_size)]
+                data = self.table.readCoordinates(rows)
+                ids, values = self.columns_to_arrays(data.columns, width)
+                yield numpy.array(rows, dtype=numpy.int64), ids, values
 
-    def get_objects(self, object_type, kvs):
+    def feature_indices(self, features):
         """
-        Retrieve OMERO objects
+        Get the column indices of a subset of features
+
+        :param features: A list of feature names, or None for all features
+        :return: A list of indices, or None if features is None
         """
-        params = omero.sys.ParametersI()
+        if features is None:
+            return None
+        lookup = dict((n, i) for (i, n) in enumerate(self.feature_names()))
+        try:
+            return [lookup[f] for f in features]
+        except KeyError as e:
+            raise TableUsageException('Unknown feature: %s' % e.args[0])
 
-        qs = self.session.getQueryService()
-        conditions = []
+    def read_arrays(self, conditions=None, features=None):
+        """
+        Read matching rows directly into preallocated arrays
 
-        for k, v in kvs.iteritems():
-            ek = k.replace('_', '__').replace('.', '_')
-            if isinstance(v, list):
-                conditions.append(
-                    '%s in (:%s)' % (k, ek))
+        :param conditions: Optional query conditions, default all rows
+        :param features: Optional list of feature names, default all
+        :return: An (n, 2) int64 array of Image-ID and Roi-ID, and an
+                 (n, nfeatures) float64 array of feature values
+        """
+        cols = self.feature_indices(features)
+        width = self.cols[2].size if cols is None else len(cols)
+        if self.snapshot_arrays is not None:
+            self.update_snapshot()
+            snap = self.snapshot_arrays
+            if conditions:
+                idx = numpy.flatnonzero(
+                    evaluate_id_conditions(conditions, snap.ids))
             else:
-                conditions.append(
-                    '%s = :%s' % (k, ek))
-            params.add(ek, wrap(v))
+                idx = numpy.arange(snap.nrows)
+            if cols is None:
+                values = numpy.take(snap.values, idx, axis=0)
+            else:
+                values = snap.values[numpy.ix_(idx, cols)]
+            return numpy.take(snap.ids, idx, axis=0), values
 
-        q = 'FROM %s' % object_type
+        nrows = self.table.getNumberOfRows()
+        offsets = None
+        n = nrows
         if conditions:
-            q += ' WHERE ' + ' AND '.join(conditions)
-
-        results = qs.findAllByQuery(q, params)
-        return results
+            offsets = self.table.getWhereList(conditions, {}, 0, nrows, 0)
+            n = len(offsets)
+        ids = numpy.empty((n, 2), dtype=numpy.int64)
+        values = numpy.empty((n, width), dtype=numpy.float64)
+        pos = 0
+        for rows, cids, cvalues in self.iter_chunks(
+                offsets=offsets, stop=nrows):
+            m = pos + len(rows)
+            ids[pos:m] = cids
+            if cols is None:
+                values[pos:m] = cvalues
+            else:
+                values[pos:m] = cvalues[:, cols]
+            pos = m
+        return ids, values
 
-    def create_file_annotation(self, object_type, object_id, ns, ofile):
+    def to_dataframe(self, conditions=None, features=None):
         """
-        Create a file annotation
+        Read matching rows into a pandas DataFrame indexed by ImageID and
+        RoiID, with a column for each feature. Requires pandas.
 
-        :param object_type: The object type
-        :param object_id: The object ID
-        :param ns: The namespace
-        :param ofile: The originalFile
+        :param conditions: Optional query conditions, default all rows
+        :param features: Optional list of feature names, default all
+        :return: A DataFrame
         """
-        fid = unwrap(ofile.getId())
-        links = self._file_annotation_exists(object_type, object_id, ns, fid)
-        if len(links) > 1:
-            log.warn('Multiple links found: ns:%s %s:%d file:%d',
-                     ns, object_type, object_id, fid)
-        if links:
-            return links[0]
+        ids, values = self.read_arrays(conditions, features)
+        if features is None:
+            features = self.feature_names()
+        return arrays_to_dataframe(ids, values, features)
 
-        obj = self.get_objects(object_type, {'id': object_id})
-        if len(obj) != 1:
-            raise OmeroTableException(
-                'Failed to get object %s:%d' % (object_type, object_id))
-        link = getattr(omero.model, '%sAnnotationLinkI' % object_type)()
-        ann = omero.model.FileAnnotationI()
-        ann.setNs(wrap(ns))
-        ann.setFile(ofile)
-        link.setParent(obj[0])
-        link.setChild(ann)
-        link = self.session.getUpdateService().saveAndReturnObject(link)
-        return link
+    def iter_matching_chunks(self, conditions=None, chunk_size=None,
+                             shuffle=False):
+        """
+        Iterate through rows matching a server-side condition in chunks,
+        reading from the local snapshot if there is one. The next chunk is
+        fetched in the background.
+
+        :param conditions: Optional query conditions, default all rows
+        :param chunk_size: The maximum number of rows in a chunk
+        :param shuffle: If True, or a numpy.random.RandomState, read the
+               chunks in a random order. Each chunk is still a block of
+               consecutive matching rows.
+        :return: A generator of tuples (ids, values)
+        """
+        rng = shuffle if isinstance(
+            shuffle, numpy.random.RandomState) else None
+        if self.snapshot_arrays is not None:
+            self.update_snapshot()
+            snap = self.snapshot_arrays
+            if not chunk_size:
+                chunk_size = self.get_chunk_size()
+            if conditions:
+                idx = numpy.flatnonzero(
+                    evaluate_id_conditions(conditions, snap.ids))
+                if shuffle:
+                    idx = shuffle_blocks(idx, chunk_size, rng)
+                blocks = (idx[n:(n + chunk_size)]
+                          for n in xrange(0, len(idx), chunk_size))
+            elif shuffle:
+                blocks = (numpy.arange(n, m) for (n, m) in shuffle_ranges(
+                    snap.nrows, chunk_size, rng))
+            else:
+                blocks = (numpy.arange(n, min(n + chunk_size, snap.nrows))
+                          for n in xrange(0, snap.nrows, chunk_size))
+            for rows in blocks:
+                yield (numpy.take(snap.ids, rows, axis=0),
+                       numpy.take(snap.values, rows, axis=0))
+            return
+
+        nrows = self.table.getNumberOfRows()
+        offsets = None
+        if conditions:
+            offsets = self.table.getWhereList(conditions, {}, 0, nrows, 0)
+        if shuffle and not chunk_size:
+            chunk_size = self.get_chunk_size()
+        if shuffle and offsets is None:
+            # Read each block as a contiguous range
+            chunks = itertools.chain.from_iterable(
+                self.iter_chunks(start=n, stop=m, chunk_size=chunk_size)
+                for (n, m) in shuffle_ranges(nrows, chunk_size, rng))
+        else:
+            if shuffle:
+                offsets = shuffle_blocks(
+                    numpy.asarray(offsets), chunk_size, rng).tolist()
+            chunks = self.iter_chunks(
+                offsets=offsets, stop=nrows, chunk_size=chunk_size)
+        for rows, ids, values in prefetch(chunks):
+            yield ids, values
+
+    def query(self, predicate, features=None):
+        """
+        Find rows matching a predicate on feature values and IDs.
+        Conditions on ImageID and RoiID are evaluated by the server, and
+        conditions on features are evaluated locally on each chunk so only
+        matching rows are kept in memory. See the predicates module.
+
+        :param predicate: A predicates.Expr or a predicate string such as
+               'x0012 > 0.5 and x0100 < 3 and ImageID == 10'
+        :param features: Optional list of feature names to return, default
+               all
+        :return: An (n, 2) int64 array of Image-ID and Roi-ID, and an
+                 (n, nfeatures) float64 array of feature values
+        """
+        predicate = predicates.as_predicate(predicate)
+        condition, expr = predicates.split(predicate)
+        names = self.feature_names()
+        cols = self.feature_indices(features)
+
+        zm = None
+        if expr is not None and self.snapshot_arrays is None:
+            zm = self.get_zone_map()
+        if zm is not None:
+            # Read only the zones which may match, evaluating the whole
+            # predicate locally
+            ranges = zm.ranges(zm.match(predicate, names))
+            log.debug('Zone map: reading %d rows in %d ranges',
+                      sum(b - a for (a, b) in ranges), len(ranges))
+            chunks = itertools.chain.from_iterable(
+                self.iter_chunks(start=a, stop=b) for (a, b) in ranges)
+            chunks = ((ids, values) for (rows, ids, values) in prefetch(
+                chunks))
+            return predicates.filter_chunks(chunks, predicate, names, cols)
+
+        return predicates.filter_chunks(
+            self.iter_matching_chunks(condition), expr, names, cols)
+
+    def build_zone_map(self, zone_rows=None):
+        """
+        Create or replace the zone map of this table. Once a table has a
+        zone map it is used by query to skip rows, and updated on writes.
 
-    def _file_annotation_exists(self, object_type, object_id, ns, file_id):
-        q = ('FROM %sAnnotationLink ial WHERE ial.parent.id=:parent AND '
-             'ial.child.ns=:ns AND ial.child.file.id=:file') % object_type
-        params = omero.sys.ParametersI()
-        params.addLong('parent', object_id)
-        params.addString('ns', ns)
-        params.addLong('file', file_id)
-        links = self.session.getQueryService().findAllByQuery(q, params)
-        return links
+        :param zone_rows: The number of rows in each zone
+        :return: The zone map
+        """
+        if not zone_rows:
+            zone_rows = zonemap.ZONE_ROWS
+        zm = zonemap.ZoneMap(zone_rows, self.cols[2].size)
+        for rows, ids, values in prefetch(self.iter_chunks()):
+            zm.add(rows[0], ids, values)
+        self.zonemap = zm
+        self.zonemap_loaded = True
+        self.zonemap_dirty = True
+        self.save_zone_map()
+        return zm
+
+    def get_zone_map(self):
+        """
+        Get the zone map, loading it from the sidecar if necessary and
+        adding any rows appended since it was last updated
 
-    @_owns_table
-    def delete(self):
+        :return: The zone map, None if this table doesn't have one
         """
-        Delete the entire featureset including annotations
+        if not self.zonemap_loaded:
+            data = self.read_sidecar(ZONE_MAP_SIDECAR)
+            if data:
+                self.zonemap = zonemap.ZoneMap.from_bytes(data)
+            self.zonemap_loaded = True
+        zm = self.zonemap
+        if zm is None:
+            return None
+
+        nrows = self.table.getNumberOfRows()
+        if nrows < zm.nrows or zm.width != self.cols[2].size:
+            log.warn('Zone map does not match table, rebuilding')
+            return self.build_zone_map(zm.zone_rows)
+        if nrows > zm.nrows:
+            log.debug('Updating zone map rows %d-%d', zm.nrows, nrows)
+            for rows, ids, values in self.iter_chunks(
+                    start=zm.nrows, stop=nrows):
+                zm.add(rows[0], ids, values)
+            self.zonemap_dirty = True
+        return zm
+
+    def save_zone_map(self):
         """
-        # There's a bug (?) which means multiple FileAnnotations with the same
-        # OriginalFile child can't be deleted using the graph spec methods.
-        # For now just delete everything individually
-        qs = self.session.getQueryService()
-        tof = self.table.getOriginalFile()
-        fid = unwrap(tof.getId())
-        params = omero.sys.ParametersI()
-        params.addId(fid)
-        ds = []
+        Write the zone map sidecar if it has changed and the table is owned
+        by the current user
+        """
+        if (self.zonemap is not None and self.zonemap_dirty and
+                self.perms.can_edit(self.table.getOriginalFile())):
+            self.write_sidecar(ZONE_MAP_SIDECAR, self.zonemap.to_bytes())
+        self.zonemap_dirty = False
+
+    def _indexes_append(self, ids, values):
+        # Rows appended by another client are picked up the next time the
+        # zone map or ID index is loaded
+        if self.bloom is not None:
+            self.bloom.add_rows(ids)
+        zm = self.zonemap
+        idx = self.idindex
+        ann = self.ann
+        if zm is None and idx is None and ann is None:
+            return
+        start = self.table.getNumberOfRows() - len(ids)
+        if zm is not None and start == zm.nrows:
+            zm.add(start, numpy.asarray(ids), numpy.asarray(values))
+            self.zonemap_dirty = True
+        if idx is not None and start == idx.nrows:
+            idx.append(start, ids)
+            self.idindex_dirty = True
+        if ann is not None and start == ann.nrows:
+            ann.append(start, values)
+            self.ann_dirty = True
+
+    def _zone_map_update(self, row, ids, values):
+        # Replaced rows can't be detected later so the zone map must be
+        # loaded now, it's saved when the table is closed
+        zm = self.get_zone_map()
+        if zm is not None:
+            zm.add(row, numpy.asarray(ids), numpy.asarray(values))
+            self.zonemap_dirty = True
+
+    def _ann_index_update(self, row, values):
+        # As for the zone map the index must be loaded now
+        ann = self.get_ann_index()
+        if ann is not None:
+            ann.replace(row, values)
+            self.ann_dirty = True
+
+    def iter_id_chunks(self, start, stop):
+        """
+        Read only the ImageID and RoiID columns in chunks
 
-        linktypes = self._get_annotation_link_types()
-        for link in linktypes:
-            r = qs.findAllByQuery(
-                'SELECT al FROM %s al WHERE al.child.file.id=:id' % link,
-                params)
-            ds.extend(r)
+        :param start: The first row
+        :param stop: One past the last row
+        :return: A generator of tuples (first-row, ids) where ids is an
+                 (n, 2) array of Image-ID and Roi-ID
+        """
+        # Two longs per row
+        chunk_size = max(FILE_CHUNK_SIZE // 16, 1)
+        for n in xrange(start, stop, chunk_size):
+            m = min(n + chunk_size, stop)
+            data = self.table.read([0, 1], n, m)
+            ids = numpy.empty((m - n, 2), dtype=numpy.int64)
+            ids[:, 0] = data.columns[0].values
+            ids[:, 1] = data.columns[1].values
+            yield n, ids
+
+    def build_id_index(self):
+        """
+        Create or replace the sorted ImageID and RoiID index of this table.
+        Once a table has an index it is used to find rows for an Image or
+        ROI instead of getWhereList, and updated on writes.
 
-        r = qs.findAllByQuery(
-            'SELECT ann FROM FileAnnotation ann WHERE ann.file.id=:id', params)
-        ds.extend(r)
-        ds.append(tof)
+        :return: The index
+        """
+        idx = idindex.IdIndex()
+        for n, ids in self.iter_id_chunks(0, self.table.getNumberOfRows()):
+            idx.append(n, ids)
+        self.idindex = idx
+        self.idindex_loaded = True
+        self.idindex_dirty = True
+        self.save_id_index()
+        return idx
+
+    def get_id_index(self):
+        """
+        Get the ID index, loading it from the sidecar if necessary and
+        merging any rows appended since it was last updated
 
-        log.info('Deleting: %s',
-                 [(d.__class__.__name__, unwrap(d.getId())) for d in ds])
+        :return: The index, None if this table doesn't have one
+        """
+        if not self.idindex_loaded:
+            data = self.read_sidecar(ID_INDEX_SIDECAR)
+            if data:
+                self.idindex = idindex.IdIndex.from_bytes(data)
+            self.idindex_loaded = True
+        idx = self.idindex
+        if idx is None:
+            return None
+
+        nrows = self.table.getNumberOfRows()
+        if nrows < idx.nrows:
+            log.warn('ID index does not match table, rebuilding')
+            return self.build_id_index()
+        if nrows > idx.nrows:
+            log.debug('Updating ID index rows %d-%d', idx.nrows, nrows)
+            for n, ids in self.iter_id_chunks(idx.nrows, nrows):
+                idx.append(n, ids)
+            self.idindex_dirty = True
+        return idx
+
+    def save_id_index(self):
+        """
+        Write the ID index sidecar if it has changed and the table is owned
+        by the current user
+        """
+        if (self.idindex is not None and self.idindex_dirty and
+                self.perms.can_edit(self.table.getOriginalFile())):
+            self.write_sidecar(ID_INDEX_SIDECAR, self.idindex.to_bytes())
+        self.idindex_dirty = False
 
-        us = self.session.getUpdateService()
-        self.close()
-        for d in ds:
-            us.deleteObject(d)
+    def get_bloom_filter(self, refresh=False):
+        """
+        Get the Bloom filter of ImageIDs and RoiIDs in this table, this is
+        built when the table is opened and updated by writes through this
+        object. Rows appended by other clients are added when the filter is
+        older than BLOOM_FILTER_TTL seconds or if refresh is True,
+        otherwise this doesn't make a server call.
+
+        :param refresh: If True check for new rows now
+        :return: A bloom.BloomFilter
+        """
+        bf = self.bloom
+        if (bf is not None and not bf.full and not refresh and
+                time.time() - self.bloom_checked < BLOOM_FILTER_TTL):
+            return bf
+        nrows = self.table.getNumberOfRows()
+        if bf is None or bf.full or nrows < bf.nrows:
+            # Allow for the table doubling in size before a rebuild
+            bf = bloom.BloomFilter(4 * nrows)
+            idx = self.get_id_index()
+            if idx is not None:
+                keys = numpy.unique(idx.image_keys)
+                bf.add('Image', keys[keys > NOID])
+                keys = numpy.unique(idx.roi_keys)
+                bf.add('Roi', keys[keys > NOID])
+                bf.nrows = idx.nrows
+        if nrows > bf.nrows:
+            log.debug('Updating Bloom filter rows %d-%d', bf.nrows, nrows)
+            for n, ids in self.iter_id_chunks(bf.nrows, nrows):
+                bf.add_rows(ids)
+        self.bloom = bf
+        self.bloom_checked = time.time()
+        return bf
+
+    def has_features_many(self, object_type, object_ids):
+        """
+        Check whether objects have any feature rows. The Bloom filter
+        answers most negatives, the ID index or a table query is only used
+        to confirm possible matches.
 
-    @staticmethod
-    def _get_annotation_link_types():
-        return [s for s in dir(omero.model) if s.endswith(
+        :param object_type: 'Image' or 'Roi'
+        :param object_ids: A list of object IDs
+        :return: A boolean array
+        """
+        if object_type not in ('Image', 'Roi'):
+            raise TableUsageException(
+                'Unsupported object type: %s' % object_type)
+        object_ids = numpy.asarray(object_ids, dtype=numpy.int64)
+        if not len(object_ids):
+            return numpy.zeros(0, dtype=bool)
+        found = self.get_bloom_filter().might_contain(object_type, object_ids)
+        maybe = numpy.flatnonzero(found)
+        if not len(maybe):
+            return found
+
+        idx = self.get_id_index()
+        if idx is not None:
+            if object_type == 'Image':
+                keys = idx.image_keys
+            else:
+                keys = idx.roi_keys
+            found[maybe] = numpy.in1d(object_ids[maybe], keys)
+        else:
+            nrows = self.table.getNumberOfRows()
+            for i in maybe:
+                found[i] = bool(self.table.getWhereList(
+                    '(%sID==%d)' % (object_type, object_ids[i]),
+                    {}, 0, nrows, 0))
+        return found
+
+    def has_features(self, object_type, object_id):
+        """
+        Check whether an object has any feature rows, see has_features_many
+
+        :param object_type: 'Image' or 'Roi'
+        :param object_id: The object ID
+        :return: True if the object has at least one row
+        """
+        return bool(self.has_features_many(object_type, [object_id])[0])
+
+    def group_stats(self, by='ImageID', funcs=None, conditions=None,
+                    features=None, chunk_size=None):
+        """
+        Stream matching rows and compute grouped statistics, see aggregate
+
+        :return: An aggregate.GroupedStats
+        """
+        if funcs is None:
+            funcs = aggregate.DEFAULT_FUNCS
+        return aggregate.aggregate_chunks(
+            self.iter_matching_chunks(conditions, chunk_size),
+            len(self.feature_names()), by, funcs,
+            self.feature_indices(features))
+
+    def aggregate(self, by='ImageID', funcs=None, conditions=None,
+                  features=None, chunk_size=None):
+        """
+        Compute per-group reductions of feature values such as the mean of
+        all ROI features for each Image. The table is read in chunks and
+        each chunk is reduced with vectorised NumPy operations, only the
+        running statistics are kept in memory except for median which
+        needs all values. NaNs are ignored, rows where the group key is
+        NOID are skipped.
+
+        :param by: The group key, 'ImageID' or 'RoiID'
+        :param funcs: A list of reductions from aggregate.FUNCS, default
+               ['mean', 'std', 'count']
+        :param conditions: Optional query conditions, default all rows
+        :param features: Optional list of feature names, default all
+        :param chunk_size: The maximum number of rows in a chunk
+        :return: A sorted array of group keys, and an OrderedDict of
+                 reduction name: (ngroups, nfeatures) array
+        """
+        if funcs is None:
+            funcs = aggregate.DEFAULT_FUNCS
+        stats = self.group_stats(by, funcs, conditions, features, chunk_size)
+        return stats.keys, stats.result(funcs)
+
+    def summary_stats(self):
+        """
+        Get the statistics of every feature over the whole table. These
+        are cached with the number of rows, rows appended since the last
+        call are read and merged.
+
+        :return: A tuple (nrows, aggregate.GroupedStats) with at most one
+                 group
+        """
+        nrows = self.table.getNumberOfRows()
+        if self.summary is None or self.summary[0] > nrows:
+            start = 0
+            stats = aggregate.GroupedStats(len(self.feature_names()))
+        else:
+            start, stats = self.summary
+        if nrows > start:
+            log.debug('Updating summary statistics rows %d-%d', start, nrows)
+            for rows, ids, values in prefetch(
+                    self.iter_chunks(start=start, stop=nrows)):
+                stats.add(numpy.zeros(len(rows), dtype=numpy.int64), values)
+        self.summary = (nrows, stats)
+        return self.summary
+
+    def describe(self, features=None):
+        """
+        Calculate summary statistics of each feature in a single streaming
+        pass, using the numerically stable pairwise update of Chan et al.
+        The result is cached and updated incrementally when rows are
+        appended. Replacing a row through this object resets the cache,
+        rows replaced by other clients aren't detected.
+
+        :param features: Optional list of feature names, default all
+        :return: An OrderedDict of name: array with one value per feature,
+                 names are count (non-NaN values), nans, mean, std, min and
+                 max
+        """
+        cols = self.feature_indices(features)
+        nrows, stats = self.summary_stats()
+        r = aggregate.describe_stats(stats, nrows)
+        if cols is not None:
+            for k in r:
+                r[k] = r[k][cols]
+        return r
+
+    def normalized(self, method='zscore', features=None):
+        """
+        Get a view of this table with every feature normalised. The
+        transform is fitted once, from the cached summary statistics for
+        zscore and minmax or from one extra streaming pass for robust, and
+        applied in place to each chunk as it is read.
+
+        :param method: 'zscore', 'minmax' or 'robust'
+        :param features: Optional list of feature names, default all
+        :return: A normalize.NormalizedView
+        """
+        return normalize.normalized_view(self, method, features)
+
+    def nearest(self, query, k=10, metric='euclidean', features=None,
+                conditions=None, chunk_size=None, exclude=None,
+                approximate=False, nprobe=None):
+        """
+        Find the k rows closest to a query. Matching rows are streamed in
+        chunks, only the best k rows are kept in memory.
+
+        If approximate is True and the table has an ANN index (see
+        build_ann_index) only the rows in the nprobe lists closest to the
+        query are read. The metric must match the index and all features
+        are compared. Without an index, or with a local snapshot, an exact
+        search is done.
+
+        :param query: A feature vector, an Image ID, or a tuple
+               (object-type, object-ID). The rows of a query object are
+               excluded from the results.
+        :param k: The maximum number of rows to return
+        :param metric: 'euclidean' or 'cosine'
+        :param features: Optional list of feature names to compare,
+               default all
+        :param conditions: Optional query conditions, default all rows
+        :param chunk_size: The maximum number of rows in a chunk
+        :param exclude: Optional tuple (object-type, object-ID) of rows to
+               skip when query is a vector
+        :param approximate: If True use the ANN index if there is one
+        :param nprobe: The number of ANN lists to search, default
+               ann.NPROBE
+        :return: An (n, 2) int64 array of Image-ID and Roi-ID and an array
+                 of n distances sorted by increasing distance, n <= k
+        """
+        nearest.check_metric(metric)
+        cols = self.feature_indices(features)
+        vector, obj = nearest.resolve_query(self, query, cols)
+        exclude = obj or exclude
+
+        idx = None
+        if approximate and self.snapshot_arrays is None:
+            idx = self.get_ann_index()
+        if idx is not None:
+            if cols is not None or metric != idx.metric:
+                raise TableUsageException(
+                    'Approximate search requires all features and the '
+                    '%s metric' % idx.metric)
+            offsets = idx.candidates(vector, nprobe or ann.NPROBE)
+            log.debug('ANN index: reading %d of %d rows',
+                      len(offsets), idx.nrows)
+            chunks = ((ids, values) for (rows, ids, values) in prefetch(
+                self.iter_chunks(offsets=offsets.tolist(),
+                                 chunk_size=chunk_size)))
+            if conditions:
+                chunks = filter_id_conditions(chunks, conditions)
+        else:
+            chunks = self.iter_matching_chunks(conditions, chunk_size)
+        return nearest.nearest_chunks(chunks, vector, k, metric, cols, exclude)
+
+    def top_k(self, feature, k=10, largest=True, conditions=None,
+              vectors=False, chunk_size=None):
+        """
+        Find the rows with the largest or smallest values of a feature.
+        Matching rows are streamed in chunks, only the feature value and
+        row number of the best k rows are kept. If vectors is True the
+        full feature vectors of those rows are read in a second pass.
+
+        :param feature: The feature name
+        :param k: The maximum number of rows to return
+        :param largest: If True return the largest values, otherwise the
+               smallest
+        :param conditions: Optional query conditions, default all rows
+        :param vectors: If True also return the feature vectors
+        :param chunk_size: The maximum number of rows in a chunk
+        :return: An (n, 2) int64 array of Image-ID and Roi-ID and an array
+                 of n feature values sorted best first, n <= k. NaNs are
+                 ignored. If vectors is True also an (n, nfeatures) array
+                 of feature values.
+        """
+        col = self.feature_indices([feature])[0]
+        snap = self.snapshot_arrays
+        if snap is not None:
+            self.update_snapshot()
+            if not chunk_size:
+                chunk_size = self.get_chunk_size()
+            if conditions:
+                idx = numpy.flatnonzero(
+                    evaluate_id_conditions(conditions, snap.ids))
+            else:
+                idx = numpy.arange(snap.nrows)
+            chunks = ((idx[n:(n + chunk_size)],
+                       snap.ids[idx[n:(n + chunk_size)]],
+                       snap.values[idx[n:(n + chunk_size)], col])
+                      for n in xrange(0, len(idx), chunk_size))
+        else:
+            nrows = self.table.getNumberOfRows()
+            offsets = None
+            if conditions:
+                offsets = self.table.getWhereList(
+                    conditions, {}, 0, nrows, 0)
+            chunks = ((rows, ids, values[:, col])
+                      for (rows, ids, values) in prefetch(self.iter_chunks(
+                          offsets=offsets, stop=nrows,
+                          chunk_size=chunk_size)))
+
+        keys, scores = nearest.top_k_chunks(
+            ((numpy.column_stack([ids, rows]), v) for (rows, ids, v) in
+             chunks), k, largest, len(ID_COLUMNS) + 1)
+        ids = numpy.ascontiguousarray(keys[:, :len(ID_COLUMNS)])
+        if not vectors:
+            return ids, scores
+
+        rows = keys[:, len(ID_COLUMNS)]
+        if snap is not None:
+            return ids, scores, numpy.take(snap.values, rows, axis=0)
+        # Read the selected rows in table order
+        order = numpy.argsort(rows)
+        full = numpy.empty((len(rows), self.cols[2].size))
+        pos = 0
+        for crows, cids, cvalues in self.iter_chunks(
+                offsets=rows[order].tolist(), chunk_size=chunk_size):
+            full[order[pos:(pos + len(crows))]] = cvalues
+            pos += len(crows)
+        return ids, scores, full
+
+    def build_ann_index(self, nlists=None, metric='euclidean'):
+        """
+        Create or replace the approximate nearest-neighbour index of this
+        table. Centroids are trained on a random sample of rows, then the
+        table is streamed to assign every row to a list. Once a table has
+        an index it is updated on writes.
+
+        :param nlists: The number of lists, default the square root of the
+               number of rows
+        :param metric: 'euclidean' or 'cosine'
+        :return: The index
+        """
+        nrows = self.table.getNumberOfRows()
+        if not nlists:
+            nlists = min(max(int(numpy.sqrt(nrows)), 1), ann.MAX_LISTS)
+        if nrows > ann.TRAIN_ROWS:
+            offsets = numpy.sort(numpy.random.choice(
+                nrows, ann.TRAIN_ROWS, replace=False)).tolist()
+            chunks = list(self.iter_chunks(offsets=offsets))
+        else:
+            chunks = list(self.iter_chunks(stop=nrows))
+        if not chunks:
+            raise TableUsageException('No rows to train the index')
+        sample = numpy.concatenate([values for (rows, ids, values) in chunks])
+        idx = ann.IvfIndex.train(sample, nlists, metric)
+
+        if nrows > ann.TRAIN_ROWS:
+            for rows, ids, values in prefetch(self.iter_chunks(stop=nrows)):
+                idx.append(rows[0], values)
+        else:
+            idx.append(0, sample)
+        self.ann = idx
+        self.ann_loaded = True
+        self.ann_dirty = True
+        self.save_ann_index()
+        return idx
+
+    def get_ann_index(self):
+        """
+        Get the approximate nearest-neighbour index, loading it from the
+        sidecar if necessary and assigning any rows appended since it was
+        last updated
+
+        :return: The index, None if this table doesn't have one
+        """
+        if not self.ann_loaded:
+            data = self.read_sidecar(ANN_INDEX_SIDECAR)
+            if data:
+                self.ann = ann.IvfIndex.from_bytes(data)
+            self.ann_loaded = True
+        idx = self.ann
+        if idx is None:
+            return None
+
+        nrows = self.table.getNumberOfRows()
+        if nrows < idx.nrows or idx.width != len(self.feature_names()):
+            log.warn('ANN index does not match table, rebuilding')
+            return self.build_ann_index(idx.nlists, idx.metric)
+        if nrows > idx.nrows:
+            log.debug('Updating ANN index rows %d-%d', idx.nrows, nrows)
+            for rows, ids, values in self.iter_chunks(
+                    start=idx.nrows, stop=nrows):
+                idx.append(rows[0], values)
+            self.ann_dirty = True
+        return idx
+
+    def save_ann_index(self):
+        """
+        Write the ANN index sidecar if it has changed and the table is
+        owned by the current user
+        """
+        if (self.ann is not None and self.ann_dirty and
+                self.perms.can_edit(self.table.getOriginalFile())):
+            self.write_sidecar(ANN_INDEX_SIDECAR, self.ann.to_bytes())
+        self.ann_dirty = False
+
+    def fit_pca(self, n_components, features=None, conditions=None,
+                chunk_size=None):
+        """
+        Fit a principal component projection in a single streaming pass,
+        and save it in a sidecar if the table is owned by the current user.
+        Rows containing NaNs are ignored. The projection is not refitted
+        when rows are written.
+
+        :param n_components: The number of components to keep
+        :param features: Optional list of feature names, default all
+        :param conditions: Optional query conditions, default all rows
+        :param chunk_size: The maximum number of rows in a chunk
+        :return: A pca.Pca
+        """
+        model = pca.Pca.fit(
+            self.iter_matching_chunks(conditions, chunk_size), n_components,
+            self.feature_indices(features), features)
+        self.set_pca(model)
+        return model
+
+    def set_pca(self, model):
+        """
+        Replace the PCA projection, the sidecar is written if the table is
+        owned by the current user
+
+        :param model: A pca.Pca
+        """
+        self.pca = model
+        self.pca_loaded = True
+        if self.perms.can_edit(self.table.getOriginalFile()):
+            self.write_sidecar(PCA_SIDECAR, model.to_bytes())
+
+    def get_pca(self):
+        """
+        Get the PCA projection, loading it from the sidecar if necessary
+
+        :return: A pca.Pca, None if one hasn't been fitted
+        """
+        if not self.pca_loaded:
+            data = self.read_sidecar(PCA_SIDECAR)
+            if data:
+                self.pca = pca.Pca.from_bytes(data)
+            self.pca_loaded = True
+        return self.pca
+
+    def project(self, conditions=None, chunk_size=None):
+        """
+        Read matching rows projected onto the principal components, only
+        the reduced vectors are held in memory. See fit_pca.
+
+        :param conditions: Optional query conditions, default all rows
+        :param chunk_size: The maximum number of rows in a chunk
+        :return: An (n, 2) int64 array of Image-ID and Roi-ID, and an
+                 (n, n_components) float64 array, rows containing NaNs are
+                 all NaN
+        """
+        model = self.get_pca()
+        if model is None:
+            raise TableUsageException('No PCA projection, see fit_pca')
+        return pca.project_chunks(
+            model, self.iter_matching_chunks(conditions, chunk_size),
+            self.feature_indices(model.features))
+
+    def kmeans(self, k, features=None, conditions=None, batch_size=None,
+               passes=None, shuffle=True, seed=None, output=None):
+        """
+        Cluster rows with mini-batch k-means. Each pass streams the
+        matching rows in batches, in a random chunk order if shuffle is
+        True, so memory use is bounded by the batch size. Rows containing
+        NaNs are ignored.
+
+        :param k: The number of clusters
+        :param features: Optional list of feature names, default all
+        :param conditions: Optional query conditions, default all rows
+        :param batch_size: The number of rows in each batch, default
+               cluster.BATCH_SIZE
+        :param passes: The maximum number of passes through the rows,
+               default cluster.PASSES
+        :param shuffle: If True read the batches in a random order
+        :param seed: Optional random seed
+        :param output: Optional empty featureset with feature names
+               cluster.ASSIGNMENT_NAMES, the cluster and distance of every
+               matching row are bulk loaded into it
+        :return: A fitted cluster.MiniBatchKMeans
+        """
+        return cluster.kmeans_store(
+            self, k, features, conditions, batch_size or cluster.BATCH_SIZE,
+            passes or cluster.PASSES, shuffle, seed, output)
+
+    def pairwise_distances(self, path, metric='euclidean', features=None,
+                           conditions=None, block_rows=None):
+        """
+        Calculate the distance between every pair of matching rows. The
+        rows are read from the server once into a local copy under path,
+        the distances are computed in blocks and written to a memory-mapped
+        file. See pairwise.pairwise_distances.
+
+        :param path: A local directory for the output
+        :param metric: 'euclidean' or 'cosine'
+        :param features: Optional list of feature names, default all
+        :param conditions: Optional query conditions, default all rows
+        :param block_rows: The number of rows in each block, default
+               pairwise.BLOCK_ROWS
+        :return: An (n, 2) array of Image-ID and Roi-ID and an (n, n)
+                 memory-mapped array of distances
+        """
+        cols = self.feature_indices(features)
+        width = len(self.feature_names()) if cols is None else len(cols)
+        return pairwise.pairwise_distances(
+            self.iter_matching_chunks(conditions), width, path, metric,
+            block_rows or pairwise.BLOCK_ROWS, cols)
+
+    def feature_correlation(self, features=None, conditions=None,
+                            chunk_size=None):
+        """
+        Calculate the correlation between every pair of features in a
+        single streaming pass. Rows containing NaNs are ignored.
+
+        :param features: Optional list of feature names, default all
+        :param conditions: Optional query conditions, default all rows
+        :param chunk_size: The maximum number of rows in a chunk
+        :return: A (nfeatures, nfeatures) array of Pearson correlation
+                 coefficients
+        """
+        return pairwise.feature_correlation(
+            self.iter_matching_chunks(conditions, chunk_size),
+            self.feature_indices(features))
+
+    def export(self, path, format=None, conditions=None, chunk_size=None):
+        """
+        Stream the table into a local columnar file, see export.export_chunks
+
+        :param path: The output file
+        :param format: 'parquet', 'arrow' or 'hdf5', default is to guess from
+               the file extension
+        :param conditions: Optional query conditions, default is to export
+               all rows
+        :param chunk_size: The maximum number of rows read in each call
+        :return: The number of rows exported
+        """
+        offsets = None
+        if conditions:
+            nrows = self.table.getNumberOfRows()
+            offsets = self.table.getWhereList(conditions, {}, 0, nrows, 0)
+        chunks = ((ids, values) for (rows, ids, values) in self.iter_chunks(
+            offsets=offsets, chunk_size=chunk_size))
+        return export.export_chunks(
+            prefetch(chunks), path, self.feature_names(), format)
+
+    def chunked_table_read(self, offsets, chunk_size):
+        """
+        Read part of a table in chunks to avoid the Ice maximum message size
+        """
+        values = None
+
+        log.info('Chunk size: %d', chunk_size)
+        for n in xrange(0, len(offsets), chunk_size):
+            log.info('Chunk offset: %d+%d', n, chunk_size)
+            data = self.table.readCoordinates(offsets[n:(n + chunk_size)])
+            if values is None:
+                values = [c.values for c in data.columns]
+            else:
+                for c, v in itertools.izip(data.columns, values):
+                    v.extend(c.values)
+
+        return values
+
+    def get_objects(self, object_type, kvs):
+        """
+        Retrieve OMERO objects
+        """
+        return get_objects(self.session, object_type, kvs)
+
+    def create_file_annotation(self, object_type, object_id, ns, ofile):
+        """
+        Create a file annotation
+
+        :param object_type: The object type
+        :param object_id: The object ID
+        :param ns: The namespace
+        :param ofile: The originalFile
+        """
+        fid = unwrap(ofile.getId())
+        links = self._file_annotation_exists(object_type, object_id, ns, fid)
+        if len(links) > 1:
+            log.warn('Multiple links found: ns:%s %s:%d file:%d',
+                     ns, object_type, object_id, fid)
+        if links:
+            return links[0]
+
+        obj = self.get_objects(object_type, {'id': object_id})
+        if len(obj) != 1:
+            raise OmeroTableException(
+                'Failed to get object %s:%d' % (object_type, object_id))
+        link = getattr(omero.model, '%sAnnotationLinkI' % object_type)()
+        ann = omero.model.FileAnnotationI()
+        ann.setNs(wrap(ns))
+        ann.setFile(ofile)
+        link.setParent(obj[0])
+        link.setChild(ann)
+        link = self.session.getUpdateService().saveAndReturnObject(link)
+        return link
+
+    def create_file_annotations(self, object_type, object_ids, ns, ofile):
+        """
+        Link multiple objects to a file, creating a single new file
+        annotation for any objects which aren't already linked
+
+        :param object_type: The object type
+        :param object_ids: A collection of object IDs
+        :param ns: The namespace
+        :param ofile: The originalFile
+        :return: The number of new links
+        """
+        fid = unwrap(ofile.getId())
+        object_ids = sorted(set(object_ids))
+        linked = set()
+        for n in xrange(0, len(object_ids), QUERY_BATCH_SIZE):
+            linked.update(self._file_annotation_parents(
+                object_type, object_ids[n:(n + QUERY_BATCH_SIZE)], ns, fid))
+        missing = [i for i in object_ids if i not in linked]
+        if not missing:
+            return 0
+
+        us = self.session.getUpdateService()
+        ann = omero.model.FileAnnotationI()
+        ann.setNs(wrap(ns))
+        ann.setFile(omero.model.OriginalFileI(fid, False))
+        ann = us.saveAndReturnObject(ann)
+        annid = unwrap(ann.getId())
+
+        linktype = getattr(omero.model, '%sAnnotationLinkI' % object_type)
+        objtype = getattr(omero.model, '%sI' % object_type)
+        for n in xrange(0, len(missing), QUERY_BATCH_SIZE):
+            links = []
+            for oid in missing[n:(n + QUERY_BATCH_SIZE)]:
+                link = linktype()
+                link.setParent(objtype(oid, False))
+                link.setChild(omero.model.FileAnnotationI(annid, False))
+                links.append(link)
+            us.saveArray(links)
+        return len(missing)
+
+    def _file_annotation_parents(self, object_type, object_ids, ns, file_id):
+        q = ('SELECT ial.parent.id FROM %sAnnotationLink ial WHERE '
+             'ial.parent.id in (:parents) AND ial.child.ns=:ns AND '
+             'ial.child.file.id=:file') % object_type
+        params = omero.sys.ParametersI()
+        params.addIds(object_ids)
+        params.map['parents'] = params.map.pop('ids')
+        params.addString('ns', ns)
+        params.addLong('file', file_id)
+        r = self.session.getQueryService().projection(q, params)
+        return [unwrap(x[0]) for x in r]
+
+    def _file_annotation_exists(self, object_type, object_id, ns, file_id):
+        q = ('FROM %sAnnotationLink ial WHERE ial.parent.id=:parent AND '
+             'ial.child.ns=:ns AND ial.child.file.id=:file') % object_type
+        params = omero.sys.ParametersI()
+        params.addLong('parent', object_id)
+        params.addString('ns', ns)
+        params.addLong('file', file_id)
+        links = self.session.getQueryService().findAllByQuery(q, params)
+        return links
+
+    @_owns_table
+    def delete(self):
+        """
+        Delete the entire featureset including annotations
+        """
+        # There's a bug (?) which means multiple FileAnnotations with the same
+        # OriginalFile child can't be deleted using the graph spec methods.
+        # For now just delete everything individually
+        qs = self.session.getQueryService()
+        tof = self.table.getOriginalFile()
+        fid = unwrap(tof.getId())
+        params = omero.sys.ParametersI()
+        params.addId(fid)
+        ds = []
+
+        linktypes = self._get_annotation_link_types()
+        for link in linktypes:
+            r = qs.findAllByQuery(
+                'SELECT al FROM %s al WHERE al.child.file.id=:id' % link,
+                params)
+            ds.extend(r)
+
+        r = qs.findAllByQuery(
+            'SELECT ann FROM FileAnnotation ann WHERE ann.file.id=:id', params)
+        ds.extend(r)
+        ds.extend(self.list_sidecars())
+        ds.append(tof)
+
+        log.info('Deleting: %s',
+                 [(d.__class__.__name__, unwrap(d.getId())) for d in ds])
+
+        us = self.session.getUpdateService()
+        self.close()
+        for d in ds:
+            us.deleteObject(d)
+
+    @staticmethod
+    def _get_annotation_link_types():
+        return [s for s in dir(omero.model) if s.endswith(
             'AnnotationLink') and not s.startswith('_')]
 
 
+class PartitionedFeatureTable(AbstractFeatureStore):
+    """
+    A feature store split across multiple tables by Image ID.
+
+    Rows are routed using either the Image ID modulo the number of
+    partitions (scheme='hash'), or a sorted list of Image ID boundaries
+    (scheme='range') where partition i holds
+    boundaries[i - 1] <= ImageID < boundaries[i].
+    Requests for a single image go to one partition, all other requests are
+    sent to every partition in parallel.
+    """
+
+    def __init__(self, session, name, ft_space, ann_space, ownerid,
+                 coldesc=None, partitions=None, boundaries=None):
+        """
+        :param partitions: The number of partitions for a new featureset
+               using the hash scheme
+        :param boundaries: The Image ID boundaries for a new featureset
+               using the range scheme, there will be len(boundaries) + 1
+               partitions
+        """
+        self.session = session
+        self.name = name
+        self.ft_space = ft_space
+        self.ann_space = ann_space
+        self.part_space = ft_space + '/' + name
+        self.tables = None
+        self.scheme = None
+        self.boundaries = None
+        if coldesc:
+            self.new_partitions(ownerid, coldesc, partitions, boundaries)
+        else:
+            self.open_partitions(ownerid)
+
+    def _new_partition(self, ownerid, n, coldesc=None):
+        return FeatureTable(
+            self.session, PARTITION_NAME % n, self.part_space,
+            self.ann_space, ownerid, coldesc)
+
+    def new_partitions(self, ownerid, coldesc, partitions, boundaries):
+        """
+        Create the partition tables and save the layout
+
+        :param ownerid: The user-ID of the owner of the featureset
+        :param coldesc: A list of feature names
+        :param partitions: The number of partitions (hash scheme)
+        :param boundaries: Sorted Image ID boundaries (range scheme)
+        """
+        if boundaries is not None:
+            if partitions is not None:
+                raise TableUsageException(
+                    'Only one of partitions or boundaries may be given')
+            if list(boundaries) != sorted(boundaries):
+                raise TableUsageException('Boundaries must be sorted')
+            layout = {'scheme': 'range', 'partitions': len(boundaries) + 1,
+                      'boundaries': list(boundaries)}
+        elif partitions and partitions > 0:
+            layout = {'scheme': 'hash', 'partitions': partitions}
+        else:
+            raise TableUsageException(
+                'Number of partitions or boundaries required')
+
+        self.tables = [self._new_partition(ownerid, 0, coldesc)]
+        self.tables[0].write_sidecar(PARTITIONS_SIDECAR, json.dumps(layout))
+        self.tables.extend(parallel_map(
+            lambda n: self._new_partition(ownerid, n, coldesc),
+            range(1, layout['partitions'])))
+        self._set_layout(layout)
+
+    def open_partitions(self, ownerid):
+        """
+        Open an existing partitioned featureset
+
+        :param ownerid: The user-ID of the owner of the featureset
+        """
+        # raises NoTableMatchException if not found
+        first = self._new_partition(ownerid, 0)
+        layout = first.read_sidecar(PARTITIONS_SIDECAR)
+        if not layout:
+            first.close()
+            raise NoTableMatchException(
+                'No partition layout found for: %s' % self.part_space)
+        layout = json.loads(layout)
+        self.tables = [first] + parallel_map(
+            lambda n: self._new_partition(ownerid, n),
+            range(1, layout['partitions']))
+        self._set_layout(layout)
+
+    def _set_layout(self, layout):
+        self.scheme = layout['scheme']
+        self.boundaries = layout.get('boundaries')
+        if len(self.tables) != layout['partitions']:
+            raise OmeroTableException(
+                'Expected %d partitions, found %d' % (
+                    layout['partitions'], len(self.tables)))
+
+    @property
+    def table(self):
+        """
+        The first partition table, None if this featureset has been closed
+        """
+        if self.tables:
+            return self.tables[0].table
+        return None
+
+    def partition_index(self, image_id):
+        """
+        Get the index of the partition holding rows for an Image
+
+        :param image_id: The Image ID, NOID for rows without an image
+        :return: The partition number
+        """
+        if self.scheme == 'range':
+            return bisect.bisect_right(self.boundaries, image_id)
+        return image_id % len(self.tables)
+
+    def partition(self, image_id):
+        """
+        Get the partition holding rows for an Image
+
+        :param image_id: The Image ID, NOID for rows without an image
+        :return: A FeatureTable
+        """
+        return self.tables[self.partition_index(image_id)]
+
+    def _fan_out(self, func):
+        return parallel_map(func, self.tables)
+
+    def close(self):
+        """
+        Close all partition tables
+        """
+        if self.tables:
+            for t in self.tables:
+                t.close()
+            self.tables = None
+
+    def feature_names(self):
+        """
+        Get the list of feature names
+        """
+        return self.tables[0].feature_names()
+
+    def store_by_image(self, image_id, values):
+        self.partition(image_id).store_by_image(image_id, values)
+
+    def store_many_by_image(self, image_ids, values):
+        """
+        Store the feature rows of multiple Images, routing each row to its
+        partition. See FeatureTable.store_many_by_image
+        """
+        groups = {}
+        for n, iid in enumerate(image_ids):
+            groups.setdefault(self.partition_index(iid), []).append(n)
+        image_ids = list(image_ids)
+
+        def store_partition(item):
+            p, rows = item
+            self.tables[p].store_many_by_image(
+                [image_ids[n] for n in rows], [values[n] for n in rows])
+
+        parallel_map(store_partition, sorted(groups.items()))
+
+    def store_by_roi(self, roi_id, values, image_id=None):
+        if image_id is None:
+            image_id = self.tables[0].get_roi_image_id(roi_id)
+        self.partition(image_id).store_by_roi(roi_id, values, image_id)
+
+    def append_rows(self, image_ids, roi_ids, values, annotate=True):
+        """
+        Append multiple feature rows, routing each row to its partition.
+        See FeatureTable.append_rows
+        """
+        groups = {}
+        for n, iid in enumerate(image_ids):
+            groups.setdefault(self.partition_index(iid), []).append(n)
+        image_ids = list(image_ids)
+        roi_ids = list(roi_ids)
+
+        def append_partition(item):
+            p, rows = item
+            self.tables[p].append_rows(
+                [image_ids[n] for n in rows], [roi_ids[n] for n in rows],
+                [values[n] for n in rows], annotate)
+
+        parallel_map(append_partition, sorted(groups.items()))
+
+    def get_chunk_size(self):
+        """
+        The maximum number of rows to read or write in one call
+        """
+        return self.tables[0].get_chunk_size()
+
+    def add_write_listener(self, func):
+        """
+        Register a write listener on every partition, see
+        FeatureTable.add_write_listener
+        """
+        for t in self.tables:
+            t.add_write_listener(func)
+
+    def remove_write_listener(self, func):
+        """
+        Unregister a write listener from every partition
+        """
+        for t in self.tables:
+            t.remove_write_listener(func)
+
+    def fetch_by_image(self, image_id, last=False):
+        return self.partition(image_id).fetch_by_image(image_id, last)
+
+    def fetch_by_roi(self, roi_id, last=False):
+        values = self.fetch_by_object('Roi', roi_id)
+        if len(values) > 1 and not last:
+            raise TableUsageException(
+                'Multiple feature rows found for Roi %d' % roi_id)
+        if not values:
+            raise TableUsageException(
+                'No feature rows found for Roi %d' % roi_id)
+        return self.tables[0].feature_row(values[-1])
+
+    def fetch_all(self, image_id):
+        return self.partition(image_id).fetch_all(image_id)
+
+    def filter(self, conditions):
+        log.warn('The filter/query syntax is still under development')
+        values = self.filter_raw(conditions)
+        return [self.tables[0].feature_row(v) for v in values]
+
+    def fetch_by_object(self, object_type, object_id):
+        """
+        Fetch all feature rows for an object
+
+        :param object_type: The object type
+        :param object_id: The object ID
+        :return: A list of tuples (Image-ID, Roi-ID, feature-values)
+        """
+        if object_type == 'Image':
+            return self.partition(object_id).fetch_by_object(
+                object_type, object_id)
+        return list(itertools.chain.from_iterable(self._fan_out(
+            lambda t: t.fetch_by_object(object_type, object_id))))
+
+    def filter_raw(self, conditions, features=None):
+        """
+        Query all partitions, return data as rows
+
+        :param conditions: The query conditions
+        :param features: Optional list of feature names, default all
+        :return: A list of tuples (Image-ID, Roi-ID, feature-values)
+        """
+        return list(itertools.chain.from_iterable(self._fan_out(
+            lambda t: t.filter_raw(conditions, features))))
+
+    def feature_indices(self, features):
+        """
+        Get the column indices of a subset of features, see
+        FeatureTable.feature_indices
+        """
+        return self.tables[0].feature_indices(features)
+
+    def iter_matching_chunks(self, conditions=None, chunk_size=None,
+                             shuffle=False):
+        """
+        Iterate through matching rows in each partition in turn, see
+        FeatureTable.iter_matching_chunks. If shuffle is set the chunks of
+        all partitions are interleaved in a random order.
+        """
+        if not shuffle:
+            for t in self.tables:
+                for chunk in t.iter_matching_chunks(conditions, chunk_size):
+                    yield chunk
+            return
+
+        rng = shuffle if isinstance(
+            shuffle, numpy.random.RandomState) else numpy.random
+        iters = [t.iter_matching_chunks(conditions, chunk_size, shuffle)
+                 for t in self.tables]
+        while iters:
+            n = rng.randint(len(iters))
+            try:
+                yield next(iters[n])
+            except StopIteration:
+                del iters[n]
+
+    def read_arrays(self, conditions=None, features=None):
+        """
+        Read matching rows from all partitions into arrays, see
+        FeatureTable.read_arrays
+        """
+        results = self._fan_out(
+            lambda t: t.read_arrays(conditions, features))
+        return (numpy.concatenate([r[0] for r in results]),
+                numpy.concatenate([r[1] for r in results]))
+
+    def group_stats(self, by='ImageID', funcs=None, conditions=None,
+                    features=None, chunk_size=None):
+        """
+        Compute grouped statistics in all partitions and merge them, see
+        FeatureTable.group_stats
+        """
+        results = self._fan_out(lambda t: t.group_stats(
+            by, funcs, conditions, features, chunk_size))
+        stats = results[0]
+        for r in results[1:]:
+            stats.update(r)
+        return stats
+
+    def aggregate(self, by='ImageID', funcs=None, conditions=None,
+                  features=None, chunk_size=None):
+        """
+        Compute per-group reductions of feature values across all
+        partitions, see FeatureTable.aggregate
+        """
+        if funcs is None:
+            funcs = aggregate.DEFAULT_FUNCS
+        stats = self.group_stats(by, funcs, conditions, features, chunk_size)
+        return stats.keys, stats.result(funcs)
+
+    def summary_stats(self):
+        """
+        Get the statistics of every feature over all partitions, see
+        FeatureTable.summary_stats
+        """
+        results = self._fan_out(lambda t: t.summary_stats())
+        stats = aggregate.GroupedStats(results[0][1].width)
+        for nrows, s in results:
+            stats.update(s)
+        return sum(r[0] for r in results), stats
+
+    def describe(self, features=None):
+        """
+        Calculate summary statistics of each feature over all partitions,
+        see FeatureTable.describe
+        """
+        cols = self.feature_indices(features)
+        nrows, stats = self.summary_stats()
+        r = aggregate.describe_stats(stats, nrows)
+        if cols is not None:
+            for k in r:
+                r[k] = r[k][cols]
+        return r
+
+    def normalized(self, method='zscore', features=None):
+        """
+        Get a view of all partitions with every feature normalised, see
+        FeatureTable.normalized
+        """
+        return normalize.normalized_view(self, method, features)
+
+    def nearest(self, query, k=10, metric='euclidean', features=None,
+                conditions=None, chunk_size=None, exclude=None,
+                approximate=False, nprobe=None):
+        """
+        Find the k rows closest to a query in all partitions, see
+        FeatureTable.nearest
+        """
+        nearest.check_metric(metric)
+        cols = self.tables[0].feature_indices(features)
+        vector, obj = nearest.resolve_query(self, query, cols)
+        results = self._fan_out(lambda t: t.nearest(
+            vector, k, metric, features, conditions, chunk_size,
+            obj or exclude, approximate, nprobe))
+        top = nearest.TopK(k)
+        for ids, distances in results:
+            top.add(ids, distances)
+        return top.result()
+
+    def top_k(self, feature, k=10, largest=True, conditions=None,
+              vectors=False, chunk_size=None):
+        """
+        Find the rows with the largest or smallest values of a feature in
+        all partitions, see FeatureTable.top_k
+        """
+        results = self._fan_out(lambda t: t.top_k(
+            feature, k, largest, conditions, vectors, chunk_size))
+        ids = numpy.concatenate([r[0] for r in results])
+        scores = numpy.concatenate([r[1] for r in results])
+        best, scores = nearest.top_k_chunks(
+            [(numpy.arange(len(ids))[:, numpy.newaxis], scores)], k,
+            largest, 1)
+        best = best[:, 0]
+        if not vectors:
+            return ids[best], scores
+        return ids[best], scores, numpy.concatenate(
+            [r[2] for r in results])[best]
+
+    def build_zone_map(self, zone_rows=None):
+        """
+        Create or replace the zone map of every partition
+        """
+        self._fan_out(lambda t: t.build_zone_map(zone_rows))
+
+    def build_id_index(self):
+        """
+        Create or replace the ID index of every partition
+        """
+        self._fan_out(lambda t: t.build_id_index())
+
+    def build_ann_index(self, nlists=None, metric='euclidean'):
+        """
+        Create or replace the ANN index of every partition
+        """
+        self._fan_out(lambda t: t.build_ann_index(nlists, metric))
+
+    def fit_pca(self, n_components, features=None, conditions=None,
+                chunk_size=None):
+        """
+        Fit a principal component projection over all partitions, it is
+        saved with the first partition. See FeatureTable.fit_pca
+        """
+        model = pca.Pca.fit(
+            self.iter_matching_chunks(conditions, chunk_size), n_components,
+            self.feature_indices(features), features)
+        self.tables[0].set_pca(model)
+        return model
+
+    def get_pca(self):
+        """
+        Get the PCA projection, see FeatureTable.get_pca
+        """
+        return self.tables[0].get_pca()
+
+    def project(self, conditions=None, chunk_size=None):
+        """
+        Read matching rows from all partitions projected onto the principal
+        components, see FeatureTable.project
+        """
+        model = self.get_pca()
+        if model is None:
+            raise TableUsageException('No PCA projection, see fit_pca')
+        return pca.project_chunks(
+            model, self.iter_matching_chunks(conditions, chunk_size),
+            self.feature_indices(model.features))
+
+    def kmeans(self, k, features=None, conditions=None, batch_size=None,
+               passes=None, shuffle=True, seed=None, output=None):
+        """
+        Cluster the rows of all partitions with mini-batch k-means, see
+        FeatureTable.kmeans
+        """
+        return cluster.kmeans_store(
+            self, k, features, conditions, batch_size or cluster.BATCH_SIZE,
+            passes or cluster.PASSES, shuffle, seed, output)
+
+    def pairwise_distances(self, path, metric='euclidean', features=None,
+                           conditions=None, block_rows=None):
+        """
+        Calculate the distance between every pair of matching rows in all
+        partitions, see FeatureTable.pairwise_distances
+        """
+        cols = self.feature_indices(features)
+        width = len(self.feature_names()) if cols is None else len(cols)
+        return pairwise.pairwise_distances(
+            self.iter_matching_chunks(conditions), width, path, metric,
+            block_rows or pairwise.BLOCK_ROWS, cols)
+
+    def feature_correlation(self, features=None, conditions=None,
+                            chunk_size=None):
+        """
+        Calculate the correlation between every pair of features over all
+        partitions, see FeatureTable.feature_correlation
+        """
+        return pairwise.feature_correlation(
+            self.iter_matching_chunks(conditions, chunk_size),
+            self.feature_indices(features))
+
+    def has_features_many(self, object_type, object_ids):
+        """
+        Check whether objects have any feature rows in any partition, see
+        FeatureTable.has_features_many
+        """
+        if object_type == 'Image':
+            object_ids = numpy.asarray(object_ids, dtype=numpy.int64)
+            found = numpy.zeros(len(object_ids), dtype=bool)
+            parts = numpy.array(
+                [self.partition_index(i) for i in object_ids], dtype=int)
+
+            def check_partition(n):
+                rows = numpy.flatnonzero(parts == n)
+                found[rows] = self.tables[n].has_features_many(
+                    object_type, object_ids[rows])
+
+            parallel_map(check_partition, numpy.unique(parts).tolist())
+            return found
+        results = self._fan_out(
+            lambda t: t.has_features_many(object_type, object_ids))
+        return numpy.any(results, axis=0)
+
+    def has_features(self, object_type, object_id):
+        """
+        Check whether an object has any feature rows in any partition
+        """
+        return bool(self.has_features_many(object_type, [object_id])[0])
+
+    def query(self, predicate, features=None):
+        """
+        Find rows matching a predicate in all partitions, see
+        FeatureTable.query
+        """
+        results = self._fan_out(lambda t: t.query(predicate, features))
+        return (numpy.concatenate([r[0] for r in results]),
+                numpy.concatenate([r[1] for r in results]))
+
+    def to_dataframe(self, conditions=None, features=None):
+        """
+        Read matching rows from all partitions into a pandas DataFrame, see
+        FeatureTable.to_dataframe
+        """
+        ids, values = self.read_arrays(conditions, features)
+        if features is None:
+            features = self.feature_names()
+        return arrays_to_dataframe(ids, values, features)
+
+    def enable_result_cache(self, maxbytes=RESULT_CACHE_BYTES,
+                            maxentries=RESULT_CACHE_SIZE):
+        """
+        Enable the filter_raw result cache of every partition, the limits
+        are per partition
+        """
+        for t in self.tables:
+            t.enable_result_cache(maxbytes, maxentries)
+
+    def disable_result_cache(self):
+        for t in self.tables:
+            t.disable_result_cache()
+
+    def delete(self):
+        """
+        Delete all partitions including annotations
+        """
+        for t in self.tables:
+            t.delete()
+        self.tables = None
+
+
 class LRUCache(object):
     """
-    A naive least-recently-used cache. Removal is O(n)
-    TODO: Improve efficiency
+    A least-recently-used cache with O(1) lookup, insertion and removal.
+
+    By default the cache holds at most size entries. If a weight function
+    is provided the total weight of all entries is also limited to
+    maxweight, though the most recently inserted entry is always kept.
+    Entries which are in use can be pinned so they aren't evicted when
+    another entry is inserted. Entries may optionally expire after ttl
+    seconds.
     """
 
-    def __init__(self, size):
+    def __init__(self, size, maxweight=None, weight=None, ttl=None):
+        """
+        :param size: The maximum number of entries
+        :param maxweight: The maximum total weight of all entries
+        :param weight: A function returning the weight of a value, if
+               omitted every value has a weight of 1
+        :param ttl: The default time-to-live of an entry in seconds
+        """
         self.maxsize = size
-        self.cache = {}
-        self.counter = 0
+        self.maxweight = maxweight
+        self.weight = weight
+        self.ttl = ttl
+        self.timer = time.time
+        # Values are [value, weight, expiry-time]
+        self.cache = OrderedDict()
+        self.totalweight = 0
+        self.reset_stats()
 
     def __len__(self):
         return len(self.cache)
 
+    def reset_stats(self):
+        """
+        Reset the hit, miss, insert, eviction and expiry counters
+        """
+        self.hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self):
+        """
+        Get the cache statistics
+
+        :return: A dictionary of counters and the current size and weight
+        """
+        return {
+            'size': len(self.cache),
+            'weight': self.totalweight,
+            'hits': self.hits,
+            'misses': self.misses,
+            'inserts': self.inserts,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
     def get(self, key, miss=None):
         try:
-            v = self.cache[key]
-            self.counter += 1
-            v[1] = self.counter
-            return v[0]
+            v = self.cache.pop(key)
         except KeyError:
+            self.misses += 1
+            return miss
+        if v[2] is not None and v[2] <= self.timer():
+            self.totalweight -= v[1]
+            self.misses += 1
+            self.expirations += 1
+            self.evicted(v[0])
             return miss
+        self.cache[key] = v
+        self.hits += 1
+        return v[0]
 
-    def insert(self, key, value):
-        if key not in self.cache and len(self.cache) >= self.maxsize:
-            self.remove_oldest()
-        self.counter += 1
-        self.cache[key] = [value, self.counter]
+    def insert(self, key, value, ttl=None, pinned=None):
+        """
+        Insert or replace a value
+
+        :param key: The key
+        :param value: The value
+        :param ttl: Time-to-live in seconds, default is the cache ttl
+        :param pinned: Optional collection of keys which must not be
+               evicted to make room for this value
+        :raise TableUsageException: If the pinned entries and this value
+               exceed the size or weight limits, the cache is unchanged
+        """
+        if self.weight:
+            w = self.weight(value)
+        else:
+            w = 1
+        pinned = set(k for k in (pinned or ()) if k in self.cache)
+        pinned.discard(key)
+        if pinned:
+            pinnedweight = sum(self.cache[k][1] for k in pinned)
+            if len(pinned) + 1 > self.maxsize or (
+                    self.maxweight is not None and
+                    pinnedweight + w > self.maxweight):
+                raise TableUsageException(
+                    'Unable to cache %d entries with a total weight of %d, '
+                    'limits are %d entries and weight %s' % (
+                        len(pinned) + 1, pinnedweight + w, self.maxsize,
+                        self.maxweight))
+
+        old = self.cache.pop(key, None)
+        if old:
+            self.totalweight -= old[1]
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = self.timer() + ttl
+        self.cache[key] = [value, w, expires]
+        self.totalweight += w
+        self.inserts += 1
+
+        pinned.add(key)
+        while len(self.cache) > self.maxsize or (
+                self.maxweight is not None and
+                self.totalweight > self.maxweight):
+            oldest = next((k for k in self.cache if k not in pinned), None)
+            if oldest is None:
+                break
+            self._evict(oldest)
 
     def remove_oldest(self):
-        mink, minv = min(self.cache.iteritems(), key=lambda kv: kv[1][1])
-        return self.cache.pop(mink)[0]
+        return self._evict(next(iter(self.cache)))
+
+    def _evict(self, key):
+        v = self.cache.pop(key)
+        self.totalweight -= v[1]
+        self.evictions += 1
+        self.evicted(v[0])
+        return v[0]
+
+    def clear(self):
+        """
+        Remove all entries without calling evicted()
+        """
+        self.cache.clear()
+        self.totalweight = 0
+
+    def remove_expired(self):
+        """
+        Remove all expired entries. This is O(n).
+        """
+        now = self.timer()
+        for k, v in self.cache.items():
+            if v[2] is not None and v[2] <= now:
+                del self.cache[k]
+                self.totalweight -= v[1]
+                self.expirations += 1
+                self.evicted(v[0])
+
+    def evicted(self, value):
+        """
+        Called when a value is removed because it is the oldest or has
+        expired
+        """
+        pass
 
 
 class LRUClosableCache(LRUCache):
     """
     Automatically call value.close() when an object is removed from the cache
     """
-    def remove_oldest(self):
-        v = super(LRUClosableCache, self).remove_oldest()
-        v.close()
-        return v
+    def evicted(self, value):
+        value.close()
 
     def close(self):
         while self.cache:
@@ -741,12 +3043,35 @@ class LRUClosableCache(LRUCache):
             self.remove_oldest()
 
 
+def count_table_handles(fs):
+    """
+    Weight function for a cache of feature stores: the number of open
+    tables held by the store
+    """
+    return len(getattr(fs, 'tables', None) or [fs])
+
+
+# Parsed feature names shared between FeatureTable instances
+_feature_names_cache = LRUCache(FEATURE_NAMES_CACHE_SIZE)
+
+
 class FeatureTableManager(AbstractFeatureStoreManager):
     """
     Manage storage of feature table files
     """
 
     def __init__(self, session, **kwargs):
+        """
+        :param session: An active session
+        :param namespace: The base namespace for tables and annotations
+        :param ft_space: The path of the table files
+        :param ann_space: The namespace of the file annotations
+        :param cachesize: The maximum number of open featuresets
+        :param maxhandles: If provided the maximum number of open tables,
+               a partitioned featureset holds one per partition
+        :param cachettl: If provided close featuresets which haven't been
+               accessed for this many seconds
+        """
         self.session = session
         namespace = kwargs.get('namespace', DEFAULT_NAMESPACE)
         self.ft_space = kwargs.get(
@@ -754,9 +3079,27 @@ class FeatureTableManager(AbstractFeatureStoreManager):
         self.ann_space = kwargs.get(
             'ann_space', namespace + '/' + DEFAULT_ANNOTATION_SUBSPACE)
         self.cachesize = kwargs.get('cachesize', 10)
-        self.fss = LRUClosableCache(kwargs.get('cachesize', 10))
-
-    def create(self, featureset_name, names):
+        maxhandles = kwargs.get('maxhandles')
+        self.fss = LRUClosableCache(
+            self.cachesize, maxweight=maxhandles,
+            weight=count_table_handles if maxhandles else None,
+            ttl=kwargs.get('cachettl'))
+        # Materialized aggregates indexed by (source-name, source-ownerid)
+        self.aggregates = {}
+        self.reset_stats()
+
+    def create(self, featureset_name, names, partitions=None,
+               boundaries=None):
+        """
+        Create a new featureset
+
+        :param featureset_name: The featureset identifier
+        :param names: A list of feature names
+        :param partitions: If provided create a featureset split into this
+               many tables by hashing the Image ID
+        :param boundaries: If provided create a featureset split into
+               multiple tables by ranges of Image IDs
+        """
         try:
             ownerid = self.session.getAdminService().getEventContext().userId
             fs = self.get(featureset_name, ownerid)
@@ -767,10 +3110,15 @@ class FeatureTableManager(AbstractFeatureStoreManager):
             pass
 
         coldesc = names
-        fs = FeatureTable(
-            self.session, featureset_name, self.ft_space, self.ann_space,
-            ownerid, coldesc)
-        self.fss.insert((featureset_name, ownerid), fs)
+        if partitions is None and boundaries is None:
+            fs = FeatureTable(
+                self.session, featureset_name, self.ft_space, self.ann_space,
+                ownerid, coldesc)
+        else:
+            fs = PartitionedFeatureTable(
+                self.session, featureset_name, self.ft_space, self.ann_space,
+                ownerid, coldesc, partitions, boundaries)
+        self._insert((featureset_name, ownerid), fs)
         return fs
 
     def get(self, featureset_name, ownerid=None):
@@ -780,12 +3128,204 @@ class FeatureTableManager(AbstractFeatureStoreManager):
         fs = self.fss.get(k)
         # If fs.table is None it has probably been closed
         if not fs or not fs.table:
-            fs = FeatureTable(
-                self.session, featureset_name, self.ft_space, self.ann_space,
-                ownerid)
-            # raises NoTableMatchException if not found
-            self.fss.insert(k, fs)
+            t0 = time.time()
+            try:
+                fs = FeatureTable(
+                    self.session, featureset_name, self.ft_space,
+                    self.ann_space, ownerid)
+            except NoTableMatchException:
+                # raises NoTableMatchException if not found
+                fs = PartitionedFeatureTable(
+                    self.session, featureset_name, self.ft_space,
+                    self.ann_space, ownerid)
+            self._record_open(1, time.time() - t0)
+            self._insert(k, fs)
+        return fs
+
+    def get_many(self, featureset_names, ownerid=None):
+        """
+        Get multiple existing feature stores
+
+        Featuresets which aren't already open are found using a single query
+        and opened in parallel. All requested featuresets are kept open
+        until this returns, if they don't fit in the cache together a
+        TableUsageException is raised.
+
+        :param featureset_names: A list of featureset identifiers
+        :param ownerid: The user-ID of the owner of the featuresets
+        :return: A list of feature stores in the same order as
+                 featureset_names
+        """
+        if ownerid is None:
+            ownerid = self.session.getAdminService().getEventContext().userId
+        names = list(set(featureset_names))
+        if len(names) > self.cachesize:
+            raise TableUsageException(
+                'Requested %d featuresets but cache size is %d' % (
+                    len(names), self.cachesize))
+
+        fss = {}
+        missing = []
+        for name in names:
+            fs = self.fss.get((name, ownerid))
+            if fs and fs.table:
+                fss[name] = fs
+            else:
+                missing.append(name)
+
+        if self.fss.maxweight is not None:
+            # Featuresets which aren't open hold at least one table each
+            handles = len(missing) + sum(
+                self.fss.weight(fs) for fs in fss.itervalues())
+            if handles > self.fss.maxweight:
+                raise TableUsageException(
+                    'Requested featuresets hold at least %d tables but the '
+                    'maximum is %d' % (handles, self.fss.maxweight))
+
+        if missing:
+            q = {'name': missing, 'path': self.ft_space}
+            if ownerid > -1:
+                q['details.owner.id'] = ownerid
+            tablefiles = {}
+            for f in get_objects(self.session, 'OriginalFile', q):
+                tablefiles.setdefault(unwrap(f.getName()), []).append(f)
+            for name, files in tablefiles.iteritems():
+                if len(files) > 1:
+                    raise TooManyTablesException(
+                        'Multiple files found for: %s/%s' % (
+                            self.ft_space, name))
+
+            def open_featureset(name):
+                try:
+                    if name in tablefiles:
+                        return FeatureTable(
+                            self.session, name, self.ft_space,
+                            self.ann_space, ownerid,
+                            tablefile=tablefiles[name][0])
+                    # raises NoTableMatchException if not found
+                    return PartitionedFeatureTable(
+                        self.session, name, self.ft_space, self.ann_space,
+                        ownerid)
+                except TableStoreException as e:
+                    return e
+
+            t0 = time.time()
+            opened = parallel_map(open_featureset, missing)
+            errors = [e for e in opened if isinstance(e, Exception)]
+            if errors:
+                for fs in opened:
+                    if not isinstance(fs, Exception):
+                        fs.close()
+                raise errors[0]
+            self._record_open(len(missing), time.time() - t0)
+            pinned = [(name, ownerid) for name in names]
+            for n, name in enumerate(missing):
+                try:
+                    self._insert((name, ownerid), opened[n], pinned)
+                except TableUsageException:
+                    for fs in opened[n:]:
+                        fs.close()
+                    raise
+                fss[name] = opened[n]
+
+        return [fss[name] for name in featureset_names]
+
+    def _insert(self, k, fs, pinned=None):
+        self.fss.insert(k, fs, pinned=pinned)
+        for agg in self.aggregates.get(k, []):
+            fs.add_write_listener(agg.source_written)
+
+    def _register_aggregate(self, agg):
+        k = (agg.source_name, agg.source_ownerid)
+        aggs = self.aggregates.setdefault(k, [])
+        if any(a.name == agg.name and a.ownerid == agg.ownerid
+               for a in aggs):
+            return
+        aggs.append(agg)
+        fs = self.fss.get(k)
+        if fs and fs.table:
+            fs.add_write_listener(agg.source_written)
+
+    def create_aggregate(self, featureset_name, source_name, funcs=None,
+                         features=None, source_ownerid=None):
+        """
+        Create a featureset holding per-image reductions of the features in
+        another featureset, for instance the mean of all ROI features of
+        each Image. The aggregate is computed once, after that writes to
+        the source through this manager recompute only the rows of the
+        affected Images.
+
+        :param featureset_name: The aggregate featureset identifier
+        :param source_name: The source featureset identifier
+        :param funcs: A list of reductions from aggregate.FUNCS, default
+               ['mean', 'std', 'count']
+        :param features: Optional list of source feature names, default all
+        :param source_ownerid: The owner of the source featureset, default
+               the current user
+        :return: The aggregate featureset, feature names are of the form
+                 'mean(x1)', see materialized.aggregate_names
+        """
+        if funcs is None:
+            funcs = aggregate.DEFAULT_FUNCS
+        ownerid = self.session.getAdminService().getEventContext().userId
+        if source_ownerid is None:
+            source_ownerid = ownerid
+        source = self.get(source_name, source_ownerid)
+        if features is None:
+            names = source.feature_names()
+        else:
+            names = features
+        fs = self.create(
+            featureset_name, materialized.aggregate_names(names, funcs))
+        agg = materialized.MaterializedAggregate(
+            self, featureset_name, ownerid, source_name, source_ownerid,
+            funcs, features)
+        agg.save_definition()
+        agg.rebuild()
+        self._register_aggregate(agg)
         return fs
 
+    def get_aggregate(self, featureset_name, ownerid=None):
+        """
+        Get an existing aggregate featureset and keep it up to date with
+        writes to its source through this manager
+
+        :param featureset_name: The aggregate featureset identifier
+        :param ownerid: The user-ID of the owner of the featureset
+        :return: The aggregate featureset
+        """
+        if ownerid is None:
+            ownerid = self.session.getAdminService().getEventContext().userId
+        fs = self.get(featureset_name, ownerid)
+        self._register_aggregate(
+            materialized.MaterializedAggregate.load(self, fs, ownerid))
+        return fs
+
+    def _record_open(self, n, seconds):
+        self.opens += n
+        self.open_time += seconds
+        log.debug('Opened %d featuresets in %f s', n, seconds)
+
+    def reset_stats(self):
+        """
+        Reset the featureset cache statistics
+        """
+        self.fss.reset_stats()
+        self.opens = 0
+        self.open_time = 0.0
+
+    def stats(self):
+        """
+        Get the featureset cache statistics
+
+        :return: A dictionary of cache counters, the number of featuresets
+                 opened because they weren't cached (opens) and the total
+                 time spent opening them in seconds (open_time)
+        """
+        s = self.fss.stats()
+        s['opens'] = self.opens
+        s['open_time'] = self.open_time
+        return s
+
     def close(self):
         self.fss.close()
@@ -1,4 +1,24 @@
+import LocalFeatureStore
 import OmeroTablesFeatureStore
+import aggregate
+import ann
+import bloom
+import bulk
+import cluster
+import exceptions
+import export
+import idindex
+import materialized
+import mmaparrays
+import nearest
+import normalize
+import pairwise
+import pca
+import predicates
 import utils
+import zonemap
 
-__all__ = ['OmeroTablesFeatureStore', 'utils']
+__all__ = ['LocalFeatureStore', 'OmeroTablesFeatureStore', 'aggregate',
+           'ann', 'bloom', 'bulk', 'cluster', 'exceptions', 'export',
+           'idindex', 'materialized', 'mmaparrays', 'nearest', 'normalize',
+           'pairwise', 'pca', 'predicates', 'utils', 'zonemap']
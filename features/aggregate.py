@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Grouped reductions of feature values, computed a chunk at a time
+
+Each chunk is sorted by group key and reduced with reduceat, partial
+results are merged using the pairwise update of Chan et al. so the mean
+and variance are numerically stable. NaN values are ignored.
+"""
+
+from exceptions import TableUsageException
+from utils import ID_COLUMNS, NOID
+
+from collections import OrderedDict
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Reductions which can be computed from the merged statistics
+STREAMING_FUNCS = ('count', 'sum', 'mean', 'var', 'std', 'min', 'max')
+
+# Reductions which need all values
+BUFFERED_FUNCS = ('median',)
+
+FUNCS = STREAMING_FUNCS + BUFFERED_FUNCS
+
+DEFAULT_FUNCS = ('mean', 'std', 'count')
+
+
+def check_funcs(funcs):
+    """
+    Check a list of reduction names
+
+    :param funcs: A list of names from FUNCS
+    :return: funcs as a list
+    """
+    funcs = list(funcs)
+    for f in funcs:
+        if f not in FUNCS:
+            raise TableUsageException(
+                'Unsupported aggregate function: %s' % f)
+    return funcs
+
+
+def group_column(by):
+    """
+    Get the ID column index for a group key
+
+    :param by: 'ImageID' or 'RoiID'
+    """
+    try:
+        return ID_COLUMNS.index(by)
+    except ValueError:
+        raise TableUsageException('Unsupported group key: %s' % by)
+
+
+class GroupedStats(object):
+    """
+    Count, mean, sum of squared deviations, minimum and maximum of every
+    feature in each group
+    """
+
+    def __init__(self, width, buffered=False):
+        """
+        :param width: The number of features
+        :param buffered: If True also keep all values so that the median
+               can be calculated
+        """
+        self.width = width
+        self.keys = numpy.empty(0, dtype=numpy.int64)
+        self.n = numpy.empty((0, width))
+        self.mean = numpy.empty((0, width))
+        self.m2 = numpy.empty((0, width))
+        self.mins = numpy.empty((0, width))
+        self.maxs = numpy.empty((0, width))
+        self.buffered = [] if buffered else None
+
+    def add(self, keys, values):
+        """
+        Add a chunk of values
+
+        :param keys: An array of n group keys
+        :param values: An (n, width) array of feature values
+        """
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if not len(keys):
+            return
+        if self.buffered is not None:
+            self.buffered.append((keys, values))
+
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        values = values[order]
+        ukeys, starts, counts = numpy.unique(
+            keys, return_index=True, return_counts=True)
+
+        valid = ~numpy.isnan(values)
+        zeroed = numpy.where(valid, values, 0)
+        n = numpy.add.reduceat(
+            valid.astype(numpy.float64), starts, axis=0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.add.reduceat(zeroed, starts, axis=0) / n
+        mean[n == 0] = 0
+        dev = numpy.where(valid, values - numpy.repeat(mean, counts, axis=0),
+                          0)
+        m2 = numpy.add.reduceat(dev * dev, starts, axis=0)
+        # fmin and fmax ignore NaNs unless a group only contains NaNs
+        mins = numpy.fmin.reduceat(values, starts, axis=0)
+        maxs = numpy.fmax.reduceat(values, starts, axis=0)
+        self._merge(ukeys, n, mean, m2, mins, maxs)
+
+    def _combine(self, a, b):
+        # Pairwise update of two lists of arrays (n, mean, m2, mins, maxs)
+        na, ma, m2a, mina, maxa = a
+        nb, mb, m2b, minb, maxb = b
+        total = na + nb
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            frac = numpy.where(total > 0, nb / total, 0)
+        delta = mb - ma
+        return (total, ma + delta * frac,
+                m2a + m2b + delta * delta * na * frac,
+                numpy.fmin(mina, minb), numpy.fmax(maxa, maxb))
+
+    def _set(self, keys, arrays, merge):
+        # Groups which already exist are updated in place so only the
+        # touched rows are copied, new groups are inserted
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        if not len(keys):
+            return
+        pos = numpy.searchsorted(self.keys, keys)
+        found = self.contains(keys)
+        fields = ['n', 'mean', 'm2', 'mins', 'maxs']
+        if found.any():
+            p = pos[found]
+            b = [a[found] for a in arrays]
+            if merge:
+                b = self._combine([getattr(self, f)[p] for f in fields], b)
+            for f, v in zip(fields, b):
+                getattr(self, f)[p] = v
+        if not found.all():
+            new = ~found
+            ins = pos[new]
+            self.keys = numpy.insert(self.keys, ins, keys[new])
+            for f, a in zip(fields, arrays):
+                setattr(self, f, numpy.insert(
+                    getattr(self, f), ins, a[new], axis=0))
+
+    def _merge(self, keys, n, mean, m2, mins, maxs):
+        self._set(keys, (n, mean, m2, mins, maxs), True)
+
+    def _check_width(self, other):
+        if other.width != self.width:
+            raise TableUsageException(
+                'Expected width %d, got %d' % (self.width, other.width))
+
+    def update(self, other):
+        """
+        Merge the statistics of another GroupedStats into this one
+
+        :param other: A GroupedStats with the same width
+        """
+        self._check_width(other)
+        self._merge(other.keys, other.n, other.mean, other.m2, other.mins,
+                    other.maxs)
+        if self.buffered is not None and other.buffered is not None:
+            self.buffered.extend(other.buffered)
+
+    def replace(self, other):
+        """
+        Replace the statistics of the groups in another GroupedStats,
+        groups which don't exist are added
+
+        :param other: A GroupedStats with the same width
+        """
+        self._check_width(other)
+        if self.buffered is not None:
+            self.buffered = self.select(other.keys, invert=True).buffered
+            if other.buffered is not None:
+                self.buffered.extend(other.buffered)
+        self._set(other.keys, (other.n, other.mean, other.m2, other.mins,
+                               other.maxs), False)
+
+    def contains(self, keys):
+        """
+        Check which keys have statistics
+
+        :param keys: An array of group keys
+        :return: A boolean array
+        """
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        pos = numpy.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        return found
+
+    def nbytes(self):
+        """
+        The approximate memory used by the statistics, excluding buffered
+        values
+        """
+        return self.keys.nbytes + sum(a.nbytes for a in (
+            self.n, self.mean, self.m2, self.mins, self.maxs))
+
+    def select(self, keys, invert=False):
+        """
+        Get the statistics of some groups
+
+        :param keys: An array of group keys
+        :param invert: If True get all groups except those in keys
+        :return: A new GroupedStats
+        """
+        selected = GroupedStats(self.width, self.buffered is not None)
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        if invert:
+            mask = numpy.in1d(self.keys, keys, invert=True)
+        else:
+            # Binary search so selecting a few groups is cheap
+            ukeys = numpy.unique(keys)
+            pos = numpy.searchsorted(self.keys, ukeys)
+            inrange = pos < len(self.keys)
+            mask = pos[inrange][self.keys[pos[inrange]] == ukeys[inrange]]
+        selected.keys = self.keys[mask]
+        selected.n = self.n[mask]
+        selected.mean = self.mean[mask]
+        selected.m2 = self.m2[mask]
+        selected.mins = self.mins[mask]
+        selected.maxs = self.maxs[mask]
+        if self.buffered is not None:
+            for k, v in self.buffered:
+                m = numpy.in1d(k, keys, invert=invert)
+                if m.any():
+                    selected.buffered.append((k[m], v[m]))
+        return selected
+
+    def median(self):
+        """
+        Calculate the median of each group from the buffered values
+
+        :return: An (ngroups, width) array
+        """
+        if self.buffered is None:
+            raise TableUsageException(
+                'Median requires GroupedStats(buffered=True)')
+        result = numpy.full((len(self.keys), self.width), numpy.nan)
+        if not self.buffered:
+            return result
+        keys = numpy.concatenate([b[0] for b in self.buffered])
+        values = numpy.concatenate([b[1] for b in self.buffered])
+        starts = numpy.searchsorted(keys[numpy.argsort(keys)], self.keys)
+        for j in xrange(self.width):
+            # NaNs are sorted after all other values in each group
+            order = numpy.lexsort((values[:, j], keys))
+            col = values[order, j]
+            n = self.n[:, j].astype(numpy.int64)
+            has = n > 0
+            lo = col[(starts + (n - 1) // 2)[has]]
+            hi = col[(starts + n // 2)[has]]
+            result[has, j] = (lo + hi) / 2
+        return result
+
+    def result(self, funcs):
+        """
+        Calculate reductions
+
+        :param funcs: A list of names from FUNCS
+        :return: An OrderedDict of name: (ngroups, width) array
+        """
+        out = OrderedDict()
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            for f in check_funcs(funcs):
+                if f == 'count':
+                    out[f] = self.n.astype(numpy.int64)
+                elif f == 'sum':
+                    out[f] = self.mean * self.n
+                elif f == 'mean':
+                    out[f] = numpy.where(self.n > 0, self.mean, numpy.nan)
+                elif f == 'var':
+                    out[f] = numpy.where(
+                        self.n > 1, self.m2 / (self.n - 1), numpy.nan)
+                elif f == 'std':
+                    out[f] = numpy.sqrt(numpy.where(
+                        self.n > 1, self.m2 / (self.n - 1), numpy.nan))
+                elif f == 'min':
+                    out[f] = self.mins.copy()
+                elif f == 'max':
+                    out[f] = self.maxs.copy()
+                elif f == 'median':
+                    out[f] = self.median()
+        return out
+
+
+def aggregate_chunks(chunks, width, by='ImageID', funcs=DEFAULT_FUNCS,
+                     cols=None):
+    """
+    Compute grouped statistics over chunks of rows. Rows where the group
+    key is NOID are skipped.
+
+    :param chunks: An iterable of tuples (ids, values)
+    :param width: The number of features in values
+    :param by: The group key, 'ImageID' or 'RoiID'
+    :param funcs: A list of names from FUNCS
+    :param cols: Optional list of feature indices to keep
+    :return: A GroupedStats
+    """
+    key = group_column(by)
+    funcs = check_funcs(funcs)
+    if cols is not None:
+        width = len(cols)
+    stats = GroupedStats(
+        width, buffered=any(f in BUFFERED_FUNCS for f in funcs))
+    for ids, values in chunks:
+        ids = numpy.asarray(ids)
+        keep = ids[:, key] != NOID
+        values = numpy.asarray(values)[keep]
+        if cols is not None:
+            values = values[:, cols]
+        stats.add(ids[keep, key], values)
+    return stats
+
+
+def describe_stats(stats, nrows):
+    """
+    Summarise single-group statistics, see FeatureTable.describe
+
+    :param stats: A GroupedStats with at most one group
+    :param nrows: The number of rows included in stats
+    :return: An OrderedDict of name: array with one value per feature,
+             names are count, nans, mean, std, min and max
+    """
+    r = stats.result(['count', 'mean', 'std', 'min', 'max'])
+    out = OrderedDict()
+    for k, v in r.iteritems():
+        if len(v):
+            out[k] = v[0]
+        elif k == 'count':
+            out[k] = numpy.zeros(stats.width, dtype=numpy.int64)
+        else:
+            out[k] = numpy.full(stats.width, numpy.nan)
+        if k == 'count':
+            out['nans'] = nrows - out[k]
+    return out
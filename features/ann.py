@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+An inverted file (IVF) index for approximate nearest-neighbour search
+
+Rows are assigned to the closest of a set of coarse centroids trained with
+k-means on a sample of the table. A search only reads the rows in the lists
+of the centroids closest to the query.
+"""
+
+from exceptions import OmeroTableException, TableUsageException
+from nearest import check_metric
+
+from cStringIO import StringIO
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Maximum number of rows used to train the centroids
+TRAIN_ROWS = 65536
+
+# Maximum number of lists, the default is the square root of the rows
+MAX_LISTS = 4096
+
+# Default number of lists searched
+NPROBE = 8
+
+KMEANS_ITERATIONS = 10
+
+# Number of rows compared with all centroids at once, limits the size of
+# the (rows, lists) distance matrix
+BLOCK_ROWS = 1024
+
+# Maximum number of inserted rows kept outside the sorted lists, these are
+# scanned by every search until they are merged
+MAX_PENDING_ROWS = 65536
+
+
+def normalise(values, metric):
+    """
+    Scale rows to unit length for the cosine metric, rows of zeros are
+    unchanged
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if metric != 'cosine':
+        return values
+    norms = numpy.sqrt(numpy.einsum('...i,...i->...', values, values))
+    norms = numpy.where(norms > 0, norms, 1)
+    return values / norms[..., numpy.newaxis]
+
+
+def closest_centroids(values, centroids, n=1):
+    """
+    Find the closest centroids to each row
+
+    :param values: An (m, width) array
+    :param centroids: An (nlists, width) array
+    :param n: The number of centroids to return for each row
+    :return: An (m, n) array of centroid indices, closest first
+    """
+    n = min(n, len(centroids))
+    # The squared norm of each row doesn't change the order
+    cnorms = numpy.einsum('ij,ij->i', centroids, centroids)
+    out = numpy.empty((len(values), n), dtype=numpy.int64)
+    for start in xrange(0, len(values), BLOCK_ROWS):
+        stop = start + BLOCK_ROWS
+        d = cnorms - 2 * values[start:stop].dot(centroids.T)
+        if n == 1:
+            out[start:stop, 0] = d.argmin(axis=1)
+            continue
+        best = numpy.argpartition(d, n - 1, axis=1)[:, :n]
+        order = numpy.argsort(
+            numpy.take_along_axis(d, best, axis=1), axis=1)
+        out[start:stop] = numpy.take_along_axis(best, order, axis=1)
+    return out
+
+
+def kmeans(data, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Lloyd's k-means, centroids are initialised from random rows
+
+    :param data: An (n, width) array without NaNs
+    :param k: The number of clusters, reduced to n if necessary
+    :return: A (k, width) array of centroids
+    """
+    rng = numpy.random.RandomState(seed)
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for i in xrange(iterations):
+        labels = closest_centroids(data, centroids)[:, 0]
+        counts = numpy.bincount(labels, minlength=k)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, labels, data)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, numpy.newaxis]
+    return centroids
+
+
+class IvfIndex(object):
+    """
+    Coarse centroids, and the table row numbers in each centroid's list
+    sorted by (list, row). Rows containing NaNs are not indexed.
+
+    Inserted rows are buffered and searched with a linear scan, they are
+    merged into the sorted lists once MAX_PENDING_ROWS are buffered or
+    when the index is serialised.
+    """
+
+    def __init__(self, centroids, metric='euclidean', nrows=0,
+                 list_keys=None, list_rows=None):
+        """
+        :param centroids: An (nlists, width) array
+        :param metric: 'euclidean' or 'cosine'
+        :param nrows: The number of table rows covered by this index
+        """
+        self.centroids = numpy.asarray(centroids, dtype=numpy.float64)
+        self.metric = check_metric(metric)
+        self.nrows = nrows
+        empty = numpy.empty(0, dtype=numpy.int64)
+        self._list_keys = empty if list_keys is None else list_keys
+        self._list_rows = empty if list_rows is None else list_rows
+        # Inserted rows which haven't been merged, a list of (keys, rows)
+        self.pending = []
+        self.npending = 0
+
+    @property
+    def list_keys(self):
+        self._merge_pending()
+        return self._list_keys
+
+    @property
+    def list_rows(self):
+        self._merge_pending()
+        return self._list_rows
+
+    @property
+    def nlists(self):
+        return len(self.centroids)
+
+    @property
+    def width(self):
+        return self.centroids.shape[1]
+
+    @classmethod
+    def train(cls, sample, nlists, metric='euclidean'):
+        """
+        Create an empty index
+
+        :param sample: An (n, width) array of feature values
+        :param nlists: The number of lists
+        :param metric: 'euclidean' or 'cosine'
+        """
+        sample = numpy.asarray(sample, dtype=numpy.float64)
+        sample = sample[~numpy.isnan(sample).any(axis=1)]
+        if not len(sample):
+            raise TableUsageException('No rows to train the index')
+        centroids = kmeans(normalise(sample, metric), nlists)
+        return cls(centroids, metric)
+
+    def _insert(self, rows, values):
+        valid = ~numpy.isnan(values).any(axis=1)
+        rows = rows[valid]
+        if not len(rows):
+            return
+        keys = closest_centroids(
+            normalise(values[valid], self.metric), self.centroids)[:, 0]
+        self.pending.append((keys, rows))
+        self.npending += len(rows)
+        if self.npending >= MAX_PENDING_ROWS:
+            self._merge_pending()
+
+    def _merge_pending(self):
+        if not self.pending:
+            return
+        keys = numpy.concatenate([k for k, r in self.pending])
+        rows = numpy.concatenate([r for k, r in self.pending])
+        self.pending = []
+        self.npending = 0
+        order = numpy.lexsort((rows, keys))
+        keys = keys[order]
+        rows = rows[order]
+        pos = numpy.searchsorted(self._list_keys, keys, side='right')
+        self._list_keys = numpy.insert(self._list_keys, pos, keys)
+        self._list_rows = numpy.insert(self._list_rows, pos, rows)
+
+    def append(self, start, values):
+        """
+        Assign rows appended to the table
+
+        :param start: The row number of the first appended row, must be
+               the number of rows already in the index
+        :param values: An (n, width) array of feature values
+        """
+        if start != self.nrows:
+            raise TableUsageException(
+                'Expected rows starting at %d, got %d' % (self.nrows, start))
+        values = numpy.asarray(values, dtype=numpy.float64)
+        self._insert(
+            numpy.arange(start, start + len(values), dtype=numpy.int64),
+            values)
+        self.nrows += len(values)
+
+    def replace(self, row, values):
+        """
+        Assign a replaced row. The row is also left in its previous list,
+        candidates are always checked against the current values.
+
+        :param row: The row number
+        :param values: The new feature values
+        """
+        self._insert(numpy.array([row], dtype=numpy.int64),
+                     numpy.asarray([values], dtype=numpy.float64))
+
+    def candidates(self, query, nprobe=NPROBE):
+        """
+        Find the rows in the lists closest to a query
+
+        :param query: A feature vector
+        :param nprobe: The number of lists to search
+        :return: A sorted array of unique row numbers
+        """
+        query = normalise(query, self.metric)
+        lists = closest_centroids(
+            query[numpy.newaxis], self.centroids, nprobe)[0]
+        lo = numpy.searchsorted(self._list_keys, lists, side='left')
+        hi = numpy.searchsorted(self._list_keys, lists, side='right')
+        rows = [self._list_rows[a:b] for (a, b) in zip(lo, hi)]
+        rows.extend(r[numpy.in1d(k, lists)] for k, r in self.pending)
+        if not rows:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate(rows))
+
+    def to_bytes(self):
+        """
+        Serialise this index
+        """
+        buf = StringIO()
+        numpy.savez_compressed(
+            buf, nrows=numpy.array(self.nrows),
+            metric=numpy.array(self.metric), centroids=self.centroids,
+            list_keys=self.list_keys, list_rows=self.list_rows)
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserialise an index
+
+        :param data: A string created by to_bytes
+        :return: An IvfIndex
+        """
+        try:
+            npz = numpy.load(StringIO(data))
+            return cls(npz['centroids'], str(npz['metric']),
+                       int(npz['nrows']), npz['list_keys'], npz['list_rows'])
+        except (IOError, KeyError, ValueError) as e:
+            raise OmeroTableException('Invalid ANN index: %s' % e)
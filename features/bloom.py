@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+A Bloom filter of Image and ROI IDs
+
+Answers "does this object definitely not have features?" without a server
+call. False positives are possible, false negatives are not.
+"""
+
+import math
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Default false positive rate
+FALSE_POSITIVE_RATE = 0.01
+
+# Minimum number of keys a filter is sized for
+MIN_CAPACITY = 1024
+
+# Object types are hashed with different seeds so Image 1 and Roi 1 are
+# different keys
+SEEDS = {'Image': 0x9e3779b97f4a7c15, 'Roi': 0xc2b2ae3d27d4eb4f}
+
+_M1 = numpy.uint64(0xbf58476d1ce4e5b9)
+_M2 = numpy.uint64(0x94d049bb133111eb)
+
+
+def _mix(x):
+    # splitmix64 finaliser
+    x = x ^ (x >> numpy.uint64(30))
+    x = x * _M1
+    x = x ^ (x >> numpy.uint64(27))
+    x = x * _M2
+    return x ^ (x >> numpy.uint64(31))
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of (object type, ID) keys using double hashing
+    """
+
+    def __init__(self, capacity, fp_rate=FALSE_POSITIVE_RATE):
+        """
+        :param capacity: The expected number of keys, the false positive
+               rate increases if this is exceeded
+        :param fp_rate: The target false positive rate at capacity
+        """
+        self.capacity = max(int(capacity), MIN_CAPACITY)
+        self.fp_rate = fp_rate
+        nbits = -self.capacity * math.log(fp_rate) / math.log(2) ** 2
+        self.nbits = int(math.ceil(nbits / 8.0)) * 8
+        self.nhashes = max(
+            int(round(self.nbits / float(self.capacity) * math.log(2))), 1)
+        self.bits = numpy.zeros(self.nbits // 8, dtype=numpy.uint8)
+        self.count = 0
+        # The number of table rows included
+        self.nrows = 0
+
+    def _positions(self, object_type, ids):
+        seed = numpy.uint64(SEEDS[object_type])
+        with numpy.errstate(over='ignore'):
+            keys = numpy.asarray(ids, dtype=numpy.int64).astype(numpy.uint64)
+            h1 = _mix(keys ^ seed)
+            h2 = _mix(h1) | numpy.uint64(1)
+            i = numpy.arange(self.nhashes, dtype=numpy.uint64)
+            h = h1[:, numpy.newaxis] + i * h2[:, numpy.newaxis]
+        return (h % numpy.uint64(self.nbits)).astype(numpy.int64)
+
+    def add(self, object_type, ids):
+        """
+        Add keys
+
+        :param object_type: 'Image' or 'Roi'
+        :param ids: A list or array of IDs
+        """
+        ids = numpy.atleast_1d(ids)
+        if not len(ids):
+            return
+        pos = self._positions(object_type, ids).ravel()
+        numpy.bitwise_or.at(
+            self.bits, pos >> 3,
+            numpy.left_shift(1, pos & 7).astype(numpy.uint8))
+        self.count += len(ids)
+
+    def add_rows(self, ids):
+        """
+        Add the Image and ROI IDs of table rows, NOID (-1) is ignored
+
+        :param ids: An (n, 2) array of Image-ID and Roi-ID
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if len(ids):
+            self.add('Image', ids[ids[:, 0] > -1, 0])
+            self.add('Roi', ids[ids[:, 1] > -1, 1])
+        self.nrows += len(ids)
+
+    def might_contain(self, object_type, ids):
+        """
+        Test keys
+
+        :param object_type: 'Image' or 'Roi'
+        :param ids: A list or array of IDs
+        :return: A boolean array, False if a key is definitely absent
+        """
+        ids = numpy.atleast_1d(ids)
+        pos = self._positions(object_type, ids)
+        bits = (self.bits[pos >> 3] >> (pos & 7).astype(numpy.uint8)) & 1
+        return bits.all(axis=1)
+
+    def __contains__(self, key):
+        object_type, object_id = key
+        return bool(self.might_contain(object_type, [object_id])[0])
+
+    @property
+    def full(self):
+        """
+        True if more keys than the capacity have been added
+        """
+        return self.count > self.capacity
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Bulk loading of feature rows into an OMERO.tables feature store
+
+Rows are read from a source in chunks small enough to fit in a single Ice
+message, and each chunk is appended with one addData call per table.
+Progress can be recorded in a checkpoint file so an interrupted load
+resumes after the last committed chunk.
+"""
+
+from exceptions import TableUsageException
+from mmaparrays import MANIFEST_FILE, MemmapFeatureArrays
+from utils import ID_COLUMNS, parallel_map
+
+from abc import ABCMeta, abstractmethod
+import csv
+import itertools
+import json
+import numpy
+import os
+
+from omero.rtypes import unwrap
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class FeatureSource(object):
+    """
+    A source of feature rows for bulk loading
+
+    Subclasses must set names (may be None if unknown), width and nrows
+    (may be None if unknown), and implement iter_chunks
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, name):
+        """
+        :param name: Identifies this source in checkpoint files
+        """
+        self.name = name
+        self.names = None
+        self.width = None
+        self.nrows = None
+
+    @abstractmethod
+    def iter_chunks(self, start, chunk_size):
+        """
+        Iterate through the rows in chunks
+
+        :param start: The first row
+        :param chunk_size: The maximum number of rows in each chunk
+        :return: A generator of tuples (ids, values), an (n, 2) array of
+                 Image-ID and Roi-ID and an (n, width) array of values
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class ArraySource(FeatureSource):
+    """
+    Rows held in a pair of arrays, which may be memory-mapped
+    """
+
+    def __init__(self, ids, values, names=None, name='arrays'):
+        """
+        :param ids: An (n, 2) array of Image-ID and Roi-ID
+        :param values: An (n, width) array of feature values
+        :param names: Optional list of feature names
+        :param name: Identifies this source in checkpoint files
+        """
+        super(ArraySource, self).__init__(name)
+        if len(ids) != len(values):
+            raise TableUsageException(
+                'ids and values must have the same number of rows')
+        self.ids = ids
+        self.values = values
+        self.names = names
+        self.nrows = len(ids)
+        self.width = values.shape[1]
+
+    def iter_chunks(self, start, chunk_size):
+        for n in xrange(start, self.nrows, chunk_size):
+            m = min(n + chunk_size, self.nrows)
+            yield (numpy.asarray(self.ids[n:m], dtype=numpy.int64),
+                   numpy.asarray(self.values[n:m], dtype=numpy.float64))
+
+
+class NpzSource(ArraySource):
+    """
+    A NumPy .npz file containing arrays ids, values and optionally names
+    """
+
+    def __init__(self, path):
+        self.npz = numpy.load(path)
+        names = None
+        if 'names' in self.npz.files:
+            names = [str(n) for n in self.npz['names']]
+        super(NpzSource, self).__init__(
+            self.npz['ids'], self.npz['values'], names, path)
+
+    def close(self):
+        self.npz.close()
+
+
+class MemmapSource(ArraySource):
+    """
+    A MemmapFeatureArrays directory, such as a LocalFeatureStore
+    """
+
+    def __init__(self, path):
+        self.arrays = MemmapFeatureArrays(path)
+        super(MemmapSource, self).__init__(
+            self.arrays.ids, self.arrays.values,
+            self.arrays.manifest.get('names'), path)
+
+    def close(self):
+        self.arrays.close()
+
+
+class HDF5Source(FeatureSource):
+    """
+    An HDF5 file containing datasets of ids and values, feature names are
+    read from the names attribute of the values dataset if present.
+    Requires h5py.
+    """
+
+    def __init__(self, path, ids='ids', values='values'):
+        """
+        :param path: The HDF5 file
+        :param ids: The name of the (n, 2) Image-ID and Roi-ID dataset
+        :param values: The name of the (n, width) feature values dataset
+        """
+        try:
+            import h5py
+        except ImportError:
+            raise TableUsageException('h5py is required to read HDF5 files')
+        super(HDF5Source, self).__init__(path)
+        self.h5 = h5py.File(path, 'r')
+        self.ids = self.h5[ids]
+        self.values = self.h5[values]
+        if len(self.ids) != len(self.values):
+            raise TableUsageException(
+                'ids and values must have the same number of rows')
+        if 'names' in self.values.attrs:
+            self.names = [str(n) for n in self.values.attrs['names']]
+        self.nrows = len(self.ids)
+        self.width = self.values.shape[1]
+
+    def iter_chunks(self, start, chunk_size):
+        for n in xrange(start, self.nrows, chunk_size):
+            m = min(n + chunk_size, self.nrows)
+            yield (numpy.asarray(self.ids[n:m], dtype=numpy.int64),
+                   numpy.asarray(self.values[n:m], dtype=numpy.float64))
+
+    def close(self):
+        self.h5.close()
+
+
+class CSVSource(FeatureSource):
+    """
+    A CSV file with a header row of ImageID, RoiID and the feature names.
+    The file is streamed so the number of rows is unknown, empty values
+    are read as NaN.
+    """
+
+    def __init__(self, path):
+        super(CSVSource, self).__init__(path)
+        with open(path, 'rb') as f:
+            header = next(csv.reader(f))
+        if tuple(header[:2]) != ID_COLUMNS:
+            raise TableUsageException(
+                'Expected CSV header to start with %s' % ','.join(ID_COLUMNS))
+        self.names = header[2:]
+        self.width = len(self.names)
+
+    @staticmethod
+    def _parse(row):
+        return [float(v) if v else float('nan') for v in row]
+
+    def iter_chunks(self, start, chunk_size):
+        with open(self.name, 'rb') as f:
+            reader = csv.reader(f)
+            next(reader)
+            reader = itertools.islice(reader, start, None)
+            while True:
+                rows = [self._parse(r) for r in itertools.islice(
+                    reader, chunk_size)]
+                if not rows:
+                    break
+                rows = numpy.array(rows, dtype=numpy.float64)
+                if rows.shape[1] != self.width + 2:
+                    raise TableUsageException(
+                        'Expected %d columns in %s' % (
+                            self.width + 2, self.name))
+                yield rows[:, :2].astype(numpy.int64), rows[:, 2:]
+
+
+def open_source(path, format=None):
+    """
+    Open a source of feature rows
+
+    :param path: A file or directory
+    :param format: One of 'npz', 'hdf5', 'csv' or 'memmap', default is to
+           guess from the path
+    :return: A FeatureSource
+    """
+    if format is None:
+        ext = os.path.splitext(path)[1].lower()
+        if os.path.exists(os.path.join(path, MANIFEST_FILE)):
+            format = 'memmap'
+        elif ext == '.npz':
+            format = 'npz'
+        elif ext in ('.h5', '.hdf5'):
+            format = 'hdf5'
+        elif ext == '.csv':
+            format = 'csv'
+    sources = {
+        'npz': NpzSource,
+        'hdf5': HDF5Source,
+        'csv': CSVSource,
+        'memmap': MemmapSource,
+    }
+    if format not in sources:
+        raise TableUsageException('Unknown source format: %s' % path)
+    return sources[format](path)
+
+
+class BulkLoader(object):
+    """
+    Append rows from a FeatureSource to a FeatureTable or
+    PartitionedFeatureTable.
+
+    If a checkpoint file is given the number of committed rows is recorded
+    after every chunk, along with the row count of each table. When a load
+    is restarted with the same checkpoint it skips the committed rows, and
+    also any part of the following chunk which was committed before the
+    checkpoint could be written.
+    """
+
+    def __init__(self, store, checkpoint=None, chunk_size=None,
+                 progress=None, annotate=True):
+        """
+        :param store: A FeatureTable or PartitionedFeatureTable
+        :param checkpoint: Optional path to a checkpoint file
+        :param chunk_size: The maximum number of rows per chunk, this will
+               be reduced if necessary to keep within the Ice message limit
+        :param progress: Optional callback progress(rows_loaded, total_rows)
+               called after each chunk, total_rows is None if unknown
+        :param annotate: If True (default) link the tables to the Images
+               and ROIs
+        """
+        self.store = store
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.annotate = annotate
+        self.tables = getattr(store, 'tables', None) or [store]
+        max_rows = store.get_chunk_size()
+        if chunk_size:
+            self.chunk_size = min(chunk_size, max_rows)
+        else:
+            self.chunk_size = max_rows
+
+    def _partition_index(self, image_id):
+        if len(self.tables) > 1:
+            return self.store.partition_index(image_id)
+        return 0
+
+    def table_ids(self):
+        """
+        Get the OriginalFile IDs of the tables
+        """
+        return [unwrap(t.table.getOriginalFile().getId())
+                for t in self.tables]
+
+    def table_rows(self):
+        """
+        Get the number of rows in each table
+        """
+        return [t.table.getNumberOfRows() for t in self.tables]
+
+    def read_checkpoint(self, source):
+        """
+        Read the checkpoint file
+
+        :param source: The FeatureSource
+        :return: The checkpoint dictionary, None if there is no checkpoint
+        """
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        if (state['source'] != source.name or
+                state['tables'] != self.table_ids()):
+            raise TableUsageException(
+                'Checkpoint %s is for a different load' % self.checkpoint)
+        return state
+
+    def write_checkpoint(self, state):
+        """
+        Atomically replace the checkpoint file
+
+        :param state: The checkpoint dictionary
+        """
+        if self.checkpoint:
+            tmp = self.checkpoint + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp, self.checkpoint)
+
+    def load(self, source):
+        """
+        Load all rows from a source
+
+        :param source: A FeatureSource
+        :return: The total number of rows loaded from the source, including
+                 rows loaded before resuming
+        """
+        names = self.store.feature_names()
+        if source.names is not None and list(source.names) != list(names):
+            raise TableUsageException(
+                'Source feature names do not match featureset')
+        if source.width != len(names):
+            raise TableUsageException(
+                'Expected %d features, source has %d' % (
+                    len(names), source.width))
+
+        state = self.read_checkpoint(source)
+        if state:
+            if state['complete']:
+                return state['rows']
+            # Rows committed after the checkpoint was last written
+            pending = [n - m for (n, m) in zip(
+                self.table_rows(), state['table_rows'])]
+        else:
+            state = {
+                'source': source.name,
+                'tables': self.table_ids(),
+                'chunk_size': self.chunk_size,
+                'rows': 0,
+                'table_rows': self.table_rows(),
+                'complete': False,
+            }
+            pending = [0] * len(self.tables)
+            self.write_checkpoint(state)
+
+        for ids, values in source.iter_chunks(
+                state['rows'], state['chunk_size']):
+            groups = {}
+            for n, iid in enumerate(ids[:, 0]):
+                groups.setdefault(self._partition_index(iid), []).append(n)
+
+            for p, rows in groups.items():
+                if pending[p]:
+                    if pending[p] != len(rows):
+                        raise TableUsageException(
+                            'Table %d has %d unexpected rows, unable to '
+                            'resume' % (p, pending[p]))
+                    log.info('Skipping %d rows already in table %d',
+                             pending[p], p)
+                    # The rows may have been committed before they were
+                    # linked, linking is idempotent
+                    if self.annotate:
+                        self.tables[p].annotate_rows(
+                            ids[rows, 0], ids[rows, 1])
+                    state['table_rows'][p] += len(rows)
+                    pending[p] = 0
+                    del groups[p]
+            if any(pending):
+                raise TableUsageException(
+                    'Tables have unexpected rows, unable to resume')
+
+            def append_partition(item):
+                p, rows = item
+                self.tables[p].append_rows(
+                    ids[rows, 0], ids[rows, 1], values[rows], self.annotate)
+
+            parallel_map(append_partition, sorted(groups.items()))
+
+            state['rows'] += len(ids)
+            for p, rows in groups.items():
+                state['table_rows'][p] += len(rows)
+            self.write_checkpoint(state)
+            if self.progress:
+                self.progress(state['rows'], source.nrows)
+
+        state['complete'] = True
+        self.write_checkpoint(state)
+        return state['rows']
+
+
+def load(store, path, format=None, **kwargs):
+    """
+    Load all rows from a file into a feature store
+
+    :param store: A FeatureTable or PartitionedFeatureTable
+    :param path: The source file or directory
+    :param format: The source format, see open_source
+    :param kwargs: Arguments passed to BulkLoader
+    :return: The number of rows loaded
+    """
+    source = open_source(path, format)
+    try:
+        return BulkLoader(store, **kwargs).load(source)
+    finally:
+        source.close()
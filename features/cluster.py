@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Mini-batch k-means clustering of streamed feature rows
+
+Centroids are updated from one batch of rows at a time (Sculley, Web-scale
+k-means clustering), each centroid moves towards the mean of its assigned
+rows with a learning rate of 1 / (rows assigned so far). Only one batch is
+held in memory.
+"""
+
+from exceptions import TableUsageException
+from ann import closest_centroids
+from bulk import BulkLoader, FeatureSource
+
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Default number of rows in each batch
+BATCH_SIZE = 4096
+
+# Default number of passes through the rows
+PASSES = 3
+
+# Stop early if no centroid moves further than this fraction of the mean
+# distance between centroids during a pass
+TOLERANCE = 1e-4
+
+# Feature names of a featureset holding cluster assignments
+ASSIGNMENT_NAMES = ['cluster', 'distance']
+
+
+def kmeans_plusplus(data, k, rng):
+    """
+    Choose initial centroids with the k-means++ algorithm
+
+    :param data: An (n, width) array without NaNs, n >= k
+    :param k: The number of centroids
+    :param rng: A numpy.random.RandomState
+    :return: A (k, width) array
+    """
+    centroids = numpy.empty((k, data.shape[1]))
+    centroids[0] = data[rng.randint(len(data))]
+    d2 = ((data - centroids[0]) ** 2).sum(axis=1)
+    for i in xrange(1, k):
+        total = d2.sum()
+        if total > 0:
+            c = rng.choice(len(data), p=d2 / total)
+        else:
+            c = rng.randint(len(data))
+        centroids[i] = data[c]
+        d2 = numpy.minimum(d2, ((data - centroids[i]) ** 2).sum(axis=1))
+    return centroids
+
+
+class MiniBatchKMeans(object):
+    """
+    Euclidean k-means updated a batch at a time. Rows containing NaNs are
+    ignored.
+    """
+
+    def __init__(self, k, seed=None):
+        """
+        :param k: The number of clusters
+        :param seed: Optional random seed
+        """
+        if k < 1:
+            raise TableUsageException('k must be at least 1: %s' % k)
+        self.k = k
+        self.rng = numpy.random.RandomState(seed)
+        self.centroids = None
+        self.counts = numpy.zeros(k, dtype=numpy.int64)
+        self.pending = []
+
+    @property
+    def fitted(self):
+        return self.centroids is not None
+
+    def _init(self, values):
+        # Rows are buffered until there are enough to choose k centroids
+        self.pending.append(values)
+        data = numpy.concatenate(self.pending)
+        if len(data) < self.k:
+            return None
+        self.pending = []
+        self.centroids = kmeans_plusplus(data, self.k, self.rng)
+        return data
+
+    def partial_fit(self, values):
+        """
+        Update the centroids with a batch of rows
+
+        :param values: An (n, width) array of feature values
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[~numpy.isnan(values).any(axis=1)]
+        if not len(values):
+            return
+        if self.centroids is None:
+            values = self._init(values)
+            if values is None:
+                return
+        labels = closest_centroids(values, self.centroids)[:, 0]
+        n = numpy.bincount(labels, minlength=self.k)
+        sums = numpy.zeros_like(self.centroids)
+        numpy.add.at(sums, labels, values)
+        self.counts += n
+        hit = n > 0
+        # Equivalent to applying the per-row update to each row in turn
+        self.centroids[hit] += (
+            sums[hit] - n[hit, numpy.newaxis] * self.centroids[hit]
+        ) / self.counts[hit, numpy.newaxis]
+
+    def finish(self):
+        """
+        Initialise the centroids from the buffered rows if there were fewer
+        than k rows in total
+
+        :return: The number of clusters
+        """
+        if self.centroids is None:
+            if not self.pending:
+                raise TableUsageException('No rows to cluster')
+            data = numpy.concatenate(self.pending)
+            self.pending = []
+            self.centroids = data.copy()
+            self.counts = numpy.ones(len(data), dtype=numpy.int64)
+            self.k = len(data)
+        return self.k
+
+    def predict(self, values):
+        """
+        Assign rows to the closest centroid
+
+        :param values: An (n, width) array of feature values
+        :return: An array of n cluster indices, and an array of n distances
+                 to the centroid. Rows containing NaNs are assigned to
+                 cluster -1 with a NaN distance.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        labels = numpy.full(len(values), -1, dtype=numpy.int64)
+        dist = numpy.full(len(values), numpy.nan)
+        valid = ~numpy.isnan(values).any(axis=1)
+        if valid.any():
+            v = values[valid]
+            lv = closest_centroids(v, self.centroids)[:, 0]
+            labels[valid] = lv
+            dist[valid] = numpy.sqrt(
+                ((v - self.centroids[lv]) ** 2).sum(axis=1))
+        return labels, dist
+
+
+class AssignmentSource(FeatureSource):
+    """
+    Stream the cluster assignments of the rows of a featureset so they can
+    be bulk loaded into another featureset with ASSIGNMENT_NAMES
+    """
+
+    def __init__(self, store, model, conditions=None, cols=None):
+        """
+        :param store: The clustered feature store
+        :param model: A fitted MiniBatchKMeans
+        :param conditions: Optional query conditions, default all rows
+        :param cols: Optional list of the feature indices used by model
+        """
+        super(AssignmentSource, self).__init__('kmeans')
+        self.store = store
+        self.model = model
+        self.conditions = conditions
+        self.cols = cols
+        self.names = ASSIGNMENT_NAMES
+        self.width = len(ASSIGNMENT_NAMES)
+
+    def iter_chunks(self, start, chunk_size):
+        skip = start
+        for ids, values in self.store.iter_matching_chunks(
+                self.conditions, chunk_size):
+            if skip >= len(ids):
+                skip -= len(ids)
+                continue
+            ids = ids[skip:]
+            values = values[skip:]
+            skip = 0
+            if self.cols is not None:
+                values = values[:, self.cols]
+            labels, dist = self.model.predict(values)
+            yield ids, numpy.column_stack([labels, dist])
+
+
+def kmeans_store(store, k, features=None, conditions=None,
+                 batch_size=BATCH_SIZE, passes=PASSES, shuffle=True,
+                 seed=None, output=None, tolerance=TOLERANCE):
+    """
+    Cluster the rows of a feature store, see FeatureTable.kmeans
+    """
+    cols = store.feature_indices(features)
+    model = MiniBatchKMeans(k, seed)
+    for p in xrange(passes):
+        before = None if model.centroids is None else model.centroids.copy()
+        for ids, values in store.iter_matching_chunks(
+                conditions, batch_size, shuffle and model.rng):
+            if cols is not None:
+                values = values[:, cols]
+            model.partial_fit(values)
+        if before is None:
+            continue
+        shift = numpy.sqrt(((model.centroids - before) ** 2).sum(axis=1))
+        scale = numpy.sqrt(((
+            model.centroids - model.centroids.mean(axis=0)) ** 2).sum(
+                axis=1)).mean()
+        log.debug('k-means pass %d maximum centroid shift %g', p, shift.max())
+        if shift.max() <= tolerance * scale:
+            break
+    model.finish()
+
+    if output is not None:
+        BulkLoader(output, chunk_size=batch_size).load(
+            AssignmentSource(store, model, conditions, cols))
+    return model
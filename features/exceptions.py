@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Exceptions raised by the OMERO.features implementations
+"""
+
+
+class TableStoreException(Exception):
+    """
+    Parent class for exceptions occuring in the OMERO.features tables store
+    implementation
+    """
+    pass
+
+
+class OmeroTableException(TableStoreException):
+    """
+    Errors whilst using the OMERO.tables API
+    """
+    pass
+
+
+class NoTableMatchException(TableStoreException):
+    """
+    No matching annotation was found when searching for a table
+    """
+    pass
+
+
+class TooManyTablesException(TableStoreException):
+    """
+    Too many matching annotation were found when searching for a table
+    """
+    pass
+
+
+class TableUsageException(TableStoreException):
+    """
+    Invalid usage of this implementation of the Features API
+    """
+    pass
+
+
+class FeaturePermissionException(TableStoreException):
+    """
+    Client does not have permission to access a feature table
+    """
+    pass
+
+
+class FeatureRowException(TableStoreException):
+    """
+    Errors in a FeatureRow object
+    """
+    pass
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Export feature rows to local columnar files
+
+Parquet and Arrow IPC files require pyarrow, HDF5 files require h5py.
+Parquet and Arrow files have int64 ImageID and RoiID columns followed by a
+float64 column per feature. HDF5 files have an (n, 2) ids dataset and an
+(n, width) values dataset with the feature names in its names attribute,
+the same layout read by bulk.HDF5Source.
+"""
+
+from exceptions import TableUsageException
+from utils import ID_COLUMNS
+
+import numpy
+import os
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise TableUsageException('pyarrow is required for this format')
+
+
+class ArrowWriter(object):
+    """
+    Write each chunk as an Arrow IPC record batch
+    """
+
+    def __init__(self, path, names):
+        self.pa = _import_pyarrow()
+        self.schema = self.pa.schema(
+            [(n, self.pa.int64()) for n in ID_COLUMNS] +
+            [(n, self.pa.float64()) for n in names])
+        self.writer = self._open(path)
+
+    def _open(self, path):
+        return self.pa.RecordBatchFileWriter(path, self.schema)
+
+    def record_batch(self, ids, values):
+        arrays = [self.pa.array(ids[:, 0]), self.pa.array(ids[:, 1])] + [
+            self.pa.array(values[:, i]) for i in xrange(values.shape[1])]
+        return self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def write(self, ids, values):
+        self.writer.write_batch(self.record_batch(ids, values))
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetWriter(ArrowWriter):
+    """
+    Write each chunk as a Parquet row group
+    """
+
+    def _open(self, path):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise TableUsageException('pyarrow is required for this format')
+        return pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, ids, values):
+        self.writer.write_table(self.pa.Table.from_batches(
+            [self.record_batch(ids, values)]))
+
+
+class HDF5Writer(object):
+    """
+    Append each chunk to resizable ids and values datasets
+    """
+
+    def __init__(self, path, names):
+        try:
+            import h5py
+        except ImportError:
+            raise TableUsageException('h5py is required for this format')
+        self.h5 = h5py.File(path, 'w')
+        width = len(names)
+        self.ids = self.h5.create_dataset(
+            'ids', (0, 2), maxshape=(None, 2), dtype=numpy.int64,
+            chunks=True)
+        self.values = self.h5.create_dataset(
+            'values', (0, width), maxshape=(None, width),
+            dtype=numpy.float64, chunks=True)
+        self.values.attrs['names'] = [str(n) for n in names]
+        self.nrows = 0
+
+    def write(self, ids, values):
+        n = self.nrows + len(ids)
+        self.ids.resize((n, 2))
+        self.values.resize((n, self.values.shape[1]))
+        self.ids[self.nrows:n] = ids
+        self.values[self.nrows:n] = values
+        self.nrows = n
+
+    def close(self):
+        self.h5.close()
+
+
+WRITERS = {
+    'arrow': ArrowWriter,
+    'parquet': ParquetWriter,
+    'hdf5': HDF5Writer,
+}
+
+
+def guess_format(path):
+    """
+    Guess the export format from a file extension
+
+    :param path: The output file
+    :return: 'parquet', 'arrow' or 'hdf5'
+    """
+    ext = os.path.splitext(path)[1].lower()
+    formats = {
+        '.parquet': 'parquet',
+        '.arrow': 'arrow',
+        '.feather': 'arrow',
+        '.h5': 'hdf5',
+        '.hdf5': 'hdf5',
+    }
+    try:
+        return formats[ext]
+    except KeyError:
+        raise TableUsageException('Unknown export format: %s' % path)
+
+
+def export_chunks(chunks, path, names, format=None):
+    """
+    Write chunks of rows to a file, only one chunk is held in memory at a
+    time
+
+    :param chunks: An iterable of tuples (ids, values) where ids is an
+           (n, 2) array of Image-ID and Roi-ID and values is an (n, width)
+           array of feature values
+    :param path: The output file
+    :param names: The feature names
+    :param format: 'parquet', 'arrow' or 'hdf5', default is to guess from
+           the file extension
+    :return: The number of rows written
+    """
+    if format is None:
+        format = guess_format(path)
+    if format not in WRITERS:
+        raise TableUsageException('Unknown export format: %s' % format)
+    writer = WRITERS[format](path, names)
+    nrows = 0
+    try:
+        for ids, values in chunks:
+            writer.write(ids, values)
+            nrows += len(ids)
+            log.debug('Exported %d rows to %s', nrows, path)
+    finally:
+        writer.close()
+    return nrows
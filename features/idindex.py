@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Sorted indexes of table row numbers by ImageID and RoiID
+
+Lookups use a binary search so they take O(log(rows)) instead of a scan
+of the whole table.
+"""
+
+from exceptions import OmeroTableException, TableUsageException
+
+from cStringIO import StringIO
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Maximum number of appended rows kept outside the sorted arrays, these are
+# scanned by every lookup until they are merged
+MAX_PENDING_ROWS = 65536
+
+
+class IdIndex(object):
+    """
+    Two sorted indexes of a table:
+    - image_keys, image_rows: ImageIDs and row numbers sorted by
+      (ImageID, row)
+    - roi_keys, roi_rows: RoiIDs and row numbers sorted by (RoiID, row)
+
+    Appended rows are buffered and merged into the sorted arrays in a
+    single pass once MAX_PENDING_ROWS are buffered, so a series of small
+    appends doesn't copy the whole index each time. Lookups scan the
+    buffered rows.
+    """
+
+    def __init__(self, nrows=0, image_keys=None, image_rows=None,
+                 roi_keys=None, roi_rows=None):
+        """
+        :param nrows: The number of table rows covered by this index
+        """
+        self.nrows = nrows
+        empty = numpy.empty(0, dtype=numpy.int64)
+        self._image_keys = empty if image_keys is None else image_keys
+        self._image_rows = empty if image_rows is None else image_rows
+        self._roi_keys = empty if roi_keys is None else roi_keys
+        self._roi_rows = empty if roi_rows is None else roi_rows
+        # Appended rows which haven't been merged, a list of (n, 2) arrays
+        # starting at row self.merged
+        self.pending = []
+        self.npending = 0
+        self.merged = nrows
+
+    @property
+    def image_keys(self):
+        self._merge_pending()
+        return self._image_keys
+
+    @property
+    def image_rows(self):
+        self._merge_pending()
+        return self._image_rows
+
+    @property
+    def roi_keys(self):
+        self._merge_pending()
+        return self._roi_keys
+
+    @property
+    def roi_rows(self):
+        self._merge_pending()
+        return self._roi_rows
+
+    @staticmethod
+    def _merge(keys, rows, newkeys, newrows):
+        order = numpy.lexsort((newrows, newkeys))
+        newkeys = newkeys[order]
+        newrows = newrows[order]
+        # New rows always follow existing rows with the same key
+        pos = numpy.searchsorted(keys, newkeys, side='right')
+        return (numpy.insert(keys, pos, newkeys),
+                numpy.insert(rows, pos, newrows))
+
+    def _merge_pending(self):
+        if not self.pending:
+            return
+        ids = numpy.concatenate(self.pending)
+        self.pending = []
+        self.npending = 0
+        rows = numpy.arange(
+            self.merged, self.merged + len(ids), dtype=numpy.int64)
+        self._image_keys, self._image_rows = self._merge(
+            self._image_keys, self._image_rows, ids[:, 0], rows)
+        self._roi_keys, self._roi_rows = self._merge(
+            self._roi_keys, self._roi_rows, ids[:, 1], rows)
+        self.merged += len(ids)
+
+    def append(self, start, ids):
+        """
+        Add rows appended to the table to the index
+
+        :param start: The row number of the first appended row, must be
+               the number of rows already in the index
+        :param ids: An (n, 2) array of Image-ID and Roi-ID
+        """
+        if start != self.nrows:
+            raise TableUsageException(
+                'Expected rows starting at %d, got %d' % (self.nrows, start))
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if not len(ids):
+            return
+        self.pending.append(ids.reshape(-1, 2))
+        self.npending += len(ids)
+        self.nrows += len(ids)
+        if self.npending >= MAX_PENDING_ROWS:
+            self._merge_pending()
+
+    @staticmethod
+    def _find(keys, rows, key):
+        lo = numpy.searchsorted(keys, key, side='left')
+        hi = numpy.searchsorted(keys, key, side='right')
+        return rows[lo:hi]
+
+    def lookup(self, object_type, object_id):
+        """
+        Find the rows for an object
+
+        :param object_type: 'Image' or 'Roi'
+        :param object_id: The object ID
+        :return: A sorted array of row numbers
+        """
+        if object_type == 'Image':
+            col = 0
+            rows = self._find(self._image_keys, self._image_rows, object_id)
+        elif object_type == 'Roi':
+            col = 1
+            rows = self._find(self._roi_keys, self._roi_rows, object_id)
+        else:
+            raise TableUsageException(
+                'Unsupported object type: %s' % object_type)
+        if not self.pending:
+            return rows
+        # Buffered rows always follow the merged rows
+        found = [rows]
+        start = self.merged
+        for ids in self.pending:
+            found.append(
+                start + numpy.flatnonzero(ids[:, col] == object_id))
+            start += len(ids)
+        return numpy.concatenate(found)
+
+    def lookup_ids(self, image_id, roi_id):
+        """
+        Find the rows with an Image-ID and Roi-ID
+
+        :return: A sorted array of row numbers
+        """
+        return numpy.intersect1d(
+            self.lookup('Image', image_id), self.lookup('Roi', roi_id))
+
+    def to_bytes(self):
+        """
+        Serialise this index
+        """
+        buf = StringIO()
+        numpy.savez_compressed(
+            buf, nrows=numpy.array(self.nrows),
+            image_keys=self.image_keys, image_rows=self.image_rows,
+            roi_keys=self.roi_keys, roi_rows=self.roi_rows)
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserialise an index
+
+        :param data: A string created by to_bytes
+        :return: An IdIndex
+        """
+        try:
+            npz = numpy.load(StringIO(data))
+            return cls(int(npz['nrows']), npz['image_keys'],
+                       npz['image_rows'], npz['roi_keys'], npz['roi_rows'])
+        except (IOError, KeyError, ValueError) as e:
+            raise OmeroTableException('Invalid ID index: %s' % e)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Materialized aggregates: a featureset holding per-image reductions of
+another featureset, updated when rows are written to the source
+"""
+
+from exceptions import OmeroTableException, TableUsageException
+from utils import NOID
+import aggregate
+
+import json
+import numpy
+import threading
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Sidecar holding the definition of a materialized aggregate featureset
+AGGREGATE_SIDECAR = 'aggregate'
+
+# Maximum number of Images recomputed in a single query
+UPDATE_BATCH_SIZE = 100
+
+# Maximum memory in bytes used for the running statistics of Images, these
+# are kept so appended rows can be merged without reading the source
+MAX_TRACKED_BYTES = 256 * 1024 * 1024
+
+
+def aggregate_names(names, funcs):
+    """
+    Get the feature names of an aggregate featureset
+
+    :param names: The source feature names
+    :param funcs: A list of reductions from aggregate.FUNCS
+    :return: A list of names such as 'mean(x1)', grouped by reduction
+    """
+    return ['%s(%s)' % (f, n) for f in funcs for n in names]
+
+
+class MaterializedAggregate(object):
+    """
+    Keeps an aggregate featureset up to date with its source. Featuresets
+    are looked up through the manager whenever they are needed so this
+    still works if either is closed and reopened.
+
+    The running statistics of recently written Images are kept so that
+    appended rows are merged into them using the pairwise update in
+    aggregate.GroupedStats. The source is only read for Images which
+    aren't tracked, when a row is replaced, or if a reduction such as the
+    median needs all values.
+    """
+
+    def __init__(self, manager, name, ownerid, source_name, source_ownerid,
+                 funcs, features=None):
+        """
+        :param manager: The FeatureTableManager
+        :param name: The aggregate featureset name
+        :param ownerid: The owner of the aggregate featureset
+        :param source_name: The source featureset name
+        :param source_ownerid: The owner of the source featureset
+        :param funcs: A list of reductions from aggregate.FUNCS
+        :param features: Optional list of source feature names, default all
+        """
+        self.manager = manager
+        self.name = name
+        self.ownerid = ownerid
+        self.source_name = source_name
+        self.source_ownerid = source_ownerid
+        self.funcs = aggregate.check_funcs(funcs)
+        self.features = features
+        self.lock = threading.Lock()
+        # GroupedStats of the tracked Images, None if not tracking
+        self.stats = None
+        self.streaming = not any(
+            f in aggregate.BUFFERED_FUNCS for f in self.funcs)
+
+    @property
+    def source(self):
+        return self.manager.get(self.source_name, self.source_ownerid)
+
+    @property
+    def target(self):
+        return self.manager.get(self.name, self.ownerid)
+
+    def definition(self):
+        """
+        The definition stored in the aggregate featureset sidecar
+        """
+        return {
+            'source': self.source_name,
+            'source_ownerid': self.source_ownerid,
+            'funcs': self.funcs,
+            'features': self.features,
+        }
+
+    def save_definition(self):
+        """
+        Write the definition sidecar of the aggregate featureset
+        """
+        self.target.write_sidecar(
+            AGGREGATE_SIDECAR, json.dumps(self.definition()))
+
+    @classmethod
+    def load(cls, manager, target, ownerid):
+        """
+        Read an aggregate definition
+
+        :param manager: The FeatureTableManager
+        :param target: The aggregate featureset
+        :param ownerid: The owner of the aggregate featureset
+        :return: A MaterializedAggregate
+        """
+        data = target.read_sidecar(AGGREGATE_SIDECAR)
+        if not data:
+            raise TableUsageException(
+                'Not an aggregate featureset: %s' % target.name)
+        try:
+            d = json.loads(data)
+            return cls(manager, target.name, ownerid,
+                       d['source'], d['source_ownerid'], d['funcs'],
+                       d['features'])
+        except (KeyError, ValueError) as e:
+            raise OmeroTableException('Invalid aggregate definition: %s' % e)
+
+    def _rows(self, stats):
+        r = stats.result(self.funcs)
+        return numpy.hstack([v.astype(numpy.float64) for v in r.values()])
+
+    def _max_tracked(self, stats):
+        # Each Image holds five float64 statistics per feature and a key
+        return MAX_TRACKED_BYTES // (8 * (5 * stats.width + 1))
+
+    def _track(self, stats):
+        # Replace the running statistics of the Images in stats
+        if not self.streaming:
+            return
+        limit = self._max_tracked(stats)
+        if self.stats is not None:
+            added = (~self.stats.contains(stats.keys)).sum()
+            if len(self.stats.keys) + added <= limit:
+                self.stats.replace(stats)
+                return
+        if len(stats.keys) <= limit:
+            self.stats = stats.select(stats.keys)
+        else:
+            self.stats = None
+
+    def _store(self, target, stats):
+        log.debug('Updating %d aggregate rows in %s',
+                  len(stats.keys), self.name)
+        keys = stats.keys
+        rows = self._rows(stats)
+        chunk_size = target.get_chunk_size()
+        for n in xrange(0, len(keys), chunk_size):
+            m = n + chunk_size
+            target.store_many_by_image(keys[n:m], rows[n:m])
+
+    def rebuild(self):
+        """
+        Compute the aggregates of all Images in the source and append them
+        to the empty aggregate featureset
+        """
+        with self.lock:
+            stats = self.source.group_stats(
+                'ImageID', self.funcs, features=self.features)
+            self._track(stats)
+            target = self.target
+            keys = stats.keys
+            rows = self._rows(stats)
+            chunk_size = target.get_chunk_size()
+            for n in xrange(0, len(keys), chunk_size):
+                m = n + chunk_size
+                target.append_rows(
+                    keys[n:m], [NOID] * len(keys[n:m]), rows[n:m])
+
+    def update(self, image_ids):
+        """
+        Recompute the aggregate rows of some Images
+
+        :param image_ids: A list of Image IDs, NOID is ignored
+        """
+        image_ids = sorted(set(long(i) for i in image_ids if i > NOID))
+        if not image_ids:
+            return
+        with self.lock:
+            source = self.source
+            target = self.target
+            for n in xrange(0, len(image_ids), UPDATE_BATCH_SIZE):
+                batch = image_ids[n:(n + UPDATE_BATCH_SIZE)]
+                conditions = '|'.join('(ImageID==%d)' % i for i in batch)
+                stats = source.group_stats(
+                    'ImageID', self.funcs, conditions, self.features)
+                self._track(stats)
+                self._store(target, stats)
+
+    def merge(self, image_ids, values):
+        """
+        Merge rows appended to the source into the aggregate rows of their
+        Images. Images which aren't tracked are recomputed from the source,
+        which already contains the appended rows.
+
+        :param image_ids: A list of Image IDs, NOID is ignored
+        :param values: A list or 2D array of all source feature values of
+               each row
+        """
+        image_ids = numpy.asarray(image_ids, dtype=numpy.int64)
+        keep = image_ids > NOID
+        if not keep.any():
+            return
+        image_ids = image_ids[keep]
+        values = numpy.asarray(values, dtype=numpy.float64)[keep]
+        with self.lock:
+            if self.stats is None:
+                tracked = numpy.zeros(len(image_ids), dtype=bool)
+            else:
+                tracked = self.stats.contains(image_ids)
+            if tracked.any():
+                cols = self.source.feature_indices(self.features)
+                if cols is not None:
+                    values = values[:, cols]
+                added = aggregate.GroupedStats(self.stats.width)
+                added.add(image_ids[tracked], values[tracked])
+                self.stats.update(added)
+                self._store(self.target, self.stats.select(added.keys))
+        untracked = image_ids[~tracked]
+        if len(untracked):
+            self.update(untracked)
+
+    def source_written(self, image_ids, values, replaced):
+        """
+        Write listener for the source featureset
+        """
+        if replaced or not self.streaming:
+            self.update(image_ids)
+        else:
+            self.merge(image_ids, values)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Appendable memory-mapped feature arrays on local disk
+"""
+
+import json
+import numpy
+import os
+
+import logging
+log = logging.getLogger(__name__)
+
+
+MANIFEST_FILE = 'manifest.json'
+IDS_FILE = 'ids.dat'
+VALUES_FILE = 'values.dat'
+
+IDS_DTYPE = numpy.dtype('<i8')
+VALUES_DTYPE = numpy.dtype('<f8')
+
+
+class MemmapFeatureArrays(object):
+    """
+    A directory holding two memory-mapped arrays with the same number of
+    rows:
+    - ids: an (nrows, 2) int64 array of Image-ID and Roi-ID
+    - values: an (nrows, width) float64 array of feature values
+
+    The arrays are stored as raw little-endian binary files. The number of
+    rows and any other metadata is held in a JSON manifest, which is only
+    updated after the array files have been written so bytes beyond the
+    recorded number of rows (for instance after an interrupted append) are
+    ignored.
+    """
+
+    def __init__(self, path):
+        """
+        Open an existing directory, use create() for a new one
+
+        :param path: The directory
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.width = self.manifest['width']
+        self.ids = None
+        self.values = None
+        self._map()
+
+    @classmethod
+    def create(cls, path, width, **kwargs):
+        """
+        Create an empty set of arrays, overwriting any existing arrays
+
+        :param path: The directory, will be created if necessary
+        :param width: The number of features
+        :param kwargs: Additional metadata to be stored in the manifest
+        :return: A MemmapFeatureArrays object
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        manifest = dict(kwargs)
+        manifest['width'] = width
+        manifest['nrows'] = 0
+        for name in (IDS_FILE, VALUES_FILE):
+            open(os.path.join(path, name), 'wb').close()
+        cls._write_manifest(path, manifest)
+        return cls(path)
+
+    @staticmethod
+    def _write_manifest(path, manifest):
+        tmp = os.path.join(path, MANIFEST_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, os.path.join(path, MANIFEST_FILE))
+
+    def _map(self):
+        n = self.manifest['nrows']
+        if n:
+            self.ids = numpy.memmap(
+                os.path.join(self.path, IDS_FILE), dtype=IDS_DTYPE,
+                mode='r', shape=(n, 2))
+            self.values = numpy.memmap(
+                os.path.join(self.path, VALUES_FILE), dtype=VALUES_DTYPE,
+                mode='r', shape=(n, self.width))
+        else:
+            self.ids = numpy.empty((0, 2), dtype=IDS_DTYPE)
+            self.values = numpy.empty((0, self.width), dtype=VALUES_DTYPE)
+
+    @property
+    def nrows(self):
+        return self.manifest['nrows']
+
+    def __len__(self):
+        return self.nrows
+
+    def update_manifest(self, **kwargs):
+        """
+        Update the metadata stored in the manifest
+
+        :param kwargs: Metadata fields, width and nrows can't be changed
+        """
+        if 'width' in kwargs or 'nrows' in kwargs:
+            raise ValueError('width and nrows can not be set directly')
+        manifest = dict(self.manifest)
+        manifest.update(kwargs)
+        self._write_manifest(self.path, manifest)
+        self.manifest = manifest
+
+    def _write_rows(self, name, arr, dtype, rowbytes, offset, truncate):
+        with open(os.path.join(self.path, name), 'r+b') as f:
+            f.seek(offset * rowbytes)
+            f.write(numpy.ascontiguousarray(arr, dtype=dtype).tostring())
+            if truncate:
+                f.truncate()
+
+    def append(self, ids, values, **kwargs):
+        """
+        Append rows
+
+        :param ids: An (n, 2) array of Image-ID and Roi-ID
+        :param values: An (n, width) array of feature values
+        :param kwargs: Optional metadata to update in the manifest
+        """
+        ids = numpy.asarray(ids, dtype=IDS_DTYPE)
+        values = numpy.asarray(values, dtype=VALUES_DTYPE)
+        if ids.ndim != 2 or ids.shape[1] != 2:
+            raise ValueError('Expected ids with shape (n, 2)')
+        if values.ndim != 2 or values.shape != (len(ids), self.width):
+            raise ValueError(
+                'Expected values with shape (%d, %d)' % (
+                    len(ids), self.width))
+
+        n = self.nrows
+        self._write_rows(IDS_FILE, ids, IDS_DTYPE, 2 * IDS_DTYPE.itemsize,
+                         n, True)
+        self._write_rows(VALUES_FILE, values, VALUES_DTYPE,
+                         self.width * VALUES_DTYPE.itemsize, n, True)
+        self._set_nrows(n + len(ids), **kwargs)
+
+    def update(self, row, ids, values):
+        """
+        Overwrite an existing row
+
+        :param row: The row number
+        :param ids: The Image-ID and Roi-ID
+        :param values: The feature values
+        """
+        if row < 0 or row >= self.nrows:
+            raise IndexError('Row %d out of range' % row)
+        values = numpy.asarray(values, dtype=VALUES_DTYPE)
+        if values.shape != (self.width,):
+            raise ValueError('Expected %d values' % self.width)
+        self._write_rows(IDS_FILE, ids, IDS_DTYPE, 2 * IDS_DTYPE.itemsize,
+                         row, False)
+        self._write_rows(VALUES_FILE, values, VALUES_DTYPE,
+                         self.width * VALUES_DTYPE.itemsize, row, False)
+
+    def truncate(self, nrows=0, **kwargs):
+        """
+        Remove rows from the end of the arrays
+
+        :param nrows: The new number of rows
+        :param kwargs: Optional metadata to update in the manifest
+        """
+        if nrows > self.nrows:
+            raise ValueError('Unable to extend arrays by truncating')
+        self.ids = None
+        self.values = None
+        for name, rowbytes in (
+                (IDS_FILE, 2 * IDS_DTYPE.itemsize),
+                (VALUES_FILE, self.width * VALUES_DTYPE.itemsize)):
+            with open(os.path.join(self.path, name), 'r+b') as f:
+                f.truncate(nrows * rowbytes)
+        self._set_nrows(nrows, **kwargs)
+
+    def _set_nrows(self, nrows, **kwargs):
+        manifest = dict(self.manifest)
+        manifest.update(kwargs)
+        manifest['nrows'] = nrows
+        self._write_manifest(self.path, manifest)
+        self.manifest = manifest
+        self._map()
+
+    def close(self):
+        """
+        Release the memory maps
+        """
+        self.ids = None
+        self.values = None
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Exact k-nearest-neighbour search over feature vectors
+
+Distances to each chunk of rows are computed with a single matrix-vector
+product, and only the best k rows seen so far are kept.
+"""
+
+from exceptions import TableUsageException
+from utils import ID_COLUMNS
+
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+METRICS = ('euclidean', 'cosine')
+
+
+def check_metric(metric):
+    if metric not in METRICS:
+        raise TableUsageException('Unsupported metric: %s' % metric)
+    return metric
+
+
+def distances(values, query, metric='euclidean'):
+    """
+    Calculate the distance from every row to a query vector
+
+    :param values: An (n, width) array of feature values
+    :param query: A vector of length width
+    :param metric: 'euclidean' or 'cosine'
+    :return: An array of n distances, NaN if a row contains a NaN
+    """
+    check_metric(metric)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    query = numpy.asarray(query, dtype=numpy.float64)
+    dots = values.dot(query)
+    sq = numpy.einsum('ij,ij->i', values, values)
+    qq = query.dot(query)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        if metric == 'euclidean':
+            # Rounding can make the squared distance slightly negative
+            return numpy.sqrt(numpy.maximum(sq - 2 * dots + qq, 0))
+        return 1 - dots / numpy.sqrt(sq * qq)
+
+
+class TopK(object):
+    """
+    The k rows with the smallest distances seen so far
+    """
+
+    def __init__(self, k, width=len(ID_COLUMNS)):
+        """
+        :param k: The number of rows to keep
+        :param width: The number of ID columns identifying each row
+        """
+        if k < 1:
+            raise TableUsageException('k must be at least 1: %s' % k)
+        self.k = k
+        self.ids = numpy.empty((0, width), dtype=numpy.int64)
+        self.distances = numpy.empty(0)
+
+    def add(self, ids, distances):
+        """
+        Add candidate rows, rows with a NaN distance are ignored
+
+        :param ids: An (n, width) array, usually Image-ID and Roi-ID
+        :param distances: An array of n distances
+        """
+        keep = ~numpy.isnan(distances)
+        ids = numpy.concatenate([self.ids, numpy.asarray(ids)[keep]])
+        distances = numpy.concatenate([self.distances, distances[keep]])
+        if len(distances) > self.k:
+            best = numpy.argpartition(distances, self.k - 1)[:self.k]
+            ids = ids[best]
+            distances = distances[best]
+        self.ids = ids
+        self.distances = distances
+
+    def result(self):
+        """
+        :return: The IDs and distances sorted by increasing distance
+        """
+        order = numpy.argsort(self.distances, kind='mergesort')
+        return self.ids[order], self.distances[order]
+
+
+def resolve_query(store, query, cols=None):
+    """
+    Get a query vector
+
+    :param store: The feature store
+    :param query: A feature vector, an Image ID, or a tuple
+           (object-type, object-ID) of an object with a single feature row
+    :param cols: Optional list of feature indices to compare
+    :return: The query vector, and a tuple (object-type, object-ID) if the
+             vector was read from the store otherwise None
+    """
+    if isinstance(query, (int, long, numpy.integer)):
+        query = ('Image', query)
+    if (isinstance(query, tuple) and len(query) == 2 and
+            isinstance(query[0], basestring)):
+        rows = store.fetch_by_object(*query)
+        if not rows:
+            raise TableUsageException(
+                'No feature rows found for %s %d' % query)
+        if len(rows) > 1:
+            raise TableUsageException(
+                'Multiple feature rows found for %s %d' % query)
+        vector = numpy.asarray(rows[0][2], dtype=numpy.float64)
+        if cols is not None:
+            vector = vector[cols]
+        return vector, query
+
+    vector = numpy.asarray(query, dtype=numpy.float64)
+    width = len(store.feature_names()) if cols is None else len(cols)
+    if vector.shape != (width,):
+        raise TableUsageException(
+            'Expected a query vector of length %d' % width)
+    return vector, None
+
+
+def nearest_chunks(chunks, query, k, metric='euclidean', cols=None,
+                   exclude=None):
+    """
+    Find the rows closest to a query vector
+
+    :param chunks: An iterable of tuples (ids, values)
+    :param query: The query vector
+    :param k: The number of rows to return
+    :param metric: 'euclidean' or 'cosine'
+    :param cols: Optional list of feature indices to compare
+    :param exclude: Optional tuple (object-type, object-ID) of rows to
+           skip, typically the object the query vector was read from
+    :return: An (n, 2) array of Image-ID and Roi-ID and an array of n
+             distances sorted by increasing distance, n <= k
+    """
+    check_metric(metric)
+    if exclude is not None:
+        excol = ID_COLUMNS.index('%sID' % exclude[0])
+    top = TopK(k)
+    for ids, values in chunks:
+        ids = numpy.asarray(ids)
+        if cols is not None:
+            values = numpy.asarray(values)[:, cols]
+        d = distances(values, query, metric)
+        if exclude is not None:
+            d[ids[:, excol] == exclude[1]] = numpy.nan
+        top.add(ids, d)
+    return top.result()
+
+
+def top_k_chunks(chunks, k, largest=True, width=len(ID_COLUMNS)):
+    """
+    Find the rows with the largest or smallest scores, only the best k
+    rows seen so far are kept
+
+    :param chunks: An iterable of tuples (ids, scores), ids is an
+           (n, width) array identifying each row
+    :param k: The number of rows to return
+    :param largest: If True return the largest scores, otherwise the
+           smallest
+    :param width: The number of ID columns
+    :return: An (n, width) array of IDs and an array of n scores sorted
+             best first, n <= k. NaN scores are ignored.
+    """
+    sign = -1.0 if largest else 1.0
+    top = TopK(k, width)
+    for ids, scores in chunks:
+        top.add(ids, sign * numpy.asarray(scores, dtype=numpy.float64))
+    ids, scores = top.result()
+    return ids, sign * scores
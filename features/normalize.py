@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Normalised views of a featureset
+
+A transform (values - center) / scale is fitted once from streaming
+statistics, and applied in place to each chunk as it is read so a
+normalised copy of the featureset is never held in memory.
+"""
+
+from exceptions import TableUsageException
+
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# zscore: mean and standard deviation
+# minmax: minimum and range, scaled to [0, 1]
+# robust: median and inter-quartile range
+METHODS = ('zscore', 'minmax', 'robust')
+
+# Number of histogram bins used to estimate quantiles, the error is at most
+# (max - min) / HISTOGRAM_BINS
+HISTOGRAM_BINS = 4096
+
+
+def histogram_quantiles(chunks, mins, maxs, qs, bins=HISTOGRAM_BINS):
+    """
+    Estimate quantiles of each feature in a single pass using fixed-width
+    histograms between known minimums and maximums. NaNs are ignored.
+
+    :param chunks: An iterable of tuples (ids, values)
+    :param mins: The minimum of each feature
+    :param maxs: The maximum of each feature
+    :param qs: A list of quantiles between 0 and 1
+    :param bins: The number of histogram bins
+    :return: A (len(qs), width) array, NaN if a feature has no values
+    """
+    mins = numpy.asarray(mins, dtype=numpy.float64)
+    maxs = numpy.asarray(maxs, dtype=numpy.float64)
+    width = len(mins)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        binwidth = numpy.where(maxs > mins, (maxs - mins) / bins, 1)
+    offsets = numpy.arange(width) * bins
+    counts = numpy.zeros(width * bins, dtype=numpy.int64)
+    for ids, values in chunks:
+        valid = ~numpy.isnan(values)
+        with numpy.errstate(invalid='ignore'):
+            b = numpy.floor((values - mins) / binwidth)
+        b = numpy.clip(numpy.nan_to_num(b), 0, bins - 1).astype(numpy.int64)
+        counts += numpy.bincount(
+            (b + offsets)[valid], minlength=width * bins)
+    counts = counts.reshape((width, bins))
+
+    result = numpy.full((len(qs), width), numpy.nan)
+    totals = counts.sum(axis=1)
+    cumulative = numpy.cumsum(counts, axis=1)
+    for j in numpy.flatnonzero(totals):
+        for i, q in enumerate(qs):
+            # Linear interpolation within the bin holding the quantile
+            rank = q * (totals[j] - 1) + 0.5
+            k = min(numpy.searchsorted(cumulative[j], rank), bins - 1)
+            before = cumulative[j, k - 1] if k else 0
+            frac = (rank - before) / counts[j, k]
+            result[i, j] = mins[j] + (k + frac) * binwidth[j]
+    return numpy.clip(result, mins, maxs)
+
+
+class Normalizer(object):
+    """
+    An affine transform (values - center) / scale of each feature
+    """
+
+    def __init__(self, method, center, scale):
+        """
+        :param method: The name of the method used to fit the transform
+        :param center: The value subtracted from each feature
+        :param scale: The divisor of each feature, zeros and NaNs are
+               replaced by 1 so constant features are mapped to 0
+        """
+        self.method = method
+        self.center = numpy.asarray(center, dtype=numpy.float64)
+        scale = numpy.asarray(scale, dtype=numpy.float64)
+        self.scale = numpy.where((scale > 0) & ~numpy.isnan(scale), scale, 1)
+
+    @classmethod
+    def fit(cls, store, method='zscore', features=None):
+        """
+        Fit a transform to a featureset
+
+        :param store: The feature store
+        :param method: One of METHODS
+        :param features: Optional list of feature names, default all
+        """
+        if method not in METHODS:
+            raise TableUsageException(
+                'Unsupported normalisation: %s' % method)
+        d = store.describe(features)
+        if method == 'zscore':
+            return cls(method, d['mean'], d['std'])
+        if method == 'minmax':
+            return cls(method, d['min'], d['max'] - d['min'])
+
+        cols = store.feature_indices(features)
+        chunks = store.iter_matching_chunks()
+        if cols is not None:
+            chunks = ((ids, values[:, cols]) for (ids, values) in chunks)
+        q1, median, q3 = histogram_quantiles(
+            chunks, d['min'], d['max'], [0.25, 0.5, 0.75])
+        return cls(method, median, q3 - q1)
+
+    def apply(self, values):
+        """
+        Transform values in place
+
+        :param values: An (n, width) float64 array
+        :return: values
+        """
+        values -= self.center
+        values /= self.scale
+        return values
+
+    def inverse(self, values):
+        """
+        Reverse the transform in place
+
+        :param values: An (n, width) float64 array
+        :return: values
+        """
+        values *= self.scale
+        values += self.center
+        return values
+
+
+class NormalizedView(object):
+    """
+    Read a featureset with a transform applied to each chunk. The store's
+    iter_matching_chunks must return arrays which aren't shared, they are
+    modified in place.
+    """
+
+    def __init__(self, store, normalizer, features=None):
+        """
+        :param store: The feature store
+        :param normalizer: A Normalizer fitted to the same features
+        :param features: Optional list of feature names, default all
+        """
+        self.store = store
+        self.normalizer = normalizer
+        self.features = features
+        self.cols = store.feature_indices(features)
+
+    def feature_names(self):
+        if self.features is None:
+            return self.store.feature_names()
+        return list(self.features)
+
+    def iter_chunks(self, conditions=None, chunk_size=None):
+        """
+        Iterate through normalised rows in chunks
+
+        :param conditions: Optional query conditions, default all rows
+        :param chunk_size: The maximum number of rows in a chunk
+        :return: A generator of tuples (ids, values)
+        """
+        for ids, values in self.store.iter_matching_chunks(
+                conditions, chunk_size):
+            if self.cols is not None:
+                values = values[:, self.cols]
+            yield ids, self.normalizer.apply(values)
+
+    def read_arrays(self, conditions=None):
+        """
+        Read normalised rows into arrays, the transform is applied in place
+
+        :param conditions: Optional query conditions, default all rows
+        :return: An (n, 2) int64 array of Image-ID and Roi-ID, and an
+                 (n, nfeatures) float64 array of normalised feature values
+        """
+        ids, values = self.store.read_arrays(conditions, self.features)
+        if not values.flags.writeable:
+            # Fancy indexing a read-only memmap returns a read-only array
+            values = values.copy()
+        return ids, self.normalizer.apply(values)
+
+
+def normalized_view(store, method='zscore', features=None):
+    """
+    Fit a transform and create a normalised view of a featureset
+
+    :param store: The feature store
+    :param method: One of METHODS
+    :param features: Optional list of feature names, default all
+    :return: A NormalizedView
+    """
+    normalizer = Normalizer.fit(store, method, features)
+    return NormalizedView(store, normalizer, features)
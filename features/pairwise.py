@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Blocked pairwise row distances and feature correlations
+
+Rows are streamed from the server once into local memory-mapped arrays.
+The distance matrix is then computed a pair of row blocks at a time with
+matrix products, and each output block is written to a memory-mapped
+file so neither the rows nor the result need to fit in memory.
+"""
+
+from exceptions import TableUsageException
+from mmaparrays import MemmapFeatureArrays
+from nearest import check_metric
+from pca import Covariance
+
+import numpy
+import os
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Default number of rows in each block, two blocks and a block of output
+# are held in memory
+BLOCK_ROWS = 2048
+
+# Sub-directory holding the local copy of the rows
+ROWS_DIR = 'rows'
+
+# Raw little-endian (nrows, nrows) float64 distance matrix
+DISTANCES_FILE = 'distances.dat'
+
+
+def distance_block(a, b, metric='euclidean'):
+    """
+    Calculate the distance between every pair of rows from two blocks
+
+    :param a: An (m, width) array
+    :param b: An (n, width) array
+    :param metric: 'euclidean' or 'cosine'
+    :return: An (m, n) array, NaN if either row contains a NaN
+    """
+    check_metric(metric)
+    dots = a.dot(b.T)
+    asq = numpy.einsum('ij,ij->i', a, a)
+    bsq = numpy.einsum('ij,ij->i', b, b)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        if metric == 'euclidean':
+            # Rounding can make the squared distance slightly negative
+            d2 = asq[:, numpy.newaxis] - 2 * dots + bsq
+            return numpy.sqrt(numpy.maximum(d2, 0))
+        return 1 - dots / numpy.sqrt(numpy.outer(asq, bsq))
+
+
+def pairwise_distances(chunks, width, path, metric='euclidean',
+                       block_rows=BLOCK_ROWS, cols=None):
+    """
+    Calculate the distance between every pair of rows
+
+    :param chunks: An iterable of tuples (ids, values)
+    :param width: The number of features in each row after selecting cols
+    :param path: A directory for the output, existing results are
+           overwritten
+    :param metric: 'euclidean' or 'cosine'
+    :param block_rows: The number of rows in each block
+    :param cols: Optional list of feature indices to compare
+    :return: An (n, 2) array of Image-ID and Roi-ID and an (n, n)
+             read-only memory-mapped array of distances, in the order rows
+             were read
+    """
+    check_metric(metric)
+    rows = MemmapFeatureArrays.create(
+        os.path.join(path, ROWS_DIR), width, metric=metric)
+    for ids, values in chunks:
+        if cols is not None:
+            values = numpy.asarray(values)[:, cols]
+        rows.append(ids, values)
+
+    n = rows.nrows
+    filename = os.path.join(path, DISTANCES_FILE)
+    if not n:
+        open(filename, 'wb').close()
+        return rows.ids, numpy.empty((0, 0))
+
+    out = numpy.memmap(filename, dtype='<f8', mode='w+', shape=(n, n))
+    values = rows.values
+    for i in xrange(0, n, block_rows):
+        a = numpy.array(values[i:(i + block_rows)])
+        ni = i + len(a)
+        for j in xrange(i, n, block_rows):
+            b = a if j == i else numpy.array(values[j:(j + block_rows)])
+            nj = j + len(b)
+            d = distance_block(a, b, metric)
+            if j == i:
+                # Exact zeros on the diagonal for rows without NaNs
+                diag = numpy.arange(len(a))
+                d[diag, diag] = numpy.where(
+                    numpy.isnan(d[diag, diag]), numpy.nan, 0)
+            out[i:ni, j:nj] = d
+            if j != i:
+                out[j:nj, i:ni] = d.T
+        log.debug('Pairwise distances: rows %d-%d of %d', i, ni, n)
+    out.flush()
+    del out
+    return rows.ids, numpy.memmap(
+        filename, dtype='<f8', mode='r', shape=(n, n))
+
+
+def feature_correlation(chunks, cols=None):
+    """
+    Calculate the Pearson correlation between every pair of features by
+    accumulating the covariance matrix a chunk at a time. Rows containing
+    NaNs are ignored.
+
+    :param chunks: An iterable of tuples (ids, values)
+    :param cols: Optional list of feature indices
+    :return: A (width, width) array, NaN for constant features
+    """
+    cov = None
+    for ids, values in chunks:
+        if cols is not None:
+            values = numpy.asarray(values)[:, cols]
+        if cov is None:
+            cov = Covariance(values.shape[1])
+        cov.add(values)
+    if cov is None:
+        raise TableUsageException('No rows to correlate')
+    c = cov.covariance()
+    std = numpy.sqrt(numpy.diag(c))
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        r = c / numpy.outer(std, std)
+    return numpy.clip(r, -1, 1)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Principal component analysis of a featureset in a single streaming pass
+
+The mean and scatter matrix of each chunk are merged using the pairwise
+update of Chan et al., so only a (width, width) matrix is held in memory.
+The principal components are the eigenvectors of the covariance matrix.
+"""
+
+from exceptions import OmeroTableException, TableUsageException
+
+from cStringIO import StringIO
+import json
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Covariance(object):
+    """
+    The count, mean and scatter matrix of rows without NaNs
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.n = 0
+        self.mean = numpy.zeros(width)
+        self.scatter = numpy.zeros((width, width))
+
+    def add(self, values):
+        """
+        Add a chunk of rows, rows containing NaNs are ignored
+
+        :param values: An (n, width) array of feature values
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[~numpy.isnan(values).any(axis=1)]
+        nb = len(values)
+        if not nb:
+            return
+        mb = values.mean(axis=0)
+        dev = values - mb
+        total = self.n + nb
+        delta = mb - self.mean
+        frac = nb / float(total)
+        self.scatter += dev.T.dot(dev)
+        self.scatter += numpy.outer(delta, delta) * (self.n * frac)
+        self.mean += delta * frac
+        self.n = total
+
+    def covariance(self):
+        """
+        :return: The (width, width) sample covariance matrix
+        """
+        if self.n < 2:
+            raise TableUsageException(
+                'At least 2 rows without NaNs are required')
+        return self.scatter / (self.n - 1)
+
+
+class Pca(object):
+    """
+    A fitted projection onto the principal components
+    """
+
+    def __init__(self, mean, components, explained_variance, total_variance,
+                 nrows, features=None):
+        """
+        :param mean: The mean of each feature
+        :param components: An (n_components, width) array of unit vectors,
+               in order of decreasing variance
+        :param explained_variance: The variance along each component
+        :param total_variance: The sum of the variances of all features
+        :param nrows: The number of rows used to fit the projection
+        :param features: The feature names, None for all features
+        """
+        self.mean = numpy.asarray(mean, dtype=numpy.float64)
+        self.components = numpy.asarray(components, dtype=numpy.float64)
+        self.explained_variance = numpy.asarray(
+            explained_variance, dtype=numpy.float64)
+        self.total_variance = float(total_variance)
+        self.nrows = nrows
+        self.features = features
+
+    @property
+    def n_components(self):
+        return len(self.components)
+
+    @property
+    def explained_variance_ratio(self):
+        if not self.total_variance:
+            return numpy.zeros(self.n_components)
+        return self.explained_variance / self.total_variance
+
+    @classmethod
+    def fit(cls, chunks, n_components, cols=None, features=None):
+        """
+        Fit a projection
+
+        :param chunks: An iterable of tuples (ids, values)
+        :param n_components: The number of components to keep
+        :param cols: Optional list of feature indices to use
+        :param features: The names of the features in cols
+        :return: A Pca
+        """
+        cov = None
+        for ids, values in chunks:
+            if cols is not None:
+                values = numpy.asarray(values)[:, cols]
+            if cov is None:
+                cov = Covariance(values.shape[1])
+            cov.add(values)
+        if cov is None:
+            raise TableUsageException('No rows to fit')
+        if not 1 <= n_components <= cov.width:
+            raise TableUsageException(
+                'n_components must be between 1 and %d' % cov.width)
+        c = cov.covariance()
+        # eigh returns eigenvalues in increasing order
+        evals, evecs = numpy.linalg.eigh(c)
+        order = numpy.argsort(evals)[::-1][:n_components]
+        components = evecs[:, order].T
+        # Make the signs deterministic, largest loading positive
+        signs = numpy.sign(components[
+            numpy.arange(n_components), numpy.abs(components).argmax(axis=1)])
+        components *= signs[:, numpy.newaxis]
+        log.debug('PCA fitted on %d rows', cov.n)
+        return cls(cov.mean, components, numpy.maximum(evals[order], 0),
+                   numpy.trace(c), cov.n, features)
+
+    def transform(self, values):
+        """
+        Project rows onto the components, rows with NaNs are all NaN
+
+        :param values: An (n, width) array of feature values
+        :return: An (n, n_components) array
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        return (values - self.mean).dot(self.components.T)
+
+    def to_bytes(self):
+        """
+        Serialise this projection
+        """
+        buf = StringIO()
+        numpy.savez_compressed(
+            buf, mean=self.mean, components=self.components,
+            explained_variance=self.explained_variance,
+            total_variance=numpy.array(self.total_variance),
+            nrows=numpy.array(self.nrows),
+            features=numpy.array(json.dumps(self.features)))
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserialise a projection
+
+        :param data: A string created by to_bytes
+        :return: A Pca
+        """
+        try:
+            npz = numpy.load(StringIO(data))
+            return cls(npz['mean'], npz['components'],
+                       npz['explained_variance'],
+                       float(npz['total_variance']), int(npz['nrows']),
+                       json.loads(str(npz['features'])))
+        except (IOError, KeyError, ValueError) as e:
+            raise OmeroTableException('Invalid PCA projection: %s' % e)
+
+
+def project_chunks(model, chunks, cols=None):
+    """
+    Project chunks of rows, only the reduced vectors are kept
+
+    :param model: A Pca
+    :param chunks: An iterable of tuples (ids, values)
+    :param cols: Optional list of the feature indices used by model
+    :return: An (n, 2) int64 array of Image-ID and Roi-ID, and an
+             (n, n_components) float64 array
+    """
+    allids = [numpy.empty((0, 2), dtype=numpy.int64)]
+    reduced = [numpy.empty((0, model.n_components))]
+    for ids, values in chunks:
+        if cols is not None:
+            values = numpy.asarray(values)[:, cols]
+        allids.append(numpy.asarray(ids))
+        reduced.append(model.transform(values))
+    return numpy.concatenate(allids), numpy.concatenate(reduced)
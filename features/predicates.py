@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Predicates over feature values and IDs
+
+All features are stored in a single DoubleArrayColumn so conditions on
+individual features can't be evaluated by OMERO.tables. A predicate is an
+expression tree which is split into conditions on ImageID and RoiID, passed
+to getWhereList, and conditions on features which are evaluated locally on
+each chunk of rows.
+
+Predicates can be built in Python:
+
+    (col('x0012') > 0.5) & (col('x0100') < 3) & (ImageID == 10)
+
+or parsed from a string, where feature names that aren't valid identifiers
+can be referenced with col():
+
+    parse("x0012 > 0.5 and col('Mean Intensity') < 3 and ImageID == 10")
+"""
+
+from exceptions import TableUsageException
+from utils import ID_COLUMNS
+
+from abc import ABCMeta, abstractmethod
+import ast
+import numpy
+import operator
+
+
+class Expr(object):
+    """
+    A node in a predicate expression tree
+    """
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def columns(self):
+        """
+        Get the names of all columns referenced by this expression
+        """
+        pass
+
+    @abstractmethod
+    def evaluate(self, env):
+        """
+        Evaluate this expression on a chunk of rows
+
+        :param env: A function mapping a column name to an array
+        :return: An array
+        """
+        pass
+
+    @abstractmethod
+    def condition(self):
+        """
+        Convert this expression to an OMERO.tables condition, only valid
+        for expressions which only reference ImageID and RoiID
+        """
+        pass
+
+    def is_id_only(self):
+        return set(self.columns()).issubset(ID_COLUMNS)
+
+    def __nonzero__(self):
+        raise TypeError(
+            'Predicates can not be used as booleans, use &, | and ~ '
+            'instead of and, or and not')
+
+    def __lt__(self, o):
+        return BinOp('<', self, o)
+
+    def __le__(self, o):
+        return BinOp('<=', self, o)
+
+    def __gt__(self, o):
+        return BinOp('>', self, o)
+
+    def __ge__(self, o):
+        return BinOp('>=', self, o)
+
+    def __eq__(self, o):
+        return BinOp('==', self, o)
+
+    def __ne__(self, o):
+        return BinOp('!=', self, o)
+
+    def __and__(self, o):
+        return BinOp('&', self, o)
+
+    def __rand__(self, o):
+        return BinOp('&', o, self)
+
+    def __or__(self, o):
+        return BinOp('|', self, o)
+
+    def __ror__(self, o):
+        return BinOp('|', o, self)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __add__(self, o):
+        return BinOp('+', self, o)
+
+    def __radd__(self, o):
+        return BinOp('+', o, self)
+
+    def __sub__(self, o):
+        return BinOp('-', self, o)
+
+    def __rsub__(self, o):
+        return BinOp('-', o, self)
+
+    def __mul__(self, o):
+        return BinOp('*', self, o)
+
+    def __rmul__(self, o):
+        return BinOp('*', o, self)
+
+    def __div__(self, o):
+        return BinOp('/', self, o)
+
+    def __rdiv__(self, o):
+        return BinOp('/', o, self)
+
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+
+    def __neg__(self):
+        return BinOp('-', Const(0), self)
+
+    __hash__ = object.__hash__
+
+
+class Column(Expr):
+    """
+    A feature, ImageID or RoiID column
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def columns(self):
+        return [self.name]
+
+    def evaluate(self, env):
+        return env(self.name)
+
+    def condition(self):
+        if self.name not in ID_COLUMNS:
+            raise TableUsageException(
+                'Feature %s can not be queried by the server' % self.name)
+        return self.name
+
+    def __repr__(self):
+        return 'col(%r)' % self.name
+
+
+class Const(Expr):
+    """
+    A numeric constant
+    """
+
+    def __init__(self, value):
+        if isinstance(value, bool) or not isinstance(
+                value, (int, long, float)):
+            raise TableUsageException('Invalid constant: %r' % (value,))
+        self.value = value
+
+    def columns(self):
+        return []
+
+    def evaluate(self, env):
+        return self.value
+
+    def condition(self):
+        if isinstance(self.value, float):
+            return repr(self.value)
+        return str(self.value)
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '&': operator.and_,
+    '|': operator.or_,
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+
+
+def _expr(x):
+    if isinstance(x, Expr):
+        return x
+    return Const(x)
+
+
+class BinOp(Expr):
+    """
+    A binary operation
+    """
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = _expr(left)
+        self.right = _expr(right)
+
+    def columns(self):
+        return self.left.columns() + self.right.columns()
+
+    def evaluate(self, env):
+        return OPERATORS[self.op](
+            self.left.evaluate(env), self.right.evaluate(env))
+
+    def condition(self):
+        return '(%s%s%s)' % (
+            self.left.condition(), self.op, self.right.condition())
+
+    def __repr__(self):
+        return '(%r %s %r)' % (self.left, self.op, self.right)
+
+
+class Not(Expr):
+    """
+    Logical negation
+    """
+
+    def __init__(self, expr):
+        self.expr = _expr(expr)
+
+    def columns(self):
+        return self.expr.columns()
+
+    def evaluate(self, env):
+        return ~numpy.asarray(self.expr.evaluate(env), dtype=bool)
+
+    def condition(self):
+        return '(~%s)' % self.expr.condition()
+
+    def __repr__(self):
+        return '~%r' % self.expr
+
+
+def col(name):
+    """
+    Reference a feature by name, or the ImageID or RoiID columns
+    """
+    return Column(name)
+
+
+ImageID = col('ImageID')
+RoiID = col('RoiID')
+
+
+_AST_OPERATORS = {
+    ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=', ast.Eq: '==',
+    ast.NotEq: '!=', ast.BitAnd: '&', ast.BitOr: '|', ast.Add: '+',
+    ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+}
+
+
+def _convert(node):
+    if isinstance(node, ast.BoolOp):
+        op = '&' if isinstance(node.op, ast.And) else '|'
+        return reduce(lambda a, b: BinOp(op, a, b), map(_convert, node.values))
+    if isinstance(node, ast.Compare):
+        # Chained comparisons a < b < c are (a < b) & (b < c)
+        terms = [_convert(node.left)] + map(_convert, node.comparators)
+        cmps = [BinOp(_AST_OPERATORS[type(op)], a, b) for (op, a, b) in zip(
+            node.ops, terms[:-1], terms[1:]) if type(op) in _AST_OPERATORS]
+        if len(cmps) != len(node.ops):
+            raise TableUsageException('Unsupported comparison')
+        return reduce(lambda a, b: BinOp('&', a, b), cmps)
+    if isinstance(node, ast.BinOp) and type(node.op) in _AST_OPERATORS:
+        return BinOp(_AST_OPERATORS[type(node.op)], _convert(node.left),
+                     _convert(node.right))
+    if isinstance(node, ast.UnaryOp):
+        if isinstance(node.op, (ast.Not, ast.Invert)):
+            return Not(_convert(node.operand))
+        if isinstance(node.op, ast.USub):
+            return -_convert(node.operand)
+        if isinstance(node.op, ast.UAdd):
+            return _convert(node.operand)
+    if isinstance(node, ast.Num):
+        return Const(node.n)
+    if isinstance(node, ast.Name):
+        return Column(node.id)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+            node.func.id == 'col' and len(node.args) == 1 and
+            isinstance(node.args[0], ast.Str) and not node.keywords):
+        return Column(node.args[0].s)
+    raise TableUsageException(
+        'Unsupported expression: %s' % type(node).__name__)
+
+
+def parse(text):
+    """
+    Parse a predicate string
+
+    :param text: A Python-like expression using feature names, ImageID,
+           RoiID, col('feature name'), numbers, comparisons, arithmetic
+           and the and, or, not, &, | and ~ operators
+    :return: An Expr
+    """
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError:
+        raise TableUsageException('Invalid predicate: %s' % text)
+    return _convert(tree.body)
+
+
+def as_predicate(predicate):
+    """
+    Convert a string to a predicate, predicates are returned unchanged
+    """
+    if isinstance(predicate, basestring):
+        return parse(predicate)
+    if not isinstance(predicate, Expr):
+        raise TableUsageException('Invalid predicate: %r' % (predicate,))
+    return predicate
+
+
+def conjuncts(expr):
+    """
+    Split an expression into terms which are combined with &
+    """
+    if isinstance(expr, BinOp) and expr.op == '&':
+        return conjuncts(expr.left) + conjuncts(expr.right)
+    return [expr]
+
+
+def split(predicate):
+    """
+    Split a predicate into a server-side condition on ImageID and RoiID,
+    and a local predicate on features
+
+    :param predicate: A predicate or predicate string
+    :return: A tuple (condition, expr), condition is an OMERO.tables
+             condition string or None, expr is an Expr or None
+    """
+    terms = conjuncts(as_predicate(predicate))
+    server = [t for t in terms if t.is_id_only() and t.columns()]
+    local = [t for t in terms if not (t.is_id_only() and t.columns())]
+    condition = None
+    expr = None
+    if server:
+        condition = ' & '.join(t.condition() for t in server)
+    if local:
+        expr = reduce(lambda a, b: BinOp('&', a, b), local)
+    return condition, expr
+
+
+def evaluate(expr, ids, values, names):
+    """
+    Evaluate a predicate on a chunk of rows
+
+    :param expr: An Expr
+    :param ids: An (n, 2) array of Image-ID and Roi-ID
+    :param values: An (n, width) array of feature values
+    :param names: The width feature names
+    :return: A boolean array of length n
+    """
+    lookup = dict((n, i) for (i, n) in enumerate(names))
+
+    def env(name):
+        if name in ID_COLUMNS:
+            return ids[:, ID_COLUMNS.index(name)]
+        try:
+            return values[:, lookup[name]]
+        except KeyError:
+            raise TableUsageException('Unknown feature: %s' % name)
+
+    mask = numpy.zeros(len(ids), dtype=bool)
+    mask[:] = expr.evaluate(env)
+    return mask
+
+
+def filter_chunks(chunks, expr, names, cols=None):
+    """
+    Apply a predicate to chunks of rows keeping only the matching rows
+
+    :param chunks: An iterable of tuples (ids, values)
+    :param expr: An Expr or None to keep all rows
+    :param names: The feature names
+    :param cols: Optional list of feature indices to return
+    :return: An (n, 2) array of Image-ID and Roi-ID, and an (n, nfeatures)
+             array of feature values of the matching rows
+    """
+    width = len(names) if cols is None else len(cols)
+    matched_ids = [numpy.empty((0, 2), dtype=numpy.int64)]
+    matched_values = [numpy.empty((0, width), dtype=numpy.float64)]
+    for ids, values in chunks:
+        if expr is not None:
+            mask = evaluate(expr, ids, values, names)
+            ids = ids[mask]
+            values = values[mask]
+        if cols is not None:
+            values = values[:, cols]
+        matched_ids.append(ids)
+        matched_values.append(values)
+    return (numpy.concatenate(matched_ids),
+            numpy.concatenate(matched_values))
@@ -26,6 +26,40 @@ OMERO.features utility methods
 import omero
 from omero.rtypes import rdouble, rint, rstring, unwrap
 
+from multiprocessing.pool import ThreadPool
+
+
+# Indicates the object ID is unknown
+NOID = -1
+
+# The ID columns, the only columns which can be used in query conditions
+ID_COLUMNS = ('ImageID', 'RoiID')
+
+# Maximum number of concurrent server calls when fanning out requests
+MAX_THREADS = 8
+
+
+def parallel_map(func, items, nthreads=MAX_THREADS):
+    """
+    Call func on every item, using multiple threads if there is more than
+    one item. Each call is expected to spend most of its time waiting for
+    the server.
+
+    :param func: A function taking a single argument
+    :param items: A list of arguments
+    :param nthreads: The maximum number of threads
+    :return: A list of results in the same order as items
+    """
+    nthreads = min(nthreads, len(items))
+    if nthreads < 2:
+        return map(func, items)
+    pool = ThreadPool(nthreads)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
 
 def create_roi_for_plane(session, iid, z, c, t, robject=False):
     """
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Zone maps: the minimum and maximum of every column in each fixed-size
+block (zone) of table rows
+
+A zone map is used to skip zones which can't contain rows matching a
+predicate. Bounds are conservative: they may be wider than the data (for
+instance after a row is replaced) but never narrower.
+"""
+
+from exceptions import OmeroTableException
+from predicates import BinOp, Column, Const, Not
+from utils import ID_COLUMNS
+
+from cStringIO import StringIO
+import numpy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Default number of rows in a zone
+ZONE_ROWS = 4096
+
+# Comparison operators with the operands swapped
+_FLIPPED = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '==', '!=': '!='}
+
+
+class ZoneMap(object):
+    """
+    Per-zone minimum, maximum and NaN flags for the ImageID, RoiID and
+    feature columns of a table
+    """
+
+    def __init__(self, zone_rows, width, nrows=0, mins=None, maxs=None,
+                 nans=None):
+        """
+        :param zone_rows: The number of rows in each zone
+        :param width: The number of features
+        :param nrows: The number of table rows covered by this zone map
+        :param mins: (nzones, width + 2) array of minimums, NaN if a zone
+               column only contains NaNs
+        :param maxs: (nzones, width + 2) array of maximums
+        :param nans: (nzones, width + 2) boolean array, True if a zone
+               column contains a NaN
+        """
+        self.zone_rows = zone_rows
+        self.width = width
+        self.nrows = nrows
+        ncols = width + len(ID_COLUMNS)
+        if mins is None:
+            mins = numpy.empty((0, ncols), dtype=numpy.float64)
+            maxs = numpy.empty((0, ncols), dtype=numpy.float64)
+            nans = numpy.empty((0, ncols), dtype=bool)
+        self.mins = mins
+        self.maxs = maxs
+        self.nans = nans
+
+    @property
+    def nzones(self):
+        return len(self.mins)
+
+    def add(self, start, ids, values):
+        """
+        Include rows in the zone map, either new rows or replacements for
+        existing rows
+
+        :param start: The row number of the first row
+        :param ids: An (n, 2) array of Image-ID and Roi-ID
+        :param values: An (n, width) array of feature values
+        """
+        n = len(ids)
+        if not n:
+            return
+        data = numpy.empty((n, self.width + len(ID_COLUMNS)))
+        data[:, :2] = ids
+        data[:, 2:] = values
+
+        stop = start + n
+        nzones = (stop + self.zone_rows - 1) // self.zone_rows
+        if nzones > self.nzones:
+            extra = nzones - self.nzones
+            shape = (extra, self.mins.shape[1])
+            self.mins = numpy.concatenate(
+                [self.mins, numpy.full(shape, numpy.nan)])
+            self.maxs = numpy.concatenate(
+                [self.maxs, numpy.full(shape, numpy.nan)])
+            self.nans = numpy.concatenate(
+                [self.nans, numpy.zeros(shape, dtype=bool)])
+
+        for z in xrange(start // self.zone_rows, nzones):
+            a = max(z * self.zone_rows, start) - start
+            b = min((z + 1) * self.zone_rows, stop) - start
+            block = data[a:b]
+            # fmin and fmax ignore NaNs unless both arguments are NaN
+            self.mins[z] = numpy.fmin(
+                self.mins[z], numpy.fmin.reduce(block, axis=0))
+            self.maxs[z] = numpy.fmax(
+                self.maxs[z], numpy.fmax.reduce(block, axis=0))
+            self.nans[z] |= numpy.isnan(block).any(axis=0)
+        self.nrows = max(self.nrows, stop)
+
+    def _column(self, name, lookup):
+        if name in ID_COLUMNS:
+            i = ID_COLUMNS.index(name)
+        else:
+            i = lookup.get(name)
+            if i is None:
+                return None
+            i += len(ID_COLUMNS)
+        return self.mins[:, i], self.maxs[:, i], self.nans[:, i]
+
+    def _compare(self, op, stats, c):
+        mins, maxs, nans = stats
+        nonan = ~nans
+        if op == '>':
+            return maxs > c, (mins > c) & nonan
+        if op == '>=':
+            return maxs >= c, (mins >= c) & nonan
+        if op == '<':
+            return mins < c, (maxs < c) & nonan
+        if op == '<=':
+            return mins <= c, (maxs <= c) & nonan
+        equal = (mins == c) & (maxs == c)
+        if op == '==':
+            return (mins <= c) & (maxs >= c), equal & nonan
+        if op == '!=':
+            return ~equal | nans, ((c < mins) | (c > maxs)) & nonan
+        return None
+
+    def _match(self, expr, lookup):
+        unknown = (numpy.ones(self.nzones, dtype=bool),
+                   numpy.zeros(self.nzones, dtype=bool))
+        if isinstance(expr, Not):
+            may, must = self._match(expr.expr, lookup)
+            return ~must, ~may
+        if not isinstance(expr, BinOp):
+            return unknown
+        if expr.op in ('&', '|'):
+            lmay, lmust = self._match(expr.left, lookup)
+            rmay, rmust = self._match(expr.right, lookup)
+            if expr.op == '&':
+                return lmay & rmay, lmust & rmust
+            return lmay | rmay, lmust | rmust
+
+        op, left, right = expr.op, expr.left, expr.right
+        if isinstance(left, Const) and isinstance(right, Column):
+            op, left, right = _FLIPPED.get(op), right, left
+        if isinstance(left, Column) and isinstance(right, Const):
+            stats = self._column(left.name, lookup)
+            if stats is not None:
+                r = self._compare(op, stats, right.value)
+                if r is not None:
+                    return r
+        return unknown
+
+    def match(self, expr, names):
+        """
+        Find the zones which may contain rows matching a predicate.
+        Comparisons between a column and a constant are used to exclude
+        zones, all other terms are assumed to match.
+
+        :param expr: A predicates.Expr
+        :param names: The feature names
+        :return: A boolean array, True for zones which may match
+        """
+        lookup = dict((n, i) for (i, n) in enumerate(names))
+        may, must = self._match(expr, lookup)
+        return may
+
+    def ranges(self, zones):
+        """
+        Convert a zone mask into a list of contiguous row ranges
+
+        :param zones: A boolean array of zones
+        :return: A list of tuples (start, stop)
+        """
+        ranges = []
+        for z in numpy.flatnonzero(zones):
+            start = int(z) * self.zone_rows
+            stop = min(start + self.zone_rows, self.nrows)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop)
+            else:
+                ranges.append((start, stop))
+        return ranges
+
+    def to_bytes(self):
+        """
+        Serialise this zone map
+        """
+        buf = StringIO()
+        numpy.savez_compressed(
+            buf, header=numpy.array([self.zone_rows, self.width, self.nrows]),
+            mins=self.mins, maxs=self.maxs, nans=self.nans)
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserialise a zone map
+
+        :param data: A string created by to_bytes
+        :return: A ZoneMap
+        """
+        try:
+            npz = numpy.load(StringIO(data))
+            zone_rows, width, nrows = npz['header'].tolist()
+            return cls(zone_rows, width, nrows, npz['mins'], npz['maxs'],
+                       npz['nans'])
+        except (IOError, KeyError, ValueError) as e:
+            raise OmeroTableException('Invalid zone map: %s' % e)
@@ -107,7 +107,12 @@ setup(name='omero-features',
       # More complex variables
       packages=['features'],
       include_package_data=True,
-      install_requires=[],
+      install_requires=['numpy'],
+      extras_require={
+          'pandas': ['pandas'],
+          'parquet': ['pyarrow'],
+          'hdf5': ['h5py'],
+      },
       zip_safe=ZIP_SAFE,
 
       # Using global variables
@@ -46,6 +46,26 @@ class FeatureTableProxy(OmeroTablesFeatureStore.FeatureTable):
         self.ftnames = None
         self.header = None
         self.chunk_size = None
+        self.result_cache = None
+        self.write_count = 0
+        self.snapshot_arrays = None
+        self.replace_count = 0
+        self.snapshot_replace_count = 0
+        self.zonemap = None
+        self.zonemap_loaded = False
+        self.zonemap_dirty = False
+        self.idindex = None
+        self.idindex_loaded = False
+        self.idindex_dirty = False
+        self.bloom = None
+        self.bloom_checked = 0
+        self.ann = None
+        self.ann_loaded = False
+        self.ann_dirty = False
+        self.summary = None
+        self.pca = None
+        self.pca_loaded = False
+        self.write_listeners = []
 
 
 class TableStoreHelper(object):
@@ -173,6 +193,23 @@ class TestFeatureTable(TableStoreTestHelper):
 
         store.close()
 
+    def test_new_table_sidecar_names(self):
+        ftnames = ['x%06d' % n for n in xrange(20000)]
+
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.new_table(ftnames)
+        assert store.cols[2].name == '@feature-names'
+        assert store.feature_names() == ftnames
+
+        sidecars = store.list_sidecars()
+        assert len(sidecars) == 1
+        assert unwrap(sidecars[0].getName()) == 'feature-names'
+        assert unwrap(sidecars[0].getPath()) == (
+            self.ft_space + '/' + self.name)
+
+        store.close()
+
     def test_open_table(self):
         tid, tcols, ftnames = TableStoreHelper.create_table(
             self.sess, self.ft_space, self.name, 1)
@@ -377,6 +414,241 @@ class TestFeatureTable(TableStoreTestHelper):
 
         store.close()
 
+    def test_snapshot(self, tmpdir):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        imageid = unwrap(TableStoreHelper.create_image(self.sess).getId())
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        snap = store.snapshot(str(tmpdir))
+        assert snap.nrows == 4
+        assert sorted(store.fetch_by_object('Image', 12)) == [
+            (12, -1, [20, 30]), (12, 56, [40, 50])]
+
+        store.store_by_object('Image', imageid, [1, 2], replace=False)
+        assert store.fetch_by_object('Image', imageid) == [
+            (imageid, -1, [1, 2])]
+        assert snap.nrows == 5
+
+        store.close()
+
+    def test_query_zone_map(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        ids, values = store.query('x1 > 30')
+        assert ids.tolist() == [[-1, 34], [12, 56], [13, -1]]
+
+        zm = store.build_zone_map(2)
+        assert zm.nzones == 2
+        ids, values = store.query('x1 > 30 and x2 < 70', ['x2'])
+        assert ids.tolist() == [[12, 56]]
+        assert values.tolist() == [[50]]
+        store.close()
+
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+        assert store.get_zone_map().nrows == 4
+        store.close()
+
+    def test_id_index(self):
+        tid = self.create_table_for_fetch(owned=True, width=1)
+        imageid = unwrap(TableStoreHelper.create_image(self.sess).getId())
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        idx = store.build_id_index()
+        assert idx.nrows == 4
+        assert store.fetch_by_object('Image', 12) == [
+            (12, -1, [10]), (12, 56, [20])]
+        assert store.fetch_by_roi(34).values == [90]
+
+        store.store_by_image(imageid, [1])
+        store.store_by_image(imageid, [2])
+        assert store.fetch_by_image(imageid).values == [2]
+        assert idx.nrows == 5
+        store.close()
+
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+        assert store.get_id_index().nrows == 5
+        store.close()
+
+    def test_has_features(self):
+        tid = self.create_table_for_fetch(owned=True, width=1)
+        imageid = unwrap(TableStoreHelper.create_image(self.sess).getId())
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        assert store.has_features('Image', 12)
+        assert store.has_features('Roi', 34)
+        assert not store.has_features('Image', imageid)
+        assert store.has_features_many('Roi', [56, 1, 34]).tolist() == [
+            True, False, True]
+        assert store.fetch_by_object('Image', imageid) == []
+
+        store.store_by_image(imageid, [1])
+        assert store.has_features('Image', imageid)
+        store.close()
+
+    def test_aggregate(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        keys, r = store.aggregate(funcs=['mean', 'max', 'count'])
+        assert keys.tolist() == [12, 13]
+        assert r['mean'].tolist() == [[30, 40], [60, 70]]
+        assert r['max'].tolist() == [[40, 50], [60, 70]]
+        assert r['count'].tolist() == [[2, 2], [1, 1]]
+
+        keys, r = store.aggregate(by='RoiID', funcs=['mean'], chunk_size=1)
+        assert keys.tolist() == [34, 56]
+        assert r['mean'].tolist() == [[80, 70], [40, 50]]
+        store.close()
+
+    def test_nearest(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        ids, d = store.nearest([20, 30], k=2, chunk_size=1)
+        assert ids.tolist() == [[12, -1], [12, 56]]
+        assert d[0] == 0
+        assert abs(d[1] - 800 ** 0.5) < 1e-9
+
+        ids, d = store.nearest(13, k=1, metric='cosine')
+        assert ids.tolist() == [[12, 56]]
+        store.close()
+
+    def test_nearest_approximate(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        imageid = unwrap(TableStoreHelper.create_image(self.sess).getId())
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        idx = store.build_ann_index(2)
+        assert idx.nrows == 4
+        ids, d = store.nearest([20, 30], k=1, approximate=True, nprobe=2)
+        assert ids.tolist() == [[12, -1]]
+
+        store.store_by_image(imageid, [21, 31])
+        assert idx.nrows == 5
+        ids, d = store.nearest(
+            [21, 31], k=1, approximate=True, nprobe=2, exclude=None)
+        assert ids.tolist() == [[imageid, -1]]
+        store.close()
+
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+        assert store.get_ann_index().nrows == 5
+        store.close()
+
+    def test_describe(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        imageid = unwrap(TableStoreHelper.create_image(self.sess).getId())
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        r = store.describe()
+        assert r['count'].tolist() == [4, 4]
+        assert r['mean'].tolist() == [50, 55]
+        assert r['min'].tolist() == [20, 30]
+        assert r['max'].tolist() == [80, 70]
+
+        store.store_by_image(imageid, [100, 55])
+        r = store.describe(['x1'])
+        assert r['count'].tolist() == [5]
+        assert r['mean'].tolist() == [60]
+        store.close()
+
+    def test_normalized(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        view = store.normalized('minmax', ['x1'])
+        ids, values = view.read_arrays()
+        assert len(ids) == 4
+        assert values.min() == 0
+        assert values.max() == 1
+        chunks = list(view.iter_chunks())
+        assert sorted(v for c in chunks for v in c[1][:, 0].tolist()) == (
+            sorted(values[:, 0].tolist()))
+        store.close()
+
+    def test_fit_pca(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        model = store.fit_pca(1)
+        assert model.nrows == 4
+        ids, r = store.project()
+        assert len(ids) == 4
+        assert r.shape == (4, 1)
+        store.close()
+
+        # Reloaded from the sidecar
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+        assert store.get_pca().components.tolist() == (
+            model.components.tolist())
+        store.close()
+
+    def test_kmeans(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        model = store.kmeans(2, batch_size=2, seed=0)
+        assert model.centroids.shape == (2, 2)
+        assert model.counts.sum() > 0
+        store.close()
+
+    def test_pairwise(self, tmpdir):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        ids, d = store.pairwise_distances(str(tmpdir), block_rows=3)
+        assert d.shape == (4, 4)
+        assert (d.diagonal() == 0).all()
+        assert (d == d.T).all()
+        r = store.feature_correlation()
+        assert r.shape == (2, 2)
+        store.close()
+
+    def test_top_k(self):
+        tid = self.create_table_for_fetch(owned=True, width=2)
+        store = FeatureTableProxy(
+            self.sess, self.name, self.ft_space, self.ann_space)
+        store.open_table(omero.model.OriginalFileI(tid))
+
+        ids, scores, values = store.top_k('x1', 2, vectors=True)
+        assert scores.tolist() == [80, 60]
+        assert values.tolist() == [[80, 70], [60, 70]]
+        ids, scores = store.top_k('x1', 1, largest=False)
+        assert scores.tolist() == [20]
+        store.close()
+
     def test_get_objects(self):
         ims = [
             TableStoreHelper.create_image(self.sess, name='image-test'),
@@ -547,3 +819,84 @@ class TestFeatureTableManager(TableStoreTestHelper):
         assert fts.get(fsname1, uid) is not None
 
         fts2.close()
+
+    def test_partitioned(self):
+        colnames = ['x1', 'x2']
+        fsname = 'fsname-partitioned'
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            self.sess, ft_space=self.ft_space, ann_space=self.ann_space)
+        fs = fts.create(fsname, colnames, partitions=2)
+        assert len(fs.tables) == 2
+
+        iids = [unwrap(TableStoreHelper.create_image(self.sess).getId())
+                for n in xrange(4)]
+        for iid in iids:
+            fs.store_by_image(iid, [iid, 1])
+        assert sum(t.table.getNumberOfRows() for t in fs.tables) == 4
+        for t in fs.tables:
+            assert t.table.getNumberOfRows() == 2
+
+        fts.close()
+
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            self.sess, ft_space=self.ft_space, ann_space=self.ann_space)
+        fs = fts.get(fsname)
+        assert isinstance(fs, OmeroTablesFeatureStore.PartitionedFeatureTable)
+        assert fs.feature_names() == colnames
+        assert fs.fetch_by_image(iids[1]).values == [iids[1], 1]
+        assert sorted(r[0] for r in fs.filter_raw('RoiID==-1')) == iids
+
+        fts.close()
+
+    def test_get_many(self):
+        fsnames = ['fsname-many%d' % n for n in xrange(3)]
+        for fsname in fsnames:
+            self.test_create(fsname)
+
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            self.sess, ft_space=self.ft_space, ann_space=self.ann_space)
+        fs1 = fts.get(fsnames[1])
+        fss = fts.get_many(fsnames)
+        assert len(fss) == 3
+        assert fss[1] == fs1
+        for fs, fsname in zip(fss, fsnames):
+            assert fs.name == fsname
+            assert fs.feature_names() == ['x1', 'x2']
+            assert fts.get(fsname) == fs
+
+        with pytest.raises(OmeroTablesFeatureStore.NoTableMatchException):
+            fts.get_many([fsnames[0], 'fsname-many-missing'])
+
+        fts.close()
+
+    def test_aggregate(self):
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            self.sess, ft_space=self.ft_space, ann_space=self.ann_space)
+        src = fts.create('fsname-agg-source', ['x1', 'x2'])
+        iids = [unwrap(TableStoreHelper.create_image(self.sess).getId())
+                for n in xrange(2)]
+        rids = [unwrap(TableStoreHelper.create_roi(self.sess).getId())
+                for n in xrange(3)]
+        src.store_by_roi(rids[0], [1, 2], iids[0])
+        src.store_by_roi(rids[1], [3, 4], iids[0])
+
+        agg = fts.create_aggregate(
+            'fsname-agg', 'fsname-agg-source', ['mean', 'count'])
+        assert agg.feature_names() == [
+            'mean(x1)', 'mean(x2)', 'count(x1)', 'count(x2)']
+        assert agg.fetch_by_image(iids[0]).values == [2, 3, 2, 2]
+
+        # Only the written Image is recomputed
+        src.store_by_roi(rids[2], [8, 9], iids[1])
+        src.store_by_roi(rids[1], [5, 6], iids[0])
+        assert agg.fetch_by_image(iids[0]).values == [3, 4, 2, 2]
+        assert agg.fetch_by_image(iids[1]).values == [8, 9, 1, 1]
+        fts.close()
+
+        # Reconnected to the source by a new manager
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            self.sess, ft_space=self.ft_space, ann_space=self.ann_space)
+        agg = fts.get_aggregate('fsname-agg')
+        fts.get('fsname-agg-source').store_by_roi(rids[2], [10, 11], iids[1])
+        assert agg.fetch_by_image(iids[1]).values == [10, 11, 1, 1]
+        fts.close()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+
+from features import aggregate
+from features.OmeroTablesFeatureStore import TableUsageException
+
+
+def split_chunks(ids, values, size):
+    return [(ids[n:(n + size)], values[n:(n + size)])
+            for n in xrange(0, len(ids), size)]
+
+
+class TestGroupedStats(object):
+
+    @pytest.mark.parametrize('size', [1, 3, 100])
+    def test_aggregate_chunks(self, size):
+        ids = numpy.array(
+            [[2, 1], [1, 2], [2, 3], [-1, 4], [1, 5], [2, 6], [3, 7]])
+        values = numpy.array(
+            [[1, 10], [2, numpy.nan], [3, 30], [9, 9], [4, numpy.nan],
+             [8, 20], [5, numpy.nan]])
+        stats = aggregate.aggregate_chunks(
+            split_chunks(ids, values, size), 2,
+            funcs=['count', 'sum', 'mean', 'std', 'min', 'max', 'median'])
+        r = stats.result(
+            ['count', 'sum', 'mean', 'std', 'min', 'max', 'median'])
+
+        assert stats.keys.tolist() == [1, 2, 3]
+        assert r.keys() == [
+            'count', 'sum', 'mean', 'std', 'min', 'max', 'median']
+        assert r['count'].tolist() == [[2, 0], [3, 3], [1, 0]]
+        assert r['sum'].tolist() == [[6, 0], [12, 60], [5, 0]]
+        numpy.testing.assert_allclose(
+            r['mean'], [[3, numpy.nan], [4, 20], [5, numpy.nan]])
+        numpy.testing.assert_allclose(
+            r['std'], [[numpy.sqrt(2), numpy.nan],
+                       [numpy.sqrt(13), 10], [numpy.nan, numpy.nan]])
+        numpy.testing.assert_allclose(
+            r['min'], [[2, numpy.nan], [1, 10], [5, numpy.nan]])
+        numpy.testing.assert_allclose(
+            r['max'], [[4, numpy.nan], [8, 30], [5, numpy.nan]])
+        numpy.testing.assert_allclose(
+            r['median'], [[3, numpy.nan], [3, 20], [5, numpy.nan]])
+
+    def test_aggregate_chunks_roi(self):
+        ids = numpy.array([[1, 2], [2, 2], [1, -1]])
+        values = numpy.array([[1., 5], [3, 6], [7, 8]])
+        stats = aggregate.aggregate_chunks(
+            [(ids, values)], 2, by='RoiID', funcs=['mean'], cols=[1])
+        assert stats.keys.tolist() == [2]
+        assert stats.result(['mean'])['mean'].tolist() == [[5.5]]
+
+    def test_random(self):
+        keys = numpy.random.randint(0, 10, 1000)
+        values = numpy.random.normal(1e6, 1, (1000, 3))
+        stats = aggregate.GroupedStats(3)
+        for n in xrange(0, 1000, 77):
+            stats.add(keys[n:(n + 77)], values[n:(n + 77)])
+        r = stats.result(['mean', 'var'])
+        for k in xrange(10):
+            v = values[keys == k]
+            numpy.testing.assert_allclose(r['mean'][k], v.mean(axis=0))
+            numpy.testing.assert_allclose(
+                r['var'][k], v.var(axis=0, ddof=1), rtol=1e-6)
+
+    def test_update(self):
+        a = aggregate.GroupedStats(1)
+        a.add([1, 2], [[1.], [2]])
+        b = aggregate.GroupedStats(1)
+        b.add([2, 3], [[4.], [5]])
+        a.update(b)
+        assert a.keys.tolist() == [1, 2, 3]
+        assert a.result(['mean'])['mean'].tolist() == [[1], [3], [5]]
+
+        with pytest.raises(TableUsageException):
+            a.update(aggregate.GroupedStats(2))
+
+    @pytest.mark.parametrize('buffered', [True, False])
+    def test_select(self, buffered):
+        stats = aggregate.GroupedStats(1, buffered)
+        stats.add([1, 2, 2, 3], [[1.], [2], [4], [5]])
+        r = stats.select([2, 4]).result(['mean', 'count'])
+        assert r['mean'].tolist() == [[3]]
+        assert r['count'].tolist() == [[2]]
+        other = stats.select([2], invert=True)
+        assert other.keys.tolist() == [1, 3]
+        if buffered:
+            assert other.median().tolist() == [[1], [5]]
+        assert stats.keys.tolist() == [1, 2, 3]
+
+    @pytest.mark.parametrize('buffered', [True, False])
+    def test_replace(self, buffered):
+        a = aggregate.GroupedStats(1, buffered)
+        a.add([1, 2, 2], [[1.], [2], [4]])
+        b = aggregate.GroupedStats(1, buffered)
+        b.add([2, 0], [[7.], [5]])
+        a.replace(b)
+        assert a.keys.tolist() == [0, 1, 2]
+        r = a.result(['mean', 'count'])
+        assert r['mean'].tolist() == [[5], [1], [7]]
+        assert r['count'].tolist() == [[1], [1], [1]]
+        if buffered:
+            assert a.median().tolist() == [[5], [1], [7]]
+        assert a.contains([3, 2, 0]).tolist() == [False, True, True]
+        assert a.nbytes() == 3 * 8 * 6
+
+    def test_invalid(self):
+        with pytest.raises(TableUsageException):
+            aggregate.check_funcs(['mean', 'mode'])
+        with pytest.raises(TableUsageException):
+            aggregate.group_column('DatasetID')
+        with pytest.raises(TableUsageException):
+            aggregate.GroupedStats(1).median()
+
+    def test_describe_stats(self):
+        stats = aggregate.GroupedStats(2)
+        r = aggregate.describe_stats(stats, 0)
+        assert r.keys() == ['count', 'nans', 'mean', 'std', 'min', 'max']
+        assert r['count'].tolist() == [0, 0]
+        assert numpy.isnan(r['mean']).all()
+
+        stats.add([0, 0, 0], [[1, numpy.nan], [2, numpy.nan], [6, 4]])
+        r = aggregate.describe_stats(stats, 3)
+        assert r['count'].tolist() == [3, 1]
+        assert r['nans'].tolist() == [0, 2]
+        assert r['mean'].tolist() == [3, 4]
+        numpy.testing.assert_allclose(r['std'][0], numpy.sqrt(7))
+        assert numpy.isnan(r['std'][1])
+        assert r['min'].tolist() == [1, 4]
+        assert r['max'].tolist() == [6, 4]
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+
+from features import ann
+from features.OmeroTablesFeatureStore import (
+    OmeroTableException, TableUsageException)
+
+
+CENTROIDS = numpy.array([[0., 0], [10, 0], [0, 10]])
+
+
+def create_index():
+    idx = ann.IvfIndex(CENTROIDS)
+    idx.append(0, [[1, 1], [9, 1], [numpy.nan, 0], [0, 11]])
+    idx.append(4, [[11, 0], [0, 0]])
+    return idx
+
+
+class TestIvfIndex(object):
+
+    def test_closest_centroids(self):
+        values = numpy.array([[1., 2], [8, 1]])
+        assert ann.closest_centroids(values, CENTROIDS).tolist() == [
+            [0], [1]]
+        assert ann.closest_centroids(values, CENTROIDS, 2).tolist() == [
+            [0, 2], [1, 0]]
+        assert ann.closest_centroids(values, CENTROIDS, 5).shape == (2, 3)
+
+    def test_closest_centroids_blocks(self, monkeypatch):
+        rng = numpy.random.RandomState(1)
+        values = rng.normal(0, 10, (50, 2))
+        expected = ann.closest_centroids(values, CENTROIDS, 2)
+        monkeypatch.setattr(ann, 'BLOCK_ROWS', 7)
+        assert ann.closest_centroids(values, CENTROIDS, 2).tolist() == (
+            expected.tolist())
+
+    def test_kmeans(self):
+        rng = numpy.random.RandomState(1)
+        data = numpy.concatenate([
+            rng.normal(0, 0.1, (50, 2)), rng.normal(5, 0.1, (50, 2))])
+        centroids = ann.kmeans(data, 2)
+        numpy.testing.assert_allclose(
+            sorted(centroids[:, 0]), [0, 5], atol=0.1)
+        assert ann.kmeans(data[:1], 3).shape == (1, 2)
+
+    def test_normalise(self):
+        v = numpy.array([[3., 4], [0, 0]])
+        assert ann.normalise(v, 'euclidean').tolist() == v.tolist()
+        numpy.testing.assert_allclose(
+            ann.normalise(v, 'cosine'), [[0.6, 0.8], [0, 0]])
+        numpy.testing.assert_allclose(
+            ann.normalise(v[0], 'cosine'), [0.6, 0.8])
+
+    def test_append(self):
+        idx = create_index()
+        assert idx.nrows == 6
+        assert idx.npending == 5
+        assert idx.list_keys.tolist() == [0, 0, 1, 1, 2]
+        assert idx.list_rows.tolist() == [0, 5, 1, 4, 3]
+        assert idx.pending == []
+
+        with pytest.raises(TableUsageException):
+            idx.append(2, [[1, 1]])
+
+    def test_replace(self):
+        idx = create_index()
+        idx.replace(0, [0, 9])
+        assert idx.nrows == 6
+        assert idx.candidates([0, 10], 1).tolist() == [0, 3]
+        assert idx.candidates([0, 0], 1).tolist() == [0, 5]
+
+    @pytest.mark.parametrize('merged', [True, False])
+    def test_candidates(self, merged):
+        idx = create_index()
+        if merged:
+            idx._merge_pending()
+        # Rows in the sorted lists and buffered rows
+        idx.append(6, [[8, 0]])
+        assert idx.candidates([9, 0], 1).tolist() == [1, 4, 6]
+        assert idx.candidates([9, 0], 2).tolist() == [0, 1, 4, 5, 6]
+        assert idx.candidates([9, 0], 10).tolist() == [0, 1, 3, 4, 5, 6]
+
+    def test_pending_limit(self, monkeypatch):
+        monkeypatch.setattr(ann, 'MAX_PENDING_ROWS', 5)
+        idx = ann.IvfIndex(CENTROIDS)
+        idx.append(0, [[1, 1], [9, 1], [0, 11]])
+        assert idx.npending == 3
+        idx.append(3, [[11, 0], [0, 0]])
+        assert idx.npending == 0
+        assert idx._list_rows.tolist() == [0, 4, 1, 3, 2]
+
+    def test_train(self):
+        sample = numpy.array([[1., 0], [2, 0], [numpy.nan, 1]])
+        idx = ann.IvfIndex.train(sample, 5, 'cosine')
+        assert idx.nlists == 2
+        assert idx.width == 2
+        assert idx.metric == 'cosine'
+        with pytest.raises(TableUsageException):
+            ann.IvfIndex.train(sample[2:], 5)
+        with pytest.raises(TableUsageException):
+            ann.IvfIndex(CENTROIDS, 'manhattan')
+
+    def test_bytes(self):
+        idx = create_index()
+        idx2 = ann.IvfIndex.from_bytes(idx.to_bytes())
+        assert idx2.nrows == 6
+        assert idx2.metric == 'euclidean'
+        numpy.testing.assert_array_equal(idx2.centroids, CENTROIDS)
+        assert idx2.list_rows.tolist() == idx.list_rows.tolist()
+
+        with pytest.raises(OmeroTableException):
+            ann.IvfIndex.from_bytes('invalid')
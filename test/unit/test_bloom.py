@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import numpy
+
+from features.bloom import BloomFilter
+
+
+class TestBloomFilter(object):
+
+    def test_size(self):
+        bf = BloomFilter(10000, 0.01)
+        # About 9.6 bits and 7 hashes per key
+        assert 95000 < bf.nbits < 97000
+        assert bf.nhashes == 7
+        assert len(bf.bits) == bf.nbits // 8
+        assert BloomFilter(1).capacity == 1024
+
+    def test_add(self):
+        bf = BloomFilter(100)
+        bf.add('Image', [1, 2, 3])
+        assert ('Image', 2) in bf
+        assert ('Roi', 2) not in bf
+        assert bf.might_contain('Image', [3, 1]).tolist() == [True, True]
+        assert bf.count == 3
+        assert not bf.full
+
+    def test_add_rows(self):
+        bf = BloomFilter(100)
+        bf.add_rows([[1, -1], [-1, 2], [3, 4]])
+        assert bf.nrows == 3
+        assert bf.count == 4
+        assert ('Image', 1) in bf
+        assert ('Roi', 2) in bf
+        assert ('Image', -1) not in bf
+        assert ('Roi', -1) not in bf
+
+    def test_false_positive_rate(self):
+        bf = BloomFilter(5000, 0.01)
+        ids = numpy.arange(0, 10000, 2)
+        bf.add('Roi', ids)
+        # No false negatives
+        assert bf.might_contain('Roi', ids).all()
+        fp = bf.might_contain('Roi', ids + 1).mean()
+        assert fp < 0.02
+
+        bf.add('Roi', ids + 1)
+        assert bf.full
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import json
+import numpy
+
+from omero.rtypes import wrap
+
+from features import bulk
+from features.mmaparrays import MemmapFeatureArrays
+from features.OmeroTablesFeatureStore import TableUsageException
+
+
+class MockTable:
+    def __init__(self, tid):
+        self.tid = tid
+        self.rows = []
+
+    def getOriginalFile(self):
+        return MockOriginalFile(self.tid)
+
+    def getNumberOfRows(self):
+        return len(self.rows)
+
+
+class MockOriginalFile:
+    def __init__(self, id):
+        self.id = wrap(id)
+
+    def getId(self):
+        return self.id
+
+
+class MockStore:
+    def __init__(self, tid, names=('a', 'b'), chunk_size=2, fail_after=None):
+        self.table = MockTable(tid)
+        self.names = list(names)
+        self.chunk_size = chunk_size
+        self.fail_after = fail_after
+        self.calls = []
+        self.annotated = []
+
+    def feature_names(self):
+        return self.names
+
+    def get_chunk_size(self):
+        return self.chunk_size
+
+    def append_rows(self, image_ids, roi_ids, values, annotate=True):
+        if self.fail_after is not None and (
+                len(self.calls) >= self.fail_after):
+            raise Exception('Simulated failure')
+        self.calls.append(len(values))
+        self.table.rows.extend(zip(
+            list(image_ids), list(roi_ids), numpy.asarray(values).tolist()))
+        if annotate:
+            self.annotate_rows(image_ids, roi_ids)
+
+    def annotate_rows(self, image_ids, roi_ids):
+        self.annotated.extend(image_ids)
+
+
+class MockPartitionedStore(MockStore):
+    def __init__(self, n, **kwargs):
+        MockStore.__init__(self, None, **kwargs)
+        self.tables = [MockStore(i, **kwargs) for i in xrange(n)]
+        self.table = self.tables[0].table
+
+    def partition_index(self, image_id):
+        return image_id % len(self.tables)
+
+
+def create_arrays(n):
+    ids = numpy.array([[i, -1] for i in xrange(n)])
+    values = numpy.array([[i, 10 * i] for i in xrange(n)], dtype=float)
+    return ids, values
+
+
+class TestSources(object):
+
+    def test_array_source(self):
+        ids, values = create_arrays(5)
+        source = bulk.ArraySource(ids, values)
+        assert source.nrows == 5
+        assert source.width == 2
+        chunks = list(source.iter_chunks(1, 3))
+        assert [len(c[0]) for c in chunks] == [3, 1]
+        assert chunks[1][0].tolist() == [[4, -1]]
+        assert chunks[1][1].tolist() == [[4, 40]]
+
+        with pytest.raises(TableUsageException):
+            bulk.ArraySource(ids[:2], values)
+
+    def test_abstract_source(self):
+        with pytest.raises(TypeError):
+            bulk.FeatureSource('abstract')
+
+    def test_npz_source(self, tmpdir):
+        path = str(tmpdir.join('f.npz'))
+        ids, values = create_arrays(3)
+        numpy.savez(path, ids=ids, values=values, names=['a', 'b'])
+        source = bulk.open_source(path)
+        assert isinstance(source, bulk.NpzSource)
+        assert source.names == ['a', 'b']
+        chunks = list(source.iter_chunks(0, 10))
+        assert chunks[0][1].tolist() == values.tolist()
+        source.close()
+
+    def test_memmap_source(self, tmpdir):
+        path = str(tmpdir.join('fs'))
+        ids, values = create_arrays(3)
+        arrays = MemmapFeatureArrays.create(path, 2, names=['a', 'b'])
+        arrays.append(ids, values)
+        arrays.close()
+
+        source = bulk.open_source(path)
+        assert isinstance(source, bulk.MemmapSource)
+        assert source.names == ['a', 'b']
+        assert source.nrows == 3
+        chunks = list(source.iter_chunks(2, 10))
+        assert chunks[0][0].tolist() == [[2, -1]]
+        source.close()
+
+    def test_csv_source(self, tmpdir):
+        path = tmpdir.join('f.csv')
+        path.write('ImageID,RoiID,a,b\n1,-1,1.5,2\n2,3,,4\n4,-1,5,6\n')
+        source = bulk.open_source(str(path))
+        assert isinstance(source, bulk.CSVSource)
+        assert source.names == ['a', 'b']
+        assert source.nrows is None
+        chunks = list(source.iter_chunks(1, 1))
+        assert [c[0].tolist() for c in chunks] == [[[2, 3]], [[4, -1]]]
+        assert numpy.isnan(chunks[0][1][0, 0])
+        assert chunks[1][1].tolist() == [[5, 6]]
+
+    def test_csv_source_invalid(self, tmpdir):
+        path = tmpdir.join('f.csv')
+        path.write('x,y,a\n')
+        with pytest.raises(TableUsageException):
+            bulk.CSVSource(str(path))
+
+        path.write('ImageID,RoiID,a\n1,2,3,4\n')
+        source = bulk.CSVSource(str(path))
+        with pytest.raises(TableUsageException):
+            list(source.iter_chunks(0, 10))
+
+    def test_unknown_source(self, tmpdir):
+        with pytest.raises(TableUsageException):
+            bulk.open_source(str(tmpdir.join('f.txt')))
+
+
+class TestBulkLoader(object):
+
+    def test_load(self):
+        store = MockStore(1)
+        progress = []
+        loader = bulk.BulkLoader(
+            store, chunk_size=10,
+            progress=lambda n, total: progress.append((n, total)))
+        # Limited by the store chunk size
+        assert loader.chunk_size == 2
+
+        ids, values = create_arrays(5)
+        assert loader.load(bulk.ArraySource(ids, values)) == 5
+        assert store.calls == [2, 2, 1]
+        assert progress == [(2, 5), (4, 5), (5, 5)]
+        assert store.table.rows[4] == (4, -1, [4, 40])
+
+    def test_load_invalid(self):
+        ids, values = create_arrays(2)
+        loader = bulk.BulkLoader(MockStore(1))
+        with pytest.raises(TableUsageException):
+            loader.load(bulk.ArraySource(ids, values, names=['a', 'c']))
+        with pytest.raises(TableUsageException):
+            loader.load(bulk.ArraySource(ids, values[:, :1]))
+
+    def test_load_partitioned(self):
+        store = MockPartitionedStore(2, chunk_size=3)
+        loader = bulk.BulkLoader(store)
+        ids, values = create_arrays(5)
+        assert loader.load(bulk.ArraySource(ids, values)) == 5
+        assert [r[0] for r in store.tables[0].table.rows] == [0, 2, 4]
+        assert [r[0] for r in store.tables[1].table.rows] == [1, 3]
+
+    def test_resume(self, tmpdir):
+        checkpoint = str(tmpdir.join('checkpoint.json'))
+        ids, values = create_arrays(5)
+        store = MockStore(1, fail_after=1)
+        loader = bulk.BulkLoader(store, checkpoint)
+        with pytest.raises(Exception):
+            loader.load(bulk.ArraySource(ids, values))
+        with open(checkpoint) as f:
+            state = json.load(f)
+        assert state['rows'] == 2
+        assert state['table_rows'] == [2]
+        assert not state['complete']
+
+        store.fail_after = None
+        assert loader.load(bulk.ArraySource(ids, values)) == 5
+        assert store.calls == [2, 2, 1]
+        assert [r[0] for r in store.table.rows] == range(5)
+
+        # Already complete
+        assert loader.load(bulk.ArraySource(ids, values)) == 5
+        assert store.calls == [2, 2, 1]
+
+    def test_resume_uncheckpointed(self, tmpdir):
+        # Rows committed to one partition but the checkpoint wasn't written
+        checkpoint = str(tmpdir.join('checkpoint.json'))
+        ids, values = create_arrays(5)
+        store = MockPartitionedStore(2, chunk_size=4)
+        loader = bulk.BulkLoader(store, checkpoint)
+        source = bulk.ArraySource(ids, values)
+        loader.write_checkpoint({
+            'source': source.name, 'tables': [0, 1], 'chunk_size': 4,
+            'rows': 0, 'table_rows': [0, 0], 'complete': False})
+        store.tables[1].append_rows([1, 3], [-1, -1], [[1, 10], [3, 30]])
+
+        assert loader.load(source) == 5
+        assert [r[0] for r in store.tables[0].table.rows] == [0, 2, 4]
+        assert [r[0] for r in store.tables[1].table.rows] == [1, 3]
+
+    def test_resume_twice(self, tmpdir):
+        # The first resume skips rows which weren't checkpointed, they must
+        # be included in the checkpoint written before the second failure
+        checkpoint = str(tmpdir.join('checkpoint.json'))
+        ids, values = create_arrays(8)
+        store = MockStore(1, fail_after=2)
+        loader = bulk.BulkLoader(store, checkpoint)
+        source = bulk.ArraySource(ids, values)
+        loader.write_checkpoint({
+            'source': source.name, 'tables': [1], 'chunk_size': 2,
+            'rows': 0, 'table_rows': [0], 'complete': False})
+        store.append_rows([0, 1], [-1, -1], [[0, 0], [1, 10]], False)
+
+        with pytest.raises(Exception):
+            loader.load(source)
+        with open(checkpoint) as f:
+            state = json.load(f)
+        assert state['rows'] == 4
+        assert state['table_rows'] == [4]
+        # Skipped rows are linked in case they weren't before the failure
+        assert store.annotated == [0, 1, 2, 3]
+
+        store.fail_after = None
+        assert loader.load(source) == 8
+        assert [r[0] for r in store.table.rows] == range(8)
+
+    def test_resume_inconsistent(self, tmpdir):
+        checkpoint = str(tmpdir.join('checkpoint.json'))
+        ids, values = create_arrays(5)
+        store = MockStore(1)
+        loader = bulk.BulkLoader(store, checkpoint)
+        source = bulk.ArraySource(ids, values)
+        loader.write_checkpoint({
+            'source': source.name, 'tables': [1], 'chunk_size': 2,
+            'rows': 0, 'table_rows': [0], 'complete': False})
+        store.append_rows([9], [9], [[9, 9]])
+        with pytest.raises(TableUsageException):
+            loader.load(source)
+
+        loader.write_checkpoint({
+            'source': 'other', 'tables': [1], 'chunk_size': 2,
+            'rows': 0, 'table_rows': [0], 'complete': False})
+        with pytest.raises(TableUsageException):
+            loader.load(source)
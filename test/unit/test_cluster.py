@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import mox
+import numpy
+
+from features import bulk
+from features import cluster
+from features.OmeroTablesFeatureStore import (
+    FeatureTable, TableUsageException)
+
+
+def create_blobs():
+    rng = numpy.random.RandomState(2)
+    return numpy.concatenate([
+        rng.normal(0, 0.1, (200, 2)), rng.normal(5, 0.1, (200, 2)),
+        rng.normal([0, 5], 0.1, (200, 2))])
+
+
+class TestMiniBatchKMeans(object):
+
+    def test_kmeans_plusplus(self):
+        data = numpy.array([[0., 0], [0, 0], [10, 10]])
+        rng = numpy.random.RandomState(0)
+        c = cluster.kmeans_plusplus(data, 2, rng)
+        assert sorted(c[:, 0].tolist()) == [0, 10]
+
+    def test_partial_fit(self):
+        data = create_blobs()
+        rng = numpy.random.RandomState(0)
+        model = cluster.MiniBatchKMeans(3, seed=0)
+        for p in xrange(3):
+            order = rng.permutation(len(data))
+            for n in xrange(0, len(data), 64):
+                model.partial_fit(data[order[n:(n + 64)]])
+        assert model.counts.sum() == 3 * len(data)
+        c = sorted(model.centroids.tolist())
+        numpy.testing.assert_allclose(c, [[0, 0], [0, 5], [5, 5]], atol=0.05)
+
+    def test_partial_fit_buffered(self):
+        model = cluster.MiniBatchKMeans(3, seed=0)
+        model.partial_fit([[0., 0], [numpy.nan, 1]])
+        assert not model.fitted
+        model.partial_fit([[1., 1], [2, 2]])
+        assert model.fitted
+        assert model.counts.sum() == 3
+
+    def test_finish(self):
+        model = cluster.MiniBatchKMeans(3)
+        model.partial_fit([[0., 0], [1, 1]])
+        assert model.finish() == 2
+        assert model.centroids.tolist() == [[0, 0], [1, 1]]
+
+        with pytest.raises(TableUsageException):
+            cluster.MiniBatchKMeans(3).finish()
+        with pytest.raises(TableUsageException):
+            cluster.MiniBatchKMeans(0)
+
+    def test_predict(self):
+        model = cluster.MiniBatchKMeans(2)
+        model.centroids = numpy.array([[0., 0], [10, 0]])
+        labels, d = model.predict([[1., 0], [7, 4], [numpy.nan, 0]])
+        assert labels.tolist() == [0, 1, -1]
+        assert d[:2].tolist() == [1, 5]
+        assert numpy.isnan(d[2])
+
+
+class TestKMeansStore(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    def test_assignment_source(self):
+        store = self.mox.CreateMock(FeatureTable)
+        model = cluster.MiniBatchKMeans(2)
+        model.centroids = numpy.array([[0.], [10]])
+        store.iter_matching_chunks('(RoiID>0)', 2).AndReturn(iter([
+            (numpy.array([[1, 2], [1, 3]]), numpy.array([[0., 1], [0, 9]])),
+            (numpy.array([[2, 4], [2, 5]]), numpy.array([[0., 4], [0, 8]])),
+        ]))
+
+        self.mox.ReplayAll()
+        source = cluster.AssignmentSource(store, model, '(RoiID>0)', [1])
+        assert source.names == ['cluster', 'distance']
+        chunks = list(source.iter_chunks(3, 2))
+        assert len(chunks) == 1
+        assert chunks[0][0].tolist() == [[2, 5]]
+        assert chunks[0][1].tolist() == [[1, 2]]
+        self.mox.VerifyAll()
+
+    def test_kmeans_store(self):
+        store = self.mox.CreateMock(FeatureTable)
+        output = self.mox.CreateMock(FeatureTable)
+        loader = self.mox.CreateMock(bulk.BulkLoader)
+        self.mox.StubOutWithMock(cluster, 'BulkLoader')
+        data = create_blobs()
+        data = data[numpy.random.RandomState(0).permutation(len(data))]
+        chunks = [(numpy.zeros((100, 2), dtype=numpy.int64),
+                   data[n:(n + 100)]) for n in xrange(0, len(data), 100)]
+
+        store.feature_indices(None).AndReturn(None)
+        for p in xrange(cluster.PASSES):
+            store.iter_matching_chunks(None, 100, False).AndReturn(
+                iter(chunks))
+        cluster.BulkLoader(output, chunk_size=100).AndReturn(loader)
+        loader.load(mox.IsA(cluster.AssignmentSource)).AndReturn(600)
+
+        self.mox.ReplayAll()
+        model = cluster.kmeans_store(
+            store, 3, batch_size=100, shuffle=False, seed=0, output=output,
+            tolerance=0)
+        c = sorted(model.centroids.tolist())
+        numpy.testing.assert_allclose(c, [[0, 0], [0, 5], [5, 5]], atol=0.1)
+        self.mox.VerifyAll()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+
+from features import bulk
+from features import export
+from features.OmeroTablesFeatureStore import TableUsageException
+
+
+class MockWriter(object):
+    written = []
+    closed = False
+
+    def __init__(self, path, names):
+        MockWriter.written = []
+        MockWriter.closed = False
+
+    def write(self, ids, values):
+        MockWriter.written.append((ids.tolist(), values.tolist()))
+
+    def close(self):
+        MockWriter.closed = True
+
+
+def create_chunks():
+    return [
+        (numpy.array([[1, -1], [1, 2]]), numpy.array([[1.0, 2.0], [3, 4]])),
+        (numpy.array([[2, -1]]), numpy.array([[5.0, 6.0]])),
+    ]
+
+
+class TestExport(object):
+
+    def test_guess_format(self):
+        assert export.guess_format('a/b.parquet') == 'parquet'
+        assert export.guess_format('b.ARROW') == 'arrow'
+        assert export.guess_format('b.h5') == 'hdf5'
+        with pytest.raises(TableUsageException):
+            export.guess_format('b.csv')
+
+    def test_export_chunks(self, monkeypatch):
+        monkeypatch.setitem(export.WRITERS, 'mock', MockWriter)
+        assert export.export_chunks(
+            iter(create_chunks()), 'out', ['a', 'b'], 'mock') == 3
+        assert MockWriter.written == [
+            ([[1, -1], [1, 2]], [[1, 2], [3, 4]]),
+            ([[2, -1]], [[5, 6]]),
+        ]
+        assert MockWriter.closed
+
+        with pytest.raises(TableUsageException):
+            export.export_chunks(iter([]), 'out', ['a'], 'unknown')
+
+    def test_export_chunks_error(self, monkeypatch):
+        monkeypatch.setitem(export.WRITERS, 'mock', MockWriter)
+
+        def chunks():
+            yield create_chunks()[0]
+            raise ValueError('x')
+
+        with pytest.raises(ValueError):
+            export.export_chunks(chunks(), 'out', ['a', 'b'], 'mock')
+        assert MockWriter.closed
+
+    @pytest.mark.parametrize('format', ['arrow', 'parquet'])
+    def test_export_arrow(self, tmpdir, format):
+        pyarrow = pytest.importorskip('pyarrow')
+        path = str(tmpdir.join('out.' + format))
+        assert export.export_chunks(
+            iter(create_chunks()), path, ['a', 'b']) == 3
+        if format == 'parquet':
+            import pyarrow.parquet
+            t = pyarrow.parquet.read_table(path)
+        else:
+            t = pyarrow.ipc.open_file(pyarrow.OSFile(path)).read_all()
+        assert t.column_names == ['ImageID', 'RoiID', 'a', 'b']
+        assert t.column('RoiID').to_pylist() == [-1, 2, -1]
+        assert t.column('b').to_pylist() == [2, 4, 6]
+
+    def test_export_hdf5(self, tmpdir):
+        pytest.importorskip('h5py')
+        path = str(tmpdir.join('out.h5'))
+        assert export.export_chunks(
+            iter(create_chunks()), path, ['a', 'b']) == 3
+
+        source = bulk.open_source(path)
+        assert source.names == ['a', 'b']
+        ids, values = next(source.iter_chunks(0, 10))
+        assert ids.tolist() == [[1, -1], [1, 2], [2, -1]]
+        assert values.tolist() == [[1, 2], [3, 4], [5, 6]]
+        source.close()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+
+from features import idindex
+from features.idindex import IdIndex
+from features.OmeroTablesFeatureStore import (
+    OmeroTableException, TableUsageException)
+
+
+def create_index():
+    idx = IdIndex()
+    idx.append(0, [[3, -1], [1, 10], [3, 11]])
+    idx.append(3, [[1, -1], [3, 11], [2, 12]])
+    return idx
+
+
+class TestIdIndex(object):
+
+    def test_append(self):
+        idx = create_index()
+        assert idx.nrows == 6
+        assert idx.image_keys.tolist() == [1, 1, 2, 3, 3, 3]
+        assert idx.image_rows.tolist() == [1, 3, 5, 0, 2, 4]
+        assert idx.roi_keys.tolist() == [-1, -1, 10, 11, 11, 12]
+        assert idx.roi_rows.tolist() == [0, 3, 1, 2, 4, 5]
+
+        with pytest.raises(TableUsageException):
+            idx.append(5, [[1, 1]])
+
+    def test_append_buffered(self):
+        idx = create_index()
+        assert len(idx.pending) == 2
+        # Lookups scan the buffered rows without merging
+        assert idx.lookup('Image', 1).tolist() == [1, 3]
+        assert idx.lookup_ids(3, 11).tolist() == [2, 4]
+        assert len(idx.pending) == 2
+        assert idx.image_keys.tolist() == [1, 1, 2, 3, 3, 3]
+        assert idx.pending == []
+        idx.append(6, [[2, -1]])
+        idx.append(7, [[1, 13]])
+        assert idx.nrows == 8
+        assert idx.npending == 2
+        assert idx.lookup('Image', 1).tolist() == [1, 3, 7]
+        assert idx.lookup('Roi', -1).tolist() == [0, 3, 6]
+        assert idx.merged == 6
+
+    def test_pending_limit(self, monkeypatch):
+        monkeypatch.setattr(idindex, 'MAX_PENDING_ROWS', 4)
+        idx = create_index()
+        assert idx.pending == []
+        assert idx.merged == 6
+        idx.append(6, [[2, -1]])
+        assert idx.npending == 1
+        assert idx.lookup('Image', 2).tolist() == [5, 6]
+
+    def test_append_random(self):
+        ids = numpy.random.randint(0, 20, (500, 2))
+        idx = IdIndex()
+        for n in xrange(0, 500, 70):
+            idx.append(n, ids[n:(n + 70)])
+        for i in xrange(20):
+            assert idx.lookup('Image', i).tolist() == numpy.flatnonzero(
+                ids[:, 0] == i).tolist()
+            assert idx.lookup('Roi', i).tolist() == numpy.flatnonzero(
+                ids[:, 1] == i).tolist()
+
+    def test_lookup(self):
+        idx = create_index()
+        assert idx.lookup('Image', 3).tolist() == [0, 2, 4]
+        assert idx.lookup('Image', 4).tolist() == []
+        assert idx.lookup('Roi', 11).tolist() == [2, 4]
+        assert idx.lookup_ids(3, 11).tolist() == [2, 4]
+        assert idx.lookup_ids(1, -1).tolist() == [3]
+        assert idx.lookup_ids(1, 11).tolist() == []
+        with pytest.raises(TableUsageException):
+            idx.lookup('Dataset', 1)
+
+    def test_bytes(self):
+        idx = create_index()
+        # Pending rows are merged before saving
+        idx.append(6, [[4, 14]])
+        idx2 = IdIndex.from_bytes(idx.to_bytes())
+        assert idx2.nrows == 7
+        assert idx2.lookup('Image', 4).tolist() == [6]
+        assert idx2.image_rows.tolist() == idx.image_rows.tolist()
+        assert idx2.roi_keys.tolist() == idx.roi_keys.tolist()
+
+        with pytest.raises(OmeroTableException):
+            IdIndex.from_bytes('invalid')
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+import os
+
+from features import LocalFeatureStore
+from features import aggregate
+from features.OmeroTablesFeatureStore import (
+    NoTableMatchException, TableUsageException, TooManyTablesException)
+
+
+class TestLocalFeatureStore(object):
+
+    def create_store(self, tmpdir, flush_rows=2):
+        store = LocalFeatureStore.LocalFeatureStore(
+            str(tmpdir.join('fs')), ['a', 'b'], flush_rows)
+        store.store_by_image(1, [1, 2])
+        store.store_by_roi(10, [3, 4], 1)
+        store.store_by_roi(20, [5, 6])
+        return store
+
+    def test_init(self, tmpdir):
+        path = str(tmpdir.join('fs'))
+        with pytest.raises(NoTableMatchException):
+            LocalFeatureStore.LocalFeatureStore(path)
+        with pytest.raises(TableUsageException):
+            LocalFeatureStore.LocalFeatureStore(path, ['a', '<>'])
+
+        store = LocalFeatureStore.LocalFeatureStore(path, ['a', 'b'])
+        assert store.feature_names() == ['a', 'b']
+        store.close()
+
+        with pytest.raises(TooManyTablesException):
+            LocalFeatureStore.LocalFeatureStore(path, ['a', 'b'])
+        store = LocalFeatureStore.LocalFeatureStore(path)
+        assert store.feature_names() == ['a', 'b']
+
+    def test_store_buffered(self, tmpdir):
+        store = self.create_store(tmpdir)
+        assert store.arrays.nrows == 2
+        assert store.buffer_ids == [(-1, 20)]
+
+        store.store_by_roi(20, [7, 8])
+        assert store.buffer_values == [[7, 8]]
+        store.store_by_image(1, [0, 0])
+        assert store.arrays.values[0].tolist() == [0, 0]
+
+        store.close()
+        store = LocalFeatureStore.LocalFeatureStore(str(tmpdir.join('fs')))
+        assert store.arrays.ids.tolist() == [[1, -1], [1, 10], [-1, 20]]
+        assert store.arrays.values.tolist() == [[0, 0], [3, 4], [7, 8]]
+
+    def test_store_no_replace(self, tmpdir):
+        store = self.create_store(tmpdir)
+        store.index = None
+        store.store_by_object('Image', 1, [9, 9], replace=False)
+        # The index isn't needed so it isn't built
+        assert store.index is None
+        assert len(store.fetch_by_object('Image', 1)) == 3
+        with pytest.raises(TableUsageException):
+            store.fetch_by_image(1)
+        assert store.fetch_by_image(1, last=True).values == [9, 9]
+        store.store_by_image(1, [8, 8])
+        assert store.get_index()[(1, -1)] == 3
+        assert store.fetch_by_image(1, last=True).values == [8, 8]
+
+    def test_store_invalid(self, tmpdir):
+        store = self.create_store(tmpdir)
+        with pytest.raises(TableUsageException):
+            store.store_by_image(1, [1, 2, 3])
+        with pytest.raises(TableUsageException):
+            store.store_by_object('Dataset', 1, [1, 2])
+
+    def test_fetch(self, tmpdir):
+        store = self.create_store(tmpdir)
+
+        r = store.fetch_by_roi(10)
+        assert r.infonames == ['ImageID', 'RoiID']
+        assert r.infovalues == (1, 10)
+        assert r.names == ['a', 'b']
+        assert r.values == [3, 4]
+
+        assert [r.values for r in store.fetch_all(1)] == [[1, 2], [3, 4]]
+        assert store.filter_raw('RoiID>0') == [
+            (1, 10, [3, 4]), (-1, 20, [5, 6])]
+        assert store.filter_raw('RoiID>0', ['b']) == [
+            (1, 10, [4]), (-1, 20, [6])]
+        assert [r['b'] for r in store.filter('ImageID<0')] == [6]
+
+        with pytest.raises(TableUsageException):
+            store.fetch_by_image(2)
+
+    def test_iter_chunks(self, tmpdir):
+        store = self.create_store(tmpdir)
+        chunks = list(store.iter_chunks(chunk_size=2))
+        assert [c[0].tolist() for c in chunks] == [[0, 1], [2]]
+        assert chunks[1][1].tolist() == [[-1, 20]]
+        assert chunks[1][2].tolist() == [[5, 6]]
+
+        chunks = list(store.iter_chunks(offsets=[2, 0], chunk_size=2))
+        assert len(chunks) == 1
+        assert chunks[0][1].tolist() == [[-1, 20], [1, -1]]
+
+    def test_read_arrays(self, tmpdir):
+        store = self.create_store(tmpdir)
+        ids, values = store.read_arrays()
+        assert ids.tolist() == [[1, -1], [1, 10], [-1, 20]]
+        assert values.tolist() == [[1, 2], [3, 4], [5, 6]]
+
+        ids, values = store.read_arrays('RoiID>0', ['b'])
+        assert ids.tolist() == [[1, 10], [-1, 20]]
+        assert values.tolist() == [[4], [6]]
+
+        with pytest.raises(TableUsageException):
+            store.read_arrays(features=['c'])
+
+    def test_query(self, tmpdir):
+        store = self.create_store(tmpdir)
+        ids, values = store.query('RoiID > 0 and b < 6', ['a'])
+        assert ids.tolist() == [[1, 10]]
+        assert values.tolist() == [[3]]
+        ids, values = store.query('a > 2')
+        assert ids.tolist() == [[1, 10], [-1, 20]]
+        assert values.tolist() == [[3, 4], [5, 6]]
+
+    def test_aggregate(self, tmpdir):
+        store = self.create_store(tmpdir)
+        keys, r = store.aggregate()
+        assert r.keys() == list(aggregate.DEFAULT_FUNCS)
+        keys, r = store.aggregate(funcs=['mean', 'count'], features=['b'])
+        assert keys.tolist() == [1]
+        assert r['mean'].tolist() == [[3]]
+        assert r['count'].tolist() == [[2]]
+
+        store.store_by_image(2, [7, 8])
+        keys, r = store.aggregate(
+            funcs=['max', 'median'], conditions='ImageID>0', chunk_size=1)
+        assert keys.tolist() == [1, 2]
+        assert r['max'].tolist() == [[3, 4], [7, 8]]
+        assert r['median'].tolist() == [[2, 3], [7, 8]]
+
+    def test_describe(self, tmpdir):
+        store = self.create_store(tmpdir)
+        r = store.describe()
+        assert r['count'].tolist() == [3, 3]
+        assert r['nans'].tolist() == [0, 0]
+        assert r['mean'].tolist() == [3, 4]
+        assert r['min'].tolist() == [1, 2]
+
+        store.store_by_image(2, [numpy.nan, 8])
+        r = store.describe(['b'])
+        assert r['count'].tolist() == [4]
+        assert r['max'].tolist() == [8]
+        r = store.describe(['a'])
+        assert r['nans'].tolist() == [1]
+
+    def test_nearest(self, tmpdir):
+        store = self.create_store(tmpdir)
+        ids, d = store.nearest([1, 2], k=2)
+        assert ids.tolist() == [[1, -1], [1, 10]]
+        numpy.testing.assert_allclose(d, [0, numpy.sqrt(8)])
+
+        ids, d = store.nearest(('Roi', 10), k=1, features=['b'])
+        assert ids.tolist() == [[1, -1]]
+        assert d.tolist() == [2]
+
+        ids, d = store.nearest([5, 6], k=2, chunk_size=1)
+        assert ids.tolist() == [[-1, 20], [1, 10]]
+        numpy.testing.assert_allclose(d, [0, numpy.sqrt(8)])
+
+        ids, d = store.nearest([5, 6], k=1, exclude=('Roi', 20))
+        assert ids.tolist() == [[1, 10]]
+
+    def test_iter_matching_chunks(self, tmpdir):
+        store = self.create_store(tmpdir)
+        chunks = list(store.iter_matching_chunks('ImageID==1', 1))
+        assert [c[0].tolist() for c in chunks] == [[[1, -1]], [[1, 10]]]
+        # Chunks are copies
+        chunks[0][1][:] = 0
+        assert store.arrays.values[0].tolist() == [1, 2]
+
+    @pytest.mark.parametrize('method', ['zscore', 'minmax', 'robust'])
+    def test_normalized(self, tmpdir, method):
+        store = self.create_store(tmpdir)
+        view = store.normalized(method, ['b'])
+        ids, values = view.read_arrays()
+        assert ids.tolist() == [[1, -1], [1, 10], [-1, 20]]
+        expected = {
+            'zscore': [-1, 0, 1],
+            'minmax': [0, 0.5, 1],
+            'robust': [-1, 0, 1],
+        }[method]
+        numpy.testing.assert_allclose(values[:, 0], expected, atol=0.01)
+        chunks = list(view.iter_chunks())
+        numpy.testing.assert_allclose(chunks[0][1], values)
+        assert store.arrays.values[:, 1].tolist() == [2, 4, 6]
+
+    def test_top_k(self, tmpdir):
+        store = self.create_store(tmpdir)
+        ids, scores = store.top_k('a', 2)
+        assert ids.tolist() == [[-1, 20], [1, 10]]
+        assert scores.tolist() == [5, 3]
+
+        ids, scores, values = store.top_k(
+            'b', 1, largest=False, conditions='RoiID>0', vectors=True)
+        assert ids.tolist() == [[1, 10]]
+        assert values.tolist() == [[3, 4]]
+
+    def test_pairwise_distances(self, tmpdir):
+        store = self.create_store(tmpdir)
+        ids, d = store.pairwise_distances(
+            str(tmpdir.join('pairwise')), features=['a'],
+            conditions='ImageID==1')
+        assert ids.tolist() == [[1, -1], [1, 10]]
+        assert d.tolist() == [[0, 2], [2, 0]]
+
+    def test_feature_correlation(self, tmpdir):
+        store = self.create_store(tmpdir)
+        r = store.feature_correlation()
+        numpy.testing.assert_allclose(r, [[1, 1], [1, 1]])
+
+    def test_to_dataframe(self, tmpdir):
+        pytest.importorskip('pandas')
+        store = self.create_store(tmpdir)
+        df = store.to_dataframe('ImageID==1')
+        assert list(df.columns) == ['a', 'b']
+        assert df.loc[(1, 10), 'a'] == 3
+
+    def test_delete(self, tmpdir):
+        store = self.create_store(tmpdir)
+        store.delete()
+        assert not os.path.exists(str(tmpdir.join('fs')))
+
+
+class TestLocalFeatureStoreManager(object):
+
+    def test_create_get(self, tmpdir):
+        m = LocalFeatureStore.LocalFeatureStoreManager(str(tmpdir))
+        fs = m.create('fs1', ['a'])
+        fs.store_by_image(1, [2])
+        assert m.get('fs1') == fs
+        assert m.list() == ['fs1']
+
+        with pytest.raises(TooManyTablesException):
+            m.create('fs1', ['a'])
+        with pytest.raises(NoTableMatchException):
+            m.get('fs2')
+        with pytest.raises(TableUsageException):
+            m.get('../fs1')
+
+        m.close()
+        assert fs.arrays is None
+        fs = m.get('fs1')
+        assert fs.fetch_by_image(1).values == [2]
+        m.close()
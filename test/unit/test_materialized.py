@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import mox
+import json
+import numpy
+
+from features import aggregate
+from features import materialized
+from features.OmeroTablesFeatureStore import (
+    FeatureTable, FeatureTableManager, OmeroTableException,
+    TableUsageException)
+
+
+def equals(expected):
+    return mox.Func(lambda a: numpy.allclose(a, expected))
+
+
+def create_stats(keys, values):
+    stats = aggregate.GroupedStats(len(values[0]))
+    stats.add(keys, values)
+    return stats
+
+
+class TestMaterializedAggregate(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+        self.manager = self.mox.CreateMock(FeatureTableManager)
+        self.source = self.mox.CreateMock(FeatureTable)
+        self.target = self.mox.CreateMock(FeatureTable)
+        self.agg = materialized.MaterializedAggregate(
+            self.manager, 'agg', 1, 'source', 2, ['mean', 'count'], ['b'])
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    def test_aggregate_names(self):
+        assert materialized.aggregate_names(['a', 'b'], ['mean', 'max']) == [
+            'mean(a)', 'mean(b)', 'max(a)', 'max(b)']
+
+    def test_definition(self):
+        self.manager.get('agg', 1).AndReturn(self.target)
+        self.target.write_sidecar('aggregate', mox.IsA(str))
+        self.target.read_sidecar('aggregate').AndReturn(
+            json.dumps(self.agg.definition()))
+        self.target.name = 'agg'
+
+        self.mox.ReplayAll()
+        self.agg.save_definition()
+        agg = materialized.MaterializedAggregate.load(
+            self.manager, self.target, 1)
+        assert (agg.name, agg.ownerid) == ('agg', 1)
+        assert (agg.source_name, agg.source_ownerid) == ('source', 2)
+        assert agg.funcs == ['mean', 'count']
+        assert agg.features == ['b']
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('data', [None, '{}'])
+    def test_load_invalid(self, data):
+        self.target.read_sidecar('aggregate').AndReturn(data)
+        self.target.name = 'agg'
+
+        self.mox.ReplayAll()
+        if data:
+            with pytest.raises(OmeroTableException):
+                materialized.MaterializedAggregate.load(
+                    self.manager, self.target, 1)
+        else:
+            with pytest.raises(TableUsageException):
+                materialized.MaterializedAggregate.load(
+                    self.manager, self.target, 1)
+        self.mox.VerifyAll()
+
+    def test_rebuild(self):
+        self.manager.get('source', 2).AndReturn(self.source)
+        self.source.group_stats(
+            'ImageID', ['mean', 'count'], features=['b']).AndReturn(
+            create_stats([1, 1, 2, 3], [[1.], [3], [5], [6]]))
+        self.manager.get('agg', 1).AndReturn(self.target)
+        self.target.get_chunk_size().AndReturn(2)
+        self.target.append_rows(
+            mox.Func(lambda a: a.tolist() == [1, 2]), [-1, -1],
+            mox.Func(lambda a: a.tolist() == [[2, 2], [5, 1]]))
+        self.target.append_rows(
+            mox.Func(lambda a: a.tolist() == [3]), [-1],
+            mox.Func(lambda a: a.tolist() == [[6, 1]]))
+
+        self.mox.ReplayAll()
+        self.agg.rebuild()
+        self.mox.VerifyAll()
+
+    def test_update(self):
+        self.mox.stubs.Set(materialized, 'UPDATE_BATCH_SIZE', 2)
+        self.manager.get('source', 2).AndReturn(self.source)
+        self.manager.get('agg', 1).AndReturn(self.target)
+        self.source.group_stats(
+            'ImageID', ['mean', 'count'], '(ImageID==1)|(ImageID==2)',
+            ['b']).AndReturn(create_stats([1, 2, 2], [[1.], [3], [5]]))
+        self.target.get_chunk_size().AndReturn(10)
+        self.target.store_many_by_image(
+            equals([1, 2]), equals([[1, 1], [4, 2]]))
+        self.source.group_stats(
+            'ImageID', ['mean', 'count'], '(ImageID==3)', ['b']).AndReturn(
+            create_stats([3], [[7.]]))
+        self.target.get_chunk_size().AndReturn(10)
+        self.target.store_many_by_image(equals([3]), equals([[7, 1]]))
+
+        self.mox.ReplayAll()
+        self.agg.update([2, -1, 3, 1, 2])
+        # Nothing to update
+        self.agg.update([-1])
+        assert self.agg.stats.keys.tolist() == [1, 2, 3]
+        self.mox.VerifyAll()
+
+    def test_source_written(self):
+        self.manager.get('source', 2).MultipleTimes().AndReturn(self.source)
+        self.manager.get('agg', 1).MultipleTimes().AndReturn(self.target)
+        # Not tracked, read from the source which includes the new row
+        self.source.group_stats(
+            'ImageID', ['mean', 'count'], '(ImageID==1)', ['b']).AndReturn(
+            create_stats([1, 1], [[1.], [3]]))
+        self.target.get_chunk_size().AndReturn(10)
+        self.target.store_many_by_image(equals([1]), equals([[2, 2]]))
+        # Tracked, merged without reading the source
+        self.source.feature_indices(['b']).AndReturn([1])
+        self.target.get_chunk_size().AndReturn(10)
+        self.target.store_many_by_image(equals([1]), equals([[3, 3]]))
+        # Replaced, read from the source
+        self.source.group_stats(
+            'ImageID', ['mean', 'count'], '(ImageID==1)', ['b']).AndReturn(
+            create_stats([1, 1, 1], [[0.], [3], [5]]))
+        self.target.get_chunk_size().AndReturn(10)
+        self.target.store_many_by_image(equals([1]), equals([[8 / 3., 3]]))
+        self.source.feature_indices(['b']).AndReturn([1])
+        self.target.get_chunk_size().AndReturn(10)
+        self.target.store_many_by_image(equals([1]), equals([[4, 4]]))
+
+        self.mox.ReplayAll()
+        self.agg.source_written([1], [[0, 3]], False)
+        self.agg.source_written([1, -1], [[0, 5], [0, 9]], False)
+        self.agg.source_written([1], [[0, 0]], True)
+        self.agg.source_written([1], [[0, 8]], False)
+        # Nothing to update
+        self.agg.source_written([-1], [[0, 1]], False)
+        self.mox.VerifyAll()
+
+    def test_source_written_median(self):
+        agg = materialized.MaterializedAggregate(
+            self.manager, 'agg', 1, 'source', 2, ['median'])
+        self.manager.get('source', 2).MultipleTimes().AndReturn(self.source)
+        self.manager.get('agg', 1).MultipleTimes().AndReturn(self.target)
+        stats = aggregate.GroupedStats(1, buffered=True)
+        stats.add([1, 1, 1], [[1.], [2], [6]])
+        self.source.group_stats(
+            'ImageID', ['median'], '(ImageID==1)', None).AndReturn(stats)
+        self.target.get_chunk_size().AndReturn(10)
+        self.target.store_many_by_image(equals([1]), equals([[2]]))
+
+        self.mox.ReplayAll()
+        agg.source_written([1], [[6]], False)
+        assert agg.stats is None
+        self.mox.VerifyAll()
+
+    def test_track_limit(self):
+        # Two Images with one feature
+        self.mox.stubs.Set(materialized, 'MAX_TRACKED_BYTES', 96)
+        self.agg._track(create_stats([1, 2], [[1.], [2]]))
+        self.agg._track(create_stats([2], [[3.]]))
+        assert self.agg.stats.keys.tolist() == [1, 2]
+        self.agg._track(create_stats([3], [[3.]]))
+        assert self.agg.stats.keys.tolist() == [3]
+        self.agg._track(create_stats([4, 5, 6], [[4.], [5], [6]]))
+        assert self.agg.stats is None
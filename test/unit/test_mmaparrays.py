@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+import os
+
+from features.mmaparrays import MemmapFeatureArrays
+
+
+class TestMemmapFeatureArrays(object):
+
+    def test_create(self, tmpdir):
+        path = str(tmpdir.join('arrays'))
+        a = MemmapFeatureArrays.create(path, 3, file_id=12)
+        assert a.nrows == 0
+        assert a.width == 3
+        assert a.ids.shape == (0, 2)
+        assert a.values.shape == (0, 3)
+        assert a.manifest == {'width': 3, 'nrows': 0, 'file_id': 12}
+        assert sorted(os.listdir(path)) == [
+            'ids.dat', 'manifest.json', 'values.dat']
+
+    def test_append(self, tmpdir):
+        path = str(tmpdir)
+        a = MemmapFeatureArrays.create(path, 2)
+        a.append([[1, -1], [2, 3]], [[0.5, 1.5], [2.5, 3.5]])
+        a.append([[4, 5]], [[6, 7]], version=2)
+        assert len(a) == 3
+        assert a.manifest['version'] == 2
+
+        b = MemmapFeatureArrays(path)
+        assert b.nrows == 3
+        assert numpy.array_equal(b.ids, [[1, -1], [2, 3], [4, 5]])
+        assert numpy.array_equal(
+            b.values, [[0.5, 1.5], [2.5, 3.5], [6, 7]])
+
+        with pytest.raises(ValueError):
+            a.append([[1, 2]], [[1, 2, 3]])
+        with pytest.raises(ValueError):
+            a.append([1, 2], [[1, 2]])
+
+    def test_append_ignores_trailing_bytes(self, tmpdir):
+        path = str(tmpdir)
+        a = MemmapFeatureArrays.create(path, 1)
+        a.append([[1, 2]], [[3]])
+        with open(os.path.join(path, 'ids.dat'), 'ab') as f:
+            f.write('x' * 5)
+
+        a = MemmapFeatureArrays(path)
+        a.append([[4, 5]], [[6]])
+        assert numpy.array_equal(a.ids, [[1, 2], [4, 5]])
+        assert os.path.getsize(os.path.join(path, 'ids.dat')) == 32
+
+    def test_truncate(self, tmpdir):
+        path = str(tmpdir)
+        a = MemmapFeatureArrays.create(path, 1)
+        a.append([[1, 2], [3, 4]], [[5], [6]])
+        a.truncate(1, file_id=3)
+        assert numpy.array_equal(a.ids, [[1, 2]])
+        assert numpy.array_equal(a.values, [[5]])
+        assert a.manifest['file_id'] == 3
+        assert os.path.getsize(os.path.join(path, 'values.dat')) == 8
+
+        with pytest.raises(ValueError):
+            a.truncate(2)
+
+    def test_update_manifest(self, tmpdir):
+        a = MemmapFeatureArrays.create(str(tmpdir), 1)
+        a.update_manifest(x='y')
+        assert MemmapFeatureArrays(str(tmpdir)).manifest['x'] == 'y'
+        with pytest.raises(ValueError):
+            a.update_manifest(nrows=2)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import mox
+import numpy
+
+from features import nearest
+from features.OmeroTablesFeatureStore import (
+    FeatureTable, TableUsageException)
+
+
+class TestNearest(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    def test_distances(self):
+        values = numpy.array([[3., 4], [0, 2], [numpy.nan, 1], [0, 0]])
+        d = nearest.distances(values, [0, 0])
+        assert d[[0, 1, 3]].tolist() == [5, 2, 0]
+        assert numpy.isnan(d[2])
+
+        d = nearest.distances(values, [0, 1], 'cosine')
+        numpy.testing.assert_allclose(d[:2], [0.2, 0])
+        assert numpy.isnan(d[2:]).all()
+
+        with pytest.raises(TableUsageException):
+            nearest.distances(values, [0, 0], 'manhattan')
+
+    def test_top_k(self):
+        top = nearest.TopK(2)
+        top.add(numpy.array([[1, -1], [2, -1]]), numpy.array([3., 1]))
+        top.add(numpy.array([[3, -1], [4, -1]]),
+                numpy.array([numpy.nan, 2.]))
+        ids, d = top.result()
+        assert ids.tolist() == [[2, -1], [4, -1]]
+        assert d.tolist() == [1, 2]
+
+        with pytest.raises(TableUsageException):
+            nearest.TopK(0)
+
+    def test_top_k_width(self):
+        top = nearest.TopK(1, 3)
+        top.add(numpy.array([[1, -1, 0], [2, -1, 1]]), numpy.array([3., 1]))
+        ids, d = top.result()
+        assert ids.tolist() == [[2, -1, 1]]
+
+    @pytest.mark.parametrize('largest', [True, False])
+    def test_top_k_chunks(self, largest):
+        chunks = [
+            (numpy.array([[1, -1], [2, -1]]), numpy.array([3., numpy.nan])),
+            (numpy.array([[3, -1], [4, -1]]), numpy.array([5., 1])),
+        ]
+        ids, scores = nearest.top_k_chunks(chunks, 2, largest)
+        if largest:
+            assert ids.tolist() == [[3, -1], [1, -1]]
+            assert scores.tolist() == [5, 3]
+        else:
+            assert ids.tolist() == [[4, -1], [1, -1]]
+            assert scores.tolist() == [1, 3]
+
+        ids, scores = nearest.top_k_chunks([], 2)
+        assert ids.shape == (0, 2)
+        assert scores.shape == (0,)
+
+    @pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+    def test_nearest_chunks(self, metric):
+        ids = numpy.column_stack([numpy.arange(100), -numpy.ones(100)])
+        values = numpy.random.random((100, 4))
+        q = numpy.random.random(4)
+        chunks = [(ids[n:(n + 7)], values[n:(n + 7)])
+                  for n in xrange(0, 100, 7)]
+        rids, d = nearest.nearest_chunks(
+            chunks, q[1:], 5, metric, cols=[1, 2, 3], exclude=('Image', 3))
+
+        expected = nearest.distances(values[:, 1:], q[1:], metric)
+        expected[3] = numpy.inf
+        order = numpy.argsort(expected)[:5]
+        assert rids[:, 0].tolist() == order.tolist()
+        numpy.testing.assert_allclose(d, expected[order])
+
+    def test_resolve_query(self):
+        store = self.mox.CreateMock(FeatureTable)
+        store.fetch_by_object('Image', 2).AndReturn([(2, -1, [1., 2, 3])])
+        store.fetch_by_object('Roi', 3).AndReturn([])
+        store.fetch_by_object('Image', 4).AndReturn(
+            [(4, -1, [1., 2, 3]), (4, 5, [1., 2, 3])])
+        store.feature_names().AndReturn(['a', 'b', 'c'])
+
+        self.mox.ReplayAll()
+        v, obj = nearest.resolve_query(store, 2L, [2, 0])
+        assert v.tolist() == [3, 1]
+        assert obj == ('Image', 2)
+        with pytest.raises(TableUsageException):
+            nearest.resolve_query(store, ('Roi', 3))
+        with pytest.raises(TableUsageException):
+            nearest.resolve_query(store, ('Image', 4))
+        v, obj = nearest.resolve_query(store, [1, 2], [0, 1])
+        assert v.tolist() == [1, 2]
+        assert obj is None
+        with pytest.raises(TableUsageException):
+            nearest.resolve_query(store, [1, 2])
+        self.mox.VerifyAll()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import mox
+import numpy
+
+from features import normalize
+from features.OmeroTablesFeatureStore import (
+    FeatureTable, TableUsageException)
+
+
+class TestNormalize(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    def test_histogram_quantiles(self):
+        values = numpy.arange(101, dtype=float).reshape((101, 1))
+        values = numpy.hstack([values, numpy.full((101, 1), numpy.nan)])
+        chunks = [(None, values[:50]), (None, values[50:])]
+        q = normalize.histogram_quantiles(
+            chunks, [0, numpy.nan], [100, numpy.nan], [0, 0.25, 0.5, 1],
+            bins=1000)
+        numpy.testing.assert_allclose(q[:, 0], [0, 25, 50, 100], atol=0.1)
+        assert numpy.isnan(q[:, 1]).all()
+
+    def test_normalizer(self):
+        n = normalize.Normalizer('zscore', [1, 2, 3], [2, 0, numpy.nan])
+        assert n.scale.tolist() == [2, 1, 1]
+        values = numpy.array([[3., 2, 4], [1, 2, numpy.nan]])
+        r = n.apply(values)
+        assert r is values
+        assert values[0].tolist() == [1, 0, 1]
+        assert numpy.isnan(values[1, 2])
+        n.inverse(values)
+        assert values[0].tolist() == [3, 2, 4]
+
+    def create_store(self, features=None):
+        store = self.mox.CreateMock(FeatureTable)
+        store.feature_indices(features).AndReturn(
+            None if features is None else [1])
+        return store
+
+    @pytest.mark.parametrize('method', ['zscore', 'minmax'])
+    def test_fit(self, method):
+        store = self.mox.CreateMock(FeatureTable)
+        store.describe(['b']).AndReturn({
+            'mean': numpy.array([2.]), 'std': numpy.array([4.]),
+            'min': numpy.array([1.]), 'max': numpy.array([5.])})
+
+        self.mox.ReplayAll()
+        n = normalize.Normalizer.fit(store, method, ['b'])
+        assert n.method == method
+        if method == 'zscore':
+            assert n.center.tolist() == [2]
+            assert n.scale.tolist() == [4]
+        else:
+            assert n.center.tolist() == [1]
+            assert n.scale.tolist() == [4]
+        self.mox.VerifyAll()
+
+    def test_fit_robust(self):
+        store = self.mox.CreateMock(FeatureTable)
+        values = numpy.array([[0., 1], [0, 2], [0, 3], [0, 4], [0, 5]])
+        store.describe(['b']).AndReturn({
+            'min': numpy.array([1.]), 'max': numpy.array([5.])})
+        store.feature_indices(['b']).AndReturn([1])
+        store.iter_matching_chunks().AndReturn(iter([
+            (None, values[:2]), (None, values[2:])]))
+
+        self.mox.ReplayAll()
+        n = normalize.Normalizer.fit(store, 'robust', ['b'])
+        numpy.testing.assert_allclose(n.center, [3], atol=0.01)
+        numpy.testing.assert_allclose(n.scale, [2], atol=0.01)
+        self.mox.VerifyAll()
+
+    def test_fit_invalid(self):
+        with pytest.raises(TableUsageException):
+            normalize.Normalizer.fit(None, 'log')
+
+    def test_view_iter_chunks(self):
+        store = self.create_store(['b'])
+        store.iter_matching_chunks('ImageID==1', 2).AndReturn(iter([
+            (numpy.array([[1, -1], [1, 2]]),
+             numpy.array([[0., 3], [0, 5]]))]))
+
+        self.mox.ReplayAll()
+        n = normalize.Normalizer('zscore', [4], [2])
+        view = normalize.NormalizedView(store, n, ['b'])
+        assert view.feature_names() == ['b']
+        chunks = list(view.iter_chunks('ImageID==1', 2))
+        assert len(chunks) == 1
+        assert chunks[0][0].tolist() == [[1, -1], [1, 2]]
+        assert chunks[0][1].tolist() == [[-0.5], [0.5]]
+        self.mox.VerifyAll()
+
+    def test_view_read_arrays(self):
+        store = self.create_store()
+        values = numpy.array([[1., 3], [3, 5]])
+        store.read_arrays(None, None).AndReturn(
+            (numpy.array([[1, -1], [2, -1]]), values))
+
+        self.mox.ReplayAll()
+        n = normalize.Normalizer('minmax', [1, 3], [2, 2])
+        view = normalize.NormalizedView(store, n)
+        ids, r = view.read_arrays()
+        # Transformed in place
+        assert r is values
+        assert r.tolist() == [[0, 0], [1, 1]]
+        self.mox.VerifyAll()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+
+from features import pairwise
+from features.OmeroTablesFeatureStore import TableUsageException
+
+
+def create_chunks():
+    rng = numpy.random.RandomState(0)
+    values = rng.normal(0, 1, (7, 3))
+    values[4, 1] = numpy.nan
+    ids = numpy.column_stack([numpy.arange(7), numpy.full(7, -1)])
+    return values, [(ids[:3], values[:3]), (ids[3:], values[3:])]
+
+
+def brute_force(values, metric):
+    n = len(values)
+    d = numpy.empty((n, n))
+    for i in xrange(n):
+        for j in xrange(n):
+            a = values[i]
+            b = values[j]
+            if metric == 'euclidean':
+                d[i, j] = numpy.sqrt(((a - b) ** 2).sum())
+            else:
+                d[i, j] = 1 - a.dot(b) / numpy.sqrt(a.dot(a) * b.dot(b))
+    return d
+
+
+class TestPairwise(object):
+
+    @pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+    def test_distance_block(self, metric):
+        values, chunks = create_chunks()
+        d = pairwise.distance_block(values[:2], values[2:], metric)
+        expected = brute_force(values, metric)[:2, 2:]
+        numpy.testing.assert_allclose(d, expected)
+
+    @pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+    def test_pairwise_distances(self, tmpdir, metric):
+        values, chunks = create_chunks()
+        path = str(tmpdir.join('out'))
+        ids, d = pairwise.pairwise_distances(chunks, 3, path, metric, 2)
+        assert ids.tolist() == [[i, -1] for i in xrange(7)]
+        assert d.shape == (7, 7)
+        expected = brute_force(values, metric)
+        numpy.testing.assert_allclose(d, expected, atol=1e-12)
+        assert numpy.isnan(d[4]).all()
+        assert numpy.isnan(d[:, 4]).all()
+        assert d[0, 0] == 0
+
+        # Reopened from the file
+        d2 = numpy.memmap(str(tmpdir.join('out', 'distances.dat')),
+                          dtype='<f8', mode='r', shape=(7, 7))
+        numpy.testing.assert_array_equal(d2, d)
+
+    def test_pairwise_distances_cols(self, tmpdir):
+        values, chunks = create_chunks()
+        ids, d = pairwise.pairwise_distances(
+            chunks, 1, str(tmpdir.join('out')), cols=[2])
+        assert d[0, 1] == abs(values[0, 2] - values[1, 2])
+
+    def test_pairwise_distances_empty(self, tmpdir):
+        ids, d = pairwise.pairwise_distances([], 2, str(tmpdir.join('out')))
+        assert ids.shape == (0, 2)
+        assert d.shape == (0, 0)
+
+    def test_feature_correlation(self):
+        values, chunks = create_chunks()
+        r = pairwise.feature_correlation(chunks)
+        keep = [0, 1, 2, 3, 5, 6]
+        numpy.testing.assert_allclose(
+            r, numpy.corrcoef(values[keep], rowvar=False))
+
+        r = pairwise.feature_correlation(chunks, [2, 0])
+        assert r.shape == (2, 2)
+        numpy.testing.assert_allclose(numpy.diag(r), [1, 1])
+
+        with pytest.raises(TableUsageException):
+            pairwise.feature_correlation([])
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+
+from features import pca
+from features.OmeroTablesFeatureStore import (
+    OmeroTableException, TableUsageException)
+
+
+def create_data():
+    rng = numpy.random.RandomState(0)
+    t = rng.normal(0, 3, 200)
+    return numpy.column_stack([
+        t + 1, t * 0.5 - 2, rng.normal(0, 0.1, 200)])
+
+
+def as_chunks(data, size=30):
+    return [(numpy.column_stack([numpy.arange(n, min(n + size, len(data))),
+                                 numpy.full(min(size, len(data) - n), -1)]),
+             data[n:(n + size)]) for n in xrange(0, len(data), size)]
+
+
+class TestPca(object):
+
+    def test_covariance(self):
+        data = create_data()
+        cov = pca.Covariance(3)
+        for ids, values in as_chunks(data):
+            cov.add(values)
+        cov.add([[numpy.nan, 0, 0]])
+        assert cov.n == 200
+        numpy.testing.assert_allclose(cov.mean, data.mean(axis=0))
+        numpy.testing.assert_allclose(
+            cov.covariance(), numpy.cov(data, rowvar=False))
+
+        with pytest.raises(TableUsageException):
+            pca.Covariance(3).covariance()
+
+    def test_fit(self):
+        data = create_data()
+        model = pca.Pca.fit(as_chunks(data), 2)
+        assert model.n_components == 2
+        assert model.nrows == 200
+        first = numpy.array([2, 1, 0]) / numpy.sqrt(5)
+        numpy.testing.assert_allclose(model.components[0], first, atol=0.01)
+        assert model.explained_variance_ratio[0] > 0.99
+        assert model.explained_variance[0] > model.explained_variance[1]
+
+        r = model.transform(data)
+        assert r.shape == (200, 2)
+        numpy.testing.assert_allclose(r.mean(axis=0), [0, 0], atol=1e-10)
+
+    def test_fit_cols(self):
+        data = create_data()
+        model = pca.Pca.fit(as_chunks(data), 1, [2], ['c'])
+        assert model.features == ['c']
+        assert model.components.tolist() == [[1]]
+
+    def test_fit_invalid(self):
+        with pytest.raises(TableUsageException):
+            pca.Pca.fit([], 1)
+        with pytest.raises(TableUsageException):
+            pca.Pca.fit(as_chunks(create_data()), 4)
+
+    def test_to_from_bytes(self):
+        model = pca.Pca.fit(as_chunks(create_data()), 2, [0, 1], ['a', 'b'])
+        m2 = pca.Pca.from_bytes(model.to_bytes())
+        assert m2.components.tolist() == model.components.tolist()
+        assert m2.mean.tolist() == model.mean.tolist()
+        assert m2.total_variance == model.total_variance
+        assert m2.nrows == 200
+        assert m2.features == ['a', 'b']
+
+        m2 = pca.Pca.from_bytes(pca.Pca([0], [[1]], [1], 1, 2).to_bytes())
+        assert m2.features is None
+
+        with pytest.raises(OmeroTableException):
+            pca.Pca.from_bytes('invalid')
+
+    def test_project_chunks(self):
+        model = pca.Pca([1, 2, 0], [[0, 1, 0]], [1], 1, 2)
+        ids, r = pca.project_chunks(model, [
+            (numpy.array([[1, -1]]), numpy.array([[5., 3, 1]])),
+            (numpy.array([[2, -1]]), numpy.array([[1., numpy.nan, 1]]))])
+        assert ids.tolist() == [[1, -1], [2, -1]]
+        assert r[0].tolist() == [1]
+        assert numpy.isnan(r[1, 0])
+
+        ids, r = pca.project_chunks(model, [])
+        assert ids.shape == (0, 2)
+        assert r.shape == (0, 1)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+
+from features import predicates
+from features.predicates import ImageID, RoiID, col
+from features.OmeroTablesFeatureStore import (
+    TableUsageException, evaluate_id_conditions)
+
+
+IDS = numpy.array([[1, -1], [1, 10], [2, 20], [3, -1]])
+VALUES = numpy.array([[0.1, 5], [0.6, 2], [0.9, 4], [0.7, 1]])
+NAMES = ['x0012', 'Mean Intensity']
+
+
+def evaluate(expr):
+    return predicates.evaluate(
+        predicates.as_predicate(expr), IDS, VALUES, NAMES).tolist()
+
+
+class TestPredicates(object):
+
+    def test_evaluate(self):
+        assert evaluate(col('x0012') > 0.5) == [False, True, True, True]
+        assert evaluate((col('x0012') > 0.5) & (col('Mean Intensity') < 3)
+                        ) == [False, True, False, True]
+        assert evaluate(~(ImageID == 1) | (RoiID == 10)) == [
+            False, True, True, True]
+        assert evaluate(col('x0012') * 10 + 1 >= 8) == [
+            False, False, True, True]
+        assert evaluate(-col('x0012') < -0.8) == [False, False, True, False]
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            predicates.Expr()
+
+    def test_bool(self):
+        with pytest.raises(TypeError):
+            bool(col('x0012') > 0.5)
+
+    @pytest.mark.parametrize('text,expected', [
+        ('x0012 > 0.5', [False, True, True, True]),
+        ("x0012 > 0.5 and col('Mean Intensity') < 3",
+         [False, True, False, True]),
+        ('0.5 < x0012 < 0.8', [False, True, False, True]),
+        ('not ImageID == 1 or RoiID == 10', [False, True, True, True]),
+        ('(ImageID == 1) & ~(RoiID > 0)', [True, False, False, False]),
+        ('x0012 / 2 - -1 > 1.4', [False, False, True, False]),
+    ])
+    def test_parse(self, text, expected):
+        assert evaluate(text) == expected
+
+    @pytest.mark.parametrize('text', [
+        'x0012 >', 'x0012 in [1]', '__import__("os")', 'x0012 > "a"',
+        'x0012 ** 2 > 1', 'col(x0012) > 1', 'x0012.real > 1'])
+    def test_parse_invalid(self, text):
+        with pytest.raises(TableUsageException):
+            predicates.parse(text)
+
+    def test_unknown_feature(self):
+        with pytest.raises(TableUsageException):
+            evaluate('y > 1')
+
+    @pytest.mark.parametrize('text,condition,local', [
+        ('x0012 > 0.5', None, [False, True, True, True]),
+        ('ImageID == 1 and x0012 > 0.5', '(ImageID==1)',
+         [False, True, True, True]),
+        ('ImageID == 1 and RoiID > 0 and x0012 > 0.5 or RoiID < 0',
+         None, [True, True, False, True]),
+        ('(ImageID >= 2) & ~(RoiID == 20)', '(ImageID>=2) & (~(RoiID==20))',
+         None),
+        ('ImageID > 0.5', '(ImageID>0.5)', None),
+    ])
+    def test_split(self, text, condition, local):
+        c, expr = predicates.split(text)
+        assert c == condition
+        if local is None:
+            assert expr is None
+        else:
+            assert evaluate(expr) == local
+
+        # The split must be equivalent to the original predicate
+        mask = numpy.ones(len(IDS), dtype=bool)
+        if c:
+            mask &= evaluate_id_conditions(c, IDS)
+        if expr is not None:
+            mask &= evaluate(expr)
+        assert mask.tolist() == evaluate(text)
+
+    def test_filter_chunks(self):
+        chunks = [(IDS[:2], VALUES[:2]), (IDS[2:], VALUES[2:])]
+        ids, values = predicates.filter_chunks(
+            chunks, predicates.parse('x0012 > 0.65'), NAMES, [1])
+        assert ids.tolist() == [[2, 20], [3, -1]]
+        assert values.tolist() == [[4], [1]]
+
+        ids, values = predicates.filter_chunks([], None, NAMES)
+        assert ids.shape == (0, 2)
+        assert values.shape == (0, 2)
@@ -22,11 +22,22 @@
 import pytest
 import mox
 import itertools
+import json
+import numpy
+import time
 
 import omero
 from omero.rtypes import unwrap, wrap
 
 from features import OmeroTablesFeatureStore
+from features import aggregate
+from features import ann
+from features import bloom
+from features import export
+from features import idindex
+from features import materialized
+from features import pca
+from features import zonemap
 
 
 class TestLRUCache(object):
@@ -92,6 +103,151 @@ class TestLRUCache(object):
         assert c.cache.keys() == []
 
 
+    def test_weight(self):
+        c = OmeroTablesFeatureStore.LRUCache(10, maxweight=5, weight=len)
+        c.insert('key1', 'aa')
+        c.insert('key2', 'bb')
+        assert c.totalweight == 4
+        c.get('key1')
+        c.insert('key3', 'cc')
+        assert c.cache.keys() == ['key1', 'key3']
+        assert c.totalweight == 4
+
+        c.insert('key3', 'c')
+        assert c.totalweight == 3
+
+        # The newest entry is always kept
+        c.insert('key4', 'dddddddd')
+        assert c.cache.keys() == ['key4']
+        assert c.totalweight == 8
+
+    def test_pinned(self):
+        # Two featuresets of three partitions with a limit of four handles
+        o1 = self.MockClosable()
+        o2 = self.MockClosable()
+        o3 = self.MockClosable()
+        c = OmeroTablesFeatureStore.LRUClosableCache(
+            10, maxweight=4, weight=lambda o: 3)
+        c.insert('key1', o1)
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            c.insert('key2', o2, pinned=['key1'])
+        assert c.cache.keys() == ['key1']
+        assert c.totalweight == 3
+        assert not o1.closed
+
+        # Pinned entries are skipped when evicting
+        c = OmeroTablesFeatureStore.LRUClosableCache(3)
+        c.insert('key1', o1)
+        c.insert('key2', o2)
+        c.insert('key3', o3)
+        c.insert('key4', 4, pinned=['key1', 'missing'])
+        assert c.cache.keys() == ['key1', 'key3', 'key4']
+        assert not o1.closed
+        assert o2.closed
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            c.insert('key5', 5, pinned=['key1', 'key3', 'key4'])
+        # Replacing a pinned entry
+        c.insert('key4', 4, pinned=['key1', 'key3', 'key4'])
+        assert c.cache.keys() == ['key1', 'key3', 'key4']
+
+    def test_ttl(self):
+        now = [100]
+        c = OmeroTablesFeatureStore.LRUClosableCache(10, ttl=10)
+        c.timer = lambda: now[0]
+        o1 = self.MockClosable()
+        o2 = self.MockClosable()
+        o3 = self.MockClosable()
+        c.insert('key1', o1)
+        c.insert('key2', o2, ttl=20)
+        c.insert('key3', o3, ttl=5)
+
+        now[0] = 108
+        assert c.get('key1') == o1
+        assert c.get('key3') is None
+        assert o3.closed
+        assert len(c) == 2
+
+        now[0] = 115
+        c.remove_expired()
+        assert c.cache.keys() == ['key2']
+        assert o1.closed
+        assert not o2.closed
+
+    def test_stats(self):
+        c = OmeroTablesFeatureStore.LRUCache(1)
+        c.insert('key1', 1)
+        c.get('key1')
+        c.get('key2')
+        c.insert('key2', 2)
+        assert c.stats() == {
+            'size': 1, 'weight': 1, 'hits': 1, 'misses': 1, 'inserts': 2,
+            'evictions': 1, 'expirations': 0}
+
+        c.reset_stats()
+        assert c.stats() == {
+            'size': 1, 'weight': 1, 'hits': 0, 'misses': 0, 'inserts': 0,
+            'evictions': 0, 'expirations': 0}
+
+    def test_count_table_handles(self):
+        fs = MockPartitionedFeatureTable(None)
+        fs.tables = [object(), object()]
+        assert OmeroTablesFeatureStore.count_table_handles(fs) == 2
+        assert OmeroTablesFeatureStore.count_table_handles(
+            MockFeatureTable(None)) == 1
+
+
+class TestPrefetch(object):
+
+    def test_prefetch(self):
+        assert list(OmeroTablesFeatureStore.prefetch(xrange(5), 2)) == range(5)
+
+    def test_prefetch_exception(self):
+        def items():
+            yield 1
+            raise ValueError('x')
+
+        it = OmeroTablesFeatureStore.prefetch(items())
+        assert next(it) == 1
+        with pytest.raises(ValueError) as excinfo:
+            next(it)
+        # The traceback includes the frame which raised in the worker
+        assert excinfo.traceback[-1].name == 'items'
+
+    def test_prefetch_stop_early(self):
+        fetched = []
+
+        def items():
+            for i in xrange(100):
+                fetched.append(i)
+                yield i
+
+        it = OmeroTablesFeatureStore.prefetch(items(), 1)
+        assert next(it) == 0
+        it.close()
+        assert len(fetched) < 100
+
+
+class TestShuffleBlocks(object):
+
+    def test_shuffle_ranges(self):
+        rng = numpy.random.RandomState(1)
+        r = OmeroTablesFeatureStore.shuffle_ranges(10, 3, rng)
+        assert sorted(r) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+        assert OmeroTablesFeatureStore.shuffle_ranges(0, 3) == []
+
+    def test_shuffle_blocks(self):
+        rng = numpy.random.RandomState(1)
+        idx = numpy.arange(10)
+        r = OmeroTablesFeatureStore.shuffle_blocks(idx, 3, rng)
+        assert sorted(r.tolist()) == range(10)
+        # Blocks are kept together
+        joined = ',%s,' % ','.join(str(i) for i in r)
+        for block in ('0,1,2', '3,4,5', '6,7,8', '9'):
+            assert ',%s,' % block in joined
+        assert OmeroTablesFeatureStore.shuffle_blocks(
+            idx[:2], 3).tolist() == [0, 1]
+
+
 class MockSharedResources:
     def __init__(self, tid, table):
         self.tid = tid
@@ -111,6 +267,9 @@ class MockUpdateService:
     def saveAndReturnObject(self, o):
         pass
 
+    def saveArray(self, objs):
+        pass
+
     def deleteObject(self, o):
         pass
 
@@ -123,6 +282,29 @@ class MockQueryService:
         pass
 
 
+class MockRawFileStore:
+    def setFileId(self, fid):
+        pass
+
+    def size(self):
+        pass
+
+    def read(self, pos, length):
+        pass
+
+    def write(self, buf, pos, length):
+        pass
+
+    def truncate(self, length):
+        pass
+
+    def save(self):
+        pass
+
+    def close(self):
+        pass
+
+
 class MockAdminService:
     class MockEventContext:
         userId = None
@@ -155,6 +337,9 @@ class MockSession:
     def sharedResources(self):
         return self.msr
 
+    def createRawFileStore(self):
+        pass
+
 
 class MockOmeroObject:
     def __init__(self, id):
@@ -165,10 +350,11 @@ class MockOmeroObject:
 
 
 class MockOriginalFile:
-    def __init__(self, id, name=None, path=None):
+    def __init__(self, id, name=None, path=None, mtime=None):
         self.id = wrap(id)
         self.name = name
         self.path = path
+        self.mtime = wrap(mtime)
 
     def getId(self):
         return self.id
@@ -179,6 +365,9 @@ class MockOriginalFile:
     def getPath(self):
         return self.path
 
+    def getMtime(self):
+        return self.mtime
+
 
 class MockColumn:
     def __init__(self, name=None, values=None, size=None):
@@ -221,7 +410,10 @@ class MockTable:
     def initialize(self, desc):
         pass
 
-    def readCoordinates(self):
+    def read(self, colNumbers, start, stop):
+        pass
+
+    def readCoordinates(self, rowNumbers):
         pass
 
     def update(self):
@@ -254,6 +446,39 @@ class MockFeatureTable(OmeroTablesFeatureStore.FeatureTable):
         self.ftnames = None
         self.header = None
         self.chunk_size = None
+        self.result_cache = None
+        self.write_count = 0
+        self.snapshot_arrays = None
+        self.replace_count = 0
+        self.snapshot_replace_count = 0
+        self.zonemap = None
+        self.zonemap_loaded = True
+        self.zonemap_dirty = False
+        self.idindex = None
+        self.idindex_loaded = True
+        self.idindex_dirty = False
+        self.bloom = None
+        self.bloom_checked = 0
+        self.ann = None
+        self.ann_loaded = True
+        self.ann_dirty = False
+        self.summary = None
+        self.pca = None
+        self.pca_loaded = True
+        self.write_listeners = []
+
+
+class MockPartitionedFeatureTable(
+        OmeroTablesFeatureStore.PartitionedFeatureTable):
+    def __init__(self, session):
+        self.session = session
+        self.name = 'table-name'
+        self.ft_space = '/test/features/ft_space'
+        self.ann_space = '/test/features/ann_space'
+        self.part_space = '/test/features/ft_space/table-name'
+        self.tables = None
+        self.scheme = None
+        self.boundaries = None
 
 
 class TestFeatureRow(object):
@@ -432,6 +657,34 @@ class TestFeatureTable(object):
         assert store.cols == tcols
         self.mox.VerifyAll()
 
+    def test_new_table_sidecar_names(self):
+        table = self.mox.CreateMock(MockTable)
+        session = MockSession(1, table, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(store, 'write_sidecar')
+
+        mf = MockOriginalFile(1, 'table-name', store.ft_space)
+        table.getOriginalFile().AndReturn(mf)
+
+        desc = ['x%06d' % n for n in xrange(10000)]
+        tcols = [
+            omero.grid.ImageColumn('ImageID', ''),
+            omero.grid.RoiColumn('RoiID', ''),
+            omero.grid.DoubleArrayColumn('@feature-names', '', len(desc)),
+        ]
+
+        table.initialize(mox.Func(lambda xs: self.columns_equal(xs, tcols)))
+        table.getHeaders().AndReturn(tcols)
+        store.write_sidecar(
+            'feature-names',
+            OmeroTablesFeatureStore.encode_feature_names(desc))
+
+        self.mox.ReplayAll()
+
+        store.new_table(desc)
+        assert store.cols == tcols
+        self.mox.VerifyAll()
+
     def test_new_table_invalid_ftname(self):
         store = MockFeatureTable(None)
         with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
@@ -458,11 +711,55 @@ class TestFeatureTable(object):
         store.table = table
         store.cols = [
             MockColumn(), MockColumn(), MockColumn(name='a,b', size=2)]
+        self.mox.StubOutWithMock(table, 'getOriginalFile')
+        table.getOriginalFile().AndReturn(MockOriginalFile(-101))
+
+        self.mox.ReplayAll()
+        assert store.feature_names() == ['a', 'b']
+        assert OmeroTablesFeatureStore._feature_names_cache.get(
+            (-101, None)) == ('a,b', ['a', 'b'])
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('cached', [True, False])
+    def test_feature_names_sidecar(self, cached):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [
+            MockColumn(), MockColumn(),
+            MockColumn(name='@feature-names', size=2)]
+        self.mox.StubOutWithMock(table, 'getOriginalFile')
+        self.mox.StubOutWithMock(store, 'get_sidecar')
+        self.mox.StubOutWithMock(store, 'read_file')
+
+        tid = -102
+        mtime = 1000 + cached
+        sidecar = MockOriginalFile(5, 'feature-names', mtime=mtime)
+        table.getOriginalFile().AndReturn(MockOriginalFile(tid))
+        store.get_sidecar('feature-names').AndReturn(sidecar)
+        if cached:
+            OmeroTablesFeatureStore._feature_names_cache.insert(
+                (tid, mtime), ['a', 'b'])
+        else:
+            store.read_file(sidecar).AndReturn(
+                OmeroTablesFeatureStore.encode_feature_names(['a', 'b']))
 
         self.mox.ReplayAll()
         assert store.feature_names() == ['a', 'b']
+        assert OmeroTablesFeatureStore._feature_names_cache.get(
+            (tid, mtime)) == ['a', 'b']
         self.mox.VerifyAll()
 
+    def test_encode_decode_feature_names(self):
+        names = ['x%06d' % n for n in xrange(100000)]
+        data = OmeroTablesFeatureStore.encode_feature_names(names)
+        assert data.startswith('OFN1')
+        assert len(data) < len(','.join(names)) / 2
+        assert OmeroTablesFeatureStore.decode_feature_names(data) == names
+
+        with pytest.raises(OmeroTablesFeatureStore.OmeroTableException):
+            OmeroTablesFeatureStore.decode_feature_names('xxxx')
+
     def test_store_by_image(self):
         store = MockFeatureTable(None)
         self.mox.StubOutWithMock(store, 'store_by_object')
@@ -552,8 +849,145 @@ class TestFeatureTable(object):
         table.getOriginalFile().AndReturn(mf)
         store.create_file_annotation('Image', 12, store.ann_space, mf)
 
+        written = []
+        store.add_write_listener(lambda *args: written.append(args))
+
         self.mox.ReplayAll()
         store.store_by_object('Image', 12, values)
+        assert store.write_count == 1
+        assert store.replace_count == (1 if exists else 0)
+        assert written == [([12], [values], exists)]
+        self.mox.VerifyAll()
+
+    def test_store_by_object_id_index(self):
+        perms = self.mox.CreateMock(MockPermissionsHandler)
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.perms = perms
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b'),
+                      MockColumn('c', None, 2)]
+        store.idindex = idindex.IdIndex()
+        store.idindex.append(0, [[12, -1], [12, 3], [12, -1]])
+
+        self.mox.StubOutWithMock(perms, 'can_edit')
+        self.mox.StubOutWithMock(table, 'getOriginalFile')
+        self.mox.StubOutWithMock(table, 'update')
+        self.mox.StubOutWithMock(store, 'create_file_annotation')
+
+        mf = MockOriginalFile(3)
+        expectedcols = [MockColumn('a', [12]), MockColumn('b', [-1]),
+                        MockColumn('c', [[10, 20]], 2)]
+        table.getOriginalFile().AndReturn(mf)
+        perms.can_edit(mf).AndReturn(True)
+        # Index catch-up check, no getWhereList
+        table.getNumberOfRows().AndReturn(3)
+        table.update(mox.Func(
+            lambda o: o.rowNumbers == [2] and o.columns == expectedcols))
+        table.getOriginalFile().AndReturn(mf)
+        store.create_file_annotation('Image', 12, store.ann_space, mf)
+
+        self.mox.ReplayAll()
+        store.store_by_object('Image', 12, [10, 20])
+        self.mox.VerifyAll()
+
+    def test_store_many_by_image(self):
+        perms = self.mox.CreateMock(MockPermissionsHandler)
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.perms = perms
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b'),
+                      MockColumn('c', None, 2)]
+        store.idindex = idindex.IdIndex()
+        store.idindex.append(0, [[12, -1], [13, 3], [13, -1], [12, -1]])
+
+        self.mox.StubOutWithMock(perms, 'can_edit')
+        self.mox.StubOutWithMock(table, 'getOriginalFile')
+        self.mox.StubOutWithMock(table, 'update')
+        self.mox.StubOutWithMock(store, 'append_rows')
+
+        mf = MockOriginalFile(3)
+        expectedcols = [MockColumn('a', [12, 13]), MockColumn('b', [-1, -1]),
+                        MockColumn('c', [[1, 2], [5, 6]], 2)]
+        table.getOriginalFile().AndReturn(mf)
+        perms.can_edit(mf).AndReturn(True)
+        table.getNumberOfRows().MultipleTimes().AndReturn(4)
+        table.update(mox.Func(
+            lambda o: o.rowNumbers == [3, 2] and o.columns == expectedcols))
+        store.append_rows([14], [-1], [[3, 4]])
+
+        written = []
+        store.add_write_listener(lambda *args: written.append(args))
+
+        self.mox.ReplayAll()
+        store.store_many_by_image(
+            numpy.array([12, 14, 13]),
+            numpy.array([[1, 2], [3, 4], [5, 6]]))
+        assert store.write_count == 1
+        assert store.replace_count == 1
+        assert store.summary is None
+        assert written == [([12, 13], [[1, 2], [5, 6]], True)]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('annotate', [True, False])
+    def test_append_rows(self, annotate):
+        perms = self.mox.CreateMock(MockPermissionsHandler)
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.perms = perms
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b'),
+                      MockColumn('c', None, 2)]
+
+        self.mox.StubOutWithMock(perms, 'can_edit')
+        self.mox.StubOutWithMock(table, 'getOriginalFile')
+        self.mox.StubOutWithMock(table, 'addData')
+        self.mox.StubOutWithMock(store, 'create_file_annotations')
+
+        mf = MockOriginalFile(3)
+        expectedcols = [MockColumn('a', [12, 12, -1]),
+                        MockColumn('b', [-1, 5, 6]),
+                        MockColumn('c', [[1, 2], [3, 4], [5, 6]], 2)]
+
+        table.getOriginalFile().AndReturn(mf)
+        perms.can_edit(mf).AndReturn(True)
+        table.addData(expectedcols)
+        if annotate:
+            table.getOriginalFile().AndReturn(mf)
+            store.create_file_annotations(
+                'Image', set([12]), store.ann_space, mf)
+            store.create_file_annotations(
+                'Roi', set([5, 6]), store.ann_space, mf)
+
+        written = []
+        store.add_write_listener(lambda *args: written.append(args))
+
+        self.mox.ReplayAll()
+        store.append_rows(numpy.array([12, 12, -1]), [-1, 5, 6],
+                          numpy.array([[1, 2], [3, 4], [5, 6]]), annotate)
+        assert store.write_count == 1
+        assert store.replace_count == 0
+        assert written == [
+            ([12, 12, -1], [[1, 2], [3, 4], [5, 6]], False)]
+        self.mox.VerifyAll()
+
+    def test_append_rows_invalid(self):
+        perms = self.mox.CreateMock(MockPermissionsHandler)
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.perms = perms
+        store.table = table
+
+        self.mox.StubOutWithMock(perms, 'can_edit')
+        self.mox.StubOutWithMock(table, 'getOriginalFile')
+        mf = MockOriginalFile(3)
+        table.getOriginalFile().AndReturn(mf)
+        perms.can_edit(mf).AndReturn(True)
+
+        self.mox.ReplayAll()
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.append_rows([1, 2], [-1], [[1, 2], [3, 4]])
         self.mox.VerifyAll()
 
     def test_store_by_object_unowned(self):
@@ -678,6 +1112,25 @@ class TestFeatureTable(object):
         assert store.fetch_by_object(objtype, 99) == rs
         self.mox.VerifyAll()
 
+    @pytest.mark.parametrize('objtype', ['Image', 'Roi'])
+    def test_fetch_by_object_id_index(self, objtype):
+        store = MockFeatureTable(None)
+        self.mox.StubOutWithMock(store, 'get_id_index')
+        self.mox.StubOutWithMock(store, 'read_rows')
+        idx = idindex.IdIndex()
+        idx.append(0, [[99, -1], [1, 99], [99, 99]])
+        rs = [1, 0, [1]]
+
+        store.get_id_index().AndReturn(idx)
+        if objtype == 'Image':
+            store.read_rows([0, 2]).AndReturn(rs)
+        else:
+            store.read_rows([1, 2]).AndReturn(rs)
+
+        self.mox.ReplayAll()
+        assert store.fetch_by_object(objtype, 99) == rs
+        self.mox.VerifyAll()
+
     @pytest.mark.parametrize('ncols', [1, 2])
     @pytest.mark.parametrize('nrows', [0, 1, 2])
     def test_filter_raw(self, ncols, nrows):
@@ -723,6 +1176,56 @@ class TestFeatureTable(object):
             assert rvalues == []
         self.mox.VerifyAll()
 
+    def test_filter_raw_result_cache(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn(), MockColumn(), MockColumn(size=1)]
+        store.enable_result_cache()
+
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(table, 'getNumberOfRows')
+        self.mox.StubOutWithMock(store, 'get_chunk_size')
+        self.mox.StubOutWithMock(store, 'chunked_table_read')
+        self.mox.StubOutWithMock(store, 'feature_names')
+
+        def expect_read(nrows, result):
+            table.getNumberOfRows().AndReturn(nrows)
+            table.getWhereList('(ImageID==1)', {}, 0, nrows, 0).AndReturn(
+                [0])
+            store.get_chunk_size().AndReturn(10)
+            store.chunked_table_read([0], 10).AndReturn(result)
+
+        expect_read(1, [[1], [-1], [[10]]])
+        # Cached
+        table.getNumberOfRows().AndReturn(1)
+        # Row count changed
+        expect_read(2, [[1], [-1], [[20]]])
+        # Written by this object
+        expect_read(2, [[1], [-1], [[30]]])
+        # Projected rows are cached separately
+        store.feature_names().MultipleTimes().AndReturn(['a', 'b'])
+        expect_read(2, [[1], [-1], [[30, 40]]])
+        table.getNumberOfRows().AndReturn(2)
+
+        self.mox.ReplayAll()
+        rows = store.filter_raw('(ImageID==1)')
+        assert rows == [(1, -1, [10])]
+        # Modifying the returned rows doesn't change the cache
+        rows[0][2][0] = 0
+        assert store.filter_raw('(ImageID==1)') == [(1, -1, [10])]
+        assert store.result_cache.stats()['hits'] == 1
+        assert store.result_cache.totalweight == 224
+        assert store.filter_raw('(ImageID==1)') == [(1, -1, [20])]
+        store.write_count += 1
+        assert store.filter_raw('(ImageID==1)') == [(1, -1, [30])]
+        assert store.filter_raw('(ImageID==1)', ['b']) == [(1, -1, [40])]
+        assert store.filter_raw('(ImageID==1)', ['b']) == [(1, -1, [40])]
+        self.mox.VerifyAll()
+
+        store.disable_result_cache()
+        assert store.result_cache is None
+
     def test_feature_row(self):
         store = MockFeatureTable(None)
         store.cols = [MockColumn('ma'), MockColumn('mb'),
@@ -775,58 +1278,1130 @@ class TestFeatureTable(object):
         assert d == [[[1], [2], [3]]]
         self.mox.VerifyAll()
 
-    def test_get_objects(self):
-        session = MockSession(None, None, None)
+    @pytest.mark.parametrize('exists', [True, False])
+    def test_write_sidecar(self, exists):
+        perms = self.mox.CreateMock(MockPermissionsHandler)
+        table = self.mox.CreateMock(MockTable)
+        session = MockSession(None, table, None)
         store = MockFeatureTable(session)
-        self.mox.StubOutWithMock(session.qs, 'findAllByQuery')
+        store.perms = perms
+        store.table = table
+        self.mox.StubOutWithMock(perms, 'can_edit')
+        self.mox.StubOutWithMock(table, 'getOriginalFile')
+        self.mox.StubOutWithMock(store, 'get_sidecar')
+        self.mox.StubOutWithMock(store, 'write_file')
+        self.mox.StubOutWithMock(session.us, 'saveAndReturnObject')
 
-        kvs = {'x': 'aaa', 'y.z': ['bbb', 'ccc']}
-        # Need to figure out which order the keys will be read
-        if kvs.keys() == ['x', 'y.z']:
-            q = "FROM ObjectType WHERE x = :x AND y.z in (:y_z)"
+        mf = MockOriginalFile(3)
+        sidecar = MockOriginalFile(4)
+        table.getOriginalFile().AndReturn(mf)
+        perms.can_edit(mf).AndReturn(True)
+
+        if exists:
+            store.get_sidecar('kind').AndReturn(sidecar)
         else:
-            q = "FROM ObjectType WHERE y.z in (:y_z) AND x = :x"
+            store.get_sidecar('kind').AndReturn(None)
+            session.us.saveAndReturnObject(mox.Func(
+                lambda o: unwrap(o.getName()) == 'kind' and
+                unwrap(o.getPath()) == store.ft_space + '/table-name' and
+                unwrap(o.getSize()) == 0)).AndReturn(sidecar)
+        store.write_file(sidecar, 'data').AndReturn(sidecar)
 
-        params = omero.sys.ParametersI()
-        params.add('x', wrap('aaa'))
-        params.add('y_z', wrap(['bbb', 'ccc']))
-        m = object()
+        self.mox.ReplayAll()
+        assert store.write_sidecar('kind', 'data') == sidecar
+        self.mox.VerifyAll()
 
-        session.qs.findAllByQuery(q, mox.Func(
-            lambda o: self.parameters_equal(params, o))).AndReturn([m])
+    def test_read_file(self):
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        rfs = self.mox.CreateMock(MockRawFileStore)
+        self.mox.StubOutWithMock(session, 'createRawFileStore')
+        self.mox.stubs.Set(OmeroTablesFeatureStore, 'FILE_CHUNK_SIZE', 4)
 
-        self.mox.ReplayAll()
+        session.createRawFileStore().AndReturn(rfs)
+        rfs.setFileId(3)
+        rfs.size().AndReturn(6)
+        rfs.read(0, 4).AndReturn('abcd')
+        rfs.read(4, 2).AndReturn('ef')
+        rfs.close()
 
-        assert store.get_objects('ObjectType', kvs) == [m]
+        self.mox.ReplayAll()
+        assert store.read_file(MockOriginalFile(3)) == 'abcdef'
         self.mox.VerifyAll()
 
-    @pytest.mark.parametrize('exists', [True, False])
-    def test_create_file_annotation(self, exists):
+    @pytest.mark.parametrize('shrink', [True, False])
+    def test_write_file(self, shrink):
         session = MockSession(None, None, None)
         store = MockFeatureTable(session)
-        self.mox.StubOutWithMock(store, 'get_objects')
-        self.mox.StubOutWithMock(store, '_file_annotation_exists')
-        self.mox.StubOutWithMock(session.us, 'saveAndReturnObject')
-
-        ofile = omero.model.OriginalFileI(2)
-        image = omero.model.ImageI(3)
+        rfs = self.mox.CreateMock(MockRawFileStore)
+        self.mox.StubOutWithMock(session, 'createRawFileStore')
+        self.mox.stubs.Set(OmeroTablesFeatureStore, 'FILE_CHUNK_SIZE', 4)
+        mf = MockOriginalFile(3)
 
-        if exists:
-            r = [MockOmeroObject(21), MockOmeroObject(22)]
+        session.createRawFileStore().AndReturn(rfs)
+        rfs.setFileId(3)
+        rfs.write('abcd', 0, 4)
+        rfs.write('ef', 4, 2)
+        if shrink:
+            rfs.size().AndReturn(10)
+            rfs.truncate(6)
         else:
-            r = []
-        store._file_annotation_exists('Image', 3, 'ns', 2).AndReturn(r)
+            rfs.size().AndReturn(6)
+        rfs.save().AndReturn(mf)
+        rfs.close()
 
-        if not exists:
-            store.get_objects('Image', {'id': 3}).AndReturn([image])
-            mocklink = MockOmeroObject(23)
+        self.mox.ReplayAll()
+        assert store.write_file(MockOriginalFile(3), 'abcdef') == mf
+        self.mox.VerifyAll()
 
-            session.us.saveAndReturnObject(mox.Func(
-                lambda o: o.getParent() == image and
-                o.getChild().getNs() == wrap('ns') and
-                o.getChild().getFile() == ofile)).AndReturn(mocklink)
+    @pytest.mark.parametrize('conditions,expected', [
+        ('ImageID==1', [True, True, False]),
+        ('(ImageID==1) & (RoiID==-1)', [True, False, False]),
+        ('(ImageID>1) | ~(RoiID<3)', [False, True, True]),
+    ])
+    def test_evaluate_id_conditions(self, conditions, expected):
+        ids = numpy.array([[1, -1], [1, 3], [2, 1]])
+        mask = OmeroTablesFeatureStore.evaluate_id_conditions(conditions, ids)
+        assert mask.tolist() == expected
+
+    @pytest.mark.parametrize('conditions', [
+        'x==1', 'ImageID.__class__', '[x for x in ImageID]', 'ImageID=='])
+    def test_evaluate_id_conditions_invalid(self, conditions):
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            OmeroTablesFeatureStore.evaluate_id_conditions(
+                conditions, numpy.zeros((1, 2)))
 
-        self.mox.ReplayAll()
+    @staticmethod
+    def mock_data(ids, values):
+        data = MockTableData()
+        data.columns = [MockColumn(values=[i[0] for i in ids]),
+                        MockColumn(values=[i[1] for i in ids]),
+                        MockColumn(values=values)]
+        return data
+
+    def test_iter_chunks(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn(), MockColumn(), MockColumn(size=1)]
+
+        table.getNumberOfRows().AndReturn(3)
+        table.read([0, 1, 2], 0, 2).AndReturn(
+            self.mock_data([[1, 2], [3, 4]], [[5], [6]]))
+        table.read([0, 1, 2], 2, 3).AndReturn(
+            self.mock_data([[7, 8]], [[9]]))
+        table.readCoordinates([5]).AndReturn(
+            self.mock_data([[1, 2]], [[3]]))
+
+        self.mox.ReplayAll()
+        chunks = list(store.iter_chunks(chunk_size=2))
+        assert len(chunks) == 2
+        assert chunks[0][0].tolist() == [0, 1]
+        assert chunks[0][1].tolist() == [[1, 2], [3, 4]]
+        assert chunks[0][2].tolist() == [[5], [6]]
+        assert chunks[1][0].tolist() == [2]
+        assert chunks[1][1].tolist() == [[7, 8]]
+        assert chunks[1][2].tolist() == [[9]]
+
+        chunks = list(store.iter_chunks(offsets=[5], chunk_size=2))
+        assert len(chunks) == 1
+        assert chunks[0][0].tolist() == [5]
+        assert chunks[0][2].dtype == numpy.float64
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('conditions', [None, '(ImageID==1)'])
+    def test_export(self, conditions):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.ftnames = ['x']
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(store, 'iter_chunks')
+        self.mox.StubOutWithMock(export, 'export_chunks')
+
+        offsets = None
+        if conditions:
+            offsets = [0, 2]
+            table.getNumberOfRows().AndReturn(3)
+            table.getWhereList(conditions, {}, 0, 3, 0).AndReturn(offsets)
+        ids = numpy.array([[1, -1], [1, 2]])
+        values = numpy.array([[1.0], [2.0]])
+        store.iter_chunks(offsets=offsets, chunk_size=10).AndReturn(
+            iter([(numpy.array([0, 2]), ids, values)]))
+
+        def check_chunks(chunks):
+            chunks = list(chunks)
+            return (len(chunks) == 1 and chunks[0][0] is ids and
+                    chunks[0][1] is values)
+
+        export.export_chunks(
+            mox.Func(check_chunks), 'out.h5', ['x'], 'hdf5').AndReturn(2)
+
+        self.mox.ReplayAll()
+        assert store.export('out.h5', 'hdf5', conditions, 10) == 2
+        self.mox.VerifyAll()
+
+    def test_feature_indices(self):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b', 'c']
+        assert store.feature_indices(None) is None
+        assert store.feature_indices(['c', 'a']) == [2, 0]
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.feature_indices(['d'])
+
+    @pytest.mark.parametrize('conditions', [None, '(ImageID==1)'])
+    @pytest.mark.parametrize('features', [None, ['c', 'a']])
+    def test_read_arrays(self, conditions, features):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.ftnames = ['a', 'b', 'c']
+        store.cols = [MockColumn(), MockColumn(), MockColumn(size=3)]
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(store, 'iter_chunks')
+
+        table.getNumberOfRows().AndReturn(3)
+        offsets = None
+        if conditions:
+            offsets = [0, 2]
+            table.getWhereList(conditions, {}, 0, 3, 0).AndReturn(offsets)
+            chunks = [
+                (numpy.array([0]), numpy.array([[1, -1]]),
+                 numpy.array([[1., 2, 3]])),
+                (numpy.array([2]), numpy.array([[1, 3]]),
+                 numpy.array([[7., 8, 9]])),
+            ]
+        else:
+            chunks = [
+                (numpy.array([0, 1]), numpy.array([[1, -1], [2, -1]]),
+                 numpy.array([[1., 2, 3], [4, 5, 6]])),
+                (numpy.array([2]), numpy.array([[1, 3]]),
+                 numpy.array([[7., 8, 9]])),
+            ]
+        store.iter_chunks(offsets=offsets, stop=3).AndReturn(iter(chunks))
+
+        self.mox.ReplayAll()
+        ids, values = store.read_arrays(conditions, features)
+        expected = numpy.concatenate([c[2] for c in chunks])
+        if features:
+            expected = expected[:, [2, 0]]
+        assert ids.tolist() == numpy.concatenate(
+            [c[1] for c in chunks]).tolist()
+        assert values.tolist() == expected.tolist()
+        self.mox.VerifyAll()
+
+    def test_read_arrays_snapshot(self, tmpdir):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b']
+        store.cols = [MockColumn(), MockColumn(), MockColumn(size=2)]
+        snap = OmeroTablesFeatureStore.MemmapFeatureArrays.create(
+            str(tmpdir.join('snapshot')), 2)
+        snap.append([[1, -1], [2, -1]], [[1, 2], [3, 4]])
+        store.snapshot_arrays = snap
+        self.mox.StubOutWithMock(store, 'update_snapshot')
+        store.update_snapshot()
+        store.update_snapshot()
+
+        self.mox.ReplayAll()
+        ids, values = store.read_arrays('(ImageID==2)', ['b'])
+        assert ids.tolist() == [[2, -1]]
+        assert values.tolist() == [[4]]
+        ids, values = store.read_arrays()
+        assert values.tolist() == [[1, 2], [3, 4]]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('conditions', [None, '(ImageID==1)'])
+    def test_iter_matching_chunks(self, conditions):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(store, 'iter_chunks')
+
+        table.getNumberOfRows().AndReturn(3)
+        offsets = None
+        if conditions:
+            offsets = [0, 2]
+            table.getWhereList(conditions, {}, 0, 3, 0).AndReturn(offsets)
+        ids = numpy.array([[1, -1], [1, 2]])
+        values = numpy.array([[1.0], [2.0]])
+        store.iter_chunks(offsets=offsets, stop=3, chunk_size=None).AndReturn(
+            iter([(numpy.array([0, 2]), ids, values)]))
+
+        self.mox.ReplayAll()
+        chunks = list(store.iter_matching_chunks(conditions))
+        assert len(chunks) == 1
+        assert chunks[0][0] is ids
+        assert chunks[0][1] is values
+        self.mox.VerifyAll()
+
+    def test_iter_matching_chunks_shuffle(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.StubOutWithMock(store, 'iter_chunks')
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        table.getNumberOfRows().AndReturn(5)
+        # Contiguous ranges without conditions
+        for n, m in [(0, 2), (2, 4), (4, 5)]:
+            store.iter_chunks(start=n, stop=m, chunk_size=2).InAnyOrder(
+                ).AndReturn(iter([(None, n, m)]))
+        table.getNumberOfRows().AndReturn(5)
+        table.getWhereList('(ImageID>1)', {}, 0, 5, 0).AndReturn([1, 3, 4])
+        store.iter_chunks(
+            offsets=mox.Func(lambda o: sorted(o) == [1, 3, 4]), stop=5,
+            chunk_size=2).AndReturn(iter([]))
+
+        self.mox.ReplayAll()
+        rng = numpy.random.RandomState(0)
+        chunks = list(store.iter_matching_chunks(None, 2, rng))
+        assert sorted(chunks) == [(0, 2), (2, 4), (4, 5)]
+        assert list(store.iter_matching_chunks('(ImageID>1)', 2, rng)) == []
+        self.mox.VerifyAll()
+
+    def test_kmeans(self):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b']
+        self.mox.StubOutWithMock(store, 'iter_matching_chunks')
+        for i in xrange(2):
+            store.iter_matching_chunks(
+                '(RoiID>0)', 2, mox.IsA(numpy.random.RandomState)).AndReturn(
+                iter([
+                    (numpy.array([[1, 2], [1, 3]]),
+                     numpy.array([[0., 0], [0, 10]])),
+                    (numpy.array([[2, 4]]), numpy.array([[0., 11]])),
+                ]))
+
+        self.mox.ReplayAll()
+        model = store.kmeans(2, ['b'], '(RoiID>0)', batch_size=2, passes=2,
+                             seed=0)
+        assert sorted(model.centroids[:, 0].tolist()) == [0, 10.5]
+        self.mox.VerifyAll()
+
+    def test_pairwise_distances(self, tmpdir):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b']
+        self.mox.StubOutWithMock(store, 'iter_matching_chunks')
+        store.iter_matching_chunks('(RoiID>0)').AndReturn(iter([
+            (numpy.array([[1, 2], [1, 3]]), numpy.array([[1., 0], [2, 0]])),
+            (numpy.array([[2, 4]]), numpy.array([[4., 0]])),
+        ]))
+
+        self.mox.ReplayAll()
+        ids, d = store.pairwise_distances(
+            str(tmpdir), features=['a'], conditions='(RoiID>0)',
+            block_rows=2)
+        assert ids.tolist() == [[1, 2], [1, 3], [2, 4]]
+        assert d.tolist() == [[0, 1, 3], [1, 0, 2], [3, 2, 0]]
+        self.mox.VerifyAll()
+
+    def test_feature_correlation(self):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b', 'c']
+        self.mox.StubOutWithMock(store, 'iter_matching_chunks')
+        store.iter_matching_chunks(None, 2).AndReturn(iter([
+            (numpy.array([[1, -1], [2, -1]]),
+             numpy.array([[1., 2, 5], [2, 4, 3]])),
+            (numpy.array([[3, -1]]), numpy.array([[3., 6, 1]])),
+        ]))
+
+        self.mox.ReplayAll()
+        r = store.feature_correlation(['a', 'c'], chunk_size=2)
+        numpy.testing.assert_allclose(r, [[1, -1], [-1, 1]])
+        self.mox.VerifyAll()
+
+    def test_aggregate(self):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b']
+        self.mox.StubOutWithMock(store, 'iter_matching_chunks')
+        store.iter_matching_chunks('(RoiID>0)', 2).AndReturn(iter([
+            (numpy.array([[1, 2], [2, 3]]), numpy.array([[1., 2], [3, 4]])),
+            (numpy.array([[1, 4]]), numpy.array([[5., 6]])),
+        ]))
+
+        self.mox.ReplayAll()
+        keys, r = store.aggregate(
+            funcs=['max', 'count'], conditions='(RoiID>0)', features=['b'],
+            chunk_size=2)
+        assert keys.tolist() == [1, 2]
+        assert r.keys() == ['max', 'count']
+        assert r['max'].tolist() == [[6], [4]]
+        assert r['count'].tolist() == [[2], [1]]
+        self.mox.VerifyAll()
+
+    def test_nearest(self):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b']
+        self.mox.StubOutWithMock(store, 'iter_matching_chunks')
+        self.mox.StubOutWithMock(store, 'fetch_by_object')
+        store.fetch_by_object('Image', 1).AndReturn([(1, -1, [0., 1])])
+        store.iter_matching_chunks(None, 2).AndReturn(iter([
+            (numpy.array([[1, -1], [2, -1]]), numpy.array([[0., 1], [0, 5]])),
+            (numpy.array([[3, -1]]), numpy.array([[9., 2]])),
+        ]))
+
+        self.mox.ReplayAll()
+        ids, d = store.nearest(1, k=5, features=['b'], chunk_size=2)
+        # The query Image is excluded
+        assert ids.tolist() == [[3, -1], [2, -1]]
+        assert d.tolist() == [1, 4]
+        self.mox.VerifyAll()
+
+    def test_iter_matching_chunks_snapshot(self, tmpdir):
+        store = MockFeatureTable(None)
+        snap = OmeroTablesFeatureStore.MemmapFeatureArrays.create(
+            str(tmpdir.join('snapshot')), 1)
+        snap.append([[1, -1], [2, -1], [1, 3]], [[1], [2], [3]])
+        store.snapshot_arrays = snap
+        self.mox.StubOutWithMock(store, 'update_snapshot')
+        store.update_snapshot()
+
+        store.update_snapshot()
+        store.update_snapshot()
+
+        self.mox.ReplayAll()
+        chunks = list(store.iter_matching_chunks('(ImageID==1)', 1))
+        assert [c[0].tolist() for c in chunks] == [[[1, -1]], [[1, 3]]]
+        assert [c[1].tolist() for c in chunks] == [[[1]], [[3]]]
+        chunks = list(store.iter_matching_chunks(None, 2))
+        assert [c[1].tolist() for c in chunks] == [[[1], [2]], [[3]]]
+        chunks = list(store.iter_matching_chunks(
+            None, 2, numpy.random.RandomState(0)))
+        assert sorted(c[1].tolist() for c in chunks) == [[[1], [2]], [[3]]]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('vectors', [True, False])
+    def test_top_k(self, vectors):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.ftnames = ['a', 'b']
+        store.cols = [MockColumn(), MockColumn(), MockColumn(size=2)]
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(store, 'iter_chunks')
+
+        table.getNumberOfRows().AndReturn(5)
+        table.getWhereList('(RoiID>0)', {}, 0, 5, 0).AndReturn(
+            [0, 1, 3, 4])
+        chunks = [
+            (numpy.array([0, 1]), numpy.array([[1, 1], [1, 2]]),
+             numpy.array([[1., 7], [2, numpy.nan]])),
+            (numpy.array([3, 4]), numpy.array([[2, 3], [2, 4]]),
+             numpy.array([[3., 9], [4, 8]])),
+        ]
+        store.iter_chunks(
+            offsets=[0, 1, 3, 4], stop=5, chunk_size=2).AndReturn(
+            iter(chunks))
+        if vectors:
+            store.iter_chunks(offsets=[3, 4], chunk_size=2).AndReturn(
+                iter(chunks[1:]))
+
+        self.mox.ReplayAll()
+        r = store.top_k('b', 2, conditions='(RoiID>0)', vectors=vectors,
+                        chunk_size=2)
+        assert r[0].tolist() == [[2, 3], [2, 4]]
+        assert r[1].tolist() == [9, 8]
+        if vectors:
+            assert r[2].tolist() == [[3, 9], [4, 8]]
+        else:
+            assert len(r) == 2
+        self.mox.VerifyAll()
+
+    def test_top_k_snapshot(self, tmpdir):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b']
+        snap = OmeroTablesFeatureStore.MemmapFeatureArrays.create(
+            str(tmpdir.join('snapshot')), 2)
+        snap.append([[1, -1], [2, -1], [1, 3]], [[1, 5], [2, 6], [3, 4]])
+        store.snapshot_arrays = snap
+        self.mox.StubOutWithMock(store, 'update_snapshot')
+        store.update_snapshot()
+
+        self.mox.ReplayAll()
+        ids, scores, values = store.top_k(
+            'b', 1, largest=False, conditions='(ImageID==1)', vectors=True,
+            chunk_size=1)
+        assert ids.tolist() == [[1, 3]]
+        assert scores.tolist() == [4]
+        assert values.tolist() == [[3, 4]]
+        self.mox.VerifyAll()
+
+    def test_query(self):
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b']
+        self.mox.StubOutWithMock(store, 'iter_matching_chunks')
+        store.iter_matching_chunks('(ImageID==1)').AndReturn(iter([
+            (numpy.array([[1, -1], [1, 2]]),
+             numpy.array([[1.0, 5], [2.0, 6]])),
+            (numpy.array([[1, 3]]), numpy.array([[3.0, 7]])),
+        ]))
+
+        self.mox.ReplayAll()
+        ids, values = store.query('ImageID == 1 and a >= 2', ['b'])
+        assert ids.tolist() == [[1, 2], [1, 3]]
+        assert values.tolist() == [[6], [7]]
+        self.mox.VerifyAll()
+
+    def create_zone_map_store(self):
+        perms = self.mox.CreateMock(MockPermissionsHandler)
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.perms = perms
+        store.table = table
+        store.ftnames = ['a']
+        store.cols = [MockColumn(), MockColumn(), MockColumn(size=1)]
+        self.mox.StubOutWithMock(store, 'iter_chunks')
+        self.mox.StubOutWithMock(store, 'read_sidecar')
+        self.mox.StubOutWithMock(store, 'write_sidecar')
+        return store
+
+    def test_build_zone_map(self):
+        store = self.create_zone_map_store()
+        mf = MockOriginalFile(3)
+        store.iter_chunks().AndReturn(iter([
+            (numpy.array([0, 1, 2]), numpy.array([[1, -1], [2, -1], [3, -1]]),
+             numpy.array([[1.], [2], [3]]))]))
+        store.table.getOriginalFile().AndReturn(mf)
+        store.perms.can_edit(mf).AndReturn(True)
+        store.write_sidecar('zonemap', mox.IsA(str))
+
+        self.mox.ReplayAll()
+        zm = store.build_zone_map(2)
+        assert zm.nrows == 3
+        assert zm.maxs[:, 2].tolist() == [2, 3]
+        assert not store.zonemap_dirty
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('exists', [True, False])
+    def test_get_zone_map(self, exists):
+        store = self.create_zone_map_store()
+        store.zonemap_loaded = False
+        zm = zonemap.ZoneMap(2, 1)
+        zm.add(0, [[1, -1]], [[1.0]])
+
+        if exists:
+            store.read_sidecar('zonemap').AndReturn(zm.to_bytes())
+            store.table.getNumberOfRows().AndReturn(3)
+            store.iter_chunks(start=1, stop=3).AndReturn(iter([
+                (numpy.array([1, 2]), numpy.array([[2, -1], [3, -1]]),
+                 numpy.array([[2.], [5]]))]))
+        else:
+            store.read_sidecar('zonemap').AndReturn(None)
+
+        self.mox.ReplayAll()
+        r = store.get_zone_map()
+        if exists:
+            assert r.nrows == 3
+            assert r.maxs[:, 2].tolist() == [2, 5]
+            assert store.zonemap_dirty
+        else:
+            assert r is None
+        # Only loaded once
+        if not exists:
+            assert store.get_zone_map() is None
+        self.mox.VerifyAll()
+
+    def test_query_zone_map(self):
+        store = self.create_zone_map_store()
+        zm = zonemap.ZoneMap(2, 1)
+        zm.add(0, [[1, -1], [1, 2], [2, -1]], [[1.0], [2], [5]])
+        store.zonemap = zm
+        self.mox.StubOutWithMock(store, 'iter_matching_chunks')
+
+        store.table.getNumberOfRows().AndReturn(3)
+        store.iter_chunks(start=2, stop=3).AndReturn(iter([
+            (numpy.array([2]), numpy.array([[2, -1]]),
+             numpy.array([[5.]]))]))
+
+        self.mox.ReplayAll()
+        ids, values = store.query('a > 4 and ImageID > 1')
+        assert ids.tolist() == [[2, -1]]
+        assert values.tolist() == [[5]]
+        self.mox.VerifyAll()
+
+    def test_indexes_append(self):
+        store = self.create_zone_map_store()
+        store.zonemap = zonemap.ZoneMap(2, 1)
+        store.zonemap.add(0, [[1, -1]], [[1.0]])
+
+        store.table.getNumberOfRows().AndReturn(3)
+        # Appended by another client
+        store.table.getNumberOfRows().AndReturn(5)
+
+        self.mox.ReplayAll()
+        store._indexes_append([[2, -1], [3, -1]], [[2.0], [3]])
+        assert store.zonemap.nrows == 3
+        assert store.zonemap_dirty
+        store._indexes_append([[2, -1]], [[2.0]])
+        assert store.zonemap.nrows == 3
+        self.mox.VerifyAll()
+
+    def test_zone_map_update(self):
+        store = self.create_zone_map_store()
+        store.zonemap = zonemap.ZoneMap(2, 1)
+        store.zonemap.add(0, [[1, -1], [2, -1]], [[1.0], [2]])
+        mf = MockOriginalFile(3)
+
+        store.table.getNumberOfRows().AndReturn(2)
+        store.table.getNumberOfRows().AndReturn(2)
+        # Saved once on close
+        store.table.getOriginalFile().AndReturn(mf)
+        store.perms.can_edit(mf).AndReturn(True)
+        store.write_sidecar('zonemap', mox.IsA(str))
+        store.table.close()
+
+        self.mox.ReplayAll()
+        store._zone_map_update(1, [[2, -1]], [[10.0]])
+        assert store.zonemap.mins[0, 2] == 1
+        assert store.zonemap.maxs[0, 2] == 10
+        assert store.zonemap_dirty
+        store._zone_map_update(0, [[1, -1]], [[-1.0]])
+        assert store.zonemap.mins[0, 2] == -1
+        store.close()
+        assert not store.zonemap_dirty
+        self.mox.VerifyAll()
+
+    def test_indexes_append_id_index(self):
+        store = self.create_zone_map_store()
+        store.idindex = idindex.IdIndex()
+        store.idindex.append(0, [[1, -1]])
+
+        store.table.getNumberOfRows().AndReturn(2)
+
+        self.mox.ReplayAll()
+        store._indexes_append([[2, -1]], [[2.0]])
+        assert store.idindex.nrows == 2
+        assert store.idindex_dirty
+        self.mox.VerifyAll()
+
+    def test_iter_id_chunks(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.stubs.Set(OmeroTablesFeatureStore, 'FILE_CHUNK_SIZE', 32)
+
+        table.read([0, 1], 1, 3).AndReturn(
+            self.mock_data([[1, 2], [3, 4]], None))
+        table.read([0, 1], 3, 4).AndReturn(self.mock_data([[5, 6]], None))
+
+        self.mox.ReplayAll()
+        chunks = list(store.iter_id_chunks(1, 4))
+        assert [c[0] for c in chunks] == [1, 3]
+        assert chunks[0][1].tolist() == [[1, 2], [3, 4]]
+        assert chunks[1][1].tolist() == [[5, 6]]
+        self.mox.VerifyAll()
+
+    def test_build_id_index(self):
+        store = self.create_zone_map_store()
+        self.mox.StubOutWithMock(store, 'iter_id_chunks')
+        mf = MockOriginalFile(3)
+
+        store.table.getNumberOfRows().AndReturn(2)
+        store.iter_id_chunks(0, 2).AndReturn(
+            iter([(0, numpy.array([[2, -1], [1, 3]]))]))
+        store.table.getOriginalFile().AndReturn(mf)
+        store.perms.can_edit(mf).AndReturn(True)
+        store.write_sidecar('idindex', mox.IsA(str))
+
+        self.mox.ReplayAll()
+        idx = store.build_id_index()
+        assert idx.image_rows.tolist() == [1, 0]
+        assert not store.idindex_dirty
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('exists', [True, False])
+    def test_get_id_index(self, exists):
+        store = self.create_zone_map_store()
+        self.mox.StubOutWithMock(store, 'iter_id_chunks')
+        store.idindex_loaded = False
+        idx = idindex.IdIndex()
+        idx.append(0, [[1, -1]])
+
+        if exists:
+            store.read_sidecar('idindex').AndReturn(idx.to_bytes())
+            store.table.getNumberOfRows().AndReturn(2)
+            store.iter_id_chunks(1, 2).AndReturn(
+                iter([(1, numpy.array([[1, 2]]))]))
+        else:
+            store.read_sidecar('idindex').AndReturn(None)
+
+        self.mox.ReplayAll()
+        r = store.get_id_index()
+        if exists:
+            assert r.lookup('Image', 1).tolist() == [0, 1]
+            assert store.idindex_dirty
+        else:
+            assert r is None
+            assert store.get_id_index() is None
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('sampled', [True, False])
+    def test_build_ann_index(self, sampled):
+        store = self.create_zone_map_store()
+        mf = MockOriginalFile(3)
+        values = numpy.array([[0.], [1], [10], [11]])
+        ids = numpy.array([[1, -1], [2, -1], [3, -1], [4, -1]])
+        if sampled:
+            self.mox.stubs.Set(ann, 'TRAIN_ROWS', 3)
+            self.mox.StubOutWithMock(numpy.random, 'choice')
+
+        store.table.getNumberOfRows().AndReturn(4)
+        if sampled:
+            numpy.random.choice(4, 3, replace=False).AndReturn(
+                numpy.array([3, 0, 1]))
+            store.iter_chunks(offsets=[0, 1, 3]).AndReturn(iter([
+                (numpy.array([0, 1, 3]), ids[[0, 1, 3]], values[[0, 1, 3]])
+            ]))
+            store.iter_chunks(stop=4).AndReturn(iter([
+                (numpy.arange(2), ids[:2], values[:2]),
+                (numpy.arange(2, 4), ids[2:], values[2:])]))
+        else:
+            store.iter_chunks(stop=4).AndReturn(iter([
+                (numpy.arange(4), ids, values)]))
+        store.table.getOriginalFile().AndReturn(mf)
+        store.perms.can_edit(mf).AndReturn(True)
+        store.write_sidecar('ann', mox.IsA(str))
+
+        self.mox.ReplayAll()
+        idx = store.build_ann_index(2)
+        assert idx.nlists == 2
+        assert idx.nrows == 4
+        assert idx.candidates([10.], 1).tolist() == [2, 3]
+        assert not store.ann_dirty
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('exists', [True, False])
+    def test_get_ann_index(self, exists):
+        store = self.create_zone_map_store()
+        store.ann_loaded = False
+        idx = ann.IvfIndex([[0.], [10]])
+        idx.append(0, [[1.]])
+
+        if exists:
+            store.read_sidecar('ann').AndReturn(idx.to_bytes())
+            store.table.getNumberOfRows().AndReturn(3)
+            store.iter_chunks(start=1, stop=3).AndReturn(iter([
+                (numpy.array([1, 2]), numpy.array([[2, -1], [3, -1]]),
+                 numpy.array([[9.], [2]]))]))
+        else:
+            store.read_sidecar('ann').AndReturn(None)
+
+        self.mox.ReplayAll()
+        r = store.get_ann_index()
+        if exists:
+            assert r.nrows == 3
+            assert r.candidates([10.], 1).tolist() == [1]
+            assert store.ann_dirty
+        else:
+            assert r is None
+            assert store.get_ann_index() is None
+        self.mox.VerifyAll()
+
+    def test_indexes_append_ann(self):
+        store = self.create_zone_map_store()
+        store.ann = ann.IvfIndex([[0.], [10]])
+        store.ann.append(0, [[1.]])
+
+        store.table.getNumberOfRows().AndReturn(2)
+
+        self.mox.ReplayAll()
+        store._indexes_append([[2, -1]], [[8.0]])
+        assert store.ann.nrows == 2
+        assert store.ann.candidates([10.], 1).tolist() == [1]
+        assert store.ann_dirty
+        self.mox.VerifyAll()
+
+    def test_ann_index_update(self):
+        store = self.create_zone_map_store()
+        store.ann = ann.IvfIndex([[0.], [10]])
+        store.ann.append(0, [[1.], [2]])
+        mf = MockOriginalFile(3)
+
+        store.table.getNumberOfRows().AndReturn(2)
+        store.table.getNumberOfRows().AndReturn(2)
+        # Saved once on close
+        store.table.getOriginalFile().AndReturn(mf)
+        store.perms.can_edit(mf).AndReturn(True)
+        store.write_sidecar('ann', mox.IsA(str))
+        store.table.close()
+
+        self.mox.ReplayAll()
+        store._ann_index_update(1, [9.0])
+        assert store.ann.candidates([10.], 1).tolist() == [1]
+        assert store.ann_dirty
+        store._ann_index_update(0, [8.0])
+        assert sorted(store.ann.candidates([10.], 2).tolist()) == [0, 1]
+        store.close()
+        assert not store.ann_dirty
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('conditions', [None, '(ImageID>2)'])
+    def test_nearest_approximate(self, conditions):
+        store = self.create_zone_map_store()
+        store.ann = ann.IvfIndex([[0.], [10]])
+        store.ann.append(0, [[1.], [9], [11], [2]])
+        self.mox.StubOutWithMock(store, 'iter_matching_chunks')
+
+        store.table.getNumberOfRows().AndReturn(4)
+        store.iter_chunks(offsets=[1, 2], chunk_size=None).AndReturn(iter([
+            (numpy.array([1, 2]), numpy.array([[2, -1], [3, -1]]),
+             numpy.array([[9.], [11]]))]))
+        store.table.getNumberOfRows().AndReturn(4)
+
+        self.mox.ReplayAll()
+        ids, d = store.nearest(
+            [10.5], 3, conditions=conditions, approximate=True, nprobe=1)
+        if conditions:
+            assert ids.tolist() == [[3, -1]]
+        else:
+            assert ids.tolist() == [[3, -1], [2, -1]]
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.nearest([10.5], metric='cosine', approximate=True)
+        self.mox.VerifyAll()
+
+    def test_describe(self):
+        store = self.create_zone_map_store()
+        store.ftnames = ['a', 'b']
+
+        store.table.getNumberOfRows().AndReturn(2)
+        store.iter_chunks(start=0, stop=2).AndReturn(iter([
+            (numpy.array([0, 1]), numpy.array([[1, -1], [2, -1]]),
+             numpy.array([[1., numpy.nan], [3, 4]]))]))
+        # Cached
+        store.table.getNumberOfRows().AndReturn(2)
+        # Appended
+        store.table.getNumberOfRows().AndReturn(3)
+        store.iter_chunks(start=2, stop=3).AndReturn(iter([
+            (numpy.array([2]), numpy.array([[3, -1]]),
+             numpy.array([[5., 6]]))]))
+
+        self.mox.ReplayAll()
+        r = store.describe()
+        assert r['count'].tolist() == [2, 1]
+        assert r['nans'].tolist() == [0, 1]
+        assert r['mean'].tolist() == [2, 4]
+        r = store.describe(['b'])
+        assert r['max'].tolist() == [4]
+        r = store.describe()
+        assert r['count'].tolist() == [3, 2]
+        assert r['mean'].tolist() == [3, 5]
+        assert r['std'].tolist() == [2, numpy.sqrt(2)]
+        assert store.summary[0] == 3
+        self.mox.VerifyAll()
+
+    def test_normalized(self):
+        store = self.create_zone_map_store()
+        store.ftnames = ['a', 'b']
+
+        store.table.getNumberOfRows().AndReturn(2)
+        store.iter_chunks(start=0, stop=2).AndReturn(iter([
+            (numpy.array([0, 1]), numpy.array([[1, -1], [2, -1]]),
+             numpy.array([[1., 2], [3, 6]]))]))
+        store.table.getNumberOfRows().AndReturn(2)
+        store.iter_chunks(offsets=None, stop=2, chunk_size=None).AndReturn(
+            iter([(numpy.array([1]), numpy.array([[2, -1]]),
+                   numpy.array([[3., 6]]))]))
+
+        self.mox.ReplayAll()
+        view = store.normalized('minmax', ['b'])
+        assert view.normalizer.center.tolist() == [2]
+        assert view.normalizer.scale.tolist() == [4]
+        chunks = list(view.iter_chunks())
+        assert chunks[0][0].tolist() == [[2, -1]]
+        assert chunks[0][1].tolist() == [[1]]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('owned', [True, False])
+    def test_fit_pca(self, owned):
+        store = self.create_zone_map_store()
+        store.ftnames = ['a', 'b']
+        mf = MockOriginalFile(3)
+
+        store.table.getNumberOfRows().AndReturn(3)
+        store.iter_chunks(offsets=None, stop=3, chunk_size=None).AndReturn(
+            iter([(numpy.array([0, 1, 2]),
+                   numpy.array([[1, -1], [2, -1], [3, -1]]),
+                   numpy.array([[1., 0], [3, 0], [5, 0]]))]))
+        store.table.getOriginalFile().AndReturn(mf)
+        store.perms.can_edit(mf).AndReturn(owned)
+        if owned:
+            store.write_sidecar('pca', mox.IsA(str))
+
+        self.mox.ReplayAll()
+        model = store.fit_pca(1, ['a'])
+        assert model.features == ['a']
+        assert model.mean.tolist() == [3]
+        assert model.explained_variance.tolist() == [4]
+        assert store.get_pca() is model
+        self.mox.VerifyAll()
+
+    def test_project(self):
+        store = self.create_zone_map_store()
+        store.ftnames = ['a', 'b']
+        store.pca_loaded = False
+        model = pca.Pca([1], [[1]], [1], 1, 2, ['b'])
+
+        store.read_sidecar('pca').AndReturn(model.to_bytes())
+        store.table.getNumberOfRows().AndReturn(2)
+        store.iter_chunks(offsets=None, stop=2, chunk_size=None).AndReturn(
+            iter([(numpy.array([0, 1]), numpy.array([[1, -1], [2, -1]]),
+                   numpy.array([[0., 3], [0, 5]]))]))
+
+        self.mox.ReplayAll()
+        ids, r = store.project()
+        assert ids.tolist() == [[1, -1], [2, -1]]
+        assert r.tolist() == [[2], [4]]
+        self.mox.VerifyAll()
+
+    def test_project_unfitted(self):
+        store = self.create_zone_map_store()
+        store.pca_loaded = False
+        store.read_sidecar('pca').AndReturn(None)
+
+        self.mox.ReplayAll()
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.project()
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('from_index', [True, False])
+    def test_get_bloom_filter(self, from_index):
+        store = self.create_zone_map_store()
+        self.mox.StubOutWithMock(store, 'iter_id_chunks')
+        if from_index:
+            store.idindex = idindex.IdIndex()
+            store.idindex.append(0, [[1, -1], [2, 3]])
+
+        store.table.getNumberOfRows().AndReturn(3)
+        if from_index:
+            # Updating the ID index
+            store.table.getNumberOfRows().AndReturn(3)
+            store.iter_id_chunks(2, 3).AndReturn(
+                iter([(2, numpy.array([[4, 5]]))]))
+            store.table.getNumberOfRows().AndReturn(4)
+        else:
+            store.iter_id_chunks(0, 3).AndReturn(
+                iter([(0, numpy.array([[1, -1], [2, 3], [4, 5]]))]))
+        # Appended by another client
+        store.table.getNumberOfRows().AndReturn(5)
+        store.iter_id_chunks(4, 5).AndReturn(
+            iter([(4, numpy.array([[6, 7]]))]))
+        store.table.getNumberOfRows().AndReturn(6)
+        store.iter_id_chunks(5, 6).AndReturn(
+            iter([(5, numpy.array([[10, -1]]))]))
+
+        self.mox.ReplayAll()
+        bf = store.get_bloom_filter()
+        assert bf.nrows == 3
+        for key in [('Image', 1), ('Image', 2), ('Roi', 3), ('Image', 4),
+                    ('Roi', 5)]:
+            assert key in bf
+        assert ('Roi', -1) not in bf
+        # Cached without a server call
+        assert store.get_bloom_filter() is bf
+        # Updated on writes
+        store._indexes_append([[8, 9]], [[1.0]])
+        assert ('Roi', 9) in bf
+        assert bf.nrows == 4
+        assert store.get_bloom_filter() is bf
+        assert bf.nrows == 4
+        # Checked for new rows when requested or expired
+        assert store.get_bloom_filter(refresh=True) is bf
+        assert ('Image', 6) in bf
+        store.bloom_checked = 0
+        assert store.get_bloom_filter() is bf
+        assert ('Image', 10) in bf
+        assert bf.nrows == 6
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('with_index', [True, False])
+    def test_has_features_many(self, with_index):
+        store = self.create_zone_map_store()
+        self.mox.StubOutWithMock(store, 'get_bloom_filter')
+        self.mox.StubOutWithMock(store.table, 'getWhereList')
+        bf = bloom.BloomFilter(10)
+        bf.add('Image', [1, 2])
+        # Simulate a false positive
+        bf.add('Image', [3])
+        if with_index:
+            store.idindex = idindex.IdIndex()
+            store.idindex.append(0, [[1, -1], [2, -1], [2, 5]])
+
+        store.get_bloom_filter().AndReturn(bf)
+        store.table.getNumberOfRows().AndReturn(3)
+        if not with_index:
+            store.table.getWhereList(
+                '(ImageID==1)', {}, 0, 3, 0).AndReturn([0])
+            store.table.getWhereList(
+                '(ImageID==2)', {}, 0, 3, 0).AndReturn([1, 2])
+            store.table.getWhereList(
+                '(ImageID==3)', {}, 0, 3, 0).AndReturn([])
+
+        self.mox.ReplayAll()
+        r = store.has_features_many('Image', [1, 2, 3, 4, 10000])
+        assert r.tolist() == [True, True, False, False, False]
+        with pytest.raises(
+                OmeroTablesFeatureStore.TableUsageException):
+            store.has_features_many('Dataset', [1])
+        self.mox.VerifyAll()
+
+    def test_fetch_by_object_bloom(self):
+        store = self.create_zone_map_store()
+        self.mox.StubOutWithMock(store, 'filter_raw')
+        self.mox.StubOutWithMock(store, 'iter_id_chunks')
+        store.bloom = bloom.BloomFilter(10)
+        store.bloom.add_rows([[1, -1]])
+        store.bloom_checked = time.time()
+
+        store.filter_raw('(ImageID==1)').AndReturn([(1, -1, [1.0])])
+        # Appended by another client
+        store.table.getNumberOfRows().AndReturn(2)
+        store.iter_id_chunks(1, 2).AndReturn(
+            iter([(1, numpy.array([[2, -1]]))]))
+        store.filter_raw('(ImageID==2)').AndReturn([(2, -1, [2.0])])
+
+        self.mox.ReplayAll()
+        assert store.fetch_by_object('Image', 1) == [(1, -1, [1.0])]
+        assert store.fetch_by_object('Image', 2) == []
+        store.get_bloom_filter(refresh=True)
+        assert store.fetch_by_object('Image', 2) == [(2, -1, [2.0])]
+        self.mox.VerifyAll()
+
+    def test_to_dataframe(self):
+        pytest.importorskip('pandas')
+        store = MockFeatureTable(None)
+        store.ftnames = ['a', 'b']
+        self.mox.StubOutWithMock(store, 'read_arrays')
+        values = numpy.array([[1., 2], [3, 4]])
+        store.read_arrays('(ImageID>0)', None).AndReturn(
+            (numpy.array([[1, -1], [2, 3]]), values))
+
+        self.mox.ReplayAll()
+        df = store.to_dataframe('(ImageID>0)')
+        assert list(df.columns) == ['a', 'b']
+        assert list(df.index.names) == ['ImageID', 'RoiID']
+        assert df.loc[(2, 3), 'b'] == 4
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('state', ['new', 'append', 'other'])
+    def test_snapshot(self, tmpdir, state):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn(), MockColumn(), MockColumn(size=1)]
+        path = str(tmpdir.join('snapshot'))
+        self.mox.StubOutWithMock(store, 'iter_chunks')
+
+        if state != 'new':
+            snap = OmeroTablesFeatureStore.MemmapFeatureArrays.create(
+                path, 1, file_id=(3 if state == 'append' else 4))
+            snap.append([[1, -1]], [[0.5]])
+
+        table.getOriginalFile().AndReturn(MockOriginalFile(3))
+        table.getNumberOfRows().AndReturn(2)
+        if state == 'append':
+            store.iter_chunks(start=1, stop=2).AndReturn([(
+                numpy.array([1]), numpy.array([[2, 3]]),
+                numpy.array([[1.5]]))])
+        else:
+            store.iter_chunks(start=0, stop=2).AndReturn([(
+                numpy.array([0, 1]), numpy.array([[1, -1], [2, 3]]),
+                numpy.array([[0.5], [1.5]]))])
+        # Unchanged
+        table.getNumberOfRows().AndReturn(2)
+
+        self.mox.ReplayAll()
+        snap = store.snapshot(path)
+        assert snap.manifest['file_id'] == 3
+        assert snap.ids.tolist() == [[1, -1], [2, 3]]
+        assert snap.values.tolist() == [[0.5], [1.5]]
+
+        assert store.filter_raw('RoiID>0') == [(2, 3, [1.5])]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('replaced', [True, False])
+    def test_update_snapshot_after_write(self, tmpdir, replaced):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn(), MockColumn(), MockColumn(size=1)]
+        self.mox.StubOutWithMock(store, 'iter_chunks')
+        store.snapshot_arrays = \
+            OmeroTablesFeatureStore.MemmapFeatureArrays.create(
+                str(tmpdir), 1, file_id=3)
+        store.snapshot_arrays.append([[1, -1]], [[0.5]])
+        store.write_count = 1
+
+        table.getNumberOfRows().AndReturn(2)
+        if replaced:
+            store.replace_count = 1
+            store.iter_chunks(start=0, stop=2).AndReturn([(
+                numpy.array([0, 1]), numpy.array([[1, -1], [2, -1]]),
+                numpy.array([[2.5], [3.5]]))])
+        else:
+            # Appends only add the new rows
+            store.iter_chunks(start=1, stop=2).AndReturn([(
+                numpy.array([1]), numpy.array([[2, -1]]),
+                numpy.array([[3.5]]))])
+
+        self.mox.ReplayAll()
+        assert store.update_snapshot() == 2
+        assert store.snapshot_arrays.values.tolist() == [
+            [2.5 if replaced else 0.5], [3.5]]
+        assert store.snapshot_replace_count == store.replace_count
+        self.mox.VerifyAll()
+
+    def test_get_objects(self):
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(session.qs, 'findAllByQuery')
+
+        kvs = {'x': 'aaa', 'y.z': ['bbb', 'ccc']}
+        # Need to figure out which order the keys will be read
+        if kvs.keys() == ['x', 'y.z']:
+            q = "FROM ObjectType WHERE x = :x AND y.z in (:y_z)"
+        else:
+            q = "FROM ObjectType WHERE y.z in (:y_z) AND x = :x"
+
+        params = omero.sys.ParametersI()
+        params.add('x', wrap('aaa'))
+        params.add('y_z', wrap(['bbb', 'ccc']))
+        m = object()
+
+        session.qs.findAllByQuery(q, mox.Func(
+            lambda o: self.parameters_equal(params, o))).AndReturn([m])
+
+        self.mox.ReplayAll()
+
+        assert store.get_objects('ObjectType', kvs) == [m]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('exists', [True, False])
+    def test_create_file_annotation(self, exists):
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(store, 'get_objects')
+        self.mox.StubOutWithMock(store, '_file_annotation_exists')
+        self.mox.StubOutWithMock(session.us, 'saveAndReturnObject')
+
+        ofile = omero.model.OriginalFileI(2)
+        image = omero.model.ImageI(3)
+
+        if exists:
+            r = [MockOmeroObject(21), MockOmeroObject(22)]
+        else:
+            r = []
+        store._file_annotation_exists('Image', 3, 'ns', 2).AndReturn(r)
+
+        if not exists:
+            store.get_objects('Image', {'id': 3}).AndReturn([image])
+            mocklink = MockOmeroObject(23)
+
+            session.us.saveAndReturnObject(mox.Func(
+                lambda o: o.getParent() == image and
+                o.getChild().getNs() == wrap('ns') and
+                o.getChild().getFile() == ofile)).AndReturn(mocklink)
+
+        self.mox.ReplayAll()
         if exists:
             assert store.create_file_annotation(
                 'Image', 3, 'ns', ofile) == r[0]
@@ -835,6 +2410,61 @@ class TestFeatureTable(object):
                 'Image', 3, 'ns', ofile) == mocklink
         self.mox.VerifyAll()
 
+    @pytest.mark.parametrize('linked', [[], [3], [3, 4]])
+    def test_create_file_annotations(self, linked):
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(store, '_file_annotation_parents')
+        self.mox.StubOutWithMock(session.us, 'saveAndReturnObject')
+        self.mox.StubOutWithMock(session.us, 'saveArray')
+        self.mox.stubs.Set(OmeroTablesFeatureStore, 'QUERY_BATCH_SIZE', 2)
+
+        ofile = omero.model.OriginalFileI(2)
+        store._file_annotation_parents(
+            'Image', [3, 4], 'ns', 2).AndReturn(linked)
+        store._file_annotation_parents('Image', [5], 'ns', 2).AndReturn([])
+
+        missing = [i for i in [3, 4, 5] if i not in linked]
+        session.us.saveAndReturnObject(mox.Func(
+            lambda o: o.getNs() == wrap('ns') and
+            unwrap(o.getFile().getId()) == 2)).AndReturn(
+            omero.model.FileAnnotationI(7))
+
+        def links_equal(ids):
+            return mox.Func(lambda links: [
+                (unwrap(k.getParent().getId()), unwrap(k.getChild().getId()))
+                for k in links] == [(i, 7) for i in ids])
+
+        session.us.saveArray(links_equal(missing[:2]))
+        if len(missing) > 2:
+            session.us.saveArray(links_equal(missing[2:]))
+
+        self.mox.ReplayAll()
+        assert store.create_file_annotations(
+            'Image', [5, 4, 3, 4], 'ns', ofile) == len(missing)
+        self.mox.VerifyAll()
+
+    def test_file_annotation_parents(self):
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(session.qs, 'projection')
+
+        params = omero.sys.ParametersI()
+        params.map['parents'] = wrap([wrap(3L), wrap(4L)])
+        params.addString('ns', 'ns')
+        params.addLong('file', 2)
+
+        session.qs.projection(
+            'SELECT ial.parent.id FROM RoiAnnotationLink ial WHERE '
+            'ial.parent.id in (:parents) AND ial.child.ns=:ns AND '
+            'ial.child.file.id=:file',
+            mox.Func(lambda o: self.parameters_equal(params, o))).AndReturn(
+            [[wrap(3L)]])
+
+        self.mox.ReplayAll()
+        assert store._file_annotation_parents('Roi', [3, 4], 'ns', 2) == [3]
+        self.mox.VerifyAll()
+
     def test_file_annotation_exists(self):
         session = MockSession(None, None, None)
         store = MockFeatureTable(session)
@@ -881,6 +2511,7 @@ class TestFeatureTable(object):
         perms.can_edit(mf).AndReturn(True)
         table.getOriginalFile().AndReturn(mf)
 
+        self.mox.StubOutWithMock(store, 'list_sidecars')
         store._get_annotation_link_types().AndReturn(
             ['ImageAnnotationLink', 'RoiAnnotationLink'])
 
@@ -899,11 +2530,14 @@ class TestFeatureTable(object):
             'SELECT ann FROM FileAnnotation ann WHERE ann.file.id=:id',
             mox.Func(lambda o: self.parameters_equal(params, o))).AndReturn(
             [mockfileann])
+        mocksidecar = MockOmeroObject(56)
+        store.list_sidecars().AndReturn([mocksidecar])
 
         store.close()
 
         session.us.deleteObject(mockimlink)
         session.us.deleteObject(mockfileann)
+        session.us.deleteObject(mocksidecar)
         session.us.deleteObject(mf)
 
         self.mox.ReplayAll()
@@ -917,6 +2551,348 @@ class TestFeatureTable(object):
         assert 'RoiAnnotationLink' in types
 
 
+class TestPartitionedFeatureTable(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    def create_store(self, n, scheme='hash', boundaries=None):
+        store = MockPartitionedFeatureTable(None)
+        store.tables = [self.mox.CreateMock(MockFeatureTable)
+                        for i in xrange(n)]
+        store.scheme = scheme
+        store.boundaries = boundaries
+        return store
+
+    def test_partition(self):
+        store = self.create_store(3)
+        assert store.partition(3) == store.tables[0]
+        assert store.partition(7) == store.tables[1]
+        assert store.partition(-1) == store.tables[2]
+
+        store = self.create_store(3, 'range', [10, 20])
+        assert store.partition(-1) == store.tables[0]
+        assert store.partition(9) == store.tables[0]
+        assert store.partition(10) == store.tables[1]
+        assert store.partition(25) == store.tables[2]
+
+    @pytest.mark.parametrize('boundaries', [None, [10]])
+    def test_new_partitions(self, boundaries):
+        store = MockPartitionedFeatureTable(None)
+        self.mox.StubOutWithMock(store, '_new_partition')
+        tables = [self.mox.CreateMock(MockFeatureTable) for i in xrange(2)]
+        if boundaries:
+            layout = {'scheme': 'range', 'partitions': 2, 'boundaries': [10]}
+        else:
+            layout = {'scheme': 'hash', 'partitions': 2}
+
+        store._new_partition(123, 0, ['x']).AndReturn(tables[0])
+        tables[0].write_sidecar('partitions', mox.Func(
+            lambda o: json.loads(o) == layout))
+        store._new_partition(123, 1, ['x']).AndReturn(tables[1])
+
+        self.mox.ReplayAll()
+        if boundaries:
+            store.new_partitions(123, ['x'], None, boundaries)
+        else:
+            store.new_partitions(123, ['x'], 2, None)
+        assert store.tables == tables
+        assert store.scheme == layout['scheme']
+        assert store.boundaries == layout.get('boundaries')
+        self.mox.VerifyAll()
+
+    def test_new_partitions_invalid(self):
+        store = MockPartitionedFeatureTable(None)
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.new_partitions(123, ['x'], None, None)
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.new_partitions(123, ['x'], 2, [10])
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.new_partitions(123, ['x'], None, [10, 5])
+
+    @pytest.mark.parametrize('exists', [True, False])
+    def test_open_partitions(self, exists):
+        store = MockPartitionedFeatureTable(None)
+        self.mox.StubOutWithMock(store, '_new_partition')
+        tables = [self.mox.CreateMock(MockFeatureTable) for i in xrange(3)]
+
+        store._new_partition(123, 0).AndReturn(tables[0])
+        if exists:
+            tables[0].read_sidecar('partitions').AndReturn(
+                '{"scheme": "hash", "partitions": 3}')
+            # Opened in parallel
+            store._new_partition(123, 1).InAnyOrder().AndReturn(tables[1])
+            store._new_partition(123, 2).InAnyOrder().AndReturn(tables[2])
+        else:
+            tables[0].read_sidecar('partitions').AndReturn(None)
+            tables[0].close()
+
+        self.mox.ReplayAll()
+        if exists:
+            store.open_partitions(123)
+            assert store.tables == tables
+            assert store.scheme == 'hash'
+        else:
+            with pytest.raises(
+                    OmeroTablesFeatureStore.NoTableMatchException):
+                store.open_partitions(123)
+        self.mox.VerifyAll()
+
+    def test_store_by_roi(self):
+        store = self.create_store(2)
+        store.tables[0].get_roi_image_id(12).AndReturn(5)
+        store.tables[1].store_by_roi(12, [1], 5)
+        store.tables[0].store_by_roi(13, [2], 6)
+
+        self.mox.ReplayAll()
+        store.store_by_roi(12, [1])
+        store.store_by_roi(13, [2], 6)
+        self.mox.VerifyAll()
+
+    def test_append_rows(self):
+        store = self.create_store(2)
+        # Appended in parallel
+        store.tables[0].append_rows(
+            [4, 2], [-1, 6], [[1], [3]], True).InAnyOrder()
+        store.tables[1].append_rows([3], [5], [[2]], True).InAnyOrder()
+
+        self.mox.ReplayAll()
+        store.append_rows([4, 3, 2], [-1, 5, 6], [[1], [2], [3]])
+        self.mox.VerifyAll()
+
+    def test_store_many_by_image(self):
+        store = self.create_store(2)
+        # Stored in parallel
+        store.tables[0].store_many_by_image([4, 2], [[1], [3]]).InAnyOrder()
+        store.tables[1].store_many_by_image([3], [[2]]).InAnyOrder()
+
+        self.mox.ReplayAll()
+        store.store_many_by_image([4, 3, 2], [[1], [2], [3]])
+        self.mox.VerifyAll()
+
+    def test_fetch_by_image(self):
+        store = self.create_store(2)
+        r = object()
+        store.tables[1].fetch_by_image(5, False).AndReturn(r)
+
+        self.mox.ReplayAll()
+        assert store.fetch_by_image(5) == r
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('last', [True, False])
+    def test_fetch_by_roi(self, last):
+        store = self.create_store(2)
+        values1 = (0, 2, [6])
+        values2 = (1, 2, [7])
+        r = object()
+        store.tables[0].fetch_by_object('Roi', 2).AndReturn([values1])
+        store.tables[1].fetch_by_object('Roi', 2).AndReturn([values2])
+        if last:
+            store.tables[0].feature_row(values2).AndReturn(r)
+
+        self.mox.ReplayAll()
+        if last:
+            assert store.fetch_by_roi(2, last) == r
+        else:
+            with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+                store.fetch_by_roi(2, last)
+        self.mox.VerifyAll()
+
+    def test_filter_raw(self):
+        store = self.create_store(3)
+        for n in xrange(3):
+            store.tables[n].filter_raw('RoiID==1', None).AndReturn(
+                [(n, 1, [n])])
+
+        self.mox.ReplayAll()
+        assert store.filter_raw('RoiID==1') == [
+            (0, 1, [0]), (1, 1, [1]), (2, 1, [2])]
+        self.mox.VerifyAll()
+
+    def test_read_arrays(self):
+        store = self.create_store(2)
+        # Read in parallel
+        store.tables[0].read_arrays(None, ['a']).InAnyOrder().AndReturn(
+            (numpy.array([[2, -1]]), numpy.array([[1.0]])))
+        store.tables[1].read_arrays(None, ['a']).InAnyOrder().AndReturn(
+            (numpy.array([[1, -1], [3, -1]]), numpy.array([[2.0], [3.0]])))
+
+        self.mox.ReplayAll()
+        ids, values = store.read_arrays(features=['a'])
+        assert ids.tolist() == [[2, -1], [1, -1], [3, -1]]
+        assert values.tolist() == [[1], [2], [3]]
+        self.mox.VerifyAll()
+
+    def test_query(self):
+        store = self.create_store(2)
+        # Queried in parallel
+        store.tables[0].query('a > 1', None).InAnyOrder().AndReturn(
+            (numpy.array([[2, -1]]), numpy.array([[2.0]])))
+        store.tables[1].query('a > 1', None).InAnyOrder().AndReturn(
+            (numpy.empty((0, 2)), numpy.empty((0, 1))))
+
+        self.mox.ReplayAll()
+        ids, values = store.query('a > 1')
+        assert ids.tolist() == [[2, -1]]
+        assert values.tolist() == [[2]]
+        self.mox.VerifyAll()
+
+    def test_aggregate(self):
+        store = self.create_store(2)
+        s0 = aggregate.GroupedStats(1)
+        s0.add([2], [[1.]])
+        s1 = aggregate.GroupedStats(1)
+        s1.add([1, 3], [[2.], [3]])
+        store.tables[0].group_stats(
+            'ImageID', ['mean'], None, None, None).InAnyOrder().AndReturn(s0)
+        store.tables[1].group_stats(
+            'ImageID', ['mean'], None, None, None).InAnyOrder().AndReturn(s1)
+
+        self.mox.ReplayAll()
+        keys, r = store.aggregate(funcs=['mean'])
+        assert keys.tolist() == [1, 2, 3]
+        assert r['mean'].tolist() == [[2], [1], [3]]
+        self.mox.VerifyAll()
+
+    def test_nearest(self):
+        store = self.create_store(2)
+        store.tables[0].feature_indices(None).AndReturn(None)
+        store.tables[1].fetch_by_object('Image', 3).AndReturn(
+            [(3, -1, [1., 1])])
+        store.tables[0].nearest(
+            mox.Func(lambda v: v.tolist() == [1, 1]), 2, 'euclidean', None,
+            None, None, ('Image', 3), False, None).InAnyOrder().AndReturn(
+            (numpy.array([[2, -1], [4, -1]]), numpy.array([1., 3])))
+        store.tables[1].nearest(
+            mox.Func(lambda v: v.tolist() == [1, 1]), 2, 'euclidean', None,
+            None, None, ('Image', 3), False, None).InAnyOrder().AndReturn(
+            (numpy.array([[5, -1]]), numpy.array([2.])))
+
+        self.mox.ReplayAll()
+        ids, d = store.nearest(3, 2)
+        assert ids.tolist() == [[2, -1], [5, -1]]
+        assert d.tolist() == [1, 2]
+        self.mox.VerifyAll()
+
+    def test_iter_matching_chunks(self):
+        store = self.create_store(2)
+        store.tables[0].iter_matching_chunks('RoiID>0', 10).AndReturn(
+            iter([(numpy.array([[2, 1]]), numpy.array([[1.]]))]))
+        store.tables[1].iter_matching_chunks('RoiID>0', 10).AndReturn(
+            iter([(numpy.array([[1, 3]]), numpy.array([[2.]]))]))
+
+        self.mox.ReplayAll()
+        chunks = list(store.iter_matching_chunks('RoiID>0', 10))
+        assert [c[0].tolist() for c in chunks] == [[[2, 1]], [[1, 3]]]
+        self.mox.VerifyAll()
+
+    def test_iter_matching_chunks_shuffle(self):
+        store = self.create_store(2)
+        rng = numpy.random.RandomState(0)
+        store.tables[0].iter_matching_chunks(None, 1, rng).AndReturn(
+            iter([(numpy.array([[2, 1]]), numpy.array([[1.]])),
+                  (numpy.array([[2, 2]]), numpy.array([[2.]]))]))
+        store.tables[1].iter_matching_chunks(None, 1, rng).AndReturn(
+            iter([(numpy.array([[1, 3]]), numpy.array([[3.]]))]))
+
+        self.mox.ReplayAll()
+        chunks = list(store.iter_matching_chunks(None, 1, rng))
+        assert sorted(c[0].tolist() for c in chunks) == [
+            [[1, 3]], [[2, 1]], [[2, 2]]]
+        self.mox.VerifyAll()
+
+    def test_top_k(self):
+        store = self.create_store(2)
+        r0 = (numpy.array([[2, -1], [4, -1]]), numpy.array([5., 1]),
+              numpy.array([[5., 0], [1, 0]]))
+        r1 = (numpy.array([[1, -1]]), numpy.array([3.]),
+              numpy.array([[3., 1]]))
+        store.tables[0].top_k(
+            'a', 2, True, None, True, None).InAnyOrder().AndReturn(r0)
+        store.tables[1].top_k(
+            'a', 2, True, None, True, None).InAnyOrder().AndReturn(r1)
+
+        self.mox.ReplayAll()
+        ids, scores, values = store.top_k('a', 2, vectors=True)
+        assert ids.tolist() == [[2, -1], [1, -1]]
+        assert scores.tolist() == [5, 3]
+        assert values.tolist() == [[5, 0], [3, 1]]
+        self.mox.VerifyAll()
+
+    def test_fit_pca(self):
+        store = self.create_store(2)
+        store.tables[0].feature_indices(None).AndReturn(None)
+        store.tables[0].iter_matching_chunks(None, None).AndReturn(
+            iter([(numpy.array([[2, -1]]), numpy.array([[1., 1]]))]))
+        store.tables[1].iter_matching_chunks(None, None).AndReturn(
+            iter([(numpy.array([[1, -1]]), numpy.array([[3., 3]]))]))
+        store.tables[0].set_pca(mox.IsA(pca.Pca))
+        store.tables[0].get_pca().AndReturn(None)
+
+        self.mox.ReplayAll()
+        model = store.fit_pca(1)
+        assert model.nrows == 2
+        numpy.testing.assert_allclose(
+            model.components, [[numpy.sqrt(0.5), numpy.sqrt(0.5)]])
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.project()
+        self.mox.VerifyAll()
+
+    def test_describe(self):
+        store = self.create_store(2)
+        s0 = aggregate.GroupedStats(2)
+        s0.add([0, 0], [[1., 2], [3, numpy.nan]])
+        s1 = aggregate.GroupedStats(2)
+        store.tables[0].feature_indices(None).AndReturn(None)
+        store.tables[0].summary_stats().InAnyOrder().AndReturn((2, s0))
+        store.tables[1].summary_stats().InAnyOrder().AndReturn((0, s1))
+
+        self.mox.ReplayAll()
+        r = store.describe()
+        assert r['count'].tolist() == [2, 1]
+        assert r['nans'].tolist() == [0, 1]
+        assert r['mean'].tolist() == [2, 2]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('objtype', ['Image', 'Roi'])
+    def test_has_features_many(self, objtype):
+        store = self.create_store(2)
+        if objtype == 'Image':
+            # Only the partitions holding each Image are checked
+            store.tables[0].has_features_many('Image', mox.Func(
+                lambda a: a.tolist() == [2, 4])).InAnyOrder().AndReturn(
+                numpy.array([True, False]))
+            store.tables[1].has_features_many('Image', mox.Func(
+                lambda a: a.tolist() == [1])).InAnyOrder().AndReturn(
+                numpy.array([True]))
+        else:
+            store.tables[0].has_features_many(
+                'Roi', [2, 1, 4]).InAnyOrder().AndReturn(
+                numpy.array([True, False, False]))
+            store.tables[1].has_features_many(
+                'Roi', [2, 1, 4]).InAnyOrder().AndReturn(
+                numpy.array([False, True, False]))
+
+        self.mox.ReplayAll()
+        r = store.has_features_many(objtype, [2, 1, 4])
+        assert r.tolist() == [True, True, False]
+        self.mox.VerifyAll()
+
+    def test_close(self):
+        store = self.create_store(2)
+        store.tables[0].close()
+        store.tables[1].close()
+
+        self.mox.ReplayAll()
+        store.close()
+        assert store.tables is None
+        assert store.table is None
+        self.mox.VerifyAll()
+
+
 class TestFeatureTableManager(object):
 
     def setup_method(self, method):
@@ -965,6 +2941,59 @@ class TestFeatureTableManager(object):
 
         self.mox.VerifyAll()
 
+    def test_create_aggregate(self):
+        ownerid = 123
+        session = MockSession(None, None, ownerid)
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            session, namespace='x')
+        source = MockFeatureTable(None)
+        source.table = object()
+        source.ftnames = ['a', 'b']
+        target = MockFeatureTable(None)
+        self.mox.StubOutWithMock(fts, 'get')
+        self.mox.StubOutWithMock(fts, 'create')
+        self.mox.StubOutWithMock(materialized.MaterializedAggregate,
+                                 'save_definition')
+        self.mox.StubOutWithMock(materialized.MaterializedAggregate,
+                                 'rebuild')
+
+        fts.get('source', ownerid).AndReturn(source)
+        fts.create('agg', ['mean(b)', 'max(b)']).AndReturn(target)
+        materialized.MaterializedAggregate.save_definition()
+        materialized.MaterializedAggregate.rebuild()
+
+        self.mox.ReplayAll()
+        fts.fss.insert(('source', ownerid), source)
+        assert fts.create_aggregate(
+            'agg', 'source', ['mean', 'max'], ['b']) == target
+        aggs = fts.aggregates[('source', ownerid)]
+        assert len(aggs) == 1
+        assert aggs[0].name == 'agg'
+        assert aggs[0].features == ['b']
+        # Listening to the open source featureset
+        assert source.write_listeners == [aggs[0].source_written]
+        self.mox.VerifyAll()
+
+    def test_insert_aggregate_source(self):
+        ownerid = 123
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            MockSession(None, None, ownerid))
+        agg = materialized.MaterializedAggregate(
+            fts, 'agg', ownerid, 'source', ownerid, ['mean'])
+        fts._register_aggregate(agg)
+        # Registered once
+        fts._register_aggregate(materialized.MaterializedAggregate(
+            fts, 'agg', ownerid, 'source', ownerid, ['mean']))
+        assert fts.aggregates == {('source', ownerid): [agg]}
+
+        # A reopened source is connected
+        source = MockFeatureTable(None)
+        fts._insert(('source', ownerid), source)
+        assert source.write_listeners == [agg.source_written]
+        other = MockFeatureTable(None)
+        fts._insert(('other', ownerid), other)
+        assert other.write_listeners == []
+
     @pytest.mark.parametrize('state', ['opened', 'unopened', 'closed'])
     def test_get(self, state):
         ownerid = 123
@@ -992,9 +3021,161 @@ class TestFeatureTableManager(object):
             OmeroTablesFeatureStore.FeatureTable(
                 session, fsname, 'x/features', 'x/source', ownerid
                 ).AndReturn(fs)
-            fts.fss.insert(k, fs)
+            fts.fss.insert(k, fs, pinned=None)
 
         self.mox.ReplayAll()
 
         assert fts.get(fsname, ownerid) == fs
         self.mox.VerifyAll()
+
+        stats = fts.stats()
+        if state == 'opened':
+            assert stats['opens'] == 0
+            assert stats['open_time'] == 0
+        else:
+            assert stats['opens'] == 1
+            assert stats['open_time'] >= 0
+
+    def test_get_partitioned(self):
+        ownerid = 123
+        session = MockSession(None, None, ownerid)
+        fs = MockPartitionedFeatureTable(session)
+        self.mox.StubOutWithMock(OmeroTablesFeatureStore, 'FeatureTable')
+        self.mox.StubOutWithMock(
+            OmeroTablesFeatureStore, 'PartitionedFeatureTable')
+        fsname = 'fsname'
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            session, namespace='x')
+
+        OmeroTablesFeatureStore.FeatureTable(
+            session, fsname, 'x/features', 'x/source', ownerid
+            ).AndRaise(OmeroTablesFeatureStore.NoTableMatchException())
+        OmeroTablesFeatureStore.PartitionedFeatureTable(
+            session, fsname, 'x/features', 'x/source', ownerid
+            ).AndReturn(fs)
+
+        self.mox.ReplayAll()
+        assert fts.get(fsname, ownerid) == fs
+        assert fts.fss.get((fsname, ownerid)) == fs
+        self.mox.VerifyAll()
+
+    def test_create_partitioned(self):
+        ownerid = 123
+        session = MockSession(None, None, ownerid)
+        fs = MockPartitionedFeatureTable(session)
+        self.mox.StubOutWithMock(OmeroTablesFeatureStore, 'FeatureTable')
+        self.mox.StubOutWithMock(
+            OmeroTablesFeatureStore, 'PartitionedFeatureTable')
+        fsname = 'fsname'
+        colnames = ['x1', 'x2']
+
+        OmeroTablesFeatureStore.FeatureTable(
+            session, fsname, 'x/features', 'x/source', ownerid
+            ).AndRaise(OmeroTablesFeatureStore.NoTableMatchException())
+        OmeroTablesFeatureStore.PartitionedFeatureTable(
+            session, fsname, 'x/features', 'x/source', ownerid
+            ).AndRaise(OmeroTablesFeatureStore.NoTableMatchException())
+        OmeroTablesFeatureStore.PartitionedFeatureTable(
+            session, fsname, 'x/features', 'x/source', ownerid, colnames,
+            4, None).AndReturn(fs)
+
+        self.mox.ReplayAll()
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            session, namespace='x')
+        assert fts.create(fsname, colnames, partitions=4) == fs
+        assert fts.fss.get((fsname, ownerid)) == fs
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('found', [True, False])
+    def test_get_many(self, found):
+        ownerid = 123
+        session = MockSession(None, None, ownerid)
+        self.mox.StubOutWithMock(OmeroTablesFeatureStore, 'FeatureTable')
+        self.mox.StubOutWithMock(
+            OmeroTablesFeatureStore, 'PartitionedFeatureTable')
+        self.mox.StubOutWithMock(OmeroTablesFeatureStore, 'get_objects')
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            session, namespace='x')
+
+        cached = MockFeatureTable(session)
+        cached.table = object()
+        fts.fss.insert(('fs1', ownerid), cached)
+        fs2 = self.mox.CreateMock(MockFeatureTable)
+        fs3 = MockPartitionedFeatureTable(session)
+        f2 = MockOriginalFile(2, 'fs2')
+
+        OmeroTablesFeatureStore.get_objects(session, 'OriginalFile', mox.Func(
+            lambda q: sorted(q['name']) == ['fs2', 'fs3'] and
+            q['path'] == 'x/features' and
+            q['details.owner.id'] == ownerid)).AndReturn([f2])
+        OmeroTablesFeatureStore.FeatureTable(
+            session, 'fs2', 'x/features', 'x/source', ownerid,
+            tablefile=f2).InAnyOrder().AndReturn(fs2)
+        if found:
+            OmeroTablesFeatureStore.PartitionedFeatureTable(
+                session, 'fs3', 'x/features', 'x/source', ownerid
+                ).InAnyOrder().AndReturn(fs3)
+        else:
+            OmeroTablesFeatureStore.PartitionedFeatureTable(
+                session, 'fs3', 'x/features', 'x/source', ownerid
+                ).InAnyOrder().AndRaise(
+                OmeroTablesFeatureStore.NoTableMatchException())
+            fs2.close()
+
+        self.mox.ReplayAll()
+        if found:
+            assert fts.get_many(['fs3', 'fs1', 'fs2']) == [fs3, cached, fs2]
+            assert fts.fss.get(('fs2', ownerid)) == fs2
+            assert fts.fss.get(('fs3', ownerid)) == fs3
+        else:
+            with pytest.raises(
+                    OmeroTablesFeatureStore.NoTableMatchException):
+                fts.get_many(['fs3', 'fs1', 'fs2'])
+            assert len(fts.fss) == 1
+        self.mox.VerifyAll()
+
+    def test_get_many_too_many(self):
+        session = MockSession(None, None, 123)
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            session, cachesize=2)
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            fts.get_many(['a', 'b', 'c'])
+
+    def test_get_many_too_many_handles(self):
+        ownerid = 123
+        session = MockSession(None, None, ownerid)
+        self.mox.StubOutWithMock(
+            OmeroTablesFeatureStore, 'PartitionedFeatureTable')
+        self.mox.StubOutWithMock(OmeroTablesFeatureStore, 'get_objects')
+        fts = OmeroTablesFeatureStore.FeatureTableManager(
+            session, namespace='x', maxhandles=4)
+
+        def create_partitioned(n):
+            fs = MockPartitionedFeatureTable(session)
+            fs.tables = [MockFeatureTable(session) for i in xrange(n)]
+            for t in fs.tables:
+                t.table = object()
+            return fs
+
+        cached = create_partitioned(3)
+        fts.fss.insert(('fs1', ownerid), cached)
+        fs2 = self.mox.CreateMock(MockPartitionedFeatureTable)
+        fs2.tables = [object()] * 3
+
+        OmeroTablesFeatureStore.get_objects(
+            session, 'OriginalFile', mox.IsA(dict)).AndReturn([])
+        OmeroTablesFeatureStore.PartitionedFeatureTable(
+            session, 'fs2', 'x/features', 'x/source', ownerid
+            ).AndReturn(fs2)
+        fs2.close()
+
+        self.mox.ReplayAll()
+        # Known to be too many before opening
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            fts.get_many(['fs1', 'fs2', 'fs3'])
+        # Too many after opening, the featureset which is in use is kept
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            fts.get_many(['fs1', 'fs2'])
+        assert fts.fss.cache.keys() == [('fs1', ownerid)]
+        assert cached.tables
+        self.mox.VerifyAll()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+import numpy
+
+from features import predicates
+from features.zonemap import ZoneMap
+from features.OmeroTablesFeatureStore import OmeroTableException
+
+
+NAMES = ['a', 'b']
+
+
+def create_zone_map():
+    # Zones of 2 rows: a is sorted, b contains NaNs
+    ids = numpy.array([[1, -1], [1, 2], [2, -1], [3, -1], [3, 4]])
+    values = numpy.array([
+        [0, numpy.nan], [1, 5], [2, numpy.nan], [3, numpy.nan], [4, 7]])
+    zm = ZoneMap(2, 2)
+    zm.add(0, ids[:3], values[:3])
+    zm.add(3, ids[3:], values[3:])
+    return zm, ids, values
+
+
+class TestZoneMap(object):
+
+    def test_add(self):
+        zm, ids, values = create_zone_map()
+        assert zm.nrows == 5
+        assert zm.nzones == 3
+        assert zm.mins[:, 0].tolist() == [1, 2, 3]
+        assert zm.maxs[:, 1].tolist() == [2, -1, 4]
+        assert zm.mins[:, 2].tolist() == [0, 2, 4]
+        assert zm.maxs[0, 3] == 5
+        assert numpy.isnan(zm.maxs[1, 3])
+        assert zm.nans[:, 3].tolist() == [True, True, False]
+
+    def test_add_replace(self):
+        zm, ids, values = create_zone_map()
+        # Bounds are widened, never narrowed
+        zm.add(1, [[1, 2]], [[10, 6]])
+        assert zm.nrows == 5
+        assert zm.mins[0, 2] == 0
+        assert zm.maxs[0, 2] == 10
+
+    @pytest.mark.parametrize('text,zones', [
+        ('a > 2.5', [False, True, True]),
+        ('a >= 4', [False, False, True]),
+        ('2.5 > a', [True, True, False]),
+        ('a == 1', [True, False, False]),
+        ('a != 4', [True, True, False]),
+        ('b > 6', [False, False, True]),
+        ('~(b <= 6)', [True, True, True]),
+        ('~(a <= 3)', [False, False, True]),
+        ('a < 1 or a > 3', [True, False, True]),
+        ('a > 1 and ImageID == 3', [False, True, True]),
+        ('a * 2 > 100', [True, True, True]),
+        ('a > b', [True, True, True]),
+        ('RoiID > 2', [False, False, True]),
+    ])
+    def test_match(self, text, zones):
+        zm, ids, values = create_zone_map()
+        expr = predicates.parse(text)
+        match = zm.match(expr, NAMES)
+        assert match.tolist() == zones
+
+        # Zones containing matching rows must never be excluded
+        rows = predicates.evaluate(expr, ids, values, NAMES)
+        for r in numpy.flatnonzero(rows):
+            assert match[r // 2]
+
+    def test_ranges(self):
+        zm, ids, values = create_zone_map()
+        assert zm.ranges(numpy.array([True, True, True])) == [(0, 5)]
+        assert zm.ranges(numpy.array([True, False, True])) == [
+            (0, 2), (4, 5)]
+        assert zm.ranges(numpy.array([False, False, False])) == []
+
+    def test_bytes(self):
+        zm, ids, values = create_zone_map()
+        zm2 = ZoneMap.from_bytes(zm.to_bytes())
+        assert (zm2.zone_rows, zm2.width, zm2.nrows) == (2, 2, 5)
+        numpy.testing.assert_array_equal(zm2.mins, zm.mins)
+        numpy.testing.assert_array_equal(zm2.maxs, zm.maxs)
+        assert zm2.nans.tolist() == zm.nans.tolist()
+
+        with pytest.raises(OmeroTableException):
+            ZoneMap.from_bytes('invalid')